@@ -1,6 +1,7 @@
 from shakenfist_utilities import logs
 
 from shakenfist import blob
+from shakenfist import etcd
 from shakenfist.baseobject import DatabaseBackedObjectIterator as dbo_iter
 from shakenfist.baseoperation import BaseOperation
 
@@ -8,6 +9,28 @@ from shakenfist.baseoperation import BaseOperation
 LOG, _ = logs.setup(__name__)
 
 
+# Agent operations waiting to be executed on an instance are individually
+# keyed queue entries, which are executed in the order they were created (that
+# is, by etcd create revision):
+#
+#   /sf/agentqueue/...instance.../...agentop... = {agentop, state}
+#
+# Every agent operation ever queued for an instance is also recorded in an
+# index, so that executed operations can be found without their UUID:
+#
+#   /sf/index/agentop/...instance.../...agentop... = {agentop}
+QUEUE_PREFIX = '/sf/agentqueue/'
+HISTORY_PREFIX = '/sf/index/agentop/'
+
+
+def queue_key(instance_uuid, agentop_uuid=''):
+    return f'{QUEUE_PREFIX}{instance_uuid}/{agentop_uuid}'
+
+
+def history_key(instance_uuid, agentop_uuid=''):
+    return f'{HISTORY_PREFIX}{instance_uuid}/{agentop_uuid}'
+
+
 class AgentOperation(BaseOperation):
     object_type = 'agentoperation'
     initial_version = 1
@@ -67,6 +90,16 @@ class AgentOperation(BaseOperation):
             return {}
         return db_data.get('results', {})
 
+    def _state_update(self, new_value, skip_transition_validation=False):
+        super()._state_update(
+            new_value, skip_transition_validation=skip_transition_validation)
+
+        # Operations are often queued before they are ready to execute.
+        # Updating the queue entry wakes the sidechannel watching the queue.
+        if new_value == self.STATE_QUEUED:
+            etcd.put_if_exists(queue_key(self.instance_uuid, self.uuid),
+                               {'agentop': self.uuid, 'state': new_value})
+
     def add_result(self, index, value):
         if 'command' in value:
             del value['command']
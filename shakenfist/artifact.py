@@ -1,5 +1,7 @@
 # Copyright 2021 Michael Still
+import time
 from functools import partial
+from urllib import parse
 from uuid import uuid4
 
 from shakenfist_utilities import logs
@@ -8,12 +10,15 @@ from shakenfist import baseobject
 from shakenfist import blob
 from shakenfist import etcd
 from shakenfist import exceptions
+from shakenfist import instance
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.baseobject import DatabaseBackedObjectIterator as dbo_iter
 from shakenfist.config import config
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.constants import EVENT_TYPE_USAGE
 from shakenfist.namespace import namespace_is_trusted
+from shakenfist.tasks import ConsolidateSnapshotTask
+from shakenfist.util import general as util_general
 
 
 LOG, _ = logs.setup(__name__)
@@ -25,6 +30,83 @@ LABEL_URL = 'sf://label/'
 SNAPSHOT_URL = 'sf://snapshot/'
 UPLOAD_URL = 'sf://upload/'
 
+# Artifacts are indexed by type and source URL, and by name and namespace, so
+# that lookups do not need to load every artifact in the cluster. Index entries
+# are individual keys which are written in the same etcd transaction as the
+# artifact changes they reflect:
+#
+#   /sf/index/artifact/url/...type.../...url.../...uuid... = {namespace, shared}
+#   /sf/index/artifact/name/...name.../...namespace.../...uuid... = {artifact_type}
+#
+# Artifacts in the error state are removed from the URL index (they cannot be
+# used to satisfy a URL), but remain in the name index until deleted. The index
+# is only used once it has been built, which the main daemon does on startup.
+INDEX_PREFIX = '/sf/index/artifact/'
+INDEX_VERSION = 1
+INDEX_READY = False
+
+
+def _quote(value):
+    return parse.quote(value, safe='')
+
+
+def _url_index_key(artifact_type, url, artifact_uuid=''):
+    return f'{INDEX_PREFIX}url/{artifact_type}/{_quote(url)}/{artifact_uuid}'
+
+
+def _name_index_key(name, namespace='', artifact_uuid=''):
+    if not namespace:
+        return f'{INDEX_PREFIX}name/{_quote(name)}/'
+    return f'{INDEX_PREFIX}name/{_quote(name)}/{_quote(namespace)}/{artifact_uuid}'
+
+
+def index_ready():
+    global INDEX_READY
+
+    if not INDEX_READY:
+        v = etcd.get_raw(INDEX_PREFIX + '_version')
+        INDEX_READY = bool(v and v.get('version', 0) >= INDEX_VERSION)
+    return INDEX_READY
+
+
+def rebuild_index():
+    # The caller should hold the index lock. Index entries are idempotent, so
+    # artifacts changed while this runs are safe.
+    puts = {}
+    for a in Artifacts([]):
+        puts.update(a._index_entries())
+        if len(puts) > 50:
+            etcd.apply_many(puts=puts)
+            puts = {}
+    if puts:
+        etcd.apply_many(puts=puts)
+    etcd.put_raw(INDEX_PREFIX + '_version', {'version': INDEX_VERSION})
+
+
+class BlobUsage:
+    """The usage of the blobs of many artifacts, shared between their summaries.
+
+    Listing artifacts reads the usage generations of all of their blobs with
+    one prefix read, and scans the instances at most once for all of them,
+    rather than doing both for each artifact in turn.
+    """
+
+    def __init__(self, blob_uuids):
+        self.blob_uuids = set(blob_uuids)
+        all_generations = blob.all_usage_generations()
+        self.generations = {
+            blob_uuid: all_generations.get(blob_uuid)
+            for blob_uuid in self.blob_uuids
+        }
+        self._instances = None
+
+    @property
+    def instances(self):
+        if self._instances is None:
+            self._instances = instance.instance_usage_for_blob_uuids(
+                self.blob_uuids)
+        return self._instances
+
 
 class Artifact(dbo):
     object_type = 'artifact'
@@ -109,7 +191,14 @@ class Artifact(dbo):
             a = Artifact(static_values)
             a.log.with_fields(static_values).info('Artifact is in-memory only')
         else:
-            Artifact._db_create(artifact_uuid, static_values)
+            Artifact._db_create(
+                artifact_uuid, static_values,
+                extra_puts={
+                    _url_index_key(artifact_type, source_url, artifact_uuid):
+                        {'namespace': namespace, 'shared': False},
+                    _name_index_key(name, namespace, artifact_uuid):
+                        {'artifact_type': artifact_type}
+                })
             a = Artifact.from_db(artifact_uuid)
 
         a.state = Artifact.STATE_INITIAL
@@ -119,11 +208,21 @@ class Artifact(dbo):
     @staticmethod
     def from_url(artifact_type, url, name=None, max_versions=0, namespace=None,
                  create_if_new=False):
-        artifacts = list(Artifacts([
-            partial(url_filter, url),
-            partial(type_filter, artifact_type),
-            not_dead_states_filter,
-            partial(namespace_or_shared_filter, namespace)]))
+        if index_ready():
+            artifacts = []
+            for key, entry in etcd.get_prefix(_url_index_key(artifact_type, url)):
+                if not _visible_to(namespace, entry.get('namespace'),
+                                   entry.get('shared', False)):
+                    continue
+                a = Artifact.from_db(key.split('/')[-1], suppress_failure_audit=True)
+                if a:
+                    artifacts.append(a)
+        else:
+            artifacts = list(Artifacts([
+                partial(url_filter, url),
+                partial(type_filter, artifact_type),
+                not_dead_states_filter,
+                partial(namespace_or_shared_filter, namespace)]))
 
         if len(artifacts) == 0:
             if create_if_new:
@@ -148,6 +247,65 @@ class Artifact(dbo):
 
         raise exceptions.TooManyMatches()
 
+    @classmethod
+    def from_db_by_ref(cls, object_ref, namespace=None):
+        if not object_ref or util_general.valid_uuid4(object_ref):
+            return super().from_db_by_ref(object_ref, namespace=namespace)
+        if not index_ready():
+            return super().from_db_by_ref(object_ref, namespace=namespace)
+
+        if namespace and namespace != 'system':
+            prefix = _name_index_key(object_ref, namespace)
+        else:
+            prefix = _name_index_key(object_ref)
+
+        found_obj = None
+        for key, _ in etcd.get_prefix(prefix):
+            o = cls.from_db(key.split('/')[-1], suppress_failure_audit=True)
+            if not o or o.state.value not in cls.ACTIVE_STATES:
+                continue
+            if found_obj:
+                raise exceptions.MultipleObjects(
+                    'multiple %ss have the name "%s" in namespace "%s"'
+                    % (cls.object_type, object_ref, namespace))
+            found_obj = o
+
+        return found_obj
+
+    def _index_entries(self, shared=None):
+        # The index entries this artifact should currently have
+        if self.in_memory_only:
+            return {}
+
+        state = self.state.value
+        if state == self.STATE_DELETED:
+            return {}
+        if shared is None:
+            shared = self.shared
+
+        entries = {
+            _name_index_key(self.name, self.namespace, self.uuid):
+                {'artifact_type': self.artifact_type}
+        }
+        if state != self.STATE_ERROR:
+            entries[_url_index_key(self.artifact_type, self.source_url, self.uuid)] = \
+                {'namespace': self.namespace, 'shared': shared}
+        return entries
+
+    def _index_changes_for_state(self, old_value, new_value):
+        if self.in_memory_only:
+            return None, None
+        if new_value == self.STATE_DELETED:
+            return None, [
+                _url_index_key(self.artifact_type, self.source_url, self.uuid),
+                _name_index_key(self.name, self.namespace, self.uuid),
+                self._blob_summary_key()
+            ]
+        if new_value == self.STATE_ERROR:
+            return None, [
+                _url_index_key(self.artifact_type, self.source_url, self.uuid)]
+        return None, None
+
     # Static values
     @property
     def artifact_type(self):
@@ -194,7 +352,41 @@ class Artifact(dbo):
 
     @shared.setter
     def shared(self, value):
-        self._db_set_attribute('shared', {'shared': value})
+        self._db_set_attribute('shared', {'shared': value},
+                               extra_puts=self._index_entries(shared=value))
+
+    @property
+    def progress(self):
+        return self._db_get_attribute('progress')
+
+    def set_progress(self, blob_uuid, phase, done=0, total=0):
+        percent = 0
+        if total:
+            percent = round(done * 100.0 / total, 1)
+        elif phase == 'created':
+            percent = 100
+        self._db_set_attribute('progress', {
+            'blob_uuid': blob_uuid,
+            'phase': phase,
+            'bytes_done': done,
+            'bytes_total': total,
+            'percent': percent,
+            'updated_at': time.time()
+        })
+
+    @property
+    def last_fetch(self):
+        return self._db_get_attribute('last_fetch')
+
+    def record_fetch(self, url, blob_uuid):
+        # Written after every successful download from the source, even when
+        # the download matched the existing index and so did not add a new
+        # one, so that nodes waiting on the download can tell it happened.
+        self._db_set_attribute('last_fetch', {
+            'url': url,
+            'blob_uuid': blob_uuid,
+            'fetched_at': time.time()
+        })
 
     def external_view_without_index(self):
         out = self._external_view()
@@ -205,30 +397,91 @@ class Artifact(dbo):
             'namespace': self.namespace,
             'shared': self.shared
         })
+        progress = self.progress
+        if progress:
+            out['progress'] = progress
         return out
 
-    def external_view(self):
+    def external_view(self, include_instances=False, indexes=None, usage=None):
         # If this is an external view, then mix back in attributes that users
         # expect
         a = self.external_view_without_index()
-        a.update(self.most_recent_index)
+        if indexes is None:
+            indexes = list(self.get_all_indexes())
+        if indexes:
+            a.update(indexes[-1])
+        else:
+            a['index'] = 0
 
         # Insert blob information
+        a['blobs'] = self.blob_summary(
+            indexes=indexes, include_instances=include_instances, usage=usage)
+        return a
+
+    def _blob_summary_key(self):
+        return etcd._construct_key('attribute/artifact', self.uuid, 'blob_summary')
+
+    def blob_summary(self, indexes=None, include_instances=True, usage=None):
+        """Summarise the blob behind each version of this artifact.
+
+        Returns a dictionary of index to blob uuid, size, reference count,
+        depends_on, and if include_instances is set the instances using that
+        blob. Finding the instances is expensive, so a summary including them
+        is cached as an attribute which is reused until either our versions
+        or the usage generation of one of their blobs changes.
+
+        Callers summarising many artifacts pass a BlobUsage shared between
+        them. Stale summaries are then rebuilt from it, but not written back,
+        so that listing artifacts does not write to etcd.
+        """
+        if indexes is None:
+            indexes = list(self.get_all_indexes())
+        versions = [[i['index'], i['blob_uuid']] for i in indexes]
+        blob_uuids = [blob_uuid for _, blob_uuid in versions]
+
+        generations = None
+        if include_instances and not self.in_memory_only:
+            if usage is not None:
+                generations = {
+                    blob_uuid: usage.generations.get(blob_uuid)
+                    for blob_uuid in blob_uuids
+                }
+            else:
+                generations = blob.usage_generations(blob_uuids)
+            cached = self._db_get_attribute('blob_summary')
+            if (cached and cached.get('generations') == generations
+                    and cached.get('versions') == versions):
+                return {index: b for index, b in cached['blobs']}
+
+        instances = {}
+        if include_instances and versions:
+            if usage is not None:
+                instances = usage.instances
+            else:
+                instances = instance.instance_usage_for_blob_uuids(blob_uuids)
+
         blobs = {}
-        for blob_index in self.get_all_indexes():
-            blob_uuid = blob_index['blob_uuid']
+        for index, blob_uuid in versions:
             b = blob.Blob.from_db(blob_uuid)
             if b:
                 # Blobs might have a UUID listed but not yet be instantiated.
                 # TODO(andy): Artifacts should not reference non-existent blobs
-                blobs[blob_index['index']] = {
+                blobs[index] = {
                     'uuid': blob_uuid,
                     'size': b.size,
                     'reference_count': b.ref_count,
                     'depends_on': b.depends_on
                 }
-        a['blobs'] = blobs
-        return a
+                if include_instances:
+                    blobs[index]['instances'] = instances[blob_uuid]
+
+        if generations is not None and usage is None:
+            self._db_set_attribute('blob_summary', {
+                'generations': generations,
+                'versions': versions,
+                'blobs': [[index, b] for index, b in blobs.items()]
+            })
+        return blobs
 
     def get_all_indexes(self):
         indices = {}
@@ -289,7 +542,8 @@ class Artifact(dbo):
                 'index': index,
                 'blob_uuid': blob_uuid
             }
-            self._db_set_attribute('index_%012d' % index, entry)
+            self._db_set_attribute('index_%012d' % index, entry,
+                                   extra_deletes=[self._blob_summary_key()])
             if not self.in_memory_only:
                 new_blob.ref_count_inc(self)
             self.add_event(EVENT_TYPE_AUDIT, 'added index to artifact',
@@ -302,12 +556,66 @@ class Artifact(dbo):
 
     def delete_old_versions(self):
         """Count versions and if necessary remove oldest versions."""
-        indexes = [i['index'] for i in self.get_all_indexes()]
+        indexes = sorted(self.get_all_indexes(), key=lambda i: i['index'])
         max = self.max_versions
         if len(indexes) > max:
-            for i in sorted(indexes)[:-max]:
-                self.del_index(i, update_billing=False)
+            for i in indexes[:-max]:
+                self.del_index(i['index'], update_billing=False)
             self.update_billing()
+            self._consolidate_pruned_versions(
+                [i['blob_uuid'] for i in indexes[:-max]],
+                [i['blob_uuid'] for i in indexes[-max:]])
+
+    def _consolidate_pruned_versions(self, pruned_blob_uuids, remaining_blob_uuids):
+        # Incremental snapshots depend on the previous version of the artifact,
+        # so a pruned version is kept alive by the version after it. Rewrite
+        # the remaining versions in the background so that they no longer
+        # depend on pruned versions, which are then freed.
+        if self.artifact_type != self.TYPE_SNAPSHOT:
+            return
+
+        pruned_blob_uuids = set(pruned_blob_uuids)
+        for blob_uuid in remaining_blob_uuids:
+            b = blob.Blob.from_db(blob_uuid)
+            if b and b.depends_on in pruned_blob_uuids:
+                etcd.enqueue(f'{config.NODE_NAME}-background', {
+                    'tasks': [ConsolidateSnapshotTask(
+                        self.uuid, sorted(pruned_blob_uuids))]
+                })
+                return
+
+    def replace_index_blob(self, index, old_blob_uuid, new_blob_uuid):
+        """Replace the blob for a version with another presenting the same data.
+
+        The replacement only happens if the version still uses old_blob_uuid.
+        Returns True if the version was updated.
+        """
+        with self.get_lock_attr('index', 'Artifact index replacement'):
+            entry = self._db_get_attribute('index_%012d' % index)
+            if not entry or entry.get('blob_uuid') != old_blob_uuid:
+                return False
+
+            new_blob = blob.Blob.from_db(new_blob_uuid)
+            if not new_blob:
+                raise exceptions.BlobMissing()
+
+            entry['blob_uuid'] = new_blob_uuid
+            self._db_set_attribute('index_%012d' % index, entry,
+                                   extra_deletes=[self._blob_summary_key()])
+            if not self.in_memory_only:
+                new_blob.ref_count_inc(self)
+                old_blob = blob.Blob.from_db(old_blob_uuid)
+                if old_blob:
+                    old_blob.ref_count_dec(self)
+
+            self.add_event(EVENT_TYPE_AUDIT, 'replaced blob for artifact index',
+                           extra={
+                               'index': index,
+                               'old_blob_uuid': old_blob_uuid,
+                               'new_blob_uuid': new_blob_uuid
+                           })
+        self.update_billing()
+        return True
 
     def del_index(self, index, update_billing=True):
         index_data = self._db_get_attribute('index_%012d' % index)
@@ -316,6 +624,7 @@ class Artifact(dbo):
             return
 
         self._db_delete_attribute('index_%012d' % index)
+        self._db_delete_attribute('blob_summary')
         b = blob.Blob.from_db(index_data['blob_uuid'])
         if b and not self.in_memory_only:
             b.ref_count_dec(self)
@@ -396,6 +705,16 @@ def namespace_exact_filter(namespace, o):
     return o.namespace == namespace
 
 
+def _visible_to(namespace, artifact_namespace, shared):
+    if namespace == 'system':
+        return True
+    if shared:
+        return True
+    if namespace_is_trusted(artifact_namespace, namespace):
+        return True
+    return artifact_namespace == namespace
+
+
 def namespace_or_shared_filter(namespace, o):
     if namespace == 'system':
         return True
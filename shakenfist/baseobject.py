@@ -1,4 +1,6 @@
 import json
+import os
+import threading
 import time
 from collections import defaultdict
 from functools import partial
@@ -33,23 +35,30 @@ class NoopLock(Lock):
         pass
 
 
-VERSION_CACHE = None
-VERSION_CACHE_AGE = 0
 OBJECT_NAMES = ['agentoperation', 'artifact', 'blob', 'instance', 'ipam',
                 'namespace', 'network', 'networkinterface', 'node', 'upload']
 
+# The minimum version of each object type across the cluster is computed by
+# the cluster maintenance daemon and published in a single key. Each process
+# reads that key once and then keeps its copy current with a watch, so upgrade
+# decisions in from_db() do not need to touch etcd. Queue workers are forked
+# from long running daemons, and inherit a current copy from their parent.
+OBJECT_VERSIONS_PREFIX = '/sf/objectversions/'
+OBJECT_VERSIONS_KEY = OBJECT_VERSIONS_PREFIX + 'minimum'
+
+# Cached versions are trusted for this long after they were last read or
+# changed, and are then read again. A watch which has been quiet for
+# VERSION_WATCH_TIMEOUT seconds is restarted, as the watch stream can fail
+# without telling us.
+VERSION_CACHE_TTL = 300
+VERSION_WATCH_TIMEOUT = 60
 
-def get_minimum_object_version(objname):
-    global VERSION_CACHE
-    global VERSION_CACHE_AGE
 
-    if not VERSION_CACHE:
-        VERSION_CACHE = {}
-    elif time.time() - VERSION_CACHE_AGE > 300:
-        VERSION_CACHE = {}
-    elif objname in VERSION_CACHE:
-        return VERSION_CACHE[objname]
+def compute_minimum_object_versions():
+    """Scan node metrics for the minimum version of each object type.
 
+    Object types which no node reports a version for have a minimum of None.
+    """
     metrics = {}
 
     # Ignore metrics for deleted nodes, but include nodes in an error state
@@ -82,32 +91,140 @@ def get_minimum_object_version(objname):
                 'metrics_age': d['metrics']['metrics_age']
             }).debug('Ignoring metrics entry for deleted node')
 
+    versions = {}
     for possible_objname in OBJECT_NAMES:
         nodes_by_version = defaultdict(list, [])
         node_metric_age = {}
-        minimum = inf
+        minimum = None
 
         for node_name in metrics:
             node_metric_age[f'metrics age {node_name}'] = \
                 metrics[node_name]['metrics_age']
             ver = metrics[node_name].get('object_version_%s' % possible_objname)
             if ver:
-                minimum = min(minimum, ver)
+                minimum = ver if minimum is None else min(minimum, ver)
                 nodes_by_version[f'version {ver}'].append(node_name)
             else:
                 nodes_by_version['no version reported'].append(node_name)
 
         LOG.with_fields(nodes_by_version).with_fields(node_metric_age).with_fields({
             'object_type': possible_objname}).debug('Object versions reported')
-        VERSION_CACHE[possible_objname] = minimum
+        versions[possible_objname] = minimum
+
+    return versions
+
+
+def publish_minimum_object_versions():
+    """Compute and publish the minimum object versions for the cluster.
+
+    The key is only written if the versions have changed, as every process in
+    the cluster is watching it. Returns the versions.
+    """
+    versions = compute_minimum_object_versions()
+    published = etcd.get_raw(OBJECT_VERSIONS_KEY)
+    if not published or published.get('versions') != versions:
+        etcd.put_raw(OBJECT_VERSIONS_KEY, {
+            'versions': versions,
+            'timestamp': time.time()
+        })
+        LOG.with_fields({'versions': versions}).info(
+            'Published minimum object versions')
+    return versions
+
+
+class ObjectVersionCache:
+    def __init__(self):
+        self.versions = None
+        self.published = False
+        self.fresh_until = 0
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _check_fork(self):
+        # A forked child has no watch thread, but the versions it inherited
+        # remain good until they would have expired in the parent.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.watcher = None
+
+    def _load(self):
+        entries, revision = etcd.get_prefix_by_create(OBJECT_VERSIONS_KEY)
+        published = None
+        for key, data, _, _ in entries:
+            if key == OBJECT_VERSIONS_KEY:
+                published = data
+
+        if published:
+            self.versions = published['versions']
+            self.published = True
+            self.fresh_until = time.time() + VERSION_CACHE_TTL
+        else:
+            # The cluster maintenance daemon has not published versions yet,
+            # for example part way through an upgrade from an older release.
+            # Scan for ourselves, and if no versions are reported at all do
+            # not cache the result.
+            self.versions = compute_minimum_object_versions()
+            self.published = False
+            if any(v is not None for v in self.versions.values()):
+                self.fresh_until = time.time() + VERSION_CACHE_TTL
+            else:
+                self.fresh_until = 0
+        return revision
+
+    def _watch(self, revision):
+        while True:
+            try:
+                events = etcd.watch_prefix(
+                    OBJECT_VERSIONS_PREFIX, start_revision=revision + 1,
+                    timeout=VERSION_WATCH_TIMEOUT)
+                try:
+                    for event in events:
+                        # A quiet watch does not confirm our versions are
+                        # current, as it might have silently stopped. Restart
+                        # it, and let the cached versions expire as normal.
+                        if not event:
+                            break
+
+                        event_type, key, value, revision = event
+                        if (key == OBJECT_VERSIONS_KEY and event_type != 'DELETE'
+                                and value):
+                            self.versions = value['versions']
+                            self.published = True
+                            self.fresh_until = time.time() + VERSION_CACHE_TTL
+                finally:
+                    events.close()
+
+            except Exception as e:
+                util_general.ignore_exception('object version watch', e)
+                time.sleep(1)
+                with self.lock:
+                    revision = self._load()
+
+    def get(self, objname):
+        self._check_fork()
+        if self.versions is None or time.time() > self.fresh_until:
+            with self.lock:
+                if self.versions is None or time.time() > self.fresh_until:
+                    revision = self._load()
+                    if not self.watcher:
+                        self.watcher = threading.Thread(
+                            target=self._watch, args=(revision,), daemon=True,
+                            name='object-version-watch')
+                        self.watcher.start()
+
+        version = self.versions.get(objname)
+        if version is None:
+            return inf
+        return version
+
+
+VERSION_CACHE = ObjectVersionCache()
 
-    if VERSION_CACHE[objname] == inf:
-        LOG.with_fields({
-            'object_type': possible_objname
-        }).debug('No object versions reported, so discarding version cache')
-    else:
-        VERSION_CACHE_AGE = time.time()
-    return VERSION_CACHE[objname]
+
+def get_minimum_object_version(objname):
+    return VERSION_CACHE.get(objname)
 
 
 class DatabaseBackedObject:
@@ -251,9 +368,10 @@ class DatabaseBackedObject:
                 yield obj
 
     @classmethod
-    def _db_create(cls, object_uuid, metadata):
+    def _db_create(cls, object_uuid, metadata, extra_puts=None):
         metadata['uuid'] = object_uuid
-        etcd.create(cls.object_type, None, object_uuid, metadata)
+        etcd.create(cls.object_type, None, object_uuid, metadata,
+                    extra_puts=extra_puts)
         eventlog.add_event(EVENT_TYPE_AUDIT, cls.object_type, object_uuid,
                            'db record created', extra=metadata)
 
@@ -309,13 +427,18 @@ class DatabaseBackedObject:
                                           self.__uuid, prefix=attribute_prefix):
                 yield key, data
 
-    def _db_set_attribute(self, attribute, value):
-        # Some attributes are simply too frequently changed to have much meaning
-        # as an event.
+    def _db_set_attribute(self, attribute, value, extra_puts=None,
+                          extra_deletes=None):
+        # extra_puts and extra_deletes are applied in the same etcd transaction
+        # as the attribute, and are used to maintain indexes.
+        #
+        # Some attributes are simply too frequently changed to have much
+        # meaning as an event.
         if (self.object_type, attribute) not in [('node', 'blobs'),
                                                  ('node', 'observed'),
                                                  ('blob', 'ref_count'),
-                                                 ('blob', 'last_used')]:
+                                                 ('blob', 'last_used'),
+                                                 ('artifact', 'blob_summary')]:
             # Coerce the value into a dictionary.
             if type(value) is State:
                 event_values = value.obj_dict()
@@ -334,7 +457,8 @@ class DatabaseBackedObject:
                 value, indent=4, sort_keys=True, cls=etcd.JSONEncoderCustomTypes)
         else:
             etcd.put('attribute/%s' % self.object_type,
-                     self.__uuid, attribute, value)
+                     self.__uuid, attribute, value, extra_puts=extra_puts,
+                     extra_deletes=extra_deletes)
 
     def _db_delete_attribute(self, attribute):
         if self.__in_memory_only and attribute in self.__in_memory_values:
@@ -430,7 +554,10 @@ class DatabaseBackedObject:
                         orig.value, new_value, self.object_type, self.uuid)
 
             new_state = State(new_value, time.time())
-            self._db_set_attribute('state', new_state)
+            extra_puts, extra_deletes = self._index_changes_for_state(
+                orig.value, new_value)
+            self._db_set_attribute('state', new_state, extra_puts=extra_puts,
+                                   extra_deletes=extra_deletes)
 
             if not self.__in_memory_only:
                 cache.update_object_state_cache(
@@ -440,6 +567,11 @@ class DatabaseBackedObject:
     def state(self, new_value):
         self._state_update(new_value)
 
+    def _index_changes_for_state(self, old_value, new_value):
+        # Objects which maintain indexes return (puts, deletes) to apply to
+        # those indexes along with a state change.
+        return None, None
+
     @property
     def error(self):
         db_data = self._db_get_attribute('error', {'message': None})
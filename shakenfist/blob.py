@@ -2,20 +2,27 @@
 # Please note: blobs are a "foundational" baseobject type, which means they
 # should not rely on any other baseobjects for their implementation. This is
 # done to help minimize circular import problems.
+import contextlib
 import hashlib
+import json
 import numbers
 import os
 import random
 import socket
+import threading
 import time
 import uuid
+from concurrent import futures
 
 import magic
 import psutil
+import requests
+from oslo_concurrency import lockutils
 from shakenfist_utilities import logs
 from shakenfist_utilities import random as sf_random
 
 from shakenfist import cache
+from shakenfist import constants
 from shakenfist import etcd
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.baseobject import DatabaseBackedObjectIterator as dbo_iter
@@ -33,6 +40,7 @@ from shakenfist.exceptions import BlobFetchFailed
 from shakenfist.exceptions import BlobMissing
 from shakenfist.exceptions import BlobsMustHaveContent
 from shakenfist.exceptions import BlobTransferSetupFailed
+from shakenfist.exceptions import HTTPError
 from shakenfist.node import Node
 from shakenfist.node import Nodes
 from shakenfist.node import nodes_by_free_disk_descending
@@ -47,6 +55,54 @@ from shakenfist.util import process as util_process
 LOG, _ = logs.setup(__name__)
 
 
+# Cached views which include blob reference counts or instance usage (for
+# example artifact blob summaries) need to know when that information might
+# have changed. Each blob has a usage generation marker, which is changed in
+# the same etcd transaction as each change to the reference count of that blob,
+# and each change to the block devices of an instance using that blob (or a
+# blob which depends on it). A cached view is valid for as long as the
+# generations of the blobs it covers are unchanged.
+USAGE_GENERATION_PREFIX = '/sf/cache/_blob_usage_generation/'
+
+
+def usage_generations(blob_uuids):
+    generations = {}
+    for blob_uuid in blob_uuids:
+        g = etcd.get_raw(USAGE_GENERATION_PREFIX + blob_uuid)
+        generations[blob_uuid] = g.get('generation') if g else None
+    return generations
+
+
+def all_usage_generations():
+    # A single prefix read, for callers interested in many blobs at once.
+    generations = {}
+    for key, data in etcd.get_prefix_paged(USAGE_GENERATION_PREFIX):
+        generations[key[len(USAGE_GENERATION_PREFIX):]] = \
+            etcd.decode_value(data).get('generation')
+    return generations
+
+
+def usage_generation_bump(blob_uuids):
+    # Returns extra_puts for _db_set_attribute() which change the generations
+    return {
+        USAGE_GENERATION_PREFIX + blob_uuid: {'generation': str(uuid.uuid4())}
+        for blob_uuid in blob_uuids
+    }
+
+
+def usage_generation_bump_for_disks(devices):
+    # Instances use the blob behind each of their disks, and everything that
+    # blob depends on.
+    blob_uuids = set()
+    for d in devices:
+        blob_uuid = d.get('blob_uuid')
+        while blob_uuid and blob_uuid not in blob_uuids:
+            blob_uuids.add(blob_uuid)
+            b = Blob.from_db(blob_uuid, suppress_failure_audit=True)
+            blob_uuid = b.depends_on if b else None
+    return usage_generation_bump(blob_uuids)
+
+
 class Blob(dbo):
     object_type = 'blob'
     initial_version = 2
@@ -214,6 +270,15 @@ class Blob(dbo):
     def record_usage(self):
         self._db_set_attribute('last_used', {'last_used': time.time()})
 
+    @property
+    def http_validators(self):
+        """The URL and HTTP validators a blob downloaded over HTTP came from."""
+        return self._db_get_attribute('http_validators')
+
+    @http_validators.setter
+    def http_validators(self, value):
+        self._db_set_attribute('http_validators', value)
+
     @property
     def expires_at(self):
         retention = self._db_get_attribute('retention', {'expires_at': 0})
@@ -236,7 +301,7 @@ class Blob(dbo):
         n = Node.from_db(node)
         n.remove_blob(self.uuid)
 
-    def observe(self):
+    def observe(self, mime_type=None):
         self.add_node_location()
 
         # Observing a blob can move it from initial to created, but it should not
@@ -256,15 +321,24 @@ class Blob(dbo):
                     if key in info:
                         del info[key]
 
-                info['mime-type'] = magic.Magic(mime=True).from_file(blob_path)
+                if not mime_type:
+                    mime_type = magic.Magic(mime=True).from_file(blob_path)
+                info['mime-type'] = mime_type
                 self._db_set_attribute('info', info)
 
+    def _index_changes_for_state(self, old_value, new_value):
+        # Deleted blobs no longer need a usage generation
+        if new_value == self.STATE_DELETED:
+            return None, [USAGE_GENERATION_PREFIX + self.uuid]
+        return None, None
+
     def ref_count_inc(self, baseobject, count=1):
         with self.get_lock_attr('ref_count', 'Increase reference count'):
             if self.state.value == self.STATE_DELETED:
                 raise BlobDeleted(self.uuid)
             new_count = self.ref_count + count
-            self._db_set_attribute('ref_count', {'ref_count': new_count})
+            self._db_set_attribute('ref_count', {'ref_count': new_count},
+                                   extra_puts=usage_generation_bump([self.uuid]))
             self.add_event(
                 EVENT_TYPE_MUTATE, 'incremented reference count',
                 extra={
@@ -312,7 +386,8 @@ class Blob(dbo):
                         'reference_count': new_count
                         })
 
-            self._db_set_attribute('ref_count', {'ref_count': new_count})
+            self._db_set_attribute('ref_count', {'ref_count': new_count},
+                                   extra_puts=usage_generation_bump([self.uuid]))
             self._delete_unused(new_count)
             return new_count
 
@@ -616,23 +691,25 @@ class Blob(dbo):
             iopriority=util_process.PRIORITY_LOW)
         return hash_out.split(' ')[0]
 
-    def verify_checksum(self, hash=None, locks=None, urgent=True):
+    def verify_checksum(self, hash=None, locks=None, urgent=True,
+                        known_hashes=None):
         # This method is focussed on sha512 hashes at the moment, but I also
         # want it to be able to do other hash types later -- for example OVA
         # support needs sha1 or sha256, and xxhash is a lot faster. So for now
         # we always make sure there is a sha512, but if we're not in a hurry
-        # we'll calculate a few others just once as well.
+        # we'll calculate a few others just once as well. Callers which have
+        # already hashed the blob can pass those hashes as known_hashes.
         if hash:
             sha512_hash = hash
         if not hash:
             sha512_hash = self._get_hash(hashtype='sha512', locks=locks)
 
         # If we're not in a hurry, calculate missing extra hashes
-        extra_hashes = {}
+        extra_hashes = dict(known_hashes or {})
         needs_rehashing = False
         c = self.checksums
         for alg in BLOB_HASH_ALGORITHMS:
-            if alg not in c:
+            if alg not in c and alg not in extra_hashes:
                 if not urgent:
                     extra_hashes[alg] = self._get_hash(
                         hashtype=alg, locks=locks)
@@ -684,17 +761,100 @@ class Blob(dbo):
         return True
 
 
-def snapshot_disk(disk, blob_uuid, related_object=None, thin=False):
-    if not os.path.exists(disk['path']):
-        return
-    dest_path = Blob.filepath(blob_uuid)
+# Snapshots are captured in a limited number of slots on each node, so that
+# several concurrent snapshots do not starve running instances of disk I/O.
+SNAPSHOT_SLOT_WAIT_SECONDS = 5
+SNAPSHOT_DIGEST_CHUNK_SIZE = constants.MiB
+
+
+@contextlib.contextmanager
+def _snapshot_slot(progress_callback=None):
+    waiting_since = None
+    while True:
+        for slot in range(max(1, config.MAX_CONCURRENT_SNAPSHOTS)):
+            lock = lockutils.external_lock(
+                'snapshot-slot-%d' % slot, lock_path='/tmp',
+                lock_file_prefix='sflock-')
+            if lock.acquire(blocking=False):
+                try:
+                    yield
+                finally:
+                    lock.release()
+                return
+
+        if not waiting_since:
+            waiting_since = time.time()
+            LOG.info('Waiting for a snapshot slot')
+            if progress_callback:
+                progress_callback('queued', 0, 0)
+        time.sleep(SNAPSHOT_SLOT_WAIT_SECONDS)
+
+
+def _digest_file(path, progress_callback=None):
+    """Hash a file and detect its mime type in a single read.
+
+    Hashes are calculated for each of BLOB_HASH_ALGORITHMS which hashlib
+    supports, the rest are left for HashBlobTask.
+    """
+    hashers = {}
+    for alg in BLOB_HASH_ALGORITHMS:
+        if alg in hashlib.algorithms_available:
+            hashers[alg] = hashlib.new(alg)
+
+    total = os.stat(path).st_size
+    done = 0
+    mime_type = None
+    with open(path, 'rb') as f:
+        while chunk := f.read(SNAPSHOT_DIGEST_CHUNK_SIZE):
+            if not mime_type:
+                mime_type = magic.Magic(mime=True).from_buffer(chunk)
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            done += len(chunk)
+            if progress_callback:
+                progress_callback('hashing', done, total)
+
+    hashes = {alg: hasher.hexdigest() for alg, hasher in hashers.items()}
+    return hashes, mime_type
+
+
+def ensure_in_image_cache(b):
+    """Ensure a snapshot blob and everything it depends on is in the image cache.
+
+    Snapshots refer to the blob they depend on by its name in the image cache,
+    so qemu-img can only read a chain of snapshots from there. Snapshots are
+    already qcow2 files and are linked into the image cache as is. The image
+    at the root of a thin snapshot chain is expected to have been transcoded
+    into the image cache when the instance it was taken from was started.
+    """
+    image_cache_path = os.path.join(config.STORAGE_PATH, 'image_cache')
+    os.makedirs(image_cache_path, exist_ok=True)
+    b.ensure_local([])
+
+    while b:
+        cached = util_general.file_permutation_exists(
+            os.path.join(image_cache_path, b.uuid), ['iso', 'qcow2'])
+        if not cached:
+            if b.info.get('mime-type') != 'application/x-qemu-disk':
+                raise BlobDependencyMissing(
+                    'Blob %s is not in the image cache' % b.uuid)
+            util_general.link(
+                Blob.filepath(b.uuid),
+                os.path.join(image_cache_path, b.uuid + '.qcow2'))
+
+        if not b.depends_on:
+            return
+        dep_blob = Blob.from_db(b.depends_on)
+        if not dep_blob:
+            raise BlobDependencyMissing(b.depends_on)
+        b = dep_blob
 
-    # Actually make the snapshot
-    depends_on = None
-    with util_general.RecordedOperation('snapshot %s' % disk['device'], related_object):
-        depends_on = util_image.snapshot(
-            None, disk['path'], dest_path + '.partial', thin=thin)
-        st = os.stat(dest_path + '.partial')
+
+def _register_snapshot(blob_uuid, partial_path, depends_on,
+                       progress_callback=None):
+    st = os.stat(partial_path)
+    hashes, mime_type = _digest_file(
+        partial_path, progress_callback=progress_callback)
 
     # Check that the dependency (if any) actually exists. This test can fail when
     # the blob used to start an instance has been deleted already.
@@ -705,79 +865,425 @@ def snapshot_disk(disk, blob_uuid, related_object=None, thin=False):
             raise BlobDependencyMissing(
                 'Snapshot depends on blob UUID %s, which is missing' % depends_on)
 
-    # And make the associated blob. Note that we deliberately don't calculate the
-    # snapshot checksum here, as this makes large snapshots even slower for users.
-    # The checksum will "catch up" when the scheduled verification occurs.
-    # We don't remove the partial file until we've finished registering the blob
-    # to avoid deletion races. Note that this _must_ be a hard link, which is why
-    # we don't use util_general.link().
-    os.link(dest_path + '.partial', dest_path)
+    # And make the associated blob. We don't remove the partial file until we've
+    # finished registering the blob to avoid deletion races. Note that this
+    # _must_ be a hard link, which is why we don't use util_general.link().
+    os.link(partial_path, Blob.filepath(blob_uuid))
     b = Blob.new(blob_uuid, st.st_size, time.time(), time.time(), depends_on=depends_on)
     b.state = Blob.STATE_CREATED
     if dep_blob:
         dep_blob.ref_count_inc(b)
-    b.observe()
+    b.observe(mime_type=mime_type)
+    b.verify_checksum(hash=hashes['sha512'], known_hashes=hashes)
     b.request_replication()
-    os.unlink(dest_path + '.partial')
+    os.unlink(partial_path)
     return b
 
 
-def http_fetch(url, resp, blob_uuid, locks, logs, instance_object=None):
-    fetched = 0
-    if resp.headers.get('Content-Length'):
-        total_size = int(resp.headers.get('Content-Length'))
-    else:
-        total_size = None
+def snapshot_disk(disk, blob_uuid, related_object=None, thin=False,
+                  progress_callback=None, incremental_from=None):
+    """Capture a disk as a new blob.
 
-    previous_percentage = 0.0
-    last_refresh = 0
-    dest_path = Blob.filepath(blob_uuid)
+    If incremental_from is the UUID of a previous snapshot of the disk, the
+    new blob only contains the changes since that snapshot, and depends on it.
 
-    md5_hash = hashlib.md5()
-    sha512_hash = hashlib.sha512()
+    progress_callback, if provided, is called with a phase name, the number
+    of bytes processed so far in that phase, and the total for that phase.
+    """
+    if not os.path.exists(disk['path']):
+        return
+    partial_path = Blob.filepath(blob_uuid) + '.partial'
+
+    def convert_progress(done, total):
+        progress_callback('converting', done, total)
+
+    # Actually make the snapshot. The snapshot is hashed immediately after it
+    # is written, while it is most likely still in the page cache.
+    with util_general.RecordedOperation('snapshot %s' % disk['device'], related_object):
+        with _snapshot_slot(progress_callback=progress_callback):
+            if incremental_from:
+                previous_blob = Blob.from_db(incremental_from)
+                if not previous_blob:
+                    raise BlobDependencyMissing(
+                        'Snapshot depends on blob UUID %s, which is missing'
+                        % incremental_from)
+                ensure_in_image_cache(previous_blob)
+                depends_on = util_image.snapshot_incremental(
+                    None, disk['path'], partial_path, incremental_from,
+                    progress_callback=convert_progress if progress_callback else None)
+            else:
+                depends_on = util_image.snapshot(
+                    None, disk['path'], partial_path, thin=thin,
+                    progress_callback=convert_progress if progress_callback else None)
+            return _register_snapshot(blob_uuid, partial_path, depends_on,
+                                      progress_callback=progress_callback)
+
+
+def rebase_snapshot(b, backing_uuid, unsafe=False, related_object=None):
+    """Copy a snapshot blob into a new blob with a different backing blob.
+
+    The new blob presents the same data as the original. See
+    util_image.rebase() for the difference between safe and unsafe rebases.
+    """
+    ensure_in_image_cache(b)
+    if backing_uuid:
+        backing_blob = Blob.from_db(backing_uuid)
+        if not backing_blob:
+            raise BlobDependencyMissing(backing_uuid)
+        ensure_in_image_cache(backing_blob)
+
+    # The rebase happens in the image cache, so that the old and new backing
+    # files can be found by their relative paths.
+    blob_uuid = str(uuid.uuid4())
+    partial_path = os.path.join(
+        config.STORAGE_PATH, 'image_cache', blob_uuid + '.partial')
+    with util_general.RecordedOperation('rebase snapshot %s' % b.uuid, related_object):
+        with _snapshot_slot():
+            try:
+                util_general.clone_file(Blob.filepath(b.uuid), partial_path)
+                util_image.rebase(None, partial_path, backing_uuid, unsafe=unsafe)
+                return _register_snapshot(blob_uuid, partial_path, backing_uuid)
+            finally:
+                if os.path.exists(partial_path):
+                    os.unlink(partial_path)
 
-    with open(dest_path + '.partial', 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            fetched += len(chunk)
-            f.write(chunk)
-            md5_hash.update(chunk)
-            sha512_hash.update(chunk)
 
+# HTTP downloads are staged in STORAGE_PATH/downloads, keyed by a hash of the
+# URL. Alongside the partial download is a small state file which records the
+# validators the server gave us, and how far each range of the download has
+# progressed. An interrupted download of the same URL resumes from where it
+# stopped, so long as the server still reports the same validators. Large
+# downloads from servers which support ranged requests can optionally be split
+# into several ranges fetched in parallel. As several artifacts (for example
+# in different namespaces) can have the same source URL, the staging files are
+# protected by a node local lock on the URL hash for the whole download.
+HTTP_FETCH_ATTEMPTS = 5
+HTTP_FETCH_CHUNK_SIZE = 64 * 1024
+HTTP_FETCH_TIMEOUT = 60
+DOWNLOAD_STATE_SAVE_SECONDS = 10
+STALE_DOWNLOAD_SECONDS = 7 * 24 * 3600
+
+
+class _RestartDownload(Exception):
+    pass
+
+
+def http_proxies():
+    proxies = {}
+    if config.HTTP_PROXY_SERVER:
+        proxies['http'] = config.HTTP_PROXY_SERVER
+    return proxies
+
+
+def http_validators_from_headers(headers):
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    if headers.get('Content-Length'):
+        validators['content_length'] = int(headers['Content-Length'])
+    return validators
+
+
+def _download_name(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _download_paths(url):
+    base = os.path.join(config.STORAGE_PATH, 'downloads', _download_name(url))
+    return base + '.partial', base + '.state'
+
+
+@contextlib.contextmanager
+def _download_lock(url, locks):
+    # Our caller's etcd locks are refreshed while we wait, as another download
+    # of the same URL can take a long time.
+    lock = lockutils.external_lock(
+        'download-%s' % _download_name(url), lock_path='/tmp',
+        lock_file_prefix='sflock-')
+    last_refresh = time.time()
+    while not lock.acquire(blocking=False):
+        if time.time() - last_refresh > LOCK_REFRESH_SECONDS:
+            etcd.refresh_locks(locks)
+            last_refresh = time.time()
+        time.sleep(1)
+
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _plan_ranges(total_size, accepts_ranges):
+    if (not total_size or not accepts_ranges or config.IMAGE_DOWNLOAD_RANGES < 2
+            or total_size < config.IMAGE_DOWNLOAD_RANGE_MINIMUM):
+        end = total_size - 1 if total_size else None
+        return [{'start': 0, 'end': end, 'offset': 0}]
+
+    ranges = []
+    step = -(-total_size // config.IMAGE_DOWNLOAD_RANGES)
+    for start in range(0, total_size, step):
+        end = min(start + step, total_size) - 1
+        ranges.append({'start': start, 'end': end, 'offset': start})
+    return ranges
+
+
+class _Download:
+    def __init__(self, url, locks, logs, instance_object, blob_uuid):
+        self.url = url
+        self.locks = locks
+        self.logs = logs
+        self.instance_object = instance_object
+        self.blob_uuid = blob_uuid
+        self.partial_path, self.state_path = _download_paths(url)
+        self.user_agent = util_general.get_user_agent()
+
+        self.lock = threading.Lock()
+        self.abort = threading.Event()
+        self.state = None
+        self.fd = None
+        self.sha512_hash = None
+        self.last_refresh = 0
+        self.last_save = 0
+        self.previous_percentage = 0.0
+
+    def _head(self):
+        try:
+            resp = requests.head(
+                self.url, allow_redirects=True, proxies=http_proxies(),
+                headers={'User-Agent': self.user_agent},
+                timeout=HTTP_FETCH_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            self.logs.with_fields({'error': str(e)}).info('HEAD request failed')
+            return None
+        if resp.status_code != 200:
+            return None
+        return resp
+
+    def _save_state(self):
+        os.fdatasync(self.fd)
+        with open(self.state_path + '.new', 'w') as f:
+            f.write(json.dumps(self.state))
+        os.rename(self.state_path + '.new', self.state_path)
+        self.last_save = time.time()
+
+    def _discard(self):
+        for path in [self.partial_path, self.state_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _load_or_plan(self, validators, accepts_ranges):
+        try:
+            with open(self.state_path) as f:
+                state = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            state = None
+
+        # Only resume if the server still describes the same resource. Without
+        # an ETag or Last-Modified we cannot tell, so we start again.
+        if (state and os.path.exists(self.partial_path)
+                and state.get('url') == self.url
+                and (validators.get('etag') or validators.get('last_modified'))
+                and state.get('validators') == validators):
+            done = sum(r['offset'] - r['start'] for r in state['ranges'])
+            self.logs.with_fields({'bytes_already_fetched': done}).info(
+                'Resuming partial download')
+            return state
+
+        self._discard()
+        return {
+            'url': self.url,
+            'validators': validators,
+            'ranges': _plan_ranges(validators.get('content_length'), accepts_ranges)
+        }
+
+    def _progress(self, length):
+        with self.lock:
+            total_size = self.state['validators'].get('content_length')
             if total_size:
+                fetched = sum(r['offset'] - r['start'] for r in self.state['ranges'])
                 percentage = fetched / total_size * 100.0
-                if (percentage - previous_percentage) > 10.0:
-                    if instance_object:
-                        instance_object.add_event(
+                if (percentage - self.previous_percentage) > 10.0:
+                    if self.instance_object:
+                        self.instance_object.add_event(
                             EVENT_TYPE_STATUS, 'fetching required HTTP resource',
                             extra={
-                                'url': url,
-                                'blob_uuid': blob_uuid,
+                                'url': self.url,
+                                'blob_uuid': self.blob_uuid,
                                 'percentage': percentage
                             })
 
-                    logs.with_fields({'bytes_fetched': fetched}).debug(
+                    self.logs.with_fields({'bytes_fetched': fetched}).debug(
                         'Fetch %.02f percent complete' % percentage)
-                    previous_percentage = percentage
-
-            if time.time() - last_refresh > LOCK_REFRESH_SECONDS:
-                etcd.refresh_locks(locks)
-                last_refresh = time.time()
-
-    if instance_object:
-        instance_object.add_event(
-            EVENT_TYPE_STATUS, 'fetching required HTTP resource complete',
-            extra={
-                'url': url,
-                'blob_uuid': blob_uuid
-            })
-    logs.with_fields({'bytes_fetched': fetched}).info('Fetch complete')
-
-    # Import the newly fetched blob
-    os.rename(dest_path + '.partial', dest_path)
-    b = Blob.new(blob_uuid, fetched, resp.headers.get('Last-Modified'),
+                    self.previous_percentage = percentage
+
+            if time.time() - self.last_refresh > LOCK_REFRESH_SECONDS:
+                etcd.refresh_locks(self.locks)
+                self.last_refresh = time.time()
+
+            if time.time() - self.last_save > DOWNLOAD_STATE_SAVE_SECONDS:
+                self._save_state()
+
+    def _fetch_range(self, rng):
+        attempts = 0
+        while rng['end'] is None or rng['offset'] <= rng['end']:
+            headers = {'User-Agent': self.user_agent}
+            ranged = (rng['offset'] > 0 or
+                      (rng['end'] is not None and len(self.state['ranges']) > 1))
+            if ranged:
+                end = '' if rng['end'] is None else rng['end']
+                headers['Range'] = 'bytes=%d-%s' % (rng['offset'], end)
+                if_range = (self.state['validators'].get('etag') or
+                            self.state['validators'].get('last_modified'))
+                if if_range:
+                    headers['If-Range'] = if_range
+
+            try:
+                with requests.get(self.url, stream=True, allow_redirects=True,
+                                  headers=headers, proxies=http_proxies(),
+                                  timeout=HTTP_FETCH_TIMEOUT) as resp:
+                    if ranged and resp.status_code == 200:
+                        # The resource changed since we started, or the
+                        # server has stopped honouring ranges.
+                        raise _RestartDownload()
+                    if resp.status_code not in (200, 206):
+                        raise HTTPError(
+                            'Failed to fetch %s (status code %d)'
+                            % (self.url, resp.status_code))
+
+                    if not self.state['validators']:
+                        self.state['validators'] = http_validators_from_headers(
+                            resp.headers)
+
+                    for chunk in resp.iter_content(chunk_size=HTTP_FETCH_CHUNK_SIZE):
+                        if self.abort.is_set():
+                            return
+                        if rng['end'] is not None:
+                            chunk = chunk[:rng['end'] + 1 - rng['offset']]
+                        os.pwrite(self.fd, chunk, rng['offset'])
+                        if self.sha512_hash:
+                            self.sha512_hash.update(chunk)
+                        rng['offset'] += len(chunk)
+                        self._progress(len(chunk))
+
+                if rng['end'] is None:
+                    return
+
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                attempts += 1
+                if attempts >= HTTP_FETCH_ATTEMPTS:
+                    raise BlobFetchFailed(
+                        'Repeated attempts to fetch %s failed: %s' % (self.url, e))
+                self.logs.with_fields({
+                    'error': str(e),
+                    'offset': rng['offset']}).info('Download interrupted, resuming')
+                time.sleep(attempts)
+
+    def _fetch(self):
+        head = self._head()
+        validators = {}
+        accepts_ranges = False
+        if head:
+            validators = http_validators_from_headers(head.headers)
+            accepts_ranges = head.headers.get('Accept-Ranges') == 'bytes'
+
+        self.state = self._load_or_plan(validators, accepts_ranges)
+        ranges = self.state['ranges']
+
+        # A single sequential range is hashed as it arrives. Parallel ranges
+        # arrive out of order, and are hashed once they are complete.
+        self.sha512_hash = None
+        if len(ranges) == 1:
+            self.sha512_hash = hashlib.sha512()
+
+        self.fd = os.open(self.partial_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if self.sha512_hash and ranges[0]['offset'] > 0:
+                with open(self.partial_path, 'rb') as f:
+                    remaining = ranges[0]['offset']
+                    while remaining > 0:
+                        d = f.read(min(remaining, HTTP_FETCH_CHUNK_SIZE))
+                        if not d:
+                            break
+                        self.sha512_hash.update(d)
+                        remaining -= len(d)
+
+            if len(ranges) == 1:
+                self._fetch_range(ranges[0])
+            else:
+                # If any range fails, the others stop early rather than
+                # finishing their ranges first.
+                with futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    fs = [executor.submit(self._fetch_range, r) for r in ranges]
+                    for f in futures.as_completed(fs):
+                        if f.exception():
+                            self.abort.set()
+                    for f in fs:
+                        f.result()
+
+            size = max(r['offset'] for r in ranges)
+            os.ftruncate(self.fd, size)
+        finally:
+            self._save_state()
+            os.close(self.fd)
+
+        if not self.sha512_hash:
+            self.sha512_hash = hashlib.sha512()
+            with open(self.partial_path, 'rb') as f:
+                while d := f.read(HTTP_FETCH_CHUNK_SIZE):
+                    self.sha512_hash.update(d)
+
+        return size
+
+    def fetch(self):
+        """Download the URL, resuming a previous attempt if possible.
+
+        Returns the path to the downloaded file, its size, its sha512
+        hexdigest and the validators the server gave for it.
+        """
+        os.makedirs(os.path.dirname(self.partial_path), exist_ok=True)
+        try:
+            size = self._fetch()
+        except _RestartDownload:
+            self.logs.info('Resource changed during download, restarting')
+            self._discard()
+            self.abort.clear()
+            try:
+                size = self._fetch()
+            except _RestartDownload:
+                raise BlobFetchFailed(
+                    'Resource %s changed repeatedly during download' % self.url)
+
+        os.unlink(self.state_path)
+        return self.partial_path, size, self.sha512_hash.hexdigest(), \
+            self.state['validators']
+
+
+def http_fetch(url, blob_uuid, locks, logs, instance_object=None):
+    with _download_lock(url, locks):
+        path, fetched, sha512, validators = _Download(
+            url, locks, logs, instance_object, blob_uuid).fetch()
+
+        if instance_object:
+            instance_object.add_event(
+                EVENT_TYPE_STATUS, 'fetching required HTTP resource complete',
+                extra={
+                    'url': url,
+                    'blob_uuid': blob_uuid
+                })
+        logs.with_fields({'bytes_fetched': fetched}).info('Fetch complete')
+
+        # Import the newly fetched blob
+        util_general.move_file(path, Blob.filepath(blob_uuid))
+
+    b = Blob.new(blob_uuid, fetched, validators.get('last_modified'),
                  time.time())
+    b.http_validators = {'url': url, **validators}
     b.state = Blob.STATE_CREATED
-    b.verify_checksum(hash=sha512_hash.hexdigest())
+    b.verify_checksum(hash=sha512)
     b.observe()
     b.request_replication()
     return b
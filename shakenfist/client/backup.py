@@ -5,6 +5,7 @@ import json
 import logging
 import os
 import tarfile
+import time
 
 import click
 from shakenfist_utilities import logs
@@ -35,6 +36,7 @@ config = sf_config.config
 
 # These imports _must_ occur after the extra config setup has run.
 from shakenfist import etcd                  # noqa
+from shakenfist import exceptions            # noqa
 
 
 @click.group()
@@ -45,38 +47,128 @@ def cli(ctx, verbose=None):
         LOG.setLevel(logging.DEBUG)
 
 
+# The original etcd key is recorded in a PAX header on each tar member,
+# because keys with a trailing slash cannot be represented as tar file names.
+KEY_HEADER = 'SF.key'
+
+
+def _progress(verb, count, start_time):
+    elapsed = max(time.time() - start_time, 0.001)
+    LOG.info('%s %d keys (%.0f keys per second)' % (verb, count, count / elapsed))
+
+
+# etcd may compact away the revision a backup is reading at if the backup is
+# slow. The backup is then restarted from scratch at a new revision, but only
+# this many times in total.
+BACKUP_ATTEMPTS = 3
+
+
+def _write_backup(output, anonymise, prefix, page_size):
+    start_time = time.time()
+    count = 0
+
+    with tarfile.open(output, 'w:gz', format=tarfile.PAX_FORMAT) as tar:
+        for p in prefix:
+            for key, data in etcd.get_prefix_paged(p, page_size=page_size):
+                if key.startswith('/sf/namespace'):
+                    d = etcd.decode_value(data)
+                    for k in d['keys']:
+                        d['keys'][k] = '...'
+                    data = json.dumps(d, indent=4, sort_keys=True).encode('utf-8')
+
+                info = tarfile.TarInfo(key.rstrip('/'))
+                info.size = len(data)
+                info.pax_headers = {KEY_HEADER: key}
+                tar.addfile(info, io.BytesIO(data))
+
+                count += 1
+                if count % page_size == 0:
+                    _progress('Backed up', count, start_time)
+
+    _progress('Backed up', count, start_time)
+
+
 @click.command()
 @click.argument('output', type=click.Path(exists=False))
 @click.option('-a', '--anonymise', is_flag=True,
               help='Remove authentication details from backup')
+@click.option('-p', '--prefix', multiple=True, default=['/'],
+              help='Only backup keys with this prefix. May be repeated.')
+@click.option('--page-size', default=1000,
+              help='The number of keys to read from etcd at a time')
 @click.pass_context
-def backup(ctx, output, anonymise=False):
-    with tarfile.open(output, 'w:gz') as tar:
-        for data, metadata in etcd.get_etcd_client().get_prefix('/'):
-            if metadata['key'].startswith(b'/sf/namespace'):
-                d = json.loads(data)
-                for k in d['keys']:
-                    d['keys'][k] = '...'
-                data = json.dumps(d, indent=4, sort_keys=True).encode('utf-8')
+def backup(ctx, output, anonymise=False, prefix=None, page_size=1000):
+    for attempt in range(1, BACKUP_ATTEMPTS + 1):
+        try:
+            _write_backup(output, anonymise, prefix, page_size)
+            return
+        except exceptions.RevisionCompacted as e:
+            LOG.warning('Restarting backup, attempt %d of %d failed: %s'
+                        % (attempt, BACKUP_ATTEMPTS, e))
 
-            info = tarfile.TarInfo(metadata['key'].decode('utf-8').rstrip('/'))
-            info.size = len(data)
-            tar.addfile(info, io.BytesIO(data))
+    raise click.ClickException(
+        'etcd compacted the revision being backed up during each of %d '
+        'attempts, try a larger page size or backing up fewer prefixes'
+        % BACKUP_ATTEMPTS)
 
 
 cli.add_command(backup)
 
 
+def _read_backup(tar, batch_size):
+    batch = []
+    for tarinfo in tar:
+        key = tarinfo.pax_headers.get(KEY_HEADER, tarinfo.name)
+        batch.append((key, tar.extractfile(tarinfo).read()))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 @click.command()
 @click.argument('input', type=click.Path(exists=True))
+@click.option('--batch-size', default=100,
+              help=('The number of keys to write in each etcd transaction. '
+                    'This must not exceed the etcd --max-txn-ops setting.'))
+@click.option('--verify/--no-verify', default=True,
+              help='Read back all restored keys and compare them to the backup')
 @click.pass_context
-def restore(ctx, input):
-    with tarfile.open(input, 'r:gz') as tar:
-        for tarinfo in tar:
-            key = tarinfo.name
-            data = tar.extractfile(key).read()
+def restore(ctx, input, batch_size=100, verify=True):
+    start_time = time.time()
+    count = 0
 
-            etcd.get_etcd_client().put(key, data)
+    with tarfile.open(input, 'r:gz') as tar:
+        for batch in _read_backup(tar, batch_size):
+            etcd.batch_put(batch)
+            count += len(batch)
+            if count % (batch_size * 10) == 0:
+                _progress('Restored', count, start_time)
+    _progress('Restored', count, start_time)
+
+    if not verify:
+        return
+
+    start_time = time.time()
+    count = 0
+    mismatched = []
+    with tarfile.open(input, 'r:gz') as tar:
+        for batch in _read_backup(tar, batch_size):
+            stored = etcd.batch_get([key for key, _ in batch])
+            for key, data in batch:
+                if stored.get(key) != data:
+                    mismatched.append(key)
+            count += len(batch)
+            if count % (batch_size * 10) == 0:
+                _progress('Verified', count, start_time)
+    _progress('Verified', count, start_time)
+
+    if mismatched:
+        for key in mismatched:
+            LOG.error('Restored value for %s does not match backup' % key)
+        raise click.ClickException(
+            '%d restored keys do not match the backup' % len(mismatched))
 
 
 cli.add_command(restore)
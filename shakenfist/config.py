@@ -92,6 +92,13 @@ class SFConfig(BaseSettings):
         13001,
         description='Where to expose internal metrics from the resources daemon.'
     )
+    DAEMON_METRICS_PORT_BASE: int = Field(
+        13010,
+        description=('The first port used to expose internal metrics such as '
+                     'etcd call counts from daemons which do not have a '
+                     'dedicated metrics port. See the operator guide for the '
+                     'port used by each daemon.')
+    )
 
     # Scheduler Options
     SCHEDULER_CACHE_TIMEOUT: int = Field(
@@ -180,6 +187,17 @@ class SFConfig(BaseSettings):
     MAX_IMAGE_TRANSFER_SECONDS: int = Field(
         1800, description='How long to wait for an image transfer to occur before giving up'
     )
+    IMAGE_DOWNLOAD_RANGES: int = Field(
+        1,
+        description='The number of parallel ranged requests used to download '
+                    'large images from servers which support them. 1 downloads '
+                    'images with a single request.'
+    )
+    IMAGE_DOWNLOAD_RANGE_MINIMUM: int = Field(
+        1024 * 1024 * 1024,
+        description='The size in bytes an image must be before it is downloaded '
+                    'with parallel ranged requests.'
+    )
 
     COMPRESS_SNAPSHOTS: bool = Field(
         True, description='Compress snapshots taken of instances'
@@ -188,6 +206,11 @@ class SFConfig(BaseSettings):
     SNAPSHOTS_DEFAULT_TO_THIN: bool = Field(
         False, description='Whether snapshots are thin (just changes from base image) or thick'
     )
+    MAX_CONCURRENT_SNAPSHOTS: int = Field(
+        2, description='How many snapshots a node will capture at once. Further '
+                       'snapshots wait for a free slot, limiting the disk I/O '
+                       'snapshots take from running instances.'
+    )
 
     # Artifact options
     ARTIFACT_MAX_VERSIONS_DEFAULT: int = Field(
@@ -197,6 +220,29 @@ class SFConfig(BaseSettings):
         0, description='The number of days to archive instance consoles for after deletion'
     )
 
+    # Console options
+    CONSOLE_LOG_ROTATE_SIZE: int = Field(
+        1024 * 1024,
+        description='The size in bytes at which an instance console log is rotated '
+                    'and the rotated output compressed into a blob.'
+    )
+    CONSOLE_LOG_MAX_SEGMENTS: int = Field(
+        10,
+        description='The number of compressed rotated console log segments to '
+                    'keep for each instance.'
+    )
+    CONSOLE_LOG_MAX_WAIT: int = Field(
+        3,
+        description='The longest time in seconds a console data API request may '
+                    'wait for new console output. Waits are also limited to a '
+                    'tenth of API_TIMEOUT, as they hold an API worker.'
+    )
+    CONSOLE_LOG_POLL_INTERVAL: float = Field(
+        0.25,
+        description='How often in seconds a waiting console data API request '
+                    'checks for new console output.'
+    )
+
     # Event options
     EVENTLOG_NODE_IP: str = Field(
         '', description='Mesh IP of the node which stores event logs',
@@ -207,6 +253,23 @@ class SFConfig(BaseSettings):
     USAGE_EVENT_FREQUENCY: int = Field(
         60, description='How frequently to collect usage events.'
     )
+    USAGE_EVENTS_IN_EVENTLOG: bool = Field(
+        False, description=(
+            'Whether usage events should also be written to the event log of '
+            'the relevant object. Usage is always recorded in the usage store '
+            'on the eventlog node.')
+    )
+    USAGE_RAW_RETENTION: int = Field(
+        3600 * 24 * 2, description=(
+            'How long to retain usage data at full resolution in the usage '
+            'store before downsampling to five minute resolution.')
+    )
+    USAGE_FIVE_MINUTE_RETENTION: int = Field(
+        3600 * 24 * 14, description=(
+            'How long to retain usage data at five minute resolution in the '
+            'usage store before downsampling to hourly resolution. Hourly '
+            'usage data is retained for MAX_USAGE_EVENT_AGE.')
+    )
 
     MAX_AUDIT_EVENT_AGE: int = Field(
         3600 * 24 * 90, description='How long to retain audit events.'
@@ -287,6 +350,13 @@ class SFConfig(BaseSettings):
         description='The bus to use for disk devices. One of virtio, scsi, '
                     'usb, ide, etc. See libvirt docs for full list of options.'
     )
+    CONFIG_DRIVE_FORMAT: str = Field(
+        'iso9660',
+        description='The filesystem used for openstack-disk config drives built '
+                    'on this node. One of iso9660 or vfat. vfat config drives '
+                    'are built from a cached filesystem skeleton with mtools, '
+                    'which is faster but requires dosfstools and mtools.'
+    )
     NODE_NAME: str = Field(
         default_factory=get_node_name, description='FQDN of this node'
     )
@@ -337,6 +407,21 @@ class SFConfig(BaseSettings):
     LOG_ETCD_CONNECTIONS: bool = Field(
         False, description='Log when a new etcd connection is created, only useful in CI.'
     )
+    ETCD_SLOW_CALL_THRESHOLD: float = Field(
+        1.0, description=(
+            'Log etcd calls which take longer than this many seconds, along '
+            'with a summary of the call stack which made them. Set to zero to '
+            'disable slow call logging.')
+    )
+    ETCD_VALUE_FORMAT: str = Field(
+        'msgpack', description=(
+            'The format used to write values to etcd. One of "json" (the '
+            'historical indented JSON format), "compact-json", or "msgpack". '
+            'Values in any format can always be read. Formats which older '
+            'versions of Shaken Fist cannot read are only written once every '
+            'node in the cluster reports that it can decode them, until then '
+            'compact JSON is written instead.')
+    )
 
     class Config:
         env_prefix = 'SHAKENFIST_'
@@ -364,6 +449,16 @@ def verify_config(skip_auth_seed=False):
     if config.ETCD_HOST == '':
         failures.append('You must configure ETCD_HOST')
 
+    if config.ETCD_VALUE_FORMAT not in ['json', 'compact-json', 'msgpack']:
+        failures.append('ETCD_VALUE_FORMAT must be one of json, compact-json, '
+                        'or msgpack')
+
+    if config.CONFIG_DRIVE_FORMAT not in ['iso9660', 'vfat']:
+        failures.append('CONFIG_DRIVE_FORMAT must be one of iso9660 or vfat')
+
+    if config.IMAGE_DOWNLOAD_RANGES < 1:
+        failures.append('IMAGE_DOWNLOAD_RANGES must be at least one')
+
     if not skip_auth_seed:
         if config.AUTH_SECRET_SEED == '~~unconfigured~~':
             failures.append('You must configure AUTH_SECRET_SEED!')
@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import pycdlib
+from shakenfist_utilities import logs
+
+from shakenfist.config import config
+from shakenfist.util import general as util_general
+from shakenfist.util import process as util_process
+
+
+LOG, _ = logs.setup(__name__)
+
+
+# OpenStack style config drives. We only pretend to implement the most recent
+# OpenStack metadata version, and present it as "latest" as well. Only
+# meta_data.json, user_data and network_data.json vary between instances, the
+# vendor data files are always empty.
+VERSIONS = ['latest', '2017-02-22']
+VENDOR_DATA = b'{}'
+
+FORMAT_ISO9660 = 'iso9660'
+FORMAT_VFAT = 'vfat'
+
+# vfat config drives are copied from a skeleton filesystem which already holds
+# the directory tree and vendor data, so that only the per-instance files need
+# to be written. Bump the skeleton version if its contents change.
+VFAT_SKELETON_VERSION = 1
+VFAT_SIZE_KB = 16 * 1024
+VFAT_LABEL = 'CONFIG-2'
+
+
+def content_hash(fmt, meta_data, user_data, network_data):
+    """Hash the content of a config drive.
+
+    The random seed in meta_data is excluded, as it differs for every build.
+    cloud-init only consumes it on the first boot of an instance anyway.
+    """
+    md = dict(meta_data)
+    md.pop('random_seed', None)
+
+    h = hashlib.sha256()
+    for value in [fmt.encode('utf-8'),
+                  json.dumps(md, sort_keys=True).encode('utf-8'),
+                  user_data,
+                  json.dumps(network_data, sort_keys=True).encode('utf-8')]:
+        h.update(len(value).to_bytes(8, 'big'))
+        h.update(value)
+    return h.hexdigest()
+
+
+def _read_hash(hash_path):
+    try:
+        with open(hash_path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def build(disk_path, meta_data, user_data, network_data, fmt=None):
+    """Build a config drive at disk_path.
+
+    If the config drive already at disk_path was built from the same content,
+    it is reused. Returns True if a new config drive was built.
+    """
+    if not fmt:
+        fmt = config.CONFIG_DRIVE_FORMAT
+
+    digest = content_hash(fmt, meta_data, user_data, network_data)
+    hash_path = disk_path + '.hash'
+    if (os.path.exists(disk_path) and os.path.getsize(disk_path) > 0 and
+            _read_hash(hash_path) == digest):
+        return False
+
+    meta_data = dict(meta_data)
+    meta_data['random_seed'] = base64.b64encode(os.urandom(512)).decode('ascii')
+    md = json.dumps(meta_data).encode('ascii')
+    nd = json.dumps(network_data).encode('ascii')
+
+    # Remove the old hash first, so that a failure part way through never
+    # leaves a hash which matches a config drive we didn't finish writing.
+    if os.path.exists(hash_path):
+        os.unlink(hash_path)
+
+    partial_path = disk_path + '.partial'
+    if os.path.exists(partial_path):
+        os.unlink(partial_path)
+    if fmt == FORMAT_VFAT:
+        _write_vfat(partial_path, md, user_data, nd)
+    else:
+        _write_iso9660(partial_path, md, user_data, nd)
+    os.rename(partial_path, disk_path)
+
+    with open(hash_path, 'w') as f:
+        f.write(digest)
+    return True
+
+
+def _write_iso9660(disk_path, md, user_data, nd):
+    # NOTE(mikal): with a big nod at https://gist.github.com/pshchelo/378f3c4e7d18441878b9652e9478233f
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=4,
+            joliet=True,
+            rock_ridge='1.09',
+            vol_ident='config-2')
+
+    iso.add_directory('/openstack',
+                      rr_name='openstack',
+                      joliet_path='/openstack')
+    iso.add_directory('/openstack/2017-02-22',
+                      rr_name='2017-02-22',
+                      joliet_path='/openstack/2017-02-22')
+    iso.add_directory('/openstack/latest',
+                      rr_name='latest',
+                      joliet_path='/openstack/latest')
+
+    iso.add_fp(io.BytesIO(md), len(md), '/openstack/latest/meta_data.json;1',
+               rr_name='meta_data.json',
+               joliet_path='/openstack/latest/meta_data.json')
+    iso.add_fp(io.BytesIO(md), len(md), '/openstack/2017-02-22/meta_data.json;2',
+               rr_name='meta_data.json',
+               joliet_path='/openstack/2017-02-22/meta_data.json')
+
+    iso.add_fp(io.BytesIO(user_data), len(user_data), '/openstack/latest/user_data',
+               rr_name='user_data',
+               joliet_path='/openstack/latest/user_data.json')
+    iso.add_fp(io.BytesIO(user_data), len(user_data), '/openstack/2017-02-22/user_data',
+               rr_name='user_data',
+               joliet_path='/openstack/2017-02-22/user_data.json')
+
+    iso.add_fp(io.BytesIO(nd), len(nd),
+               '/openstack/latest/network_data.json;3',
+               rr_name='network_data.json',
+               joliet_path='/openstack/latest/vendor_data.json')
+    iso.add_fp(io.BytesIO(nd), len(nd),
+               '/openstack/2017-02-22/network_data.json;4',
+               rr_name='network_data.json',
+               joliet_path='/openstack/2017-02-22/vendor_data.json')
+
+    vd = VENDOR_DATA
+    iso.add_fp(io.BytesIO(vd), len(vd),
+               '/openstack/latest/vendor_data.json;5',
+               rr_name='vendor_data.json',
+               joliet_path='/openstack/latest/vendor_data.json')
+    iso.add_fp(io.BytesIO(vd), len(vd),
+               '/openstack/2017-02-22/vendor_data.json;6',
+               rr_name='vendor_data.json',
+               joliet_path='/openstack/2017-02-22/vendor_data.json')
+    iso.add_fp(io.BytesIO(vd), len(vd),
+               '/openstack/latest/vendor_data2.json;7',
+               rr_name='vendor_data2.json',
+               joliet_path='/openstack/latest/vendor_data2.json')
+    iso.add_fp(io.BytesIO(vd), len(vd),
+               '/openstack/2017-02-22/vendor_data2.json;8',
+               rr_name='vendor_data2.json',
+               joliet_path='/openstack/2017-02-22/vendor_data2.json')
+
+    if os.path.exists(disk_path):
+        os.unlink(disk_path)
+    iso.write(disk_path)
+    iso.close()
+
+
+def _copy_into_vfat(disk_path, files):
+    # files is a dictionary of directory to a dictionary of filename to data.
+    # Each directory is written with a single mcopy.
+    with tempfile.TemporaryDirectory() as tempdir:
+        for directory, contents in files.items():
+            sources = []
+            for filename, data in contents.items():
+                source = os.path.join(tempdir, directory.replace('/', '_'), filename)
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                with open(source, 'wb') as f:
+                    f.write(data)
+                sources.append(source)
+            util_process.execute(
+                None, 'mcopy -o -i %s %s ::%s/' % (disk_path, ' '.join(sources), directory))
+
+
+def _make_vfat_skeleton(disk_path, size_kb):
+    util_process.execute(
+        None, f'mkfs.vfat -C -n {VFAT_LABEL} {disk_path} {size_kb}')
+    directories = ['/openstack'] + ['/openstack/%s' % v for v in VERSIONS]
+    util_process.execute(
+        None, 'mmd -i %s %s' % (disk_path, ' '.join('::' + d for d in directories)))
+
+    files = {}
+    for version in VERSIONS:
+        files['/openstack/%s' % version] = {
+            'vendor_data.json': VENDOR_DATA,
+            'vendor_data2.json': VENDOR_DATA
+        }
+    _copy_into_vfat(disk_path, files)
+
+
+def _vfat_skeleton_path():
+    return os.path.join(config.STORAGE_PATH, 'configdrive',
+                        'skeleton-v%d.vfat' % VFAT_SKELETON_VERSION)
+
+
+def _ensure_vfat_skeleton():
+    skeleton_path = _vfat_skeleton_path()
+    if not os.path.exists(skeleton_path):
+        # Several workers may race to create the skeleton, so each builds its
+        # own and then atomically moves it into place.
+        os.makedirs(os.path.dirname(skeleton_path), exist_ok=True)
+        fd, partial_path = tempfile.mkstemp(dir=os.path.dirname(skeleton_path))
+        os.close(fd)
+        os.unlink(partial_path)
+        try:
+            _make_vfat_skeleton(partial_path, VFAT_SIZE_KB)
+            os.rename(partial_path, skeleton_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+    return skeleton_path
+
+
+def _write_vfat(disk_path, md, user_data, nd):
+    # Leave room for filesystem overhead when deciding if the skeleton is
+    # large enough for this instance's files.
+    needed_kb = (len(md) + len(user_data) + len(nd)) * len(VERSIONS) // 1024
+    if needed_kb > VFAT_SIZE_KB // 2:
+        _make_vfat_skeleton(disk_path, needed_kb * 2)
+    else:
+        util_general.clone_file(_ensure_vfat_skeleton(), disk_path)
+
+    files = {}
+    for version in VERSIONS:
+        files['/openstack/%s' % version] = {
+            'meta_data.json': md,
+            'user_data': user_data,
+            'network_data.json': nd
+        }
+    _copy_into_vfat(disk_path, files)
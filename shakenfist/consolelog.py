@@ -0,0 +1,220 @@
+import gzip
+import json
+import os
+import time
+
+from shakenfist_utilities import logs
+
+from shakenfist import exceptions
+from shakenfist.config import config
+
+
+LOG, _ = logs.setup(__name__)
+
+
+# Instance console output is written by libvirt to console.log in the instance
+# directory. Positions in the console output are expressed as absolute byte
+# offsets from the start of the instance's life, which do not change when the
+# log is rotated. This means API clients following a console can ask for the
+# bytes after the last offset they saw, instead of re-reading the tail of the
+# log on every call.
+#
+# The recent console output on the hypervisor node is a bounded ring of two
+# files: console.log, which libvirt appends to, and console.log.previous,
+# which holds the bytes most recently rotated out of console.log. The cleaner
+# daemon rotates console.log once it exceeds CONSOLE_LOG_ROTATE_SIZE bytes, and
+# the rotated bytes are also compressed into a blob (see
+# Instance.rotate_console_log()) so that older output remains available.
+#
+# The offsets of the two files are recorded in console.state. Rotation is not
+# atomic, so the state includes a sequence number which is odd while a rotation
+# is in progress. Readers retry if the sequence number is odd, or changed while
+# they were reading, in the style of a seqlock.
+
+STATE_FILE = 'console.state'
+LOG_FILE = 'console.log'
+PREVIOUS_FILE = 'console.log.previous'
+
+READ_RETRIES = 5
+TRUNCATE_READ_ATTEMPTS = 5
+
+
+def max_wait():
+    # A waiting console data request holds an API worker on the hypervisor, and
+    # on the node which proxied the request there, so keep the wait well below
+    # the worker timeout regardless of configuration.
+    return min(config.CONSOLE_LOG_MAX_WAIT, config.API_TIMEOUT / 10)
+
+
+def compress_segment(path, data):
+    with gzip.open(path, 'wb') as f:
+        f.write(data)
+    return os.stat(path).st_size
+
+
+def decompress_segment(path):
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+class ConsoleLog:
+    def __init__(self, instance_path):
+        self.state_path = os.path.join(instance_path, STATE_FILE)
+        self.log_path = os.path.join(instance_path, LOG_FILE)
+        self.previous_path = os.path.join(instance_path, PREVIOUS_FILE)
+
+    def exists(self):
+        return os.path.exists(self.log_path)
+
+    def _read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {'sequence': 0, 'base': 0, 'previous_base': 0}
+
+    def _write_state(self, state):
+        with open(self.state_path + '.new', 'w') as f:
+            f.write(json.dumps(state))
+        os.rename(self.state_path + '.new', self.state_path)
+
+    def _size(self, path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _read_file(self, path, offset, length):
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                if length < 0:
+                    return f.read()
+                return f.read(length)
+        except FileNotFoundError:
+            return b''
+
+    def _consistent(self, func):
+        for _ in range(READ_RETRIES):
+            before = self._read_state()
+            if before['sequence'] % 2 == 0:
+                result = func(before)
+                if self._read_state()['sequence'] == before['sequence']:
+                    return result
+            time.sleep(0.05)
+        raise exceptions.ConsoleLogBusy(self.log_path)
+
+    def extent(self):
+        """Return the first and last (exclusive) offsets held on this node."""
+        def _extent(state):
+            start = state['base']
+            if os.path.exists(self.previous_path):
+                start = state['previous_base']
+            return start, state['base'] + self._size(self.log_path)
+        return self._consistent(_extent)
+
+    def read(self, offset, length=-1):
+        """Read up to length bytes from offset.
+
+        Returns the offset of the first byte returned, and the data. If offset
+        is older than the ring on this node the data starts at the oldest
+        offset which is still available.
+        """
+        def _read(state):
+            start = state['base']
+            previous_base = state['previous_base']
+            if os.path.exists(self.previous_path):
+                start = previous_base
+
+            read_from = max(offset, start)
+            data = b''
+            if read_from < state['base']:
+                data = self._read_file(
+                    self.previous_path, read_from - previous_base,
+                    length if length < 0 else min(length, state['base'] - read_from))
+
+            remaining = -1 if length < 0 else length - len(data)
+            if remaining != 0:
+                data += self._read_file(
+                    self.log_path, max(0, read_from - state['base']), remaining)
+            return read_from, data
+        return self._consistent(_read)
+
+    def tail(self, length):
+        """Read the last length bytes, or everything on this node for -1."""
+        start, end = self.extent()
+        if length < 0:
+            return self.read(start)
+        return self.read(max(start, end - length), length)
+
+    def wait(self, offset, timeout):
+        """Wait up to timeout seconds for data after offset to arrive.
+
+        Only the size of console.log is polled, so waiting is cheap. The wait
+        is limited by max_wait() however, as it holds an API worker.
+        """
+        deadline = time.time() + min(timeout, max_wait())
+        while True:
+            _, end = self.extent()
+            if end > offset or time.time() >= deadline:
+                return end
+            time.sleep(config.CONSOLE_LOG_POLL_INTERVAL)
+
+    def _truncate(self, keep_previous):
+        # The caller is responsible for excluding other rotations, for example
+        # by holding the instance console lock.
+        state = self._read_state()
+        state['sequence'] += 1
+        self._write_state(state)
+
+        try:
+            # Console output written by libvirt while we read is picked up by
+            # reading again until the file stops growing. This narrows the
+            # window where output is lost to between the final read and the
+            # truncate, instead of the time taken to read the whole log.
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+                for _ in range(TRUNCATE_READ_ATTEMPTS):
+                    more = f.read()
+                    if not more:
+                        break
+                    data += more
+                os.truncate(self.log_path, 0)
+
+            if keep_previous and data:
+                with open(self.previous_path + '.new', 'wb') as f:
+                    f.write(data)
+                os.rename(self.previous_path + '.new', self.previous_path)
+                state['previous_base'] = state['base']
+            elif os.path.exists(self.previous_path):
+                os.unlink(self.previous_path)
+                state['previous_base'] = state['base'] + len(data)
+            state['base'] += len(data)
+            return state['previous_base'], data
+
+        finally:
+            state['sequence'] += 1
+            self._write_state(state)
+
+    def needs_rotation(self, threshold):
+        return self.exists() and self._size(self.log_path) >= threshold
+
+    def rotate(self, threshold):
+        """Rotate console.log if it is larger than threshold bytes.
+
+        Returns the offset of the rotated data and the data, or (None, None)
+        if no rotation was required.
+        """
+        if not self.needs_rotation(threshold):
+            return None, None
+        return self._truncate(True)
+
+    def clear(self):
+        """Discard all console output held on this node.
+
+        Offsets are not reset, so clients following the console simply see no
+        new data until the instance writes more output.
+        """
+        if not self.exists():
+            return
+        self._truncate(False)
@@ -20,6 +20,7 @@ from shakenfist import upload
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.blob import Blob
 from shakenfist.blob import Blobs
+from shakenfist.blob import STALE_DOWNLOAD_SECONDS
 from shakenfist.config import config
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.constants import EVENT_TYPE_STATUS
@@ -282,6 +283,14 @@ class Monitor(daemon.Daemon):
             LOG.debug('Removing stale libvirt log %s' % ent)
             os.unlink(os.path.join(config.LIBVIRT_LOG_PATH, ent))
 
+    def _rotate_console_logs(self, n):
+        for inst in instance.healthy_instances_on_node(n):
+            try:
+                inst.rotate_console_log()
+            except Exception as e:
+                util_general.ignore_exception(
+                    'console log rotation for %s' % inst, e)
+
     def _maintain_blobs(self):
         # Find orphaned and deleted blobs still on disk
         blob_path = os.path.join(config.STORAGE_PATH, 'blobs')
@@ -410,6 +419,21 @@ class Monitor(daemon.Daemon):
                     'upload': upload_uuid}).info('Removing stale upload')
                 os.unlink(os.path.join(upload_path, upload_uuid))
 
+    def _remove_stale_downloads(self):
+        # Partial HTTP downloads are kept so that they can be resumed, but not
+        # forever.
+        download_path = os.path.join(config.STORAGE_PATH, 'downloads')
+        os.makedirs(download_path, exist_ok=True)
+        for ent in os.listdir(download_path):
+            entpath = os.path.join(download_path, ent)
+            try:
+                if time.time() - os.stat(entpath).st_mtime > STALE_DOWNLOAD_SECONDS:
+                    LOG.with_fields({
+                        'download': ent}).info('Removing stale partial download')
+                    os.unlink(entpath)
+            except FileNotFoundError:
+                pass
+
     def _compact_etcd(self):
         try:
             # We need to determine what revision to compact to, so we keep a
@@ -469,6 +493,11 @@ class Monitor(daemon.Daemon):
                                                 threshold=1):
                 self._maintain_blobs()
 
+            if config.NODE_IS_HYPERVISOR:
+                with util_general.RecordedOperation('rotate console logs', n,
+                                                    threshold=1):
+                    self._rotate_console_logs(n)
+
             if time.time() - last_missing_blob_check > 300:
                 with util_general.RecordedOperation('find missing blobs', n,
                                                     threshold=1):
@@ -479,6 +508,7 @@ class Monitor(daemon.Daemon):
                 with util_general.RecordedOperation('remove stale uploads', n,
                                                     threshold=1):
                     self._remove_stale_uploads()
+                    self._remove_stale_downloads()
                     last_stale_upload_check = time.time()
 
             # Perform etcd maintenance, if we are an etcd master
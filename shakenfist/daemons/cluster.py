@@ -2,7 +2,6 @@
 # urgent. Hard deleting data for example. Its therefore pretty relaxed about
 # obtaining the lock to do work et cetera. There is only one active cluster
 # maintenance daemon per cluster.
-import json
 import time
 from collections import defaultdict
 from functools import partial
@@ -11,6 +10,7 @@ import setproctitle
 from shakenfist_utilities import logs
 
 from shakenfist import artifact
+from shakenfist import baseobject
 from shakenfist import cache
 from shakenfist import etcd
 from shakenfist import instance
@@ -58,6 +58,11 @@ class Monitor(daemon.Daemon):
     def _cluster_wide_cleanup(self, last_loop_run):
         LOG.info('Running cluster maintenance')
 
+        # Publish the minimum object versions in the cluster, which every
+        # process watches to decide if online upgrades can be committed.
+        baseobject.publish_minimum_object_versions()
+        self.lock.refresh()
+
         # Recompute our cache of what blobs are on what nodes every 30 minutes
         if time.time() - last_loop_run > 1800:
             per_node = defaultdict(list)
@@ -73,6 +78,11 @@ class Monitor(daemon.Daemon):
                 node.blobs = per_node.get(node.uuid, [])
             self.lock.refresh()
 
+        # Remove expired service keys left behind by older releases
+        for ns in namespace.Namespaces([], prefilter='active'):
+            ns.remove_expired_keys()
+        self.lock.refresh()
+
         # Cleanup soft deleted objects
         for objtype in OBJECT_NAMES_TO_ITERATORS:
             for obj in OBJECT_NAMES_TO_ITERATORS[objtype]([], prefilter='deleted'):
@@ -86,8 +96,7 @@ class Monitor(daemon.Daemon):
             when = objdata.get('when')
             if not when:
                 objdata['when'] = time.time()
-                etcd.get_etcd_client().put(
-                    k, json.dumps(objdata, indent=4, sort_keys=True))
+                etcd.put_raw(k, objdata)
                 continue
 
             if time.time() - when < 300:
@@ -140,8 +149,7 @@ class Monitor(daemon.Daemon):
         fn = network.floating_network()
         releaseable = []
         with fn.ipam.get_lock('reservations', op='Delete stray reservations'):
-            for addr in fn.ipam.in_use:
-                reservation = fn.ipam.get_reservation(addr)
+            for addr, reservation in fn.ipam.reservations.items():
                 if reservation['type'] not in [ipam.RESERVATION_TYPE_GATEWAY,
                                                ipam.RESERVATION_TYPE_FLOATING,
                                                ipam.RESERVATION_TYPE_ROUTED]:
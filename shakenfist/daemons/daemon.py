@@ -1,9 +1,15 @@
 import faulthandler
 import logging
+import os
+import shutil
 import signal
 from threading import Event
 
 import setproctitle
+from prometheus_client import CollectorRegistry
+from prometheus_client import multiprocess
+from prometheus_client import REGISTRY
+from prometheus_client import start_http_server
 from shakenfist_utilities import logs
 
 from shakenfist import etcd
@@ -26,6 +32,26 @@ DAEMON_NAMES = {
     'transfers': 'sf-transfers'
 }
 
+# Daemons which do not otherwise run a metrics server export their metrics
+# (for example etcd call counts) on DAEMON_METRICS_PORT_BASE plus this offset.
+# The eventlog and resources daemons export the same metrics on their existing
+# metrics ports.
+DAEMON_METRICS_PORT_OFFSETS = {
+    'checksum': 0,
+    'cleaner': 1,
+    'cluster': 2,
+    'net': 3,
+    'queues': 4,
+    'sidechannel': 5,
+    'transfers': 6,
+    'api': 7
+}
+
+# The API is served by gunicorn worker processes, which cannot each run a
+# metrics server. Instead they record their metrics in this directory, and the
+# API daemon exports the combined values.
+API_METRICS_DIR = '/var/run/sf/api-metrics'
+
 
 def process_name(name):
     if name not in DAEMON_NAMES:
@@ -49,11 +75,33 @@ def set_log_level(log, name):
     log.setLevel(numeric_level)
 
 
+def api_metrics_registry(path):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    return registry
+
+
+def start_metrics_server(name):
+    if name not in DAEMON_METRICS_PORT_OFFSETS:
+        return
+
+    registry = REGISTRY
+    if name == 'api':
+        # Values left by a previous run of the API would be added to ours
+        shutil.rmtree(API_METRICS_DIR, ignore_errors=True)
+        os.makedirs(API_METRICS_DIR)
+        registry = api_metrics_registry(API_METRICS_DIR)
+
+    start_http_server(config.DAEMON_METRICS_PORT_BASE +
+                      DAEMON_METRICS_PORT_OFFSETS[name], registry=registry)
+
+
 class Daemon:
     def __init__(self, name):
         setproctitle.setproctitle(process_name(name))
         self.log, _ = logs.setup(name)
         set_log_level(self.log, name)
+        etcd.set_instrumentation_caller(name)
 
         self.exit = Event()
         signal.signal(signal.SIGTERM, self.exit_gracefully)
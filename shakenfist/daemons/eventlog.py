@@ -15,9 +15,11 @@ from shakenfist import event_pb2
 from shakenfist import event_pb2_grpc
 from shakenfist import eventlog
 from shakenfist import node
+from shakenfist import usage
 from shakenfist.config import config
 from shakenfist.constants import API_REQUESTS
 from shakenfist.constants import EVENT_TYPE_HISTORIC
+from shakenfist.constants import EVENT_TYPE_USAGE
 from shakenfist.constants import EVENT_TYPES
 from shakenfist.daemons import daemon
 from shakenfist.util import general as util_general
@@ -26,6 +28,18 @@ from shakenfist.util import general as util_general
 LOG, _ = logs.setup(__name__)
 
 
+def _record_usage(object_type, object_uuid, timestamp, extra):
+    # Usage events are stored in the usage store. They are only also written
+    # to the object's event log if the deployment has asked for that. The
+    # namespace is passed along in the extra data by the resources daemon.
+    extra = dict(extra or {})
+    namespace = extra.pop('namespace', None)
+    with usage.UsageStore() as store:
+        store.record(object_type, object_uuid, timestamp, extra,
+                     namespace=namespace)
+    return config.USAGE_EVENTS_IN_EVENTLOG
+
+
 class EventService(event_pb2_grpc.EventServiceServicer):
     def __init__(self, monitor):
         super().__init__()
@@ -56,7 +70,12 @@ class EventService(event_pb2_grpc.EventServiceServicer):
                         'extra': request.extra
                     }).error('Event has invalid timestamp')
 
-                if not eventdb.write_event(
+                write_to_eventlog = True
+                if request.event_type == EVENT_TYPE_USAGE:
+                    write_to_eventlog = _record_usage(
+                        request.object_type, request.object_uuid, timestamp, extra)
+
+                if write_to_eventlog and not eventdb.write_event(
                         request.event_type, timestamp, request.fqdn,
                         request.duration, request.message, extra):
                     # Write the event failed, queue it to etcd instead
@@ -108,6 +127,7 @@ class Monitor(daemon.WorkerPoolDaemon):
         LOG.info('Starting')
         prune_targets = []
         prune_sweep_started = 0
+        last_usage_maintenance = 0
 
         for event_type in EVENT_TYPES:
             self.counters[event_type] = Counter(
@@ -156,11 +176,18 @@ class Monitor(daemon.WorkerPoolDaemon):
                         with eventlog.EventLog(objtype, objuuid) as eventdb:
                             for k, v in results[(objtype, objuuid)]:
                                 event_type = v.get('event_type', EVENT_TYPE_HISTORIC)
-                                eventdb.write_event(
-                                    event_type,
-                                    v['timestamp'], v['fqdn'],
-                                    v.get('duration'),
-                                    v['message'], extra=v.get('extra'))
+                                write_to_eventlog = True
+                                if event_type == EVENT_TYPE_USAGE:
+                                    write_to_eventlog = _record_usage(
+                                        objtype, objuuid, v['timestamp'],
+                                        v.get('extra'))
+
+                                if write_to_eventlog:
+                                    eventdb.write_event(
+                                        event_type,
+                                        v['timestamp'], v['fqdn'],
+                                        v.get('duration'),
+                                        v['message'], extra=v.get('extra'))
                                 self.counters[event_type].inc()
                                 etcd.get_etcd_client().delete(k)
                     except Exception as e:
@@ -170,6 +197,20 @@ class Monitor(daemon.WorkerPoolDaemon):
                 if results:
                     did_work = True
 
+                elif time.time() - last_usage_maintenance > 300:
+                    # Seal buffered usage samples into compressed segments,
+                    # and downsample older segments.
+                    with usage.UsageStore() as store:
+                        sealed = store.compact()
+                        downsampled = store.downsample()
+                    if sealed or downsampled:
+                        self.log.with_fields({
+                            'sealed': sealed,
+                            'downsampled': downsampled
+                        }).info('Performed usage store maintenance')
+                    last_usage_maintenance = time.time()
+                    did_work = True
+
                 else:
                     # Prune old events
                     if not prune_targets:
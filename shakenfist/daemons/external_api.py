@@ -18,6 +18,11 @@ class Monitor(daemon.Daemon):
 
         present_cpus = util_libvirt.get_cpu_count()
         os.makedirs('/var/run/sf', exist_ok=True)
+
+        # Workers share their metrics through files, see start_metrics_server()
+        env = dict(os.environ)
+        env['PROMETHEUS_MULTIPROC_DIR'] = daemon.API_METRICS_DIR
+
         util_process.execute(None, (config.API_COMMAND_LINE
                                     % {
                                         'port': config.API_PORT,
@@ -26,7 +31,7 @@ class Monitor(daemon.Daemon):
                                         'workers': present_cpus * 2 + 1,
                                         'threads': present_cpus * 2 + 1
                                     }),
-                             env_variables=os.environ,
+                             env_variables=env,
                              check_exit_code=[0, 1, -15])
 
         LOG.info('Terminated')
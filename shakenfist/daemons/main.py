@@ -13,6 +13,7 @@ import psutil
 import setproctitle
 from shakenfist_utilities import logs
 
+from shakenfist import artifact
 from shakenfist import cache
 from shakenfist import config as sf_config
 from shakenfist import etcd
@@ -205,6 +206,7 @@ def main():
     # This is awkward, but let's verify our configuration before we get any
     # further.
     sf_config.verify_config()
+    etcd.set_instrumentation_caller('main')
 
     # We need to report object versions very early before the resources daemon
     # has started. This code is duplicated from the resources daemon code. Sorry.
@@ -212,6 +214,7 @@ def main():
     for obj in OBJECT_NAMES_TO_CLASSES:
         stats['object_version_%s' % obj] = \
             OBJECT_NAMES_TO_CLASSES[obj].current_version
+    stats['etcd_value_codec_version'] = etcd.VALUE_CODEC_VERSION
     etcd.put(
         'metrics', config.NODE_NAME, None,
         {
@@ -250,6 +253,12 @@ def main():
         cache_version['version'] = 2
         etcd.put_raw('/sf/cache/_version', cache_version)
 
+    # Similarly, build the artifact lookup index if it is absent.
+    if not artifact.index_ready():
+        with etcd.get_lock('index', None, 'artifact', op='Artifact index build'):
+            if not artifact.index_ready():
+                artifact.rebuild_index()
+
     # If you ran this, it means we're not shutting down any more
     n = Node.new(config.NODE_NAME, config.NODE_MESH_IP)
     n.state = Node.STATE_CREATED
@@ -1,4 +1,3 @@
-import itertools
 import os
 import signal
 import time
@@ -39,6 +38,166 @@ LOG, _ = logs.setup(__name__)
 EXTRA_VLANS_HISTORY = {}
 
 
+# A floating address must have been reserved for at least this long before it
+# is considered leaked, to ensure that the network setup isn't still queued.
+FLOATING_LEAK_MINIMUM_AGE = 300
+
+
+def _floating_address_users():
+    """Find the floating addresses which networks and interfaces expect to hold.
+
+    Returns a dictionary of address to the user and reservation type which
+    should hold it, and the set of UUIDs of networks which exist. This reads
+    the attributes of all networks and network interfaces in one pass each,
+    instead of loading each object.
+    """
+    expected = {}
+    network_uuids = set()
+
+    attributes = defaultdict(dict)
+    for object_type, wanted in [('network', ('state', 'routing')),
+                                ('networkinterface', ('state', 'floating'))]:
+        prefix = '/sf/attribute/%s/' % object_type
+        for key, data in etcd.get_prefix_paged(prefix):
+            object_uuid, _, attribute = key[len(prefix):].partition('/')
+            if attribute in wanted:
+                attributes[(object_type, object_uuid)][attribute] = \
+                    etcd.decode_value(data)
+
+    for (object_type, object_uuid), attrs in attributes.items():
+        if object_type == 'network' and attrs.get('state', {}).get('value'):
+            network_uuids.add(object_uuid)
+
+        address, reservation_type = _claimed_floating_address(object_type, attrs)
+        if address:
+            expected[address] = ((object_type, object_uuid), reservation_type)
+
+    return expected, network_uuids
+
+
+def _claimed_floating_address(object_type, attrs):
+    """Return the floating address and reservation type an object claims.
+
+    attrs are the object's state and routing or floating attributes. Objects
+    which are not active claim no address.
+    """
+    if attrs.get('state', {}).get('value') not in dbo.ACTIVE_STATES:
+        return None, None
+    if object_type == 'network':
+        return (attrs.get('routing', {}).get('floating_gateway'),
+                ipam.RESERVATION_TYPE_GATEWAY)
+    return (attrs.get('floating', {}).get('floating_address'),
+            ipam.RESERVATION_TYPE_FLOATING)
+
+
+def _current_floating_address(object_type, object_uuid):
+    attrs = {}
+    attribute = 'routing' if object_type == 'network' else 'floating'
+    for name in ('state', attribute):
+        attrs[name] = etcd.get('attribute/%s' % object_type, object_uuid,
+                               name) or {}
+    return _claimed_floating_address(object_type, attrs)[0]
+
+
+def plan_floating_ip_reconciliation(reservations, expected, network_uuids,
+                                    infrastructure, now):
+    """Compare floating IP reservations with what should be reserved.
+
+    Returns a dictionary of the addresses which should be reserved but are not,
+    to their user and reservation type, and a dictionary of leaked addresses to
+    the time they were reserved.
+    """
+    missing = {}
+    for address, user in expected.items():
+        if address not in reservations:
+            missing[address] = user
+
+    leaks = {}
+    for address, reservation in reservations.items():
+        if address in expected or address in infrastructure:
+            continue
+
+        reservation_type = reservation.get('type')
+        if reservation_type == ipam.RESERVATION_TYPE_DELETION_HALO:
+            continue
+
+        if reservation_type == ipam.RESERVATION_TYPE_ROUTED:
+            user_type, user_uuid = reservation['user']
+            if user_type != 'network':
+                LOG.with_fields(reservation).error(
+                    'Objects of type %s should not be routing floating IPs!'
+                    % user_type)
+            elif user_uuid in network_uuids:
+                continue
+            else:
+                LOG.with_fields(reservation).error(
+                    'Routed IP reserved by missing network')
+
+        when = reservation.get('when', now)
+        if now - when > FLOATING_LEAK_MINIMUM_AGE:
+            leaks[address] = when
+
+    return missing, leaks
+
+
+def reconcile_floating_ips():
+    """Ensure floating IP reservations match the objects using floating IPs.
+
+    The reservations, networks and network interfaces are each read once and
+    compared without holding any locks. Only the resulting changes are made
+    while holding the floating ipmanager lock, and each is rechecked against
+    the current reservation or owner first, so that floating IP API calls are not
+    stalled by the comparison.
+    """
+    floating_network = network.floating_network()
+    reservations = floating_network.ipam.reservations
+    expected, network_uuids = _floating_address_users()
+    infrastructure = {
+        floating_network.ipam.get_address_at_index(0),
+        floating_network.ipam.get_address_at_index(1),
+        floating_network.ipam.broadcast_address,
+        floating_network.ipam.network_address
+    }
+    missing, leaks = plan_floating_ip_reconciliation(
+        reservations, expected, network_uuids, infrastructure, time.time())
+    LOG.with_fields({
+        'reservations': len(reservations),
+        'expected': len(expected),
+        'missing': len(missing),
+        'leaks': len(leaks)
+    }).info('Compared floating IP reservations')
+
+    if not missing and not leaks:
+        return
+
+    with etcd.get_lock('ipmanager', None, 'floating', ttl=120,
+                       op='Cleanup leaks'):
+        for address, (user, reservation_type) in missing.items():
+            # The owner may have released the address, or been deleted, since
+            # the comparison. Owners release the reservation before clearing
+            # their address, so a release still in progress can be rescued
+            # here, but that reservation is then found as a leak later.
+            if _current_floating_address(*user) != address:
+                continue
+            if floating_network.ipam.reserve(
+                    address, user, reservation_type,
+                    'Rescued from incorrect registration'):
+                LOG.with_fields({
+                    user[0]: user[1],
+                    'address': address
+                }).error('Floating address not reserved correctly')
+
+        for address, when in leaks.items():
+            # Only release the reservation we saw, not one made since.
+            reservation = floating_network.ipam.get_reservation(address)
+            if not reservation or reservation.get('when') != when:
+                continue
+            if reservation.get('type') == ipam.RESERVATION_TYPE_DELETION_HALO:
+                continue
+            floating_network.ipam.release(address)
+            LOG.error('Leaked floating IP %s has been released.' % address)
+
+
 class Monitor(daemon.WorkerPoolDaemon):
     def _remove_stray_interfaces(self):
         last_loop = 0
@@ -386,101 +545,7 @@ class Monitor(daemon.WorkerPoolDaemon):
                 continue
 
             last_loop = time.time()
-
-            # Ensure we haven't leaked any floating IPs (because we used to). We
-            # have to hold a lock here to avoid races where an IP is freed while
-            # we're iterating through the loop. Note that this means we can't call
-            # anything which also wants to lock the ipmanager.
-            with etcd.get_lock('ipmanager', None, 'floating', ttl=120,
-                               op='Cleanup leaks'):
-                floating_network = network.floating_network()
-                LOG.debug('Floating network registrations: %s'
-                          % floating_network.ipam.in_use)
-
-                # Collect floating gateways and floating IPs, while ensuring that
-                # they are correctly reserved on the floating network as well.
-                floating_gateways = []
-                for n in network.Networks([], prefilter='active'):
-                    fg = n.floating_gateway
-                    if fg:
-                        floating_gateways.append(fg)
-                        if floating_network.ipam.is_free(fg):
-                            floating_network.ipam.reserve(
-                                fg, n.unique_label(), ipam.RESERVATION_TYPE_GATEWAY,
-                                'Rescued from incorrect registration')
-                            LOG.with_fields({
-                                'network': n.uuid,
-                                'address': fg
-                            }).error('Floating gateway not reserved correctly')
-                LOG.info('Found floating gateways: %s' % floating_gateways)
-
-                floating_addresses = []
-                for ni in networkinterface.NetworkInterfaces([], prefilter='active'):
-                    fa = ni.floating.get('floating_address')
-                    if fa:
-                        floating_addresses.append(fa)
-                        if floating_network.ipam.is_free(fa):
-                            floating_network.ipam.reserve(
-                                fg, n.unique_label(), ipam.RESERVATION_TYPE_FLOATING,
-                                'Rescued from incorrect registration')
-                            LOG.with_fields({
-                                'networkinterface': ni.uuid,
-                                'address': fa
-                            }).error('Floating address not reserved correctly')
-                LOG.info('Found floating addresses: %s' % floating_addresses)
-
-                floating_routed = []
-                for addr in floating_network.ipam.in_use:
-                    reservation = floating_network.ipam.get_reservation(addr)
-                    if not reservation:
-                        continue
-                    if reservation.get('type') != ipam.RESERVATION_TYPE_ROUTED:
-                        continue
-                    user_type, user_uuid = reservation['user']
-                    if user_type != 'network':
-                        LOG.with_fields(reservation).error(
-                            'Objects of type %s should not be routing floating IPs!'
-                            % user_type)
-                        continue
-
-                    n = network.Network.from_db(user_uuid)
-                    if not n:
-                        LOG.with_fields(reservation).error(
-                            'Routed IP reserved by missing network')
-                        continue
-
-                    floating_routed.append(addr)
-                LOG.info('Found routed addresses: %s' % floating_routed)
-
-                floating_reserved = [
-                    floating_network.ipam.get_address_at_index(0),
-                    floating_network.ipam.get_address_at_index(1),
-                    floating_network.ipam.broadcast_address,
-                    floating_network.ipam.network_address
-                ]
-                LOG.info('Found floating reservations: %s' % floating_reserved)
-
-                floating_halo = list(floating_network.ipam.get_haloed_addresses())
-                LOG.info('Found floating deletion halos: %s' % floating_halo)
-
-                # Now the reverse check. Test if there are any reserved IPs which
-                # are not actually in use. Free any we find.
-                leaks = []
-                for ip in floating_network.ipam.in_use:
-                    if ip not in itertools.chain(floating_gateways,
-                                                 floating_addresses,
-                                                 floating_routed,
-                                                 floating_reserved,
-                                                 floating_halo):
-                        # This IP needs to have been allocated more than 300 seconds
-                        # ago to ensure that the network setup isn't still queued.
-                        if time.time() - floating_network.ipam.get_allocation_age(ip) > 300:
-                            LOG.error('Floating IP %s has leaked.' % ip)
-                            leaks.append(ip)
-
-                for ip in leaks:
-                    LOG.error('Leaked floating IP %s has been released.' % ip)
-                    floating_network.ipam.release(ip)
+            reconcile_floating_ips()
 
     def _validate_mtus(self):
         last_loop = 0
@@ -1,9 +1,11 @@
+import multiprocessing
 import os
 import time
 import uuid
 
 import requests
 import setproctitle
+from prometheus_client import Histogram
 from shakenfist_utilities import logs
 
 from shakenfist import blob
@@ -13,6 +15,7 @@ from shakenfist import images
 from shakenfist import instance
 from shakenfist import network
 from shakenfist import networkinterface
+from shakenfist import portallocator
 from shakenfist import scheduler
 from shakenfist.agentoperation import AgentOperation
 from shakenfist.artifact import Artifact
@@ -22,6 +25,7 @@ from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.constants import EVENT_TYPE_STATUS
 from shakenfist.daemons import daemon
 from shakenfist.tasks import ArchiveTranscodeTask
+from shakenfist.tasks import ConsolidateSnapshotTask
 from shakenfist.tasks import DeleteInstanceTask
 from shakenfist.tasks import DeleteNetworkWhenClean
 from shakenfist.tasks import DestroyNetworkTask
@@ -39,12 +43,27 @@ from shakenfist.tasks import SnapshotTask
 from shakenfist.tasks import StartInstanceTask
 from shakenfist.util import general as util_general
 from shakenfist.util import libvirt as util_libvirt
-from shakenfist.util import process as util_process
 
 
 LOG, _ = logs.setup(__name__)
 
 
+# Workers are short lived processes which are never scraped, so they pass the
+# start profiles of the instances they start back to the queues daemon, which
+# exports them.
+START_PROFILES = multiprocessing.SimpleQueue()
+
+INSTANCE_START_SECONDS = Histogram(
+    'instance_start_seconds', 'Time taken to start an instance on a hypervisor',
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+INSTANCE_START_PHASE_SECONDS = Histogram(
+    'instance_start_phase_seconds', 'Time taken by each phase of instance start',
+    ['phase'], buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+
+# How often, in seconds, snapshot progress is written to the artifact.
+SNAPSHOT_PROGRESS_INTERVAL = 5
+
+
 def handle(queue_name, jobname, workitem):
     libvirt = util_libvirt.get_libvirt()
 
@@ -78,6 +97,7 @@ def handle(queue_name, jobname, workitem):
                 log = log.with_fields({'instance': inst})
 
             log.with_fields({'task_name': task.name()}).info('Starting task')
+            etcd.set_instrumentation_task(task.name())
 
             if isinstance(task, FetchImageTask):
                 n = task.namespace()
@@ -118,7 +138,10 @@ def handle(queue_name, jobname, workitem):
 
             elif isinstance(task, SnapshotTask):
                 snapshot(inst, task.disk(), task.artifact_uuid(), task.blob_uuid(),
-                         task.thin())
+                         task.thin(), incremental=task.incremental())
+
+            elif isinstance(task, ConsolidateSnapshotTask):
+                consolidate_snapshot(task.artifact_uuid(), task.blob_uuids())
 
             elif isinstance(task, DeleteNetworkWhenClean):
                 # This is a historical concept, it turns out the network node
@@ -176,15 +199,19 @@ def handle(queue_name, jobname, workitem):
                     if b:
                         transcode_blob_uuid = str(uuid.uuid4())
                         transcode_blob_path = blob.Blob.filepath(transcode_blob_uuid)
-                        util_process.execute(
-                            [], f'cp {task.cache_path()} {transcode_blob_path}')
+                        method = util_general.clone_file(
+                            task.cache_path(), transcode_blob_path)
                         st = os.stat(transcode_blob_path)
+                        b.add_event(
+                            EVENT_TYPE_AUDIT, 'archived transcode',
+                            extra={'transcode_blob_uuid': transcode_blob_uuid,
+                                   'method': method})
 
                         transcode_blob = blob.Blob.new(
                             transcode_blob_uuid, st.st_size, time.time(), time.time())
                         transcode_blob.state = blob.Blob.STATE_CREATED
                         transcode_blob.observe()
-                        transcode_blob.verify_checksum(locks=[])
+                        transcode_blob.verify_checksum(hash=task.sha512(), locks=[])
                         transcode_blob.request_replication()
                         log.with_fields({
                             'blob': b,
@@ -237,8 +264,15 @@ def handle(queue_name, jobname, workitem):
             inst.enqueue_delete_due_error('Failed queue task: %s' % e)
 
     finally:
+        etcd.set_instrumentation_task(None)
         etcd.resolve(queue_name, jobname)
 
+        # Queue workers are short lived and never scraped, so log a summary
+        # of the etcd calls made while processing this workitem instead.
+        log.with_fields({'etcd_calls': etcd.get_instrumentation_summary()}).info(
+            'Workitem etcd usage')
+        etcd.reset_instrumentation()
+
 
 def image_fetch(url, namespace, inst):
     a = Artifact.from_url(Artifact.TYPE_IMAGE, url, namespace=namespace,
@@ -330,8 +364,9 @@ def instance_start(inst, netdescs):
 
     with inst.get_lock(ttl=900, op='Instance start', global_scope=False):
         try:
-            # Ensure networks are connected to this node
+            # Check the networks we need are usable
             iface_uuids = []
+            networks = []
             for netdesc in netdescs:
                 iface_uuids.append(netdesc['iface_uuid'])
                 n = network.Network.from_db(netdesc['network_uuid'])
@@ -362,16 +397,22 @@ def instance_start(inst, netdescs):
                     return
 
                 ni.state = dbo.STATE_CREATED
-                n.create_on_hypervisor()
-                n.ensure_mesh()
-                n.update_dnsmasq()
+                networks.append(n)
 
-            # Allocate console and VDI ports
-            inst.allocate_instance_ports()
+            # Ensure networks are connected to this node. This happens
+            # concurrently with preparing the instance's disks, but must be
+            # complete before the instance is powered on.
+            def _plumb_networks():
+                for n in networks:
+                    n.create_on_hypervisor()
+                    n.ensure_mesh()
+                    n.update_dnsmasq()
 
             # Now we can start the instance
             with util_general.RecordedOperation('instance creation', inst):
-                inst.create(iface_uuids)
+                start_profile = inst.create(
+                    iface_uuids, prerequisites={'networks': _plumb_networks})
+            START_PROFILES.put(start_profile)
 
         except exceptions.InvalidStateException as e:
             # This instance is in an error or deleted state. Given the check
@@ -442,14 +483,45 @@ def instance_delete(inst):
                 n.delete_on_hypervisor()
 
 
-def snapshot(inst, disk, artifact_uuid, blob_uuid, thin=False):
+def snapshot(inst, disk, artifact_uuid, blob_uuid, thin=False, incremental=False):
     a = Artifact.from_db(artifact_uuid)
     if a.state.value == Artifact.STATE_DELETED:
         # The artifact was deleted before the queued blob creation occurred
         return
 
+    # An incremental snapshot is taken against the most recent version of the
+    # artifact. If there is no previous version, the snapshot is a normal one.
+    incremental_from = None
+    if incremental:
+        previous = blob.Blob.from_db(a.most_recent_index.get('blob_uuid'))
+        if previous and previous.state.value == blob.Blob.STATE_CREATED:
+            incremental_from = previous.uuid
+
+    # Record progress whenever the phase changes, and otherwise only
+    # occasionally, so that large snapshots do not hammer etcd.
+    last_progress = {'phase': None, 'at': 0}
+
+    def progress(phase, done, total):
+        now = time.time()
+        if (phase == last_progress['phase'] and
+                now - last_progress['at'] < SNAPSHOT_PROGRESS_INTERVAL):
+            return
+        last_progress['phase'] = phase
+        last_progress['at'] = now
+        a.set_progress(blob_uuid, phase, done, total)
+
     try:
-        b = blob.snapshot_disk(disk, blob_uuid, thin=thin)
+        try:
+            b = blob.snapshot_disk(disk, blob_uuid, thin=thin,
+                                   progress_callback=progress,
+                                   incremental_from=incremental_from)
+        except exceptions.BlobDependencyMissing as e:
+            if not incremental_from:
+                raise
+            LOG.with_fields({'artifact': a, 'previous': incremental_from}).warning(
+                'Cannot take incremental snapshot, taking a full snapshot: %s' % e)
+            b = blob.snapshot_disk(disk, blob_uuid, thin=thin,
+                                   progress_callback=progress)
     except exceptions.BlobDependencyMissing:
         return
 
@@ -468,6 +540,7 @@ def snapshot(inst, disk, artifact_uuid, blob_uuid, thin=False):
     try:
         a.add_index(b.uuid)
         a.state = Artifact.STATE_CREATED
+        a.set_progress(blob_uuid, 'created', b.size, b.size)
     except exceptions.BlobDeleted:
         if a.state.value != Artifact.STATE_DELETED:
             a.state = Artifact.STATE_ERROR
@@ -475,6 +548,57 @@ def snapshot(inst, disk, artifact_uuid, blob_uuid, thin=False):
         b.ref_count_dec(a)
 
 
+def consolidate_snapshot(artifact_uuid, pruned_blob_uuids):
+    """Rewrite the versions of a snapshot artifact which depend on pruned versions.
+
+    The oldest remaining version has the data of the pruned versions it
+    depends on merged into it. Later versions are then pointed at their
+    rewritten predecessors, which is a change to their qcow2 headers only.
+    Each rewrite is a new blob, and the replaced blobs and pruned versions are
+    freed by reference counting as the artifact stops using them.
+    """
+    a = Artifact.from_db(artifact_uuid)
+    if not a or a.state.value == Artifact.STATE_DELETED:
+        return
+
+    log = LOG.with_fields({'artifact': a})
+    pruned_blob_uuids = set(pruned_blob_uuids)
+    replacements = {}
+    for idx in sorted(a.get_all_indexes(), key=lambda i: i['index']):
+        b = blob.Blob.from_db(idx['blob_uuid'])
+        if not b or not b.depends_on:
+            continue
+
+        if b.depends_on in replacements:
+            new_blob = blob.rebase_snapshot(
+                b, replacements[b.depends_on], unsafe=True, related_object=a)
+
+        elif b.depends_on in pruned_blob_uuids:
+            # Merge all the pruned versions we depend on into this version.
+            backing_uuid = b.depends_on
+            while backing_uuid in pruned_blob_uuids:
+                backing_blob = blob.Blob.from_db(backing_uuid)
+                if not backing_blob:
+                    raise exceptions.BlobDependencyMissing(backing_uuid)
+                backing_uuid = backing_blob.depends_on
+            new_blob = blob.rebase_snapshot(
+                b, backing_uuid, related_object=a)
+
+        else:
+            continue
+
+        if not a.replace_index_blob(idx['index'], b.uuid, new_blob.uuid):
+            # Someone else changed this version while we were working on it.
+            log.with_fields({'index': idx['index']}).info(
+                'Artifact version changed during consolidation, stopping')
+            new_blob.state = blob.Blob.STATE_DELETED
+            return
+        replacements[b.uuid] = new_blob.uuid
+
+    log.with_fields({'replacements': replacements}).info(
+        'Consolidated snapshot versions')
+
+
 def preflight_agent_operation(agentop_uuid):
     agentop = AgentOperation.from_db(agentop_uuid)
     if not agentop:
@@ -495,12 +619,26 @@ def preflight_agent_operation(agentop_uuid):
 
 
 class Monitor(daemon.WorkerPoolDaemon):
+    def _record_start_profiles(self):
+        while not START_PROFILES.empty():
+            start_profile = START_PROFILES.get()
+            for phase, timing in start_profile['phases'].items():
+                INSTANCE_START_PHASE_SECONDS.labels(phase).observe(
+                    timing['duration'])
+            INSTANCE_START_SECONDS.observe(start_profile['total'])
+
     def run(self):
         LOG.info('Starting')
 
+        # Workers are forked from this process, so keeping the console port
+        # bitmap current here means workers rarely need to read it from etcd.
+        if config.NODE_IS_HYPERVISOR:
+            portallocator.get_allocator().start_watching()
+
         while not self.exit.is_set():
             try:
                 self.reap_workers()
+                self._record_start_profiles()
 
                 if not self.exit.is_set():
                     if not self.dequeue_work_item(config.NODE_NAME, handle):
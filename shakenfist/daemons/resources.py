@@ -207,6 +207,7 @@ class Monitor(daemon.Daemon):
             for obj in OBJECT_NAMES_TO_CLASSES:
                 retval['object_version_%s' % obj] = \
                     OBJECT_NAMES_TO_CLASSES[obj].current_version
+            retval['etcd_value_codec_version'] = etcd.VALUE_CODEC_VERSION
 
             # How much CPU time have the various SF components consumed since restart?
             # We only traverse two layers here, so its not worth doing something
@@ -369,6 +370,9 @@ class Monitor(daemon.Daemon):
                             except FileNotFoundError:
                                 ...
 
+                            # The usage store on the eventlog node groups
+                            # usage by namespace for billing exports.
+                            statistics['namespace'] = inst.namespace
                             inst.add_event(
                                 EVENT_TYPE_USAGE, 'usage', extra=statistics,
                                 suppress_event_logging=True)
@@ -387,9 +391,10 @@ class Monitor(daemon.Daemon):
 
                 interface = 'egr-%06x-o' % n.vxid
                 try:
+                    statistics = util_network.get_interface_statistics(interface) or {}
+                    statistics['namespace'] = n.namespace
                     n.add_event(
-                        EVENT_TYPE_USAGE, 'usage',
-                        extra=util_network.get_interface_statistics(interface),
+                        EVENT_TYPE_USAGE, 'usage', extra=statistics,
                         suppress_event_logging=True)
                 except exceptions.NoInterfaceStatistics as e:
                     LOG.with_fields({'network': n}).info(
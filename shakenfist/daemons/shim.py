@@ -5,6 +5,7 @@ import sys
 from shakenfist.daemons import checksums as checksums_daemon
 from shakenfist.daemons import cleaner as cleaner_daemon
 from shakenfist.daemons import cluster as cluster_daemon
+from shakenfist.daemons import daemon
 from shakenfist.daemons import eventlog as eventlog_daemon
 from shakenfist.daemons import external_api as external_api_daemon
 from shakenfist.daemons import net as net_daemon
@@ -30,4 +31,6 @@ DAEMON_IMPLEMENTATIONS = {
 
 def main():
     d = sys.argv[1]
-    DAEMON_IMPLEMENTATIONS[d].Monitor(d).run()
+    m = DAEMON_IMPLEMENTATIONS[d].Monitor(d)
+    daemon.start_metrics_server(d)
+    m.run()
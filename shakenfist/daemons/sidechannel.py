@@ -2,6 +2,7 @@ import base64
 import os
 import select
 import signal
+import threading
 import time
 import uuid
 
@@ -30,6 +31,10 @@ LOG, _ = logs.setup(__name__)
 # generally gets bumped when the protocol changes.
 MINIMUM_AGENT_VERSION = '0.3.16'
 
+# How long to wait for a change to an instance's agent operation queue before
+# checking the queue anyway.
+AGENTOP_WATCH_TIMEOUT = 60
+
 
 class ConnectionFailed(Exception):
     ...
@@ -303,6 +308,25 @@ class Monitor(daemon.Daemon):
 
         os.unlink(blob_path + '.partial')
 
+    def _watch_agent_operations(self):
+        revision = 0
+        while not self.exit.is_set():
+            try:
+                changed = self.instance.agent_operation_wait(
+                    AGENTOP_WATCH_TIMEOUT, start_revision=revision)
+                if changed:
+                    revision = changed + 1
+            except Exception as e:
+                # Most likely the revision we were watching from has been
+                # compacted away, so start again from now.
+                util_general.ignore_exception('agent operation watch', e)
+                revision = 0
+                time.sleep(1)
+
+            # We also wake up on a timeout, so that a missed watch event does
+            # not leave an operation queued forever.
+            self.agentop_wakeup.set()
+
     def single_instance_monitor(self, instance_uuid):
         setproctitle.setproctitle('sf-sidechannel-%s' % instance_uuid)
 
@@ -398,6 +422,14 @@ class Monitor(daemon.Daemon):
             while not self.exit.is_set():
                 time.sleep(1)
 
+        # Only look for queued agent operations when the queue changes, instead
+        # of reading it from etcd every time around the loop.
+        self.agentop_wakeup = threading.Event()
+        self.agentop_wakeup.set()
+        watcher = threading.Thread(target=self._watch_agent_operations,
+                                   daemon=True)
+        watcher.start()
+
         # Spin reading packets and responding until we see an error or are asked
         # to exit.
         try:
@@ -407,10 +439,14 @@ class Monitor(daemon.Daemon):
                         'Unexpected sidechannel client packet')
 
                 # If idle, try to do something
-                if self.instance_ready in [constants.AGENT_READY,
-                                           constants.AGENT_READY_DEGRADED]:
+                if (self.instance_ready in [constants.AGENT_READY,
+                                            constants.AGENT_READY_DEGRADED]
+                        and self.agentop_wakeup.is_set()):
+                    self.agentop_wakeup.clear()
                     agentop = self.instance.agent_operation_dequeue()
                     if agentop:
+                        # There might be more operations queued behind this one
+                        self.agentop_wakeup.set()
                         self.instance.add_event(
                             EVENT_TYPE_AUDIT, 'dequeued agent operation',
                             extra={'agentoperation': agentop.uuid})
@@ -1,16 +1,25 @@
 import json
 import os
+import queue
 import threading
 import time
+import traceback
 from collections import defaultdict
 
+import msgpack
 import psutil
 import requests
 from etcd3gw.client import Etcd3Client
+from etcd3gw.exceptions import Etcd3Exception
 from etcd3gw.exceptions import InternalServerError
+from etcd3gw.exceptions import WatchTimedOut
 from etcd3gw.lock import Lock
+from etcd3gw.utils import _decode
 from etcd3gw.utils import _encode
 from etcd3gw.utils import _increment_last_byte
+from etcd3gw.watch import Watcher
+from prometheus_client import Counter
+from prometheus_client import Histogram
 from shakenfist_utilities import logs
 from shakenfist_utilities import random as util_random
 
@@ -24,6 +33,201 @@ from shakenfist.util import callstack as util_callstack
 
 LOG, _ = logs.setup(__name__)
 LOCK_PREFIX = '/sflocks'
+LOCK_WAITER_PREFIX = '/sflockwaiters'
+
+# How long to wait on a watch before checking the state of a lock queue again.
+# Watches normally fire well before this, but we need to refresh the lease on
+# our waiter key and we don't want to rely on never missing an event.
+LOCK_WATCH_INTERVAL = 5
+
+LOCK_WAIT_SECONDS = Histogram(
+    'etcd_lock_wait_seconds', 'Time spent waiting to acquire locks', ['lock'])
+LOCK_HOLD_SECONDS = Histogram(
+    'etcd_lock_hold_seconds', 'Time locks were held for', ['lock'])
+LOCK_CONTENDED = Counter(
+    'etcd_lock_contended', 'Lock acquisitions which had to wait for another holder',
+    ['lock'])
+LOCK_TIMEOUTS = Counter(
+    'etcd_lock_timeouts', 'Lock acquisitions which timed out', ['lock'])
+
+
+# Instrumentation of etcd calls. Every call to etcd passes through
+# WrappedEtcdClient.post(), so we record calls there, labelled by the type of
+# operation, the object type prefix of the key being operated on, and the
+# daemon (and optionally queue task) making the call. Daemons export these
+# counters via their prometheus metrics endpoint.
+INSTRUMENTATION_LABELS = ['operation', 'prefix', 'caller']
+ETCD_CALLS = Counter(
+    'etcd_calls', 'Number of etcd calls', INSTRUMENTATION_LABELS)
+ETCD_CALL_SECONDS = Counter(
+    'etcd_call_seconds', 'Time spent waiting for etcd calls',
+    INSTRUMENTATION_LABELS)
+ETCD_CALL_BYTES = Counter(
+    'etcd_call_bytes', 'Size of values sent to and received from etcd',
+    INSTRUMENTATION_LABELS)
+ETCD_CALL_LATENCY = Histogram(
+    'etcd_call_latency_seconds', 'Latency of etcd calls', ['operation'])
+
+# Per process totals, used for summaries from short lived processes which
+# are never scraped, such as queue workers.
+INSTRUMENTATION_CALLER = 'unknown'
+INSTRUMENTATION_TOTALS = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'bytes': 0})
+
+# Key prefixes where the next path element is also an object type
+NESTED_PREFIXES = ['attribute', 'cache', 'event']
+
+
+def set_instrumentation_caller(name):
+    global INSTRUMENTATION_CALLER
+    INSTRUMENTATION_CALLER = name
+
+
+def set_instrumentation_task(name):
+    # Attribute etcd calls made by this thread to a specific task as well as
+    # the daemon. Pass None to clear.
+    local.instrumentation_task = name
+
+
+def reset_instrumentation():
+    INSTRUMENTATION_TOTALS.clear()
+
+
+def get_instrumentation_summary():
+    out = {}
+    for (operation, prefix, caller), totals in INSTRUMENTATION_TOTALS.items():
+        out[f'{operation} {prefix}'] = {
+            'count': totals['count'],
+            'seconds': round(totals['seconds'], 3),
+            'bytes': totals['bytes']
+        }
+    return out
+
+
+def _key_prefix(key):
+    # Reduce a key like /sf/attribute/instance/...uuid.../state to the object
+    # type portion of the key, in this case attribute/instance.
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', errors='replace')
+
+    elements = key.split('/')
+    if len(elements) < 3:
+        return 'other'
+    if elements[1] in [LOCK_PREFIX[1:], LOCK_WAITER_PREFIX[1:]]:
+        kind = 'locks' if elements[1] == LOCK_PREFIX[1:] else 'lockwaiters'
+        elements = elements[1:]
+        if len(elements) < 3 or elements[1] != 'sf':
+            return kind
+        return '%s/%s' % (kind, elements[2])
+    if elements[1] != 'sf':
+        return 'other'
+    if elements[2] in NESTED_PREFIXES and len(elements) > 3:
+        return '%s/%s' % (elements[2], elements[3])
+    return elements[2]
+
+
+def _classify_call(url, kwargs):
+    # Determine the operation, the key it applies to, and the size of the
+    # values being sent, from the arguments to WrappedEtcdClient.post().
+    path = url.split('/v3beta/')[-1].split('/v3/')[-1]
+    payload = kwargs.get('json')
+    if payload is None and 'data' in kwargs:
+        try:
+            payload = json.loads(kwargs['data'])
+        except (TypeError, ValueError):
+            payload = {}
+    if payload is None:
+        payload = {}
+
+    if path == 'kv/range':
+        operation = 'get_prefix' if payload.get('range_end') else 'get'
+        return operation, payload.get('key', ''), 0
+    if path == 'kv/put':
+        return 'put', payload.get('key', ''), len(payload.get('value', ''))
+    if path == 'kv/deleterange':
+        operation = 'delete_prefix' if payload.get('range_end') else 'delete'
+        return operation, payload.get('key', ''), 0
+    if path == 'kv/txn':
+        compare = payload.get('compare', [])
+        success = payload.get('success', [])
+        key = ''
+        if compare:
+            key = compare[0].get('key', '')
+        elif success:
+            key = list(success[0].values())[0].get('key', '')
+
+        size = 0
+        for op in success:
+            size += len(op.get('request_put', {}).get('value', ''))
+
+        operation = 'txn'
+        if compare and compare[0].get('target') == 'CREATE' and success:
+            if 'lease' in success[0].get('request_put', {}):
+                operation = 'lock_acquire'
+            else:
+                operation = 'create'
+        elif (compare and compare[0].get('target') == 'VALUE' and success and
+              'request_delete_range' in success[0]):
+            operation = 'lock_release'
+        return operation, key, size
+    return path.replace('/', '_'), None, 0
+
+
+def _result_size(result):
+    size = 0
+    if isinstance(result, dict):
+        for kv in result.get('kvs', []):
+            size += len(kv.get('value', ''))
+        for response in result.get('responses', []):
+            for kv in response.get('response_range', {}).get('kvs', []):
+                size += len(kv.get('value', ''))
+    return size
+
+
+def _stack_summary():
+    frames = []
+    for frame in traceback.extract_stack()[:-3]:
+        if frame.filename.endswith('/etcd.py') or '/etcd3gw/' in frame.filename:
+            continue
+        frames.append('%s:%d:%s()' % (os.path.basename(frame.filename),
+                                      frame.lineno, frame.name))
+    return ' <- '.join(reversed(frames[-6:]))
+
+
+def _record_call(url, kwargs, result, duration):
+    operation, key, size = _classify_call(url, kwargs)
+    if key is None:
+        prefix = operation.split('_')[0]
+    else:
+        try:
+            prefix = _key_prefix(_decode(key)) if key else 'other'
+        except ValueError:
+            prefix = 'other'
+    size += _result_size(result)
+
+    caller = INSTRUMENTATION_CALLER
+    task = getattr(local, 'instrumentation_task', None)
+    if task:
+        caller = f'{caller}/{task}'
+
+    ETCD_CALLS.labels(operation, prefix, caller).inc()
+    ETCD_CALL_SECONDS.labels(operation, prefix, caller).inc(duration)
+    ETCD_CALL_BYTES.labels(operation, prefix, caller).inc(size)
+    ETCD_CALL_LATENCY.labels(operation).observe(duration)
+
+    totals = INSTRUMENTATION_TOTALS[(operation, prefix, caller)]
+    totals['count'] += 1
+    totals['seconds'] += duration
+    totals['bytes'] += size
+
+    if config.ETCD_SLOW_CALL_THRESHOLD and duration > config.ETCD_SLOW_CALL_THRESHOLD:
+        LOG.with_fields({
+            'operation': operation,
+            'prefix': prefix,
+            'caller': caller,
+            'duration': '%.03f' % duration,
+            'bytes': size,
+            'stack': _stack_summary()
+        }).warning('Slow etcd call')
 
 
 class WrappedEtcdClient(Etcd3Client):
@@ -68,9 +272,81 @@ class WrappedEtcdClient(Etcd3Client):
                         sort_target=sort_target,
                         limit=limit)
 
+    # Read a single page of a key range in key order. Returns the values with
+    # metadata, the revision the read was performed at, and whether more keys
+    # remain. Passing the revision from the first page to later pages gives a
+    # consistent view of the keyspace across all pages.
+    def get_range_page(self, key, range_end, limit=0, revision=0):
+        payload = {
+            'key': _encode(key),
+            'range_end': _encode(range_end),
+            'sort_order': 1,    # ascend
+            'sort_target': 0,   # key
+            'limit': limit
+        }
+        if revision:
+            payload['revision'] = revision
+        try:
+            result = self.post(self.get_url('/kv/range'), json=payload)
+        except Etcd3Exception as e:
+            # etcd will not read at a revision older than its last compaction,
+            # retrying will never succeed so tell the caller instead.
+            if revision and 'compacted' in str(e.detail_text):
+                raise exceptions.RevisionCompacted(
+                    'etcd revision %d has been compacted' % revision) from e
+            raise
+
+        kvs = []
+        for item in result.get('kvs', []):
+            item['key'] = _decode(item['key'])
+            kvs.append((_decode(item.pop('value', '')), item))
+        return kvs, int(result['header']['revision']), result.get('more', False)
+
+    # Read keys in a range in the order they were created, optionally only
+    # those created at or after a given revision. Returns the values with
+    # metadata, and the revision the read was performed at.
+    def get_range_by_create(self, key, range_end, limit=0, min_create_revision=0):
+        payload = {
+            'key': _encode(key),
+            'range_end': _encode(range_end),
+            'sort_order': 'ASCEND',
+            'sort_target': 'CREATE',
+            'limit': limit
+        }
+        if min_create_revision:
+            payload['min_create_revision'] = min_create_revision
+        result = self.post(self.get_url('/kv/range'), json=payload)
+
+        kvs = []
+        for item in result.get('kvs', []):
+            item['key'] = _decode(item['key'])
+            kvs.append((_decode(item.pop('value', '')), item))
+        return kvs, int(result['header']['revision'])
+
+    # Count the keys in a range without fetching them. Returns the count, and
+    # the revision the read was performed at.
+    def count_range(self, key, range_end):
+        payload = {
+            'key': _encode(key),
+            'range_end': _encode(range_end),
+            'count_only': True
+        }
+        result = self.post(self.get_url('/kv/range'), json=payload)
+        return int(result.get('count', 0)), int(result['header']['revision'])
+
     # Wrap post() to retry on errors. These errors are caused by our long lived
-    # connections sometimes being dropped.
+    # connections sometimes being dropped. This is also where calls are
+    # instrumented.
     def post(self, *args, **kwargs):
+        start_time = time.time()
+        result = self._post_with_retry(*args, **kwargs)
+        try:
+            _record_call(args[0], kwargs, result, time.time() - start_time)
+        except Exception as e:
+            LOG.debug('Failed to record etcd call instrumentation: %s' % e)
+        return result
+
+    def _post_with_retry(self, *args, **kwargs):
         try:
             return super().post(*args, **kwargs)
         except Exception as e:
@@ -89,6 +365,7 @@ class WrappedEtcdClient(Etcd3Client):
 # This module stores some state in thread local storage.
 local = threading.local()
 local.sf_etcd_client = None
+local.instrumentation_task = None
 
 
 def get_etcd_client():
@@ -126,6 +403,12 @@ def retry_etcd_forever(func):
 
 
 class ActualLock(Lock):
+    # Waiters queue for a lock by creating a key under LOCK_WAITER_PREFIX. The
+    # waiter with the lowest create revision is at the head of the queue and
+    # attempts to acquire the lock, the others watch for the deletion of the
+    # waiter immediately ahead of them. This is the etcd lock recipe, except
+    # that ownership of the lock is still the key under LOCK_PREFIX so that
+    # lock listing and stale lock cleanup continue to work.
     def __init__(self, objecttype, subtype, name, ttl=120,
                  client=None, timeout=120, log_ctx=LOG,
                  op=None):
@@ -138,12 +421,21 @@ class ActualLock(Lock):
         self.operation = op
         self.lockid = util_random.random_id()
 
+        # Metrics are labelled by the kind of lock, not the specific object
+        self.metric_name = objecttype
+        if subtype:
+            self.metric_name = f'{objecttype}/{subtype}'
+        self.acquired_at = None
+
         node = config.NODE_NAME
         pid = os.getpid()
         caller = util_callstack.get_caller(offset=3)
 
         # We also override the location of the lock so that we're in our own spot
         self.key = LOCK_PREFIX + self.path
+        self.waiter_prefix = LOCK_WAITER_PREFIX + self.path + '/'
+        self.waiter_key = self.waiter_prefix + self.lockid
+        self.waiter_lease = None
 
         self.log_ctx = log_ctx.with_fields(
             {
@@ -192,44 +484,161 @@ class ActualLock(Lock):
         super().refresh()
         self.log_ctx.info('Refreshed lock')
 
+    def _enqueue_waiter(self):
+        # Returns the revision at which our waiter key was created
+        self.waiter_lease = self.client.lease(self.ttl)
+        result = self.client.post(
+            self.client.get_url('/kv/put'),
+            json={
+                'key': _encode(self.waiter_key),
+                'value': _encode(self._uuid),
+                'lease': self.waiter_lease.id
+            })
+        return int(result['header']['revision'])
+
+    def _predecessor(self, revision):
+        # Find the waiter immediately ahead of us in the queue, if any. Returns
+        # that waiter's key and the revision the queue was observed at.
+        result = self.client.post(
+            self.client.get_url('/kv/range'),
+            json={
+                'key': _encode(self.waiter_prefix),
+                'range_end': _encode(_increment_last_byte(self.waiter_prefix)),
+                'sort_order': 'DESCEND',
+                'sort_target': 'CREATE',
+                'max_create_revision': revision - 1,
+                'limit': 1,
+                'keys_only': True
+            })
+        observed = int(result['header']['revision'])
+        for kv in result.get('kvs', []):
+            return _decode(kv['key']), observed
+        return None, observed
+
+    def _wait_for_delete(self, key, revision, timeout):
+        # Wait for a key to be deleted after a given revision. Returns False if
+        # the timeout expired first.
+        try:
+            self.client.watch_once(key, timeout=timeout,
+                                   start_revision=revision + 1,
+                                   filters=['NOPUT'])
+            return True
+        except WatchTimedOut:
+            return False
+
+    def acquire(self):
+        if not self.waiter_lease:
+            return super().acquire()
+
+        # Take the lock with the lease we already hold for our waiter key, and
+        # remove the waiter key in the same transaction so that the next
+        # waiter is woken immediately.
+        self.lease = self.waiter_lease
+        key = _encode(self.key)
+        result = self.client.transaction({
+            'compare': [{
+                'key': key,
+                'result': 'EQUAL',
+                'target': 'CREATE',
+                'create_revision': 0
+            }],
+            'success': [
+                {
+                    'request_put': {
+                        'key': key,
+                        'value': _encode(self._uuid),
+                        'lease': self.lease.id
+                    }
+                },
+                {
+                    'request_delete_range': {
+                        'key': _encode(self.waiter_key)
+                    }
+                }
+            ],
+            'failure': []
+        })
+        if result.get('succeeded'):
+            self.waiter_lease = None
+            return True
+        return False
+
+    def _dequeue_waiter(self):
+        # Revoking the lease also deletes the waiter key
+        if self.waiter_lease:
+            try:
+                self.waiter_lease.revoke()
+            except Exception as e:
+                self.log_ctx.with_fields({'error': str(e)}).warning(
+                    'Failed to remove lock waiter, it will expire')
+            self.waiter_lease = None
+
     def __enter__(self):
         start_time = time.time()
         slow_warned = False
+        contended = False
         threshold = self.timeout / 2
 
-        while time.time() - start_time < self.timeout:
-            res = self.acquire()
-            self.log_ctx = self.log_ctx.with_fields({
-                'leased_keys': self.get_lease().keys()
-            })
-
-            duration = time.time() - start_time
-            if res:
-                current = self.get_holder()
-                current_id = current.get('id')
-                if current_id != self.lockid:
-                    self.log_ctx.with_fields({
-                        'current_id': current_id,
-                        'duration': duration
-                        }).error('We should hold lock, but do not!')
-                elif duration > threshold:
-                    self.log_ctx.with_fields({
-                        'duration': duration}).info('Acquired lock, but it was slow')
-                    return self
+        revision = self._enqueue_waiter()
+        try:
+            while time.time() - start_time < self.timeout:
+                predecessor, observed = self._predecessor(revision)
+                if not predecessor:
+                    res = self.acquire()
+                    self.log_ctx = self.log_ctx.with_fields({
+                        'leased_keys': self.get_lease().keys()
+                    })
+
+                    duration = time.time() - start_time
+                    if res:
+                        current = self.get_holder()
+                        current_id = current.get('id')
+                        if current_id != self.lockid:
+                            self.log_ctx.with_fields({
+                                'current_id': current_id,
+                                'duration': duration
+                                }).error('We should hold lock, but do not!')
+                        else:
+                            LOCK_WAIT_SECONDS.labels(self.metric_name).observe(duration)
+                            if contended:
+                                LOCK_CONTENDED.labels(self.metric_name).inc()
+                            self.acquired_at = time.time()
+
+                            if duration > threshold:
+                                self.log_ctx.with_fields({
+                                    'duration': duration}).info(
+                                    'Acquired lock, but it was slow')
+                            else:
+                                self.log_ctx.info('Acquired lock')
+                            return self
+
+                    # Someone else holds the lock, wait for them to release it
+                    wait_key = self.key
                 else:
-                    self.log_ctx.info('Acquired lock')
-                    return self
-
-            if (duration > threshold and not slow_warned):
-                current = self.get_holder(key_prefix='current')
-                self.log_ctx.with_fields(current).with_fields({
-                    'duration': duration,
-                    'threshold': threshold
-                    }).info('Waiting to acquire lock')
-                slow_warned = True
-
-            time.sleep(1)
-
+                    # Wait for the waiter ahead of us to acquire and move on
+                    wait_key = predecessor
+
+                contended = True
+                duration = time.time() - start_time
+                if (duration > threshold and not slow_warned):
+                    current = self.get_holder(key_prefix='current')
+                    self.log_ctx.with_fields(current).with_fields({
+                        'duration': duration,
+                        'threshold': threshold,
+                        'waiting_on': wait_key
+                        }).info('Waiting to acquire lock')
+                    slow_warned = True
+
+                remaining = self.timeout - (time.time() - start_time)
+                if remaining > 0:
+                    self._wait_for_delete(
+                        wait_key, observed, min(remaining, LOCK_WATCH_INTERVAL))
+                    if self.waiter_lease:
+                        self.waiter_lease.refresh()
+        finally:
+            self._dequeue_waiter()
+
+        LOCK_TIMEOUTS.labels(self.metric_name).inc()
         current = self.get_holder(key_prefix='current')
         self.log_ctx.with_fields(current).with_fields({
             'duration': time.time() - start_time
@@ -240,6 +649,11 @@ class ActualLock(Lock):
             % (self.name, self.timeout))
 
     def __exit__(self, _exception_type, _exception_value, _traceback):
+        if self.acquired_at:
+            LOCK_HOLD_SECONDS.labels(self.metric_name).observe(
+                time.time() - self.acquired_at)
+            self.acquired_at = None
+
         attempts = 0
         while attempts < 4:
             if self.release():
@@ -302,19 +716,31 @@ def clear_stale_locks():
     # timeout and that can take a long time.
     client = get_etcd_client()
 
-    for data, metadata in client.get_prefix(
-            LOCK_PREFIX + '/', sort_order='ascend', sort_target='key'):
-        lockname = str(metadata['key']).replace(LOCK_PREFIX + '/', '')
-        holder = json.loads(data)
-        node = holder['node']
-        pid = int(holder['pid'])
+    # Waiters are included so that other processes are not left queued behind
+    # a waiter which will never acquire the lock.
+    for prefix in [LOCK_PREFIX, LOCK_WAITER_PREFIX]:
+        for data, metadata in client.get_prefix(
+                prefix + '/', sort_order='ascend', sort_target='key'):
+            lockname = str(metadata['key']).replace(prefix + '/', '')
+            holder = json.loads(data)
+            node = holder['node']
+            pid = int(holder['pid'])
+
+            if node == config.NODE_NAME and not psutil.pid_exists(pid):
+                client.delete(metadata['key'])
+                LOG.with_fields({'lock': lockname,
+                                 'old-pid': pid,
+                                 'old-node': node,
+                                 }).warning('Removed stale lock')
+
 
-        if node == config.NODE_NAME and not psutil.pid_exists(pid):
-            client.delete(metadata['key'])
-            LOG.with_fields({'lock': lockname,
-                             'old-pid': pid,
-                             'old-node': node,
-                             }).warning('Removed stale lock')
+@retry_etcd_forever
+def get_lock_holder(objecttype, subtype, name):
+    value = get_etcd_client().get(
+        LOCK_PREFIX + _construct_key(objecttype, subtype, name))
+    if not value or not value[0]:
+        return None
+    return json.loads(value[0])
 
 
 @retry_etcd_forever
@@ -325,6 +751,132 @@ def get_existing_locks():
     return key_val
 
 
+# Values are stored in etcd in one of several formats. Readers detect the
+# format automatically. Writers use config.ETCD_VALUE_FORMAT, but only once
+# every node in the cluster reports a codec version which can decode that
+# format. VALUE_CODEC_VERSION is reported by each node in its metrics, and
+# should be incremented when a new format is added.
+VALUE_CODEC_VERSION = 2
+VALUE_FORMAT_JSON = 'json'
+VALUE_FORMAT_COMPACT_JSON = 'compact-json'
+VALUE_FORMAT_MSGPACK = 'msgpack'
+VALUE_FORMAT_MINIMUM_CODEC_VERSION = {
+    VALUE_FORMAT_JSON: 1,
+    VALUE_FORMAT_COMPACT_JSON: 1,
+    VALUE_FORMAT_MSGPACK: 2
+}
+
+# msgpack encoded values start with this header. 0xc1 is never used by msgpack
+# and can never start a JSON document, the second byte is a format version.
+MSGPACK_MAGIC = b'\xc1\x01'
+
+WRITE_FORMAT_CACHE = None
+WRITE_FORMAT_CACHE_AGE = 0
+
+
+def _msgpack_default(obj):
+    if QueueTask.__subclasscheck__(type(obj)):
+        return obj.obj_dict()
+    if type(obj) is baseobject.State:
+        return obj.obj_dict()
+    if isinstance(obj, int):
+        raise OverflowError('Integer too large for msgpack')
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not serializable')
+
+
+def _json_keys(obj):
+    # JSON only has string keys, and callers expect the same from msgpack.
+    for k in obj:
+        if not isinstance(k, str):
+            return {k if isinstance(k, str) else json.dumps(k): v
+                    for k, v in obj.items()}
+    return obj
+
+
+def encode_value(data, value_format=None):
+    if not value_format:
+        value_format = get_write_format()
+
+    if value_format == VALUE_FORMAT_MSGPACK:
+        try:
+            return MSGPACK_MAGIC + msgpack.packb(
+                data, default=_msgpack_default, use_bin_type=True)
+        except OverflowError:
+            # Integers larger than 64 bits are valid JSON but not msgpack
+            value_format = VALUE_FORMAT_COMPACT_JSON
+
+    if value_format == VALUE_FORMAT_COMPACT_JSON:
+        return json.dumps(data, separators=(',', ':'), sort_keys=True,
+                          cls=JSONEncoderCustomTypes)
+
+    return json.dumps(data, indent=4, sort_keys=True,
+                      cls=JSONEncoderCustomTypes)
+
+
+def decode_value(data, object_hook=None):
+    if isinstance(data, bytes) and data.startswith(MSGPACK_MAGIC):
+        if object_hook:
+            def hook(obj):
+                return object_hook(_json_keys(obj))
+        else:
+            hook = _json_keys
+
+        return msgpack.unpackb(data[len(MSGPACK_MAGIC):], raw=False,
+                               strict_map_key=False, object_hook=hook)
+
+    return json.loads(data, object_hook=object_hook)
+
+
+def get_minimum_value_codec_version():
+    # Nodes which do not report a codec version can only decode JSON. Unlike
+    # baseobject.get_minimum_object_version() we therefore treat a missing
+    # version as version one, not as no information.
+    minimum = None
+    for _, d in get_all('metrics', None):
+        if time.time() - d.get('timestamp', 0) > 24 * 7 * 3600:
+            continue
+
+        state = get('attribute/node', d['fqdn'], 'state')
+        if not state or state['value'] == baseobject.DatabaseBackedObject.STATE_DELETED:
+            continue
+
+        ver = d.get('metrics', {}).get('etcd_value_codec_version', 1)
+        if minimum is None or ver < minimum:
+            minimum = ver
+
+    return minimum
+
+
+def get_write_format():
+    global WRITE_FORMAT_CACHE
+    global WRITE_FORMAT_CACHE_AGE
+
+    value_format = config.ETCD_VALUE_FORMAT
+    required = VALUE_FORMAT_MINIMUM_CODEC_VERSION.get(value_format)
+    if not required:
+        return VALUE_FORMAT_COMPACT_JSON
+    if required == 1:
+        return value_format
+
+    if (WRITE_FORMAT_CACHE and WRITE_FORMAT_CACHE[0] == value_format and
+            time.time() - WRITE_FORMAT_CACHE_AGE < 300):
+        return WRITE_FORMAT_CACHE[1]
+
+    minimum = get_minimum_value_codec_version()
+    if minimum is not None and minimum >= required:
+        effective = value_format
+    else:
+        effective = VALUE_FORMAT_COMPACT_JSON
+        LOG.with_fields({
+            'requested_format': value_format,
+            'minimum_codec_version': minimum
+        }).debug('Not all nodes can decode requested etcd value format')
+
+    WRITE_FORMAT_CACHE = (value_format, effective)
+    WRITE_FORMAT_CACHE_AGE = time.time()
+    return effective
+
+
 def _construct_key(objecttype, subtype, name):
     if subtype and name:
         return f'/sf/{objecttype}/{subtype}/{name}'
@@ -346,33 +898,194 @@ class JSONEncoderCustomTypes(json.JSONEncoder):
 
 @retry_etcd_forever
 def put_raw(path, data):
-    encoded = json.dumps(data, indent=4, sort_keys=True,
-                         cls=JSONEncoderCustomTypes)
+    encoded = encode_value(data)
     get_etcd_client().put(path, encoded, lease=None)
     LOG.info('etcd put %s' % path)
 
 
 @retry_etcd_forever
-def put(objecttype, subtype, name, data):
+def put(objecttype, subtype, name, data, extra_puts=None, extra_deletes=None):
     path = _construct_key(objecttype, subtype, name)
-    put_raw(path, data)
+    if extra_puts or extra_deletes:
+        puts = {path: data}
+        puts.update(extra_puts or {})
+        apply_many(puts=puts, deletes=extra_deletes)
+    else:
+        put_raw(path, data)
 
 
 @retry_etcd_forever
-def create(objecttype, subtype, name, data):
+def create(objecttype, subtype, name, data, extra_puts=None):
     path = _construct_key(objecttype, subtype, name)
-    encoded = json.dumps(data, indent=4, sort_keys=True,
-                         cls=JSONEncoderCustomTypes)
     LOG.info('etcd create %s' % path)
+    if extra_puts:
+        puts = {path: data}
+        puts.update(extra_puts)
+        return apply_many(puts=puts, create=path)
+
+    encoded = encode_value(data)
     return get_etcd_client().create(path, encoded, lease=None)
 
 
+@retry_etcd_forever
+def apply_many(puts=None, deletes=None, create=None):
+    """Apply several changes in a single etcd transaction.
+
+    puts is a dictionary of path to data, and deletes is a list of paths. If
+    create is set to a path or a list of paths, then nothing is changed unless
+    none of those paths already exist. Returns True if the changes were
+    applied.
+    """
+    if isinstance(create, str):
+        create = [create]
+
+    compare = []
+    for path in create or []:
+        compare.append({
+            'key': _encode(path),
+            'result': 'EQUAL',
+            'target': 'CREATE',
+            'create_revision': 0
+        })
+
+    success = []
+    for path, data in (puts or {}).items():
+        success.append({
+            'request_put': {'key': _encode(path), 'value': _encode(encode_value(data))}
+        })
+    for path in deletes or []:
+        success.append({'request_delete_range': {'key': _encode(path)}})
+
+    result = get_etcd_client().transaction(
+        {'compare': compare, 'success': success, 'failure': []})
+    LOG.info('etcd transaction with %d puts and %d deletes'
+             % (len(puts or {}), len(deletes or [])))
+    return result.get('succeeded', False)
+
+
+@retry_etcd_forever
+def get_prefix_by_create(path, limit=0, min_create_revision=0):
+    """Return the keys under a prefix in the order they were created.
+
+    Returns a list of (key, value, create_revision, mod_revision) tuples, and
+    the revision the read was performed at.
+    """
+    if isinstance(path, str):
+        path = path.encode('utf-8')
+    kvs, revision = get_etcd_client().get_range_by_create(
+        path, _increment_last_byte(path), limit=limit,
+        min_create_revision=min_create_revision)
+
+    out = []
+    for data, metadata in kvs:
+        out.append((metadata['key'].decode('utf-8'), decode_value(data),
+                    int(metadata['create_revision']),
+                    int(metadata['mod_revision'])))
+    return out, revision
+
+
+@retry_etcd_forever
+def count_prefix(path):
+    """Return the number of keys under a prefix, counted by etcd."""
+    if isinstance(path, str):
+        path = path.encode('utf-8')
+    count, _ = get_etcd_client().count_range(path, _increment_last_byte(path))
+    return count
+
+
+@retry_etcd_forever
+def delete_if_unchanged(path, mod_revision):
+    """Delete a key only if it has not been modified since mod_revision.
+
+    Returns True if the key was deleted by us.
+    """
+    result = get_etcd_client().transaction({
+        'compare': [{
+            'key': _encode(path),
+            'result': 'EQUAL',
+            'target': 'MOD',
+            'mod_revision': mod_revision
+        }],
+        'success': [{'request_delete_range': {'key': _encode(path)}}],
+        'failure': []
+    })
+    return result.get('succeeded', False)
+
+
+@retry_etcd_forever
+def put_if_exists(path, data):
+    """Update a key only if it already exists. Returns True if updated."""
+    result = get_etcd_client().transaction({
+        'compare': [{
+            'key': _encode(path),
+            'result': 'GREATER',
+            'target': 'CREATE',
+            'create_revision': 0
+        }],
+        'success': [{
+            'request_put': {'key': _encode(path), 'value': _encode(encode_value(data))}
+        }],
+        'failure': []
+    })
+    return result.get('succeeded', False)
+
+
+def watch_prefix_once(path, timeout, start_revision=0):
+    """Wait for a change to any key under a prefix.
+
+    Changes made at or after start_revision are reported. Returns the revision
+    of the change, or None if the timeout expired first.
+    """
+    kwargs = {}
+    if start_revision:
+        kwargs['start_revision'] = start_revision
+    try:
+        event = get_etcd_client().watch_prefix_once(path, timeout=timeout, **kwargs)
+        return int(event['kv']['mod_revision'])
+    except WatchTimedOut:
+        return None
+
+
+def watch_prefix(path, start_revision=0, timeout=None):
+    """Watch for changes to any key under a prefix.
+
+    Yields (event type, key, value, revision) for each change, where the event
+    type is either PUT or DELETE. If timeout is set and nothing changes for
+    that many seconds, None is yielded instead. The watch is cancelled when
+    the generator is closed.
+    """
+    if isinstance(path, str):
+        path = path.encode('utf-8')
+    kwargs = {'range_end': _increment_last_byte(path)}
+    if start_revision:
+        kwargs['start_revision'] = start_revision
+
+    events = queue.Queue()
+    watcher = Watcher(get_etcd_client(), path, events.put, **kwargs)
+    try:
+        while True:
+            try:
+                event = events.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+
+            kv = event['kv']
+            value = None
+            if kv.get('value'):
+                value = decode_value(kv['value'])
+            yield (event.get('type', 'PUT'), kv['key'].decode('utf-8'), value,
+                   int(kv['mod_revision']))
+    finally:
+        watcher.stop()
+
+
 @retry_etcd_forever
 def get_raw(path):
     value = get_etcd_client().get(path)
     if value is None or len(value) == 0:
         return None
-    return json.loads(value[0])
+    return decode_value(value[0])
 
 
 @retry_etcd_forever
@@ -385,7 +1098,7 @@ def get(objecttype, subtype, name):
 def get_prefix(path, sort_order=None, sort_target='key', limit=0):
     for data, metadata in get_etcd_client().get_prefix(
             path, sort_order=sort_order, sort_target='key', limit=limit):
-        yield str(metadata['key'].decode('utf-8')), json.loads(data)
+        yield str(metadata['key'].decode('utf-8')), decode_value(data)
 
 
 def get_all(objecttype, subtype, prefix=None, sort_order=None, limit=0):
@@ -400,11 +1113,85 @@ def get_all_dict(objecttype, subtype=None, sort_order=None, limit=0):
 
     for value in get_etcd_client().get_prefix(
             path, sort_order=sort_order, sort_target='key', limit=limit):
-        key_val[value[1]['key'].decode('utf-8')] = json.loads(value[0])
+        key_val[value[1]['key'].decode('utf-8')] = decode_value(value[0])
 
     return key_val
 
 
+def get_prefix_paged(path, page_size=1000):
+    """Iterate all keys under a prefix without loading them all at once.
+
+    Keys are fetched page_size at a time, with every page read at the revision
+    of the first page so that the caller sees a consistent snapshot. Yields
+    (key, value) tuples where the value is the raw bytes stored in etcd.
+    RevisionCompacted is raised if etcd compacts away that revision before
+    the last page is read.
+    """
+    if isinstance(path, str):
+        path = path.encode('utf-8')
+    range_end = _increment_last_byte(path)
+    start = path
+    revision = 0
+
+    while True:
+        kvs, page_revision, more = retry_etcd_forever(
+            get_etcd_client().get_range_page)(
+                start, range_end, limit=page_size, revision=revision)
+        if not revision:
+            revision = page_revision
+
+        for data, metadata in kvs:
+            yield metadata['key'].decode('utf-8'), data
+
+        if not more or not kvs:
+            return
+
+        # Start the next page just after the last key we saw
+        start = kvs[-1][1]['key'] + b'\x00'
+
+
+@retry_etcd_forever
+def batch_put(items):
+    """Put many keys in a single etcd transaction.
+
+    items is a list of (key, value) tuples, where values are the raw bytes or
+    strings to store. Callers should keep batches smaller than the etcd
+    server's --max-txn-ops, which defaults to 128.
+    """
+    txn = {
+        'compare': [],
+        'success': [
+            {'request_put': {'key': _encode(key), 'value': _encode(value)}}
+            for key, value in items
+        ],
+        'failure': []
+    }
+    result = get_etcd_client().transaction(txn)
+    return result.get('succeeded', False)
+
+
+@retry_etcd_forever
+def batch_get(keys):
+    """Get many keys in a single etcd transaction.
+
+    Returns a dictionary of key to raw value for the keys which exist.
+    """
+    txn = {
+        'compare': [],
+        'success': [
+            {'request_range': {'key': _encode(key)}} for key in keys
+        ],
+        'failure': []
+    }
+    result = get_etcd_client().transaction(txn)
+
+    out = {}
+    for response in result.get('responses', []):
+        for item in response.get('response_range', {}).get('kvs', []):
+            out[_decode(item['key']).decode('utf-8')] = _decode(item.get('value', ''))
+    return out
+
+
 @retry_etcd_forever
 def delete_raw(path):
     get_etcd_client().delete(path)
@@ -491,7 +1278,7 @@ def dequeue(queuename):
         if float(jobname.split('-')[0]) > time.time():
             return None
 
-        workitem = json.loads(data, object_hook=decodeTasks)
+        workitem = decode_value(data, object_hook=decodeTasks)
         put('processing', queuename, jobname, workitem)
         client.delete(metadata['key'])
         LOG.with_fields({
@@ -533,7 +1320,7 @@ def _restart_queue(queuename):
     for data, metadata in get_etcd_client().get_prefix(
             queue_path, sort_order='ascend'):
         jobname = str(metadata['key']).split('/')[-1].rstrip("'")
-        workitem = json.loads(data)
+        workitem = decode_value(data)
         put('queue', queuename, jobname, workitem)
         delete('processing', queuename, jobname)
         LOG.with_fields({
@@ -544,9 +1331,9 @@ def _restart_queue(queuename):
 
 def get_outstanding_jobs():
     for data, metadata in get_etcd_client().get_prefix('/sf/processing'):
-        yield metadata['key'].decode('utf-8'), json.loads(data, object_hook=decodeTasks)
+        yield metadata['key'].decode('utf-8'), decode_value(data, object_hook=decodeTasks)
     for data, metadata in get_etcd_client().get_prefix('/sf/queued'):
-        yield metadata['key'].decode('utf-8'), json.loads(data, object_hook=decodeTasks)
+        yield metadata['key'].decode('utf-8'), decode_value(data, object_hook=decodeTasks)
 
 
 def get_current_blob_transfers(absent_nodes=[]):
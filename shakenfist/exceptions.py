@@ -57,6 +57,14 @@ class InvalidLifecycleState(InstanceException):
     ...
 
 
+class ConsoleLogBusy(InstanceException):
+    ...
+
+
+class ConsolePortsExhausted(InstanceException):
+    ...
+
+
 # Scheduler
 class SchedulerException(Exception):
     ...
@@ -103,6 +111,10 @@ class PrefixNotInCache(DatabaseException):
     ...
 
 
+class RevisionCompacted(DatabaseException):
+    ...
+
+
 # Virt
 class VirtException(Exception):
     ...
@@ -126,6 +138,10 @@ class ImageMissingFromCache(Exception):
     ...
 
 
+class ImageDecompressionFailed(Exception):
+    ...
+
+
 # Tasks
 class TaskException(Exception):
     ...
@@ -175,13 +175,12 @@ class InstanceAgentOperationsEndpoint(sf_api.Resource):
     @api_base.log_token_use
     def get(self, instance_ref=None, instance_from_db=None, all=False):
         out = []
-        ops = instance_from_db.agent_operations
-
-        key = 'queue'
         if all:
-            key = 'all'
+            agentop_uuids = instance_from_db.agent_operation_history()
+        else:
+            agentop_uuids = instance_from_db.agent_operation_queue()
 
-        for agentop_uuid in ops.get(key, []):
+        for agentop_uuid in agentop_uuids:
             aop = AgentOperation.from_db(agentop_uuid)
             if aop:
                 out.append(aop.external_view())
@@ -23,6 +23,7 @@ from shakenfist_utilities import api as sf_api
 from shakenfist_utilities import logs
 
 from shakenfist import constants
+from shakenfist import etcd
 from shakenfist import eventlog
 from shakenfist.config import config
 from shakenfist.daemons import daemon
@@ -42,6 +43,7 @@ from shakenfist.external_api import upload as api_upload
 
 LOG, HANDLER = logs.setup(__name__)
 daemon.set_log_level(LOG, 'api')
+etcd.set_instrumentation_caller('api')
 
 
 app = flask.Flask(__name__)
@@ -126,7 +128,7 @@ class Root(sf_api.Resource):
              '<li>artifacts: artifact-metadata, artifact-upload-types</li>'
              '<li>blobs: blob-metadata, blob-search-by-hash, blob-data-limit, '
              'blob-hash-sha1, blob-hash-sha256, blob-hash-xxh128</li>'
-             '<li>events: events-by-type</li>'
+             '<li>events: events-by-type, namespace-usage-export</li>'
              '<li>instances: pure-affinity, spice-vdi-console, vdi-console-helper, '
              'instance-put-blob, instance-execute, instance-get, instance-screenshot, '
              'get-instance-namespace, hot-plug-interface</li>'
@@ -186,6 +188,8 @@ api.add_resource(api_auth.AuthNamespaceTrustsEndpoint,
                  '/auth/namespaces/<namespace>/trust')
 api.add_resource(api_auth.AuthNamespaceTrustEndpoint,
                  '/auth/namespaces/<namespace>/trust/<external_namespace>')
+api.add_resource(api_auth.AuthNamespaceUsageEndpoint,
+                 '/auth/namespaces/<namespace>/usage')
 
 api.add_resource(api_blob.BlobsEndpoint, '/blobs')
 api.add_resource(api_blob.BlobEndpoint, '/blobs/<blob_uuid>')
@@ -232,6 +236,8 @@ api.add_resource(api_instance.InstanceAgentExecuteEndpoint,
                  '/instances/<instance_ref>/agent/execute')
 api.add_resource(api_instance.InstanceScreenshotEndpoint,
                  '/instances/<instance_ref>/screenshot')
+api.add_resource(api_instance.InstanceStartProfileEndpoint,
+                 '/instances/<instance_ref>/startprofile')
 
 api.add_resource(api_interface.InterfaceEndpoint,
                  '/interfaces/<interface_uuid>')
@@ -8,13 +8,10 @@
 #   - Has complete CI coverage:
 import json
 import os
-import shutil
 import time
 import uuid
 from functools import partial
 
-import flask
-import requests
 from flasgger import swag_from
 from flask_jwt_extended import get_jwt_identity
 from shakenfist_utilities import api as sf_api
@@ -26,6 +23,7 @@ from shakenfist import eventlog
 from shakenfist import exceptions
 from shakenfist.artifact import Artifact
 from shakenfist.artifact import Artifacts
+from shakenfist.artifact import BlobUsage
 from shakenfist.artifact import namespace_exact_filter
 from shakenfist.artifact import namespace_or_shared_filter
 from shakenfist.artifact import UPLOAD_URL
@@ -34,8 +32,7 @@ from shakenfist.config import config
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.daemons import daemon
 from shakenfist.external_api import base as api_base
-from shakenfist.instance import instance_usage_for_blob_uuid
-from shakenfist.namespace import get_api_token
+from shakenfist.external_api import proxy
 from shakenfist.namespace import namespace_is_trusted
 from shakenfist.tasks import FetchImageTask
 from shakenfist.upload import Upload
@@ -183,11 +180,7 @@ class ArtifactEndpoint(sf_api.Resource):
     @requires_artifact_access
     @api_base.log_token_use
     def get(self, artifact_ref=None, artifact_from_db=None):
-        ev = artifact_from_db.external_view()
-        for idx in ev['blobs']:
-            ev['blobs'][idx]['instances'] = instance_usage_for_blob_uuid(
-                ev['blobs'][idx]['uuid'])
-        return ev
+        return artifact_from_db.external_view(include_instances=True)
 
     @swag_from(api_base.swagger_helper(
         'artifacts', 'Delete an artifact.',
@@ -255,23 +248,24 @@ class ArtifactsEndpoint(sf_api.Resource):
     @api_base.verify_token
     @api_base.log_token_use
     def get(self, node=None):
-        retval = []
+        listed = []
         for a in Artifacts(filters=[
                 partial(namespace_or_shared_filter, get_jwt_identity()[0])],
                 prefilter='active'):
+            indexes = list(a.get_all_indexes())
             if node:
-                idx = a.most_recent_index
-                if 'blob_uuid' in idx:
-                    b = Blob.from_db(idx['blob_uuid'])
-                    if b and node in b.locations:
-                        ev = a.external_view()
-                        ev['instances']: instance_usage_for_blob_uuid(b.uuid)
-                        retval.append(ev)
-            else:
-                ev = a.external_view()
-                ev['instances']: instance_usage_for_blob_uuid(b.uuid)
-                retval.append(ev)
-        return retval
+                if not indexes:
+                    continue
+                b = Blob.from_db(indexes[-1]['blob_uuid'])
+                if not b or node not in b.locations:
+                    continue
+            listed.append((a, indexes))
+
+        # The usage of the blobs of all listed artifacts is found once
+        usage = BlobUsage(
+            [idx['blob_uuid'] for _, indexes in listed for idx in indexes])
+        return [a.external_view(include_instances=True, indexes=indexes, usage=usage)
+                for a, indexes in listed]
 
     @swag_from(api_base.swagger_helper(
         'artifacts', ('Fetch an image artifact into the cluster.'),
@@ -403,26 +397,9 @@ class ArtifactUploadEndpoint(sf_api.Resource):
                 return sf_api.error(404, 'upload not found')
 
             if u.node != config.NODE_NAME:
-                url = 'http://%s:%d%s' % (u.node, config.API_PORT,
-                                          flask.request.environ['PATH_INFO'])
-                api_token = get_api_token(
-                    'http://%s:%d' % (u.node, config.API_PORT),
-                    namespace=get_jwt_identity()[0])
-                r = requests.request(
-                    flask.request.environ['REQUEST_METHOD'], url,
-                    data=json.dumps(sf_api.flask_get_post_body()),
-                    headers={
-                        'Authorization': api_token,
-                        'User-Agent': util_general.get_user_agent(),
-                        'X-Request-ID': flask.request.headers.get('X-Request-ID')
-                    })
-
-                LOG.info('Proxied %s %s returns: %d, %s' % (
-                        flask.request.environ['REQUEST_METHOD'], url,
-                        r.status_code, r.text))
-                resp = flask.Response(r.text,  mimetype='application/json')
-                resp.status_code = r.status_code
-                return resp
+                return proxy.proxy_request(
+                    u.node, get_jwt_identity()[0],
+                    data=json.dumps(sf_api.flask_get_post_body()))
 
         if not source_url:
             source_url = ('%s%s/%s'
@@ -462,9 +439,9 @@ class ArtifactUploadEndpoint(sf_api.Resource):
                 upload_dir = os.path.join(config.STORAGE_PATH, 'uploads')
                 upload_path = os.path.join(upload_dir, u.uuid)
 
-                # NOTE(mikal): we can't use os.rename() here because these paths
-                # might be on different filesystems.
-                shutil.move(upload_path, blob_path)
+                # NOTE(mikal): we can't just use os.rename() here because these
+                # paths might be on different filesystems.
+                util_general.move_file(upload_path, blob_path)
                 st = os.stat(blob_path)
                 b = Blob.new(
                     blob_uuid, st.st_size,
@@ -575,13 +552,15 @@ class ArtifactVersionsEndpoint(sf_api.Resource):
     @requires_artifact_access
     def get(self, artifact_ref=None, artifact_from_db=None):
         retval = []
-        for idx in artifact_from_db.get_all_indexes():
+        indexes = list(artifact_from_db.get_all_indexes())
+        summary = artifact_from_db.blob_summary(indexes=indexes)
+        for idx in indexes:
             b = Blob.from_db(idx['blob_uuid'])
             if b:
                 bout = b.external_view()
-                bout['instances'] = instance_usage_for_blob_uuid(b.uuid)
-            bout['index'] = idx['index']
-            retval.append(bout)
+                bout['instances'] = summary.get(idx['index'], {}).get('instances', [])
+                bout['index'] = idx['index']
+                retval.append(bout)
         return retval
 
     @swag_from(api_base.swagger_helper(
@@ -7,6 +7,10 @@
 #        - and include examples: yes
 #   - Has complete CI coverage: yes
 import base64
+import hashlib
+import hmac
+import secrets
+import time
 
 import bcrypt
 import flask
@@ -18,6 +22,7 @@ from shakenfist_utilities import logs
 from shakenfist import artifact
 from shakenfist import instance
 from shakenfist import network
+from shakenfist import usage
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.daemons import daemon
@@ -71,6 +76,64 @@ auth_token_example = """{
 """
 
 
+# Successful key verifications are cached briefly, so that repeated logins with
+# the same key do not each pay for a bcrypt check. Entries are keyed by an HMAC
+# of the namespace and key using a per process secret, and record the stored
+# hash they were verified against, so that replacing or removing a key
+# invalidates its cache entry.
+VERIFIED_KEYS = {}
+VERIFIED_KEY_TTL = 60
+VERIFIED_KEYS_MAX = 1000
+VERIFIED_KEYS_SECRET = secrets.token_bytes(32)
+
+
+def _verified_key_digest(namespace, key):
+    return hmac.new(VERIFIED_KEYS_SECRET,
+                    ('%s\0%s' % (namespace, key)).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def _cached_key_name(namespace, key, keys):
+    digest = _verified_key_digest(namespace, key)
+    cached = VERIFIED_KEYS.get(digest)
+    if not cached:
+        return None
+
+    keyname, encoded, expiry = cached
+    if time.time() > expiry or keys.get(keyname, {}).get('key') != encoded:
+        del VERIFIED_KEYS[digest]
+        return None
+    return keyname
+
+
+def _cache_key_name(namespace, key, keyname, encoded):
+    now = time.time()
+    if len(VERIFIED_KEYS) >= VERIFIED_KEYS_MAX:
+        for digest in list(VERIFIED_KEYS.keys()):
+            if now > VERIFIED_KEYS[digest][2]:
+                del VERIFIED_KEYS[digest]
+        if len(VERIFIED_KEYS) >= VERIFIED_KEYS_MAX:
+            VERIFIED_KEYS.clear()
+
+    VERIFIED_KEYS[_verified_key_digest(namespace, key)] = (
+        keyname, encoded, now + VERIFIED_KEY_TTL)
+
+
+def _check_key(namespace_from_db, keyname, keydata, key):
+    possible_key = base64.b64decode(keydata['key'])
+    try:
+        return bcrypt.checkpw(key.encode('utf-8'), possible_key)
+    except ValueError as e:
+        namespace_from_db.add_event(
+            EVENT_TYPE_AUDIT, 'namespace key is invalid',
+            extra={
+                'error': str(e),
+                'key_name': keyname,
+                'key-body': keydata
+            })
+        return False
+
+
 class AuthEndpoint(sf_api.Resource):
     @swag_from(api_base.swagger_helper(
         'auth', 'Authenticate and create access token.',
@@ -78,13 +141,16 @@ class AuthEndpoint(sf_api.Resource):
             ('namespace', 'body', 'string',
              'The namespace to authenticate against.', True),
             ('key', 'body', 'string',
-             'The secret for the key you wish to use.', True)
+             'The secret for the key you wish to use.', True),
+            ('key_name', 'body', 'string',
+             'The name of the key you wish to use. If omitted, all keys in the '
+             'namespace are tried.', False)
         ],
         [(200, 'An access token.', auth_token_example),
          (400, 'Missing namepsace or key in request or key is not a string.', None),
          (404, 'Namespace not found.', None)]))
     @arg_is_namespace
-    def post(self, namespace=None, key=None, namespace_from_db=None):
+    def post(self, namespace=None, key=None, key_name=None, namespace_from_db=None):
         if not key:
             return sf_api.error(400, 'missing key in request')
         if not isinstance(key, str):
@@ -92,20 +158,25 @@ class AuthEndpoint(sf_api.Resource):
             return sf_api.error(400, 'key is not a string')
 
         keys = namespace_from_db.keys.get('nonced_keys', {})
-        for keyname in keys:
-            possible_key = base64.b64decode(keys[keyname]['key'])
-            try:
-                if bcrypt.checkpw(key.encode('utf-8'), possible_key):
-                    return access_tokens.create_token(
-                        namespace_from_db, keyname, keys[keyname]['nonce'])
-            except ValueError as e:
-                namespace_from_db.add_event(
-                    EVENT_TYPE_AUDIT, 'namespace key is invalid',
-                    extra={
-                        'error': str(e),
-                        'key_name': keyname,
-                        'key-body': keys[keyname]
-                    })
+
+        keyname = _cached_key_name(namespace_from_db.uuid, key, keys)
+        if keyname and (not key_name or key_name == keyname):
+            return access_tokens.create_token(
+                namespace_from_db, keyname, keys[keyname]['nonce'])
+
+        if key_name:
+            candidates = [key_name] if key_name in keys else []
+        else:
+            # Service keys created by older releases are never used with this
+            # endpoint, so there is no point paying to check them.
+            candidates = [k for k in keys if not k.startswith('_service_key_')]
+
+        for keyname in candidates:
+            if _check_key(namespace_from_db, keyname, keys[keyname], key):
+                _cache_key_name(namespace_from_db.uuid, key, keyname,
+                                keys[keyname]['key'])
+                return access_tokens.create_token(
+                    namespace_from_db, keyname, keys[keyname]['nonce'])
 
         namespace_from_db.add_event(
             EVENT_TYPE_AUDIT, 'attempt to use incorrect namespace key')
@@ -523,3 +594,72 @@ class AuthNamespaceTrustEndpoint(sf_api.Resource):
             EVENT_TYPE_AUDIT, 'remove trust request from REST API')
         namespace_from_db.remove_trust(external_namespace)
         return namespace_from_db.external_view()
+
+
+namespace_usage_example = """[
+    {
+        "object_type": "instance",
+        "object_uuid": "b9c6c8e5-8e6e-4d1a-bb3b-3f4b8e1c0a42",
+        "namespace": "system",
+        "metrics": {
+            "cpu usage/cpu time ns": [
+                [1685229480, 2938743000000],
+                [1685229540, 2938801000000],
+                ...
+            ],
+            ...
+        }
+    },
+    ...
+]"""
+
+
+class AuthNamespaceUsageEndpoint(sf_api.Resource):
+    @swag_from(api_base.swagger_helper(
+        'auth', 'Export usage for all objects in a namespace over a time range.',
+        [
+            ('namespace', 'query', 'string',
+             'The namespace to export usage for.', True),
+            ('start', 'body', 'integer',
+             'The UNIX timestamp to start the export at. Defaults to a day ago.',
+             False),
+            ('end', 'body', 'integer',
+             'The UNIX timestamp to end the export at. Defaults to now.', False),
+            ('resolution', 'body', 'integer',
+             'Downsample the export to this many seconds per sample. Defaults '
+             'to the best resolution retained.', False)
+        ],
+        [(200, 'Usage for objects in the namespace.', namespace_usage_example),
+         (400, 'Invalid time range or resolution.', None),
+         (404, 'Namespace not found.', None)]))
+    @api_base.verify_token
+    @requires_namespace_ownership
+    @arg_is_namespace
+    @api_base.redirect_to_eventlog_node
+    @api_base.log_token_use
+    def get(self, namespace=None, start=None, end=None, resolution=None,
+            namespace_from_db=None):
+        try:
+            end = int(end) if end else int(time.time())
+            start = int(start) if start else end - 24 * 3600
+            resolution = int(resolution) if resolution else None
+        except ValueError:
+            return sf_api.error(400, 'start, end and resolution must be integers')
+
+        if start > end:
+            return sf_api.error(400, 'start must be before end')
+        if resolution is not None and resolution <= 0:
+            return sf_api.error(400, 'resolution must be positive')
+
+        out = []
+        with usage.UsageStore() as store:
+            results = store.query(start, end, namespace=namespace,
+                                  resolution=resolution)
+        for (objtype, objuuid), data in sorted(results.items()):
+            out.append({
+                'object_type': objtype,
+                'object_uuid': objuuid,
+                'namespace': data['namespace'],
+                'metrics': data['metrics']
+            })
+        return out
@@ -1,7 +1,7 @@
 import json
 
 import flask
-import requests
+from flask_jwt_extended import get_jwt
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import verify_jwt_in_request
 from flask_jwt_extended.exceptions import NoAuthorizationError
@@ -14,11 +14,11 @@ from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.config import config
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.daemons import daemon
+from shakenfist.external_api import proxy
 from shakenfist.instance import Instance
-from shakenfist.namespace import get_api_token
 from shakenfist.namespace import Namespace
 from shakenfist.upload import Upload
-from shakenfist.util import general as util_general
+from shakenfist.util import access_tokens
 
 
 LOG, _ = logs.setup(__name__)
@@ -135,6 +135,11 @@ def verify_token(func):
                       'the subject field')
             raise NoAuthorizationError()
 
+        # Service tokens are minted by other nodes in this cluster for requests
+        # they have already authenticated. Their signature is sufficient.
+        if access_tokens.is_service_token(jwt_data):
+            return func(*args, **kwargs)
+
         ns = Namespace.from_db(ns_name)
         if not ns:
             LOG.with_fields({'namespace', ns_name}).error(
@@ -145,22 +150,21 @@ def verify_token(func):
                 'JWT token is for deleted namespace')
             raise NoAuthorizationError()
 
-        if key_name != '_service_key':
-            keys = ns.keys.get('nonced_keys', {})
-            if key_name not in keys:
-                LOG.with_fields({'namespace', ns_name}).error(
-                    'JWT token uses non-existent key')
-                raise NoAuthorizationError()
-
-            nonce = keys[key_name].get('nonce')
-            if 'nonce' not in jwt_data:
-                LOG.with_fields({'namespace', ns_name}).error(
-                    'JWT token lacks nonce')
-                raise NoAuthorizationError()
-            if jwt_data['nonce'] != nonce:
-                LOG.with_fields({'namespace', ns_name}).error(
-                    'JWT token has incorrect nonce')
-                raise NoAuthorizationError()
+        keys = ns.keys.get('nonced_keys', {})
+        if key_name not in keys:
+            LOG.with_fields({'namespace', ns_name}).error(
+                'JWT token uses non-existent key')
+            raise NoAuthorizationError()
+
+        nonce = keys[key_name].get('nonce')
+        if 'nonce' not in jwt_data:
+            LOG.with_fields({'namespace', ns_name}).error(
+                'JWT token lacks nonce')
+            raise NoAuthorizationError()
+        if jwt_data['nonce'] != nonce:
+            LOG.with_fields({'namespace', ns_name}).error(
+                'JWT token has incorrect nonce')
+            raise NoAuthorizationError()
 
         return func(*args, **kwargs)
     return wrapper
@@ -168,6 +172,10 @@ def verify_token(func):
 
 def log_token_use(func):
     def wrapper(*args, **kwargs):
+        # Proxied requests were logged by the node which received them.
+        if access_tokens.is_service_token(get_jwt()):
+            return func(*args, **kwargs)
+
         auth_header = flask.request.headers.get('Authorization', 'Bearer none')
         token = auth_header.split(' ')[1]
         namespace, keyname = get_jwt_identity()
@@ -221,27 +229,9 @@ def redirect_instance_request(func):
             return
 
         if placement.get('node') != config.NODE_NAME:
-            url = 'http://%s:%d%s' % (placement['node'], config.API_PORT,
-                                      flask.request.environ['PATH_INFO'])
-            api_token = get_api_token(
-                'http://%s:%d' % (placement['node'], config.API_PORT),
-                namespace=get_jwt_identity()[0])
-            r = requests.request(
-                flask.request.environ['REQUEST_METHOD'], url,
-                data=json.dumps(sf_api.flask_get_post_body()),
-                headers={
-                    'Authorization': api_token,
-                    'User-Agent': util_general.get_user_agent(),
-                    'X-Request-ID': flask.request.headers.get('X-Request-ID')
-                })
-
-            LOG.info('Proxied %s %s returns: %d, %s' % (
-                     flask.request.environ['REQUEST_METHOD'], url,
-                     r.status_code, r.text))
-            resp = flask.Response(r.text,
-                                  mimetype='application/json')
-            resp.status_code = r.status_code
-            return resp
+            return proxy.proxy_request(
+                placement['node'], get_jwt_identity()[0],
+                data=json.dumps(sf_api.flask_get_post_body()))
 
         return func(*args, **kwargs)
     return wrapper
@@ -306,26 +296,7 @@ def redirect_to_network_node(func):
     # Redirect method to the network node
     def wrapper(*args, **kwargs):
         if not config.NODE_IS_NETWORK_NODE:
-            admin_token = get_api_token(
-                'http://%s:%d' % (config.NETWORK_NODE_IP, config.API_PORT),
-                namespace='system')
-            r = requests.request(
-                flask.request.environ['REQUEST_METHOD'],
-                'http://%s:%d%s'
-                % (config.NETWORK_NODE_IP, config.API_PORT,
-                   flask.request.environ['PATH_INFO']),
-                data=flask.request.data,
-                headers={
-                    'Authorization': admin_token,
-                    'User-Agent': util_general.get_user_agent(),
-                    'X-Request-ID': flask.request.headers.get('X-Request-ID')
-                })
-
-            LOG.info('Returning proxied request: %d, %s'
-                     % (r.status_code, r.text))
-            resp = flask.Response(r.text, mimetype='application/json')
-            resp.status_code = r.status_code
-            return resp
+            return proxy.proxy_request(config.NETWORK_NODE_IP, 'system')
 
         return func(*args, **kwargs)
     return wrapper
@@ -406,27 +377,7 @@ def redirect_upload_request(func):
             return
 
         if u.node != config.NODE_NAME:
-            url = 'http://%s:%d%s' % (u.node, config.API_PORT,
-                                      flask.request.environ['PATH_INFO'])
-            api_token = get_api_token(
-                'http://%s:%d' % (u.node, config.API_PORT),
-                namespace=get_jwt_identity()[0])
-            r = requests.request(
-                flask.request.environ['REQUEST_METHOD'], url,
-                data=flask.request.get_data(cache=False, as_text=False,
-                                            parse_form_data=False),
-                headers={
-                    'Authorization': api_token,
-                    'User-Agent': util_general.get_user_agent(),
-                    'X-Request-ID': flask.request.headers.get('X-Request-ID')
-                })
-
-            LOG.info('Proxied %s %s returns: %d, %s' % (
-                     flask.request.environ['REQUEST_METHOD'], url,
-                     r.status_code, r.text))
-            resp = flask.Response(r.text,  mimetype='application/json')
-            resp.status_code = r.status_code
-            return resp
+            return proxy.proxy_request(u.node, get_jwt_identity()[0])
 
         return func(*args, **kwargs)
     return wrapper
@@ -436,26 +387,7 @@ def redirect_to_eventlog_node(func):
     # Redirect method to the event node
     def wrapper(*args, **kwargs):
         if not config.NODE_IS_EVENTLOG_NODE:
-            admin_token = get_api_token(
-                'http://%s:%d' % (config.EVENTLOG_NODE_IP, config.API_PORT),
-                namespace='system')
-            r = requests.request(
-                flask.request.environ['REQUEST_METHOD'],
-                'http://%s:%d%s'
-                % (config.EVENTLOG_NODE_IP, config.API_PORT,
-                   flask.request.environ['PATH_INFO']),
-                data=flask.request.data,
-                headers={
-                    'Authorization': admin_token,
-                    'User-Agent': util_general.get_user_agent(),
-                    'X-Request-ID': flask.request.headers.get('X-Request-ID')
-                })
-
-            LOG.info('Returning proxied request: %d, %s'
-                     % (r.status_code, r.text))
-            resp = flask.Response(r.text, mimetype='application/json')
-            resp.status_code = r.status_code
-            return resp
+            return proxy.proxy_request(config.EVENTLOG_NODE_IP, 'system')
 
         return func(*args, **kwargs)
     return wrapper
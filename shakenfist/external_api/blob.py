@@ -11,7 +11,6 @@ import os
 import random
 
 import flask
-import requests
 from flasgger import swag_from
 from flask_jwt_extended import get_jwt_identity
 from shakenfist_utilities import api as sf_api
@@ -23,14 +22,12 @@ from shakenfist import cache
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.blob import Blob
 from shakenfist.blob import Blobs
-from shakenfist.config import config
 from shakenfist.constants import BLOB_HASH_ALGORITHMS
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.daemons import daemon
 from shakenfist.external_api import base as api_base
+from shakenfist.external_api import proxy
 from shakenfist.instance import instance_usage_for_blob_uuid
-from shakenfist.namespace import get_api_token
-from shakenfist.util import general as util_general
 
 
 LOG, HANDLER = logs.setup(__name__)
@@ -53,26 +50,15 @@ def _read_file(filename, offset, limit=0):
 
 
 def _read_remote(target, blob_uuid, offset=0, limit=0):
-    api_token = get_api_token(
-        'http://%s:%d' % (target, config.API_PORT),
-        namespace=get_jwt_identity()[0])
-
-    url = 'http://%s:%d/blobs/%s/data?offset=%d&limit=%d' % (
-        target, config.API_PORT, blob_uuid, offset, limit)
-
     LOG.with_fields({
         'blob': blob_uuid,
         'offset': offset,
         'host': target
     }).info('Requesting blob from remote host')
-    r = requests.request(
-            'GET', url, stream=True,
-            headers={
-                'Authorization': api_token,
-                'User-Agent': util_general.get_user_agent(),
-                'X-Request-ID': flask.request.headers.get('X-Request-ID')
-            })
-    yield from r.iter_content(chunk_size=CHUNK_SIZE)
+    r = proxy.request(
+        target, 'GET', '/blobs/%s/data' % blob_uuid, get_jwt_identity()[0],
+        params={'offset': offset, 'limit': limit})
+    yield from proxy.iter_content(target, r)
 
 
 def arg_is_blob_uuid(func):
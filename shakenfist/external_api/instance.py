@@ -1258,9 +1258,20 @@ class InstanceConsoleDataEndpoint(sf_api.Resource):
             ('instance_ref', 'query', 'uuidorname',
              'The instance fetch console data for.', True),
             ('length', 'body', 'integer',
-             'The amount of data to fetch, defaults to 10240 bytes.', False)
+             ('The amount of data to fetch, defaults to 10240 bytes. If an '
+              'offset is specified, defaults to all available data.'), False),
+            ('offset', 'body', 'integer',
+             ('Return console data starting at this byte offset, instead of '
+              'the most recent data. Use the X-Console-Next-Offset header from '
+              'a previous call to follow the console.'), False),
+            ('wait', 'body', 'integer',
+             ('If there is no console data after offset yet, wait up to this '
+              'many seconds for some to arrive.'), False)
         ],
-        [(200, 'The console data as an application/octet-stream.', None),
+        [(200, ('The console data as an application/octet-stream. The '
+                'X-Console-Offset header is the offset of the first byte '
+                'returned, and X-Console-Next-Offset is the offset to request '
+                'next.'), None),
          (404, 'Instance not found.', None)],
         requires_admin=True))
     @api_base.verify_token
@@ -1268,27 +1279,38 @@ class InstanceConsoleDataEndpoint(sf_api.Resource):
     @api_base.requires_instance_ownership
     @api_base.redirect_instance_request
     @api_base.log_token_use
-    def get(self, instance_ref=None, length=None, instance_from_db=None):
-        parsed_length = None
-
-        if not length:
-            parsed_length = 10240
-        else:
+    def get(self, instance_ref=None, length=None, offset=None, wait=None,
+            instance_from_db=None):
+        parsed = {}
+        for name, value in [('length', length), ('offset', offset), ('wait', wait)]:
+            if value is None or value == '':
+                continue
             try:
-                parsed_length = int(length)
+                parsed[name] = int(value)
             except ValueError:
                 pass
 
             # This is done this way so that there is no active traceback for
             # the sf_api.error call, otherwise it would be logged.
-            if parsed_length is None:
-                return sf_api.error(400, 'length is not an integer')
+            if name not in parsed:
+                return sf_api.error(400, '%s is not an integer' % name)
+
+        if parsed.get('offset', 0) < 0:
+            return sf_api.error(400, 'offset must not be negative')
 
         instance_from_db.add_event(
             EVENT_TYPE_AUDIT, 'get console data request from REST API')
-        resp = flask.Response(
-            instance_from_db.get_console_data(parsed_length),
-            mimetype='applicaton/octet-stream')
+        if 'offset' in parsed:
+            start, data = instance_from_db.read_console_data(
+                parsed['offset'], length=parsed.get('length') or -1,
+                wait=min(max(0, parsed.get('wait', 0)), config.CONSOLE_LOG_MAX_WAIT))
+        else:
+            start, data = instance_from_db.get_console_data(
+                parsed.get('length') or 10240)
+
+        resp = flask.Response(data, mimetype='applicaton/octet-stream')
+        resp.headers['X-Console-Offset'] = str(start)
+        resp.headers['X-Console-Next-Offset'] = str(start + len(data))
         resp.status_code = 200
         return resp
 
@@ -1544,3 +1566,34 @@ class InstanceScreenshotEndpoint(sf_api.Resource):
         instance_from_db.add_event(
             EVENT_TYPE_AUDIT, 'screenshot request from REST API')
         return instance_from_db.get_screenshot()
+
+
+instance_start_profile_example = """{
+    "phases": {
+        "block_devices": {"duration": 2.1, "start": 0.0},
+        "boot": {"duration": 0.8, "start": 2.5},
+        "config_drive": {"duration": 0.2, "start": 2.1},
+        "define_domain": {"duration": 0.1, "start": 2.4},
+        "networks": {"duration": 1.4, "start": 0.0},
+        "ports": {"duration": 0.1, "start": 0.0}
+    },
+    "total": 3.4
+}"""
+
+
+class InstanceStartProfileEndpoint(sf_api.Resource):
+    @swag_from(api_base.swagger_helper(
+        'instances', 'Get the timing of each phase of the most recent start of an instance.',
+        [
+            ('instance_ref', 'query', 'uuidorname',
+             'The UUID or name of the instance.', True)
+        ],
+        [(200, 'The start profile of the instance, empty if it has not been started.',
+          instance_start_profile_example),
+         (404, 'Instance not found.', None)]))
+    @api_base.verify_token
+    @api_base.arg_is_instance_ref
+    @api_base.requires_instance_ownership
+    @api_base.log_token_use
+    def get(self, instance_ref=None, instance_from_db=None):
+        return instance_from_db.start_profile
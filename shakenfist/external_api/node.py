@@ -9,12 +9,12 @@
 from flasgger import swag_from
 from shakenfist_utilities import api as sf_api
 
-from shakenfist import etcd
 from shakenfist import eventlog
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.external_api import base as api_base
+from shakenfist.node import get_node_inventory
+from shakenfist.node import inventory_external_view
 from shakenfist.node import Node
-from shakenfist.node import Nodes
 
 
 node_get_example = """{
@@ -107,17 +107,8 @@ class NodesEndpoint(sf_api.Resource):
     @api_base.caller_is_admin
     @api_base.log_token_use
     def get(self):
-        # This is a little terrible. The way to work out which node is currently
-        # doing cluster maintenance is to lookup the lock.
-        locks = etcd.get_existing_locks()
-        maintainer = locks.get('/sflocks/sf/cluster/', {}).get('node')
-
-        out = []
-        for n in Nodes([]):
-            node_out = n.external_view()
-            node_out['is_cluster_maintainer'] = node_out['name'] == maintainer
-            out.append(node_out)
-        return out
+        return [inventory_external_view(entry)
+                for entry in get_node_inventory().values()]
 
 
 node_events_example = """[
@@ -0,0 +1,163 @@
+# Node to node HTTP requests made on behalf of an API request, for example to
+# forward a request to the hypervisor hosting an instance. Each API worker
+# process keeps a single pooled session, so that repeated requests to the same
+# node reuse connections, and responses are streamed back to our caller rather
+# than being buffered in the worker.
+import os
+import threading
+import time
+
+import flask
+import requests
+from prometheus_client import Counter
+from prometheus_client import Histogram
+from shakenfist_utilities import logs
+
+from shakenfist.config import config
+from shakenfist.daemons import daemon
+from shakenfist.namespace import get_api_token
+from shakenfist.util import general as util_general
+
+
+LOG, _ = logs.setup(__name__)
+daemon.set_log_level(LOG, 'api')
+
+
+PROXY_CHUNK_SIZE = 128 * 1024
+PROXY_POOL_SIZE = 16
+PROXY_CONNECT_TIMEOUT = 10
+PROXY_SLOW_REQUEST_SECONDS = 5
+
+PROXY_LATENCY = Histogram(
+    'api_proxy_latency_seconds',
+    'Time until a node to node API request returned response headers',
+    ['target'])
+PROXY_BYTES = Counter(
+    'api_proxy_bytes', 'Response bytes streamed from node to node API requests',
+    ['target'])
+PROXY_ERRORS = Counter(
+    'api_proxy_errors', 'Node to node API requests which failed', ['target'])
+
+# Headers from the remote response which are passed back to our caller. Console
+# data positions are returned as headers.
+PASSED_HEADER_PREFIXES = ['x-console-']
+
+_SESSION = None
+_SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+_USER_AGENT = None
+
+
+def _session():
+    global _SESSION
+    global _SESSION_PID
+
+    # Connections must not be shared across a fork, so a forked child builds
+    # its own session.
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_PID != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=PROXY_POOL_SIZE, pool_maxsize=PROXY_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSION = session
+            _SESSION_PID = os.getpid()
+        return _SESSION
+
+
+def _user_agent():
+    global _USER_AGENT
+
+    if not _USER_AGENT:
+        _USER_AGENT = util_general.get_user_agent()
+    return _USER_AGENT
+
+
+def _request_id():
+    request_id = flask.request.headers.get('X-Request-ID')
+    if not request_id:
+        request_id = flask.request.environ.get('FLASK_REQUEST_ID')
+    return request_id
+
+
+def request(target, method, path, namespace, data=None, params=None,
+            timeout=None):
+    """Make a streamed API request to another node.
+
+    The caller must close the returned response, or consume all of its
+    content, to return the connection to the pool.
+    """
+    base_url = 'http://%s:%d' % (target, config.API_PORT)
+    headers = {
+        'Authorization': get_api_token(base_url, namespace=namespace),
+        'User-Agent': _user_agent()
+    }
+    request_id = _request_id()
+    if request_id:
+        headers['X-Request-ID'] = request_id
+
+    if not timeout:
+        timeout = (PROXY_CONNECT_TIMEOUT, config.API_TIMEOUT)
+
+    start_time = time.time()
+    try:
+        r = _session().request(
+            method, base_url + path, data=data, params=params,
+            headers=headers, stream=True, timeout=timeout)
+    except requests.exceptions.RequestException:
+        PROXY_ERRORS.labels(target).inc()
+        raise
+    duration = time.time() - start_time
+    PROXY_LATENCY.labels(target).observe(duration)
+
+    log = LOG.with_fields({
+        'target': target,
+        'method': method,
+        'path': path,
+        'status': r.status_code,
+        'request-id': request_id,
+        'duration': duration
+    })
+    if duration > PROXY_SLOW_REQUEST_SECONDS:
+        log.warning('Slow node to node API request')
+    else:
+        log.debug('Node to node API request returned')
+    return r
+
+
+def iter_content(target, r):
+    try:
+        for chunk in r.iter_content(chunk_size=PROXY_CHUNK_SIZE):
+            PROXY_BYTES.labels(target).inc(len(chunk))
+            yield chunk
+    except requests.exceptions.RequestException:
+        PROXY_ERRORS.labels(target).inc()
+        raise
+    finally:
+        r.close()
+
+
+def proxy_request(target, namespace, data=None):
+    """Forward the current API request to another node.
+
+    The response is streamed back to our caller as it arrives.
+    """
+    path = flask.request.environ['PATH_INFO']
+    query = flask.request.environ.get('QUERY_STRING')
+    if query:
+        path += '?' + query
+
+    if data is None:
+        data = flask.request.get_data(as_text=False, parse_form_data=False)
+
+    r = request(target, flask.request.environ['REQUEST_METHOD'], path,
+                namespace, data=data)
+    resp = flask.Response(
+        iter_content(target, r), status=r.status_code,
+        content_type=r.headers.get('Content-Type', 'application/json'))
+    for header in r.headers:
+        for prefix in PASSED_HEADER_PREFIXES:
+            if header.lower().startswith(prefix):
+                resp.headers[header] = r.headers[header]
+    return resp
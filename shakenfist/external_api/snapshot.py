@@ -32,14 +32,15 @@ class InstanceSnapshotEndpoint(sf_api.Resource):
     @api_base.requires_instance_active
     @api_base.log_token_use
     def post(self, instance_ref=None, instance_from_db=None, all=None,
-             device=None, max_versions=0, thin=None):
+             device=None, max_versions=0, thin=None, incremental=False):
         if not thin:
             thin = config.SNAPSHOTS_DEFAULT_TO_THIN
 
         instance_from_db.add_event(
             EVENT_TYPE_AUDIT, 'snapshot request from REST API')
         return instance_from_db.snapshot(
-            all=all, device=device, max_versions=max_versions, thin=thin)
+            all=all, device=device, max_versions=max_versions, thin=thin,
+            incremental=incremental)
 
     @api_base.verify_token
     @api_base.arg_is_instance_ref
@@ -20,7 +20,6 @@ from shakenfist.constants import TRANSCODE_DESCRIPTION
 from shakenfist.tasks import ArchiveTranscodeTask
 from shakenfist.util import general as util_general
 from shakenfist.util import image as util_image
-from shakenfist.util import process as util_process
 
 
 LOG, _ = logs.setup(__name__)
@@ -109,24 +108,27 @@ class ImageFetchHelper:
         self.log = LOG.with_fields({'artifact': self.artifact.uuid})
 
     def get_image(self):
+        # Preparing an image is mostly local work -- pulling blobs from other
+        # nodes and transcoding them -- which only needs to be serialized
+        # within this node. Many nodes can therefore prepare the same image at
+        # once. Only the one time cluster actions, downloading the image from
+        # its source and updating the artifact index, take the cluster wide
+        # artifact lock (see _http_get_single_flight()).
         fetched_blobs = []
-        with self.artifact.get_lock(ttl=(12 * LOCK_REFRESH_SECONDS),
-                                    timeout=config.MAX_IMAGE_TRANSFER_SECONDS,
-                                    op='get image') as lock:
+        with self.artifact.get_lock(op='get image', global_scope=False):
             # Transfer the requested image, in its original format, from either
             # within the cluster (if we have it cached), or from the source. This
             # means that even if we have a cached post transcode version of the image
             # we insist on having the original locally. This was mostly done because
             # I am lazy, but it also serves as a partial access check.
-            fetched_blobs.append(self.transfer_image(lock))
+            fetched_blobs.append(self.transfer_image())
 
             # If the image depends on another image, we must fetch that too.
             while depends_on := fetched_blobs[-1].depends_on:
                 self.log.with_fields({
                     'parent_blob_uuid': fetched_blobs[-1].uuid,
                     'child_blob_uuid': depends_on}).info('Fetching dependency')
-                fetched_blobs.append(
-                    self._blob_get(lock, 'sf://blob/%s' % depends_on))
+                fetched_blobs.append(self._blob_get('sf://blob/%s' % depends_on))
 
             # We might already have a transcoded version of the image cached. If so
             # we use that. Otherwise, we might have a transcoded version within the
@@ -136,93 +138,151 @@ class ImageFetchHelper:
             # transcode version of the image, and we don't completely trust the
             # transcode process to be deterministic.
             for b in fetched_blobs:
-                self.transcode_image(lock, b)
-
-    def transfer_image(self, lock):
-        # NOTE(mikal): it is assumed the caller holds a lock on the artifact, and passes
-        # it in.
+                self.transcode_image(b)
+
+    def _most_recent_blob_if_current(self, url, most_recent):
+        # Return the most recently fetched blob for this artifact if it is
+        # still the current version of the image at url, otherwise None.
+        if most_recent.get('index', 0) == 0:
+            self.log.info('Cluster does not have a copy of image')
+            return None
+
+        most_recent_blob = blob.Blob.from_db(most_recent['blob_uuid'])
+        validators = {}
+        if most_recent_blob:
+            validators = most_recent_blob.http_validators
+            if validators.get('url') != url:
+                validators = {}
+        dirty = False
 
-        url = _resolve_image(self.artifact.source_url)
+        try:
+            resp = self._check_source(url, validators)
+        except (exceptions.HTTPError, requests.exceptions.RequestException) as e:
+            self.artifact.add_event(
+                EVENT_TYPE_AUDIT,
+                'image fetch had HTTP error, not fetching image',
+                extra={'error': str(e)})
+        else:
+            if most_recent_blob and resp.status_code == 304:
+                self.log.info('Image source reports image is unchanged')
+                return most_recent_blob
 
-        # If this is a request for a URL, do we have the most recent version
-        # somewhere in the cluster?
-        if not url.startswith(BLOB_URL):
-            most_recent = self.artifact.most_recent_index
-            dirty = False
+            normalized_new_timestamp = blob.Blob.normalize_timestamp(
+                resp.headers.get('Last-Modified'))
 
-            if most_recent.get('index', 0) == 0:
-                self.log.info('Cluster does not have a copy of image')
+            if not most_recent_blob:
                 dirty = True
             else:
-                most_recent_blob = blob.Blob.from_db(most_recent['blob_uuid'])
-
-                try:
-                    resp = self._open_connection(url)
-                except exceptions.HTTPError as e:
+                if not most_recent_blob.modified:
                     self.artifact.add_event(
                         EVENT_TYPE_AUDIT,
-                        'image fetch had HTTP error, not fetching image',
-                        extra={'error': str(e)})
-                else:
-                    normalized_new_timestamp = blob.Blob.normalize_timestamp(
-                        resp.headers.get('Last-Modified'))
+                        'image requires fetch, no Last-Modified recorded')
+                    dirty = True
+                elif most_recent_blob.modified != normalized_new_timestamp:
+                    self.artifact.add_event(
+                        EVENT_TYPE_AUDIT,
+                        'image requires fetch, Last-Modified changed',
+                        extra={
+                            'old': most_recent_blob.modified,
+                            'new': normalized_new_timestamp
+                        })
+                    dirty = True
+
+                new_etag = resp.headers.get('ETag')
+                if (validators.get('etag') and new_etag and
+                        validators['etag'] != new_etag):
+                    self.artifact.add_event(
+                        EVENT_TYPE_AUDIT,
+                        'image requires fetch, ETag changed',
+                        extra={
+                            'old': validators['etag'],
+                            'new': new_etag
+                        })
+                    dirty = True
+
+                response_size = resp.headers.get('Content-Length')
+                if response_size:
+                    response_size = int(response_size)
+
+                if not most_recent_blob.size:
+                    self.artifact.add_event(
+                        EVENT_TYPE_AUDIT,
+                        'image requires fetch, no Content-Length recorded')
+                    dirty = True
+                elif most_recent_blob.size != response_size:
+                    self.artifact.add_event(
+                        EVENT_TYPE_AUDIT,
+                        'image requires fetch, Content-Length changed',
+                        extra={
+                            'old': most_recent_blob.size,
+                            'new': response_size
+                        })
+                    dirty = True
+
+        if dirty:
+            return None
+        return most_recent_blob
+
+    def transfer_image(self):
+        url = _resolve_image(self.artifact.source_url)
 
-                    if not most_recent_blob:
-                        dirty = True
-                    else:
-                        if not most_recent_blob.modified:
-                            self.artifact.add_event(
-                                EVENT_TYPE_AUDIT,
-                                'image requires fetch, no Last-Modified recorded')
-                            dirty = True
-                        elif most_recent_blob.modified != normalized_new_timestamp:
-                            self.artifact.add_event(
-                                EVENT_TYPE_AUDIT,
-                                'image requires fetch, Last-Modified changed',
-                                extra={
-                                    'old': most_recent_blob.modified,
-                                    'new': normalized_new_timestamp
-                                })
-                            dirty = True
-
-                        response_size = resp.headers.get('Content-Length')
-                        if response_size:
-                            response_size = int(response_size)
-
-                        if not most_recent_blob.size:
-                            self.artifact.add_event(
-                                EVENT_TYPE_AUDIT,
-                                'image requires fetch, no Content-Length recorded')
-                            dirty = True
-                        elif most_recent_blob.size != response_size:
-                            self.artifact.add_event(
-                                EVENT_TYPE_AUDIT,
-                                'image requires fetch, Content-Length changed',
-                                extra={
-                                    'old': most_recent_blob.size,
-                                    'new': response_size
-                                })
-                            dirty = True
-
-            if not dirty:
+        # If this is a request for a URL, do we have the most recent version
+        # somewhere in the cluster? Note the last fetch before we check, so
+        # that we notice if another node downloads the image in the meantime.
+        if not url.startswith(BLOB_URL):
+            seen_fetch = self.artifact.last_fetch
+            most_recent = self.artifact.most_recent_index
+            most_recent_blob = self._most_recent_blob_if_current(url, most_recent)
+            if most_recent_blob:
                 url = f'{BLOB_URL}{most_recent_blob.uuid}'
 
         # Ensure that we have the blob in the local store. This blob is in the
         # "original format" if downloaded from an HTTP source.
         if url.startswith(BLOB_URL):
             self.log.info('Fetching image from within the cluster')
-            b = self._blob_get(lock, url)
-        else:
-            self.log.info('Fetching image from the internet')
-            b = self._http_get_inner(lock, url, instance_object=self.instance)
+            return self._blob_get(url)
 
-        return b
-
-    def transcode_image(self, lock, b):
-        # NOTE(mikal): it is assumed the caller holds a lock on the artifact, and passes
-        # it in lock.
+        return self._http_get_single_flight(url, most_recent, seen_fetch)
 
-        # If this blob uuid is not the most recent index for the artifact, set that
+    def _http_get_single_flight(self, url, seen_index, seen_fetch):
+        # Only one node downloads a given image from its source. Everyone else
+        # waits for the artifact lock, and then finds that the artifact has
+        # been fetched since they looked and pulls the fetched blob from
+        # within the cluster instead. The index alone is not enough to detect
+        # this, as it does not change if the download matched the existing
+        # most recent blob.
+        with self.artifact.get_lock(ttl=(12 * LOCK_REFRESH_SECONDS),
+                                    timeout=config.MAX_IMAGE_TRANSFER_SECONDS,
+                                    op='fetch image') as lock:
+            last_fetch = self.artifact.last_fetch
+            most_recent = self.artifact.most_recent_index
+            if last_fetch and last_fetch != seen_fetch and last_fetch['url'] == url:
+                fetched_blob_uuid = last_fetch['blob_uuid']
+            elif most_recent.get('index', 0) > seen_index.get('index', 0):
+                fetched_blob_uuid = most_recent['blob_uuid']
+            else:
+                self.log.info('Fetching image from the internet')
+                b = self._http_get_inner(lock, url, instance_object=self.instance)
+
+                # Update the index and record the fetch while we still hold
+                # the lock, so that nodes waiting for it see the new blob.
+                # If the download matched the most recent blob then the index
+                # is unchanged, and waiters use that blob.
+                mri = self.artifact.add_index(b.uuid)
+                self.artifact.record_fetch(url, mri.get('blob_uuid', b.uuid))
+                return b
+
+        self.log.with_fields({'blob': fetched_blob_uuid}).info(
+            'Image was fetched by another node, fetching from within the cluster')
+        return self._blob_get(f'{BLOB_URL}{fetched_blob_uuid}')
+
+    def transcode_image(self, b):
+        # NOTE(mikal): it is assumed the caller holds the node local lock on the
+        # artifact.
+
+        # If this blob uuid is not the most recent index for the artifact, set that.
+        # add_index() takes its own lock and ignores repeats, so nodes racing
+        # to do this is harmless.
         if self.artifact.most_recent_index.get('blob_uuid') != b.uuid:
             self.artifact.add_index(b.uuid)
 
@@ -261,7 +321,7 @@ class ImageFetchHelper:
             remote_blob = blob.Blob.from_db(cached_remotely)
             if not remote_blob:
                 raise exceptions.BlobMissing(cached_remotely)
-            remote_blob.ensure_local([lock], instance_object=self.instance)
+            remote_blob.ensure_local([], instance_object=self.instance)
 
             cache_path = os.path.join(
                 config.STORAGE_PATH, 'image_cache', b.uuid + '.qcow2')
@@ -271,33 +331,56 @@ class ImageFetchHelper:
 
         else:
             blob_path = blob.Blob.filepath(b.uuid)
-
-            if mimetype == 'application/gzip':
-                cache_path = os.path.join(
-                    config.STORAGE_PATH, 'image_cache', b.uuid)
-                with util_general.RecordedOperation('decompress image', self.instance):
-                    util_process.execute(
-                        [lock], f'gunzip -k -q -c {blob_path} > {cache_path}')
-                blob_path = cache_path
-
             cache_path = os.path.join(
                 config.STORAGE_PATH, 'image_cache', b.uuid + '.qcow2')
-            cache_info = util_image.identify(blob_path)
-
             cluster_size_as_int = int(util_image.convert_numeric_qemu_value(
                 QCOW2_CLUSTER_SIZE))
 
-            if (cache_info.get('file format', '') == 'qcow2' and
-                    cache_info.get('cluster_size', 0) == cluster_size_as_int):
+            # If we know the sha512 of the final cache file, we pass it to the
+            # archive task so that it doesn't need to reread the file to hash it.
+            cache_sha512 = None
+
+            compression = util_image.COMPRESSED_MIME_TYPES.get(mimetype)
+            if compression:
+                # Decompress in a single pass which also identifies the image
+                # and hashes it. If the image inside is already a qcow2 with
+                # the right cluster size the decompressed file is the final
+                # cache file, otherwise qemu-img needs a seekable file to
+                # convert from, so the decompressed copy is written sparsely
+                # and removed once converted.
+                partial_path = cache_path + '.partial'
+                with util_general.RecordedOperation('decompress image', self.instance):
+                    cache_info, sha512 = util_image.decompress(
+                        blob_path, compression, partial_path)
+
                 try:
-                    util_general.link(blob_path, cache_path)
-                except FileExistsError:
-                    ...
+                    if (cache_info.get('file format', '') == 'qcow2' and
+                            cache_info.get('cluster_size', 0) == cluster_size_as_int):
+                        os.rename(partial_path, cache_path)
+                        cache_sha512 = sha512
+                    else:
+                        with util_general.RecordedOperation('transcode image', self.instance):
+                            self.log.with_fields({'blob': b}).info(
+                                f'Transcoding {blob_path} -> {cache_path}')
+                            util_image.create_qcow2(None, partial_path, cache_path)
+                finally:
+                    if os.path.exists(partial_path):
+                        os.unlink(partial_path)
+
             else:
-                with util_general.RecordedOperation('transcode image', self.instance):
-                    self.log.with_fields({'blob': b}).info(
-                        f'Transcoding {blob_path} -> {cache_path}')
-                    util_image.create_qcow2([lock], blob_path, cache_path)
+                cache_info = util_image.identify(blob_path)
+                if (cache_info.get('file format', '') == 'qcow2' and
+                        cache_info.get('cluster_size', 0) == cluster_size_as_int):
+                    try:
+                        util_general.link(blob_path, cache_path)
+                    except FileExistsError:
+                        ...
+                    cache_sha512 = b.checksums.get('sha512')
+                else:
+                    with util_general.RecordedOperation('transcode image', self.instance):
+                        self.log.with_fields({'blob': b}).info(
+                            f'Transcoding {blob_path} -> {cache_path}')
+                        util_image.create_qcow2(None, blob_path, cache_path)
 
             # We will cache this transcode, but we do it later as part of a
             # task so the instance isn't waiting for it.
@@ -306,7 +389,8 @@ class ImageFetchHelper:
                 {
                     'tasks': [
                         ArchiveTranscodeTask(
-                            b.uuid, cache_path, TRANSCODE_DESCRIPTION)]
+                            b.uuid, cache_path, TRANSCODE_DESCRIPTION,
+                            sha512=cache_sha512)]
                 })
 
         shutil.chown(cache_path, config.LIBVIRT_USER,
@@ -317,7 +401,7 @@ class ImageFetchHelper:
         if self.artifact.state.value == Artifact.STATE_INITIAL:
             self.artifact.state = Artifact.STATE_CREATED
 
-    def _blob_get(self, lock, url):
+    def _blob_get(self, url):
         """Fetch a blob from the cluster."""
 
         blob_uuid = url[len(BLOB_URL):]
@@ -326,14 +410,13 @@ class ImageFetchHelper:
         if not b:
             raise exceptions.BlobMissing(blob_uuid)
 
-        b.ensure_local([lock], instance_object=self.instance)
+        b.ensure_local([], instance_object=self.instance)
         return b
 
     def _http_get_inner(self, lock, url, instance_object=None):
         """Fetch image if not downloaded and return image path."""
 
         with util_general.RecordedOperation('fetch image', self.instance):
-            resp = self._open_connection(url)
             blob_uuid = str(uuid.uuid4())
             self.log.with_fields({
                 'artifact': self.artifact,
@@ -342,7 +425,7 @@ class ImageFetchHelper:
 
             try:
                 b = blob.http_fetch(
-                    url, resp, blob_uuid, [lock], self.log, instance_object=instance_object)
+                    url, blob_uuid, [lock], self.log, instance_object=instance_object)
             except exceptions.BadCheckSum as e:
                 self.instance.add_event(
                     EVENT_TYPE_AUDIT, 'fetched image had bad checksum')
@@ -352,16 +435,39 @@ class ImageFetchHelper:
 
             return b
 
-    def _open_connection(self, url):
-        proxies = {}
-        if config.HTTP_PROXY_SERVER:
-            proxies['http'] = config.HTTP_PROXY_SERVER
+    def _check_source(self, url, validators):
+        # Ask the source about the image without downloading it. If we have
+        # validators from our last download, the request is conditional and
+        # the source replies 304 if the image is unchanged.
+        headers = {'User-Agent': util_general.get_user_agent()}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        resp = requests.head(url, allow_redirects=True, headers=headers,
+                             proxies=blob.http_proxies(),
+                             timeout=blob.HTTP_FETCH_TIMEOUT)
+        if resp.status_code in (200, 304):
+            return resp
+
+        if resp.status_code in (405, 501):
+            # Some servers do not implement HEAD, so we start a GET and close it
+            # once we have the headers instead.
+            resp = self._open_connection(url)
+            resp.close()
+            return resp
 
+        raise exceptions.HTTPError(
+            'Failed to fetch HEAD of %s (status code %d)'
+            % (url, resp.status_code))
+
+    def _open_connection(self, url):
         resp = requests.get(url, allow_redirects=True, stream=True,
                             headers={'User-Agent': util_general.get_user_agent()},
-                            proxies=proxies)
+                            proxies=blob.http_proxies())
         if resp.status_code != 200:
             raise exceptions.HTTPError(
-                'Failed to fetch HEAD of %s (status code %d)'
+                'Failed to fetch %s (status code %d)'
                 % (url, resp.status_code))
         return resp
@@ -3,15 +3,12 @@
 # part of their role is to combine foundational baseobjects into something more
 # useful.
 import base64
-import io
-import json
 import os
 import pathlib
-import random
 import shutil
-import socket
 import time
 from collections import defaultdict
+from concurrent import futures
 from functools import partial
 from uuid import uuid4
 
@@ -19,15 +16,19 @@ import jinja2
 import pycdlib
 from shakenfist_utilities import logs
 
+from shakenfist import agentoperation
 from shakenfist import artifact
 from shakenfist import baseobject
 from shakenfist import blob
 from shakenfist import cache
+from shakenfist import configdrive
+from shakenfist import consolelog
 from shakenfist import constants
 from shakenfist import etcd
 from shakenfist import exceptions
 from shakenfist import network
 from shakenfist import networkinterface
+from shakenfist import portallocator
 from shakenfist.agentoperation import AgentOperation
 from shakenfist.agentoperation import AgentOperations
 from shakenfist.agentoperation import instance_filter as agent_instance_filter
@@ -47,6 +48,35 @@ from shakenfist.util import libvirt as util_libvirt
 LOG, _ = logs.setup(__name__)
 
 
+# Agent operations moved from a single attribute to individually keyed queue
+# and history entries in instance version 15. Nodes running older releases only
+# understand the attribute, so instances stored before then keep using it until
+# every node has been upgraded.
+AGENT_OPERATION_KEYS_VERSION = 15
+
+
+def _migrate_agent_operations(instance_uuid):
+    # Move the queue and list of all operations from the legacy attribute into
+    # individual entries. Entries are written one at a time so that their
+    # create revisions preserve the original order.
+    if not etcd.get('attribute/instance', instance_uuid, 'agent_operations'):
+        return
+
+    with etcd.get_lock('attribute/instance', instance_uuid, 'agent_operations',
+                       op='Migrate agent operations'):
+        db_data = etcd.get('attribute/instance', instance_uuid,
+                           'agent_operations') or {}
+        queued = db_data.get('queue', [])
+        for agentop_uuid in db_data.get('all', []):
+            puts = {agentoperation.history_key(instance_uuid, agentop_uuid):
+                    {'agentop': agentop_uuid}}
+            if agentop_uuid in queued:
+                puts[agentoperation.queue_key(instance_uuid, agentop_uuid)] = \
+                    {'agentop': agentop_uuid}
+            etcd.apply_many(puts=puts)
+        etcd.delete('attribute/instance', instance_uuid, 'agent_operations')
+
+
 def _get_defaulted_disk_bus(disk):
     bus = disk.get('bus')
     if bus:
@@ -87,7 +117,7 @@ def _safe_int_cast(i):
 
 class Instance(dbo):
     object_type = 'instance'
-    current_version = 14
+    current_version = 15
 
     # docs/developer_guide/state_machine.md has a description of these states.
     STATE_INITIAL_ERROR = 'initial-error'
@@ -134,10 +164,18 @@ class Instance(dbo):
     METADATA_KEY_AFFINITY = 'affinity'
 
     def __init__(self, static_values):
+        stored_version = static_values.get('version', self.initial_version)
         self.upgrade(static_values)
 
         super().__init__(static_values.get('uuid'), static_values.get('version'))
 
+        # If every node was upgraded when we were loaded, the upgrade has moved
+        # any legacy agent operations already.
+        self.__legacy_agent_operations = (
+            stored_version < AGENT_OPERATION_KEYS_VERSION and
+            baseobject.get_minimum_object_version(self.object_type) <
+            AGENT_OPERATION_KEYS_VERSION)
+
         self.__cpus = static_values.get('cpus')
         self.__disk_spec = static_values.get('disk_spec')
         self.__memory = static_values.get('memory')
@@ -231,6 +269,15 @@ class Instance(dbo):
                         'attribute/instance', static_values['uuid'],
                         'block_devices', bd)
 
+    @classmethod
+    def _upgrade_step_14_to_15(cls, static_values):
+        # Agent operations are only moved once every node understands the new
+        # keys, which is also when this upgrade is committed. Until then they
+        # stay in the legacy attribute, see _agent_operations_legacy().
+        if (baseobject.get_minimum_object_version(cls.object_type) >=
+                AGENT_OPERATION_KEYS_VERSION):
+            _migrate_agent_operations(static_values['uuid'])
+
     @classmethod
     def new(cls, name=None, cpus=None, memory=None, namespace=None, ssh_key=None,
             disk_spec=None, user_data=None, video=None, requested_placement=None,
@@ -270,6 +317,14 @@ class Instance(dbo):
         i._db_set_attribute('power_state', {'power_state': cls.STATE_INITIAL})
         return i
 
+    def _index_changes_for_state(self, old_value, new_value):
+        # Instances stop counting towards blob usage once they are no longer
+        # healthy, so cached views of blob usage need to be refreshed.
+        if old_value in self.HEALTHY_STATES and new_value not in self.HEALTHY_STATES:
+            return blob.usage_generation_bump_for_disks(
+                self.block_devices.get('devices', [])), None
+        return None, None
+
     def external_view(self):
         # If this is an external view, then mix back in attributes that users
         # expect
@@ -434,6 +489,14 @@ class Instance(dbo):
     def ports(self, ports):
         self._db_set_attribute('ports', ports)
 
+    @property
+    def start_profile(self):
+        return self._db_get_attribute('start_profile')
+
+    @start_profile.setter
+    def start_profile(self, start_profile):
+        self._db_set_attribute('start_profile', start_profile)
+
     @property
     def enforced_deletes(self):
         return self._db_get_attribute('enforced_deletes')
@@ -681,23 +744,50 @@ class Instance(dbo):
     # creation. It is assumed that the image sits in local cache already, and
     # has been transcoded to the right format. This has been done to facilitate
     # moving to a queue and task based creation mechanism.
-    def create(self, iface_uuids, lock=None):
+    def create(self, iface_uuids, lock=None, prerequisites=None):
+        """Create the instance on this hypervisor and power it on.
+
+        prerequisites is an optional dictionary of phase name to a callable
+        which must complete before the instance is powered on, for example
+        network plumbing. These run concurrently with console port allocation
+        and the preparation of block devices and the config drive. The time
+        taken by each phase is recorded in the instance's start profile, which
+        is also returned.
+        """
         self.state = self.STATE_CREATING
         self.interfaces = iface_uuids
 
         # Ensure we have state on disk
         os.makedirs(self.instance_path, exist_ok=True)
 
-        # Configure block devices, not including config drive creation which is
-        # done in power_on().
-        self._configure_block_devices(lock)
+        profile = util_general.PhaseProfile()
+        prerequisites = dict(prerequisites or {})
+        prerequisites['ports'] = self.allocate_instance_ports
+
+        with futures.ThreadPoolExecutor(max_workers=len(prerequisites)) as executor:
+            pending = []
+            for name, func in prerequisites.items():
+                pending.append(executor.submit(profile.run, name, func))
+
+            # The config drive needs the block device layout, so these two
+            # phases run in order.
+            profile.run('block_devices', self._configure_block_devices, lock)
+            profile.run('config_drive', self._make_config_drive)
+
+            # Raise any exception from the other phases
+            for f in pending:
+                f.result()
+
+        self.power_on(config_drive=False, profile=profile)
+        start_profile = profile.summary()
+        self.start_profile = start_profile
 
-        self.power_on()
         if self.is_powered_on():
             self.state = self.STATE_CREATED
         else:
             self.add_event(EVENT_TYPE_AUDIT, 'instance failed to power on')
             self.enqueue_delete_due_error('Instance failed to power on')
+        return start_profile
 
     def _delete_on_hypervisor(self):
         if config.ARCHIVE_INSTANCE_CONSOLE_DURATION > 0:
@@ -737,6 +827,10 @@ class Instance(dbo):
                 util_general.ignore_exception(
                     'instance delete disks %s' % self, e)
 
+    def hard_delete(self):
+        etcd.delete_prefix(agentoperation.history_key(self.uuid))
+        super().hard_delete()
+
     def _delete_globally(self):
         blob_refs = self.blob_references
         for blob_uuid in blob_refs:
@@ -744,6 +838,7 @@ class Instance(dbo):
             if b:
                 b.ref_count_dec(self, blob_refs[blob_uuid])
         self.blob_references = {}
+        self._release_console_segments()
 
         self.deallocate_instance_ports()
 
@@ -758,6 +853,7 @@ class Instance(dbo):
                 [partial(agent_instance_filter, self)],
                 suppress_failure_audit=True):
             agentop.delete()
+        etcd.delete_prefix(agentoperation.queue_key(self.uuid))
 
         if self.state.value.endswith('-%s' % self.STATE_ERROR):
             self.state = self.STATE_ERROR
@@ -768,58 +864,25 @@ class Instance(dbo):
         self._delete_on_hypervisor()
         self._delete_globally()
 
-    def _allocate_console_port(self):
-        node = config.NODE_NAME
-        consumed = [value['port']
-                    for _, value in etcd.get_all('console', node)]
-        while True:
-            port = random.randint(30000, 50000)
-            # avoid hitting etcd if it's probably in use
-            if port in consumed:
-                continue
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                # We hold this port open until it's in etcd to prevent
-                # anyone else needing to hit etcd to find out they can't
-                # use it as well as to verify we can use it
-                s.bind(('0.0.0.0', port))
-                allocatedPort = etcd.create(
-                    'console', node, port,
-                    {
-                        'instance_uuid': self.uuid,
-                        'port': port,
-                    })
-                if allocatedPort:
-                    return port
-            except OSError:
-                LOG.with_fields({'instance': self.uuid}).info(
-                    'Collided with in use port %d, selecting another' % port)
-                consumed.append(port)
-            finally:
-                s.close()
-
-    def _free_console_port(self, port):
-        if port:
-            etcd.delete('console', config.NODE_NAME, port)
-
     def allocate_instance_ports(self):
         with self.get_lock_attr('ports', 'Instance port allocation'):
             p = self.ports
             if not p:
-                p = {
-                    'console_port': self._allocate_console_port(),
-                    'vdi_port': self._allocate_console_port()
-                }
+                names = ['console_port', 'vdi_port']
                 if self.video['vdi'].startswith('spice'):
-                    p['vdi_tls_port'] = self._allocate_console_port()
+                    names.append('vdi_tls_port')
+
+                allocated = portallocator.get_allocator().allocate(
+                    self.uuid, len(names))
+                self.ports = dict(zip(names, allocated))
 
-                self.ports = p
+    def _free_instance_ports(self, ports):
+        portallocator.get_allocator().release(
+            [ports.get('console_port'), ports.get('vdi_port'),
+             ports.get('vdi_tls_port')])
 
     def deallocate_instance_ports(self):
-        ports = self.ports
-        self._free_console_port(ports.get('console_port'))
-        self._free_console_port(ports.get('vdi_port'))
-        self._free_console_port(ports.get('vdi_tls_port'))
+        self._free_instance_ports(self.ports)
         self._db_delete_attribute('ports')
 
     def _configure_block_devices(self, lock):
@@ -964,32 +1027,16 @@ class Instance(dbo):
 
                 block_devices['devices'] = modified_disks
                 block_devices['finalized'] = True
-                self._db_set_attribute('block_devices', block_devices)
+                self._db_set_attribute(
+                    'block_devices', block_devices,
+                    extra_puts=blob.usage_generation_bump_for_disks(modified_disks))
 
     def _make_config_drive_openstack_disk(self, disk_path):
         """Create a config drive"""
 
-        # NOTE(mikal): with a big nod at https://gist.github.com/pshchelo/378f3c4e7d18441878b9652e9478233f
-        iso = pycdlib.PyCdlib()
-        iso.new(interchange_level=4,
-                joliet=True,
-                rock_ridge='1.09',
-                vol_ident='config-2')
-
-        # We're only going to pretend to do the most recent OpenStack version
-        iso.add_directory('/openstack',
-                          rr_name='openstack',
-                          joliet_path='/openstack')
-        iso.add_directory('/openstack/2017-02-22',
-                          rr_name='2017-02-22',
-                          joliet_path='/openstack/2017-02-22')
-        iso.add_directory('/openstack/latest',
-                          rr_name='latest',
-                          joliet_path='/openstack/latest')
-
-        # meta_data.json -- note that limits on hostname are imposted at the API layer
-        md = json.dumps({
-            'random_seed': base64.b64encode(os.urandom(512)).decode('ascii'),
+        # meta_data.json -- note that limits on hostname are imposted at the API
+        # layer. The random seed is added when the config drive is built.
+        md = {
             'uuid': self.uuid,
             'availability_zone': config.ZONE,
             'hostname': '%s.local' % self.name,
@@ -1000,13 +1047,7 @@ class Instance(dbo):
             'public_keys': {
                 'mykey': self.ssh_key
             }
-        }).encode('ascii')
-        iso.add_fp(io.BytesIO(md), len(md), '/openstack/latest/meta_data.json;1',
-                   rr_name='meta_data.json',
-                   joliet_path='/openstack/latest/meta_data.json')
-        iso.add_fp(io.BytesIO(md), len(md), '/openstack/2017-02-22/meta_data.json;2',
-                   rr_name='meta_data.json',
-                   joliet_path='/openstack/2017-02-22/meta_data.json')
+        }
 
         # user_data: we used to only write this if there was some user data
         # specified, but that reports a schema error with cloud-init like this:
@@ -1018,13 +1059,6 @@ class Instance(dbo):
         else:
             user_data = b'#cloud-config\n'
 
-        iso.add_fp(io.BytesIO(user_data), len(user_data), '/openstack/latest/user_data',
-                   rr_name='user_data',
-                   joliet_path='/openstack/latest/user_data.json')
-        iso.add_fp(io.BytesIO(user_data), len(user_data), '/openstack/2017-02-22/user_data',
-                   rr_name='user_data',
-                   joliet_path='/openstack/2017-02-22/user_data.json')
-
         # network_data.json
         nd = {
             'links': [],
@@ -1094,40 +1128,11 @@ class Instance(dbo):
                 'type': 'dns'
             })
 
-        nd_encoded = json.dumps(nd).encode('ascii')
-        iso.add_fp(io.BytesIO(nd_encoded), len(nd_encoded),
-                   '/openstack/latest/network_data.json;3',
-                   rr_name='network_data.json',
-                   joliet_path='/openstack/latest/vendor_data.json')
-        iso.add_fp(io.BytesIO(nd_encoded), len(nd_encoded),
-                   '/openstack/2017-02-22/network_data.json;4',
-                   rr_name='network_data.json',
-                   joliet_path='/openstack/2017-02-22/vendor_data.json')
-
-        # empty vendor_data.json and vendor_data2.json
-        vd = b'{}'
-        iso.add_fp(io.BytesIO(vd), len(vd),
-                   '/openstack/latest/vendor_data.json;5',
-                   rr_name='vendor_data.json',
-                   joliet_path='/openstack/latest/vendor_data.json')
-        iso.add_fp(io.BytesIO(vd), len(vd),
-                   '/openstack/2017-02-22/vendor_data.json;6',
-                   rr_name='vendor_data.json',
-                   joliet_path='/openstack/2017-02-22/vendor_data.json')
-        iso.add_fp(io.BytesIO(vd), len(vd),
-                   '/openstack/latest/vendor_data2.json;7',
-                   rr_name='vendor_data2.json',
-                   joliet_path='/openstack/latest/vendor_data2.json')
-        iso.add_fp(io.BytesIO(vd), len(vd),
-                   '/openstack/2017-02-22/vendor_data2.json;8',
-                   rr_name='vendor_data2.json',
-                   joliet_path='/openstack/2017-02-22/vendor_data2.json')
-
-        # Dump to disk
-        if os.path.exists(disk_path):
-            os.unlink(disk_path)
-        iso.write(disk_path)
-        iso.close()
+        # Only rebuild the config drive if its content has changed
+        if configdrive.build(disk_path, md, user_data, nd):
+            self.log.info('Built config drive')
+        else:
+            self.log.info('Reused unchanged config drive')
 
     def _create_domain_xml(self):
         """Create the domain XML for the instance."""
@@ -1167,7 +1172,7 @@ class Instance(dbo):
                 b.ensure_local([], instance_object=self)
                 b.add_event(EVENT_TYPE_AUDIT, 'instance is using blob',
                             extra={'instance_uuid': self.uuid})
-                shutil.copyfile(
+                util_general.clone_file(
                     blob.Blob.filepath(b.uuid), os.path.join(self.instance_path, 'nvram'))
                 nvram_template_attribute = ''
 
@@ -1230,23 +1235,31 @@ class Instance(dbo):
 
             return lc.extract_power_state(inst)
 
-    def power_on(self):
-        # Generate a config drive. It is deliberate that this is in power_on now,
-        # as a hard power off / on cycle should imply the re-creation of the
-        # config drive. This is useful for hotplugged devices, because subsequent
-        # cloud-init runs will now know about the new devices.
+    def _make_config_drive(self):
         if self.configdrive == 'openstack-disk':
             self._make_config_drive_openstack_disk(
                 os.path.join(self.instance_path,
                              self.block_devices['devices'][1]['path']))
 
+    def power_on(self, config_drive=True, profile=None):
+        if not profile:
+            profile = util_general.PhaseProfile()
+
+        # Generate a config drive. It is deliberate that this is in power_on now,
+        # as a hard power off / on cycle should imply the re-creation of the
+        # config drive. This is useful for hotplugged devices, because subsequent
+        # cloud-init runs will now know about the new devices. create() builds
+        # the config drive itself, concurrently with other start phases.
+        if config_drive:
+            profile.run('config_drive', self._make_config_drive)
+
         # Create the actual instance. Sometimes on Ubuntu 20.04 we need to wait
         # for port binding to work. Revisiting this is tracked by issue 320 on
         # github. Additionally, sometimes ports are not released correctly by a
         # domain destroy, which means we need to reassign on domain start.
-        if not self._power_on_inner():
+        if not self._power_on_inner(profile):
             attempts = 0
-            while not self._power_on_inner() and attempts < 5:
+            while not self._power_on_inner(profile) and attempts < 5:
                 self.log.warning(
                     'Instance required an additional attempt to power on')
                 time.sleep(5)
@@ -1254,18 +1267,20 @@ class Instance(dbo):
 
             self.agent_state = constants.AGENT_NEVER_TALKED
 
-    def _power_on_inner(self):
+    def _power_on_inner(self, profile):
         with util_libvirt.LibvirtConnection() as lc:
             inst = lc.get_domain_from_sf_uuid(self.uuid)
             if not inst:
-                inst = lc.define_xml(self._create_domain_xml())
+                with profile.phase('define_domain'):
+                    inst = lc.define_xml(self._create_domain_xml())
                 if not inst:
                     self.enqueue_delete_due_error(
                         'power on failed to create domain')
                     raise exceptions.NoDomainException()
 
             try:
-                inst.create()
+                with profile.phase('boot'):
+                    inst.create()
             except lc.libvirt.libvirtError as e:
                 if str(e).startswith('Requested operation is not valid: '
                                      'domain is already running'):
@@ -1279,10 +1294,7 @@ class Instance(dbo):
                         extra={'message': str(e)})
 
                     # Free those ports and pick some new ones
-                    ports = self.ports
-                    self._free_console_port(ports['console_port'])
-                    self._free_console_port(ports['vdi_port'])
-                    self._free_console_port(ports['vdi_tls_port'])
+                    self._free_instance_ports(self.ports)
 
                     # We need to delete the nvram file before we can undefine
                     # the domain. This will be recreated by libvirt on the next
@@ -1395,25 +1407,99 @@ class Instance(dbo):
 
             self.agent_state = constants.AGENT_NEVER_TALKED
 
+    @property
+    def console_segments(self):
+        return self._db_get_attribute('console_segments').get('segments', [])
+
     def get_console_data(self, length):
-        console_path = os.path.join(self.instance_path, 'console.log')
-        if not os.path.exists(console_path):
-            return ''
-
-        d = None
-        file_length = os.stat(console_path).st_size
-        with open(console_path, 'rb') as f:
-            if length != -1:
-                offset = max(0, file_length - length)
-                f.seek(offset)
-            d = f.read()
-        return d
+        """Return the last length bytes of console output, and their offset."""
+        cl = consolelog.ConsoleLog(self.instance_path)
+        if not cl.exists():
+            return 0, b''
+        return cl.tail(length)
+
+    def read_console_data(self, offset, length=-1, wait=0):
+        """Return console output starting at an absolute byte offset.
+
+        Returns the offset of the first byte returned and the data. Output
+        which has been rotated off this node is read from the compressed
+        console log segments, one segment per call. If wait is set and there
+        is no output after offset yet, wait up to that many seconds for some.
+        """
+        cl = consolelog.ConsoleLog(self.instance_path)
+        if not cl.exists():
+            return offset, b''
+        if wait > 0:
+            cl.wait(offset, wait)
+
+        start, _ = cl.extent()
+        if offset < start:
+            for segment in self.console_segments:
+                if segment['end'] <= offset:
+                    continue
+                segment_path = blob.Blob.filepath(segment['blob_uuid'])
+                if not os.path.exists(segment_path):
+                    continue
 
-    def delete_console_data(self):
-        console_path = os.path.join(self.instance_path, 'console.log')
-        if not os.path.exists(console_path):
+                read_from = max(offset, segment['start'])
+                data = consolelog.decompress_segment(segment_path)
+                data = data[read_from - segment['start']:]
+                if length >= 0:
+                    data = data[:length]
+                return read_from, data
+
+        return cl.read(offset, length)
+
+    def rotate_console_log(self):
+        cl = consolelog.ConsoleLog(self.instance_path)
+        if not cl.needs_rotation(config.CONSOLE_LOG_ROTATE_SIZE):
             return
-        os.truncate(console_path, 0)
+
+        with self.get_lock_attr('console', 'Console log rotation'):
+            start, data = cl.rotate(config.CONSOLE_LOG_ROTATE_SIZE)
+            if not data:
+                return
+
+            blob_uuid = str(uuid4())
+            size = consolelog.compress_segment(blob.Blob.filepath(blob_uuid), data)
+            b = blob.Blob.new(blob_uuid, size, time.time(), time.time())
+            b.observe()
+            b.ref_count_inc(self)
+
+            segments = self.console_segments
+            segments.append({
+                'start': start,
+                'end': start + len(data),
+                'blob_uuid': blob_uuid
+            })
+            while len(segments) > config.CONSOLE_LOG_MAX_SEGMENTS:
+                self._release_console_segment(segments.pop(0))
+            self._db_set_attribute('console_segments', {'segments': segments})
+
+            self.add_event(
+                EVENT_TYPE_AUDIT, 'console log rotated',
+                extra={
+                    'start': start,
+                    'end': start + len(data),
+                    'blob': blob_uuid,
+                    'compressed_size': size
+                })
+
+    def _release_console_segment(self, segment):
+        b = blob.Blob.from_db(segment['blob_uuid'])
+        if b:
+            b.ref_count_dec(self)
+
+    def _release_console_segments(self):
+        for segment in self.console_segments:
+            self._release_console_segment(segment)
+        self._db_delete_attribute('console_segments')
+
+    def delete_console_data(self):
+        cl = consolelog.ConsoleLog(self.instance_path)
+        with self.get_lock_attr('console', 'Console log clear'):
+            cl.clear()
+            self._release_console_segments()
         self.add_event(EVENT_TYPE_AUDIT, 'console log cleared')
 
     def enqueue_delete_remote(self, node):
@@ -1436,7 +1522,8 @@ class Instance(dbo):
         self.error = error_msg
         self.enqueue_delete_remote(config.NODE_NAME)
 
-    def snapshot(self, all=False, device=None, max_versions=None, thin=False):
+    def snapshot(self, all=False, device=None, max_versions=None, thin=False,
+                 incremental=False):
         disks = self.block_devices['devices']
 
         # Include NVRAM as a snapshot option if we are UEFI booted
@@ -1488,7 +1575,7 @@ class Instance(dbo):
                 # These are small and don't use qemu-img to capture, so just
                 # do them now.
                 dest_path = blob.Blob.filepath(blob_uuid)
-                shutil.copyfile(disk['path'], dest_path)
+                util_general.clone_file(disk['path'], dest_path)
 
                 st = os.stat(dest_path)
                 b = blob.Blob.new(blob_uuid, st.st_size,
@@ -1502,19 +1589,35 @@ class Instance(dbo):
             else:
                 etcd.enqueue(config.NODE_NAME, {
                     'tasks': [SnapshotTask(self.uuid, disk, a.uuid, blob_uuid,
-                                           thin=thin)],
+                                           thin=thin, incremental=incremental)],
                 })
 
         self.add_event(EVENT_TYPE_AUDIT, 'snapshot', extra=out)
         return out
 
     def archive_console_log(self):
-        console_path = os.path.join(self.instance_path, 'console.log')
-        if not os.path.exists(console_path):
+        cl = consolelog.ConsoleLog(self.instance_path)
+        if not cl.exists():
             return
 
-        st = os.stat(console_path)
-        if st.st_size > 0:
+        # The archive is the output from any rotated segments, followed by
+        # whatever is currently in console.log.
+        blob_uuid = str(uuid4())
+        dest_path = blob.Blob.filepath(blob_uuid)
+        segments = self.console_segments
+        if not segments:
+            util_general.clone_file(cl.log_path, dest_path)
+        else:
+            with open(dest_path, 'wb') as f:
+                for segment in segments:
+                    segment_path = blob.Blob.filepath(segment['blob_uuid'])
+                    if os.path.exists(segment_path):
+                        f.write(consolelog.decompress_segment(segment_path))
+                with open(cl.log_path, 'rb') as log:
+                    shutil.copyfileobj(log, f)
+        size = os.stat(dest_path).st_size
+
+        if size > 0:
             # These two artifacts need to appear in this order, or the system
             # artifact wont be created because system can "see" the other
             # namespace.
@@ -1531,11 +1634,7 @@ class Instance(dbo):
                     name='%s/console' % self.uuid, max_versions=1,
                     namespace=self.namespace))
 
-            blob_uuid = str(uuid4())
-            dest_path = blob.Blob.filepath(blob_uuid)
-            shutil.copyfile(console_path, dest_path)
-
-            b = blob.Blob.new(blob_uuid, st.st_size, time.time(), time.time())
+            b = blob.Blob.new(blob_uuid, size, time.time(), time.time())
             b.set_lifetime(config.ARCHIVE_INSTANCE_CONSOLE_DURATION * 3600 * 24)
             b.observe()
             b.verify_checksum()
@@ -1551,15 +1650,55 @@ class Instance(dbo):
                         'blob': b.uuid
                         })
         else:
+            os.unlink(dest_path)
             self.add_event(
                 EVENT_TYPE_AUDIT,
                 'the console log for this instance was not archived as it was empty')
 
-    @property
-    def agent_operations(self):
-        return self._db_get_attribute('agent_operations')
+    def _agent_operations_legacy(self):
+        # Instances stored before AGENT_OPERATION_KEYS_VERSION keep their agent
+        # operations in a single attribute until every node is upgraded. If
+        # that has happened since we were loaded, move them now.
+        if not self.__legacy_agent_operations:
+            return False
+        if (baseobject.get_minimum_object_version(self.object_type) <
+                AGENT_OPERATION_KEYS_VERSION):
+            return True
 
-    def agent_operation_dequeue(self):
+        _migrate_agent_operations(self.uuid)
+        self.__legacy_agent_operations = False
+        return False
+
+    def agent_operation_queue(self):
+        """Return the UUIDs of agent operations waiting to execute, in order."""
+        if self._agent_operations_legacy():
+            return self._db_get_attribute('agent_operations').get('queue', [])
+
+        entries, _ = etcd.get_prefix_by_create(agentoperation.queue_key(self.uuid))
+        return [data['agentop'] for _, data, _, _ in entries]
+
+    def agent_operation_history(self, page_size=100):
+        """Yield the UUIDs of all agent operations ever queued, in order.
+
+        The history is read page_size entries at a time.
+        """
+        if self._agent_operations_legacy():
+            yield from self._db_get_attribute('agent_operations').get('all', [])
+            return
+
+        min_create_revision = 0
+        while True:
+            entries, _ = etcd.get_prefix_by_create(
+                agentoperation.history_key(self.uuid), limit=page_size,
+                min_create_revision=min_create_revision)
+            for _, data, _, _ in entries:
+                yield data['agentop']
+
+            if len(entries) < page_size:
+                return
+            min_create_revision = entries[-1][2] + 1
+
+    def _legacy_agent_operation_dequeue(self):
         # First check cheaply if there are any agent operations queued. This is
         # likely to be the case 99% of the time.
         if not self._db_get_attribute('agent_operations', {}).get('queue', []):
@@ -1593,21 +1732,61 @@ class Instance(dbo):
             self._db_set_attribute('agent_operations', db_data)
             return agentop
 
+    def agent_operation_dequeue(self):
+        if self._agent_operations_legacy():
+            return self._legacy_agent_operation_dequeue()
+
+        entries, _ = etcd.get_prefix_by_create(
+            agentoperation.queue_key(self.uuid), limit=1)
+        if not entries:
+            return None
+
+        key, data, _, mod_revision = entries[0]
+        agentop = AgentOperation.from_db(data['agentop'])
+        if not agentop:
+            # AgentOp is invalid, remove from queue and say we have nothing
+            # to do.
+            etcd.delete_if_unchanged(key, mod_revision)
+            return None
+
+        if agentop.state.value != AgentOperation.STATE_QUEUED:
+            # The AgentOp isn't ready, but we like maintaining this order,
+            # so claim we have no work to do right now.
+            return None
+
+        # Otherwise, claim the operation. If the queue entry has changed since
+        # we read it then someone else got there first.
+        if not etcd.delete_if_unchanged(key, mod_revision):
+            return None
+        return agentop
+
     def agent_operation_enqueue(self, agentop_uuid):
-        with self.get_lock_attr('agent_operations', 'Enqueue agent operation'):
-            # NOTE(mikal): the "queue" entry is agent operations not yet executed,
-            # the "all" entry is a log of all agent operations ever. We need "all",
-            # otherwise its quite hard to lookup an executed agent operation if
-            # you've lost its UUID.
-            db_data = self._db_get_attribute('agent_operations')
-            if 'queue' not in db_data:
-                db_data['queue'] = []
-            if 'all' not in db_data:
-                db_data['all'] = []
+        if self._agent_operations_legacy():
+            with self.get_lock_attr('agent_operations', 'Enqueue agent operation'):
+                # NOTE(mikal): the "queue" entry is agent operations not yet
+                # executed, the "all" entry is a log of all agent operations
+                # ever.
+                db_data = self._db_get_attribute('agent_operations')
+                db_data.setdefault('queue', []).append(agentop_uuid)
+                db_data.setdefault('all', []).append(agentop_uuid)
+                self._db_set_attribute('agent_operations', db_data)
+            return
 
-            db_data['queue'].append(agentop_uuid)
-            db_data['all'].append(agentop_uuid)
-            self._db_set_attribute('agent_operations', db_data)
+        etcd.apply_many(puts={
+            agentoperation.queue_key(self.uuid, agentop_uuid): {'agentop': agentop_uuid},
+            agentoperation.history_key(self.uuid, agentop_uuid): {'agentop': agentop_uuid}
+        })
+
+    def agent_operation_wait(self, timeout, start_revision=0):
+        """Wait for a change to the agent operation queue.
+
+        Returns the revision of the change, or None if timeout expired first.
+        """
+        prefix = agentoperation.queue_key(self.uuid)
+        if self._agent_operations_legacy():
+            prefix = etcd._construct_key(
+                'attribute/instance', self.uuid, 'agent_operations')
+        return etcd.watch_prefix_once(prefix, timeout, start_revision=start_revision)
 
     def get_screenshot(self):
         blob_uuid = str(uuid4())
@@ -1709,34 +1888,50 @@ def all_instances():
 
 
 def instance_usage_for_blob_uuid(blob_uuid, node=None):
+    return instance_usage_for_blob_uuids([blob_uuid], node=node)[blob_uuid]
+
+
+def instance_usage_for_blob_uuids(blob_uuids, node=None):
+    """Find the instances using each of a set of blobs in a single pass.
+
+    Returns a dictionary of blob uuid to a list of instance uuids. An instance
+    uses a blob if one of its disks is that blob, or depends on it.
+    """
     filters = []
     if node:
         filters.append(partial(placement_filter, node))
 
-    instance_uuids = []
+    usage = {blob_uuid: [] for blob_uuid in blob_uuids}
+
+    # The chain of blobs each disk blob depends on is the same for every
+    # instance using it, so we only look it up once per pass.
+    chains = {}
+
+    def _chain(disk_blob_uuid):
+        if disk_blob_uuid not in chains:
+            chain = [disk_blob_uuid]
+            disk_blob = blob.Blob.from_db(disk_blob_uuid, suppress_failure_audit=True)
+            while disk_blob and disk_blob.depends_on:
+                chain.append(disk_blob.depends_on)
+                disk_blob = blob.Blob.from_db(disk_blob.depends_on)
+            chains[disk_blob_uuid] = chain
+        return chains[disk_blob_uuid]
+
     for inst in Instances(filters, prefilter='healthy'):
         # inst.block_devices isn't populated until the instance is created,
         # so it may not be ready yet. This means we will miss instances
         # which have been requested but not yet started.
+        used = set()
         for d in inst.block_devices.get('devices', []):
             if 'blob_uuid' not in d:
                 continue
 
-            # This blob is in direct use
-            if d['blob_uuid'] == blob_uuid:
-                instance_uuids.append(inst.uuid)
-                continue
-
-            # The blob is deleted
-            disk_blob = blob.Blob.from_db(d['blob_uuid'], suppress_failure_audit=True)
-            if not disk_blob:
-                continue
+            # The disk blob itself, and the blobs it depends on
+            for blob_uuid in _chain(d['blob_uuid']):
+                if blob_uuid in usage:
+                    used.add(blob_uuid)
 
-            # Recurse for dependencies
-            while disk_blob.depends_on:
-                disk_blob = blob.Blob.from_db(disk_blob.depends_on)
-                if disk_blob and disk_blob.uuid == blob_uuid:
-                    instance_uuids.append(inst.uuid)
-                    break
+        for blob_uuid in used:
+            usage[blob_uuid].append(inst.uuid)
 
-    return instance_uuids
+    return usage
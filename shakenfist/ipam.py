@@ -212,6 +212,18 @@ class IPAM(dbo):
     def in_use_counter(self):
         return len(self.in_use)
 
+    @property
+    def reservations(self):
+        """Return all reservations keyed by address, read in a single pass."""
+        if self.version == 3:
+            return dict(self.cached_ipmanager_object.in_use)
+
+        reservations = {}
+        for _, data in etcd.get_prefix_paged(self.reservations_path):
+            reservation = etcd.decode_value(data)
+            reservations[reservation['address']] = reservation
+        return reservations
+
     def get_address_at_index(self, idx):
         return str(self.ipblock[idx])
 
@@ -219,7 +231,9 @@ class IPAM(dbo):
         return ipaddress.ip_address(address) in self.ipblock
 
     def is_free(self, address):
-        return address not in self.in_use
+        if self.version == 3:
+            return address not in self.in_use
+        return etcd.get_raw(self.reservations_path + address) is None
 
     def reserve(self, address, user, reservation_type, comment):
         self.release_haloed(config.IP_DELETION_HALO_DURATION)
@@ -343,9 +357,6 @@ class IPAM(dbo):
         raise exceptions.CongestedNetwork('No free addresses on network')
 
     def get_reservation(self, address):
-        if address not in self.in_use:
-            return None
-
         if self.version == 3:
             return self.cached_ipmanager_object.in_use.get(address)
 
@@ -1,6 +1,4 @@
 import base64
-import secrets
-import string
 import time
 
 import bcrypt
@@ -146,6 +144,21 @@ class Namespace(dbo):
 
         return nonce
 
+    def remove_expired_keys(self):
+        # Service keys minted by older releases expire, but linger in the
+        # stored keys until removed.
+        db_data = self._db_get_attribute('keys')
+        if not db_data:
+            return
+
+        now = time.time()
+        stored = db_data.get('nonced_keys', {})
+        if not any(now > v.get('expiry', now) for v in stored.values()):
+            return
+
+        with self.get_lock_attr('keys', 'Remove expired keys'):
+            self._db_set_attribute('keys', self.keys)
+
     def remove_key(self, name):
         with self.get_lock_attr('keys', 'Remove key'):
             k = self.keys
@@ -231,22 +244,14 @@ def get_api_token(base_url, namespace='system'):
         if expiry - time.time() > 15:
             return 'Bearer %s' % access_token
 
-    auth_url = base_url + '/auth'
-    LOG.info('Fetching %s auth token from %s', namespace, auth_url)
-
-    ns = Namespace.from_db(namespace)
-
-    key = ''.join(secrets.choice(string.ascii_letters) for i in range(50))
-    unique = ''.join(secrets.choice(string.ascii_letters) for i in range(5))
-    keyname = '_service_key_%s' % unique
-    expiry = time.time() + 300
-    nonce = ns.add_key(keyname, key, expiry=expiry)
-
-    # Cheat and don't actually call the auth API to create a token, just call its
-    # underlying code, thus saving a network round trip.
-    token = access_tokens.create_token(ns, keyname, nonce, duration=5)
+    # Service tokens are signed node credentials, so minting one needs neither
+    # a new namespace key nor a round trip to the auth API. base_url is retained
+    # for callers, but all nodes in the cluster accept the same token.
+    LOG.with_fields({'namespace': namespace}).debug('Minting service token')
+    token = access_tokens.create_service_token(namespace)
 
-    CACHED_TOKENS[namespace] = (expiry, token['access_token'])
+    CACHED_TOKENS[namespace] = (time.time() + token['expires_in'],
+                                token['access_token'])
     return 'Bearer %s' % token['access_token']
 
 
@@ -4,6 +4,7 @@ from collections import defaultdict
 import versions
 from shakenfist_utilities import logs
 
+from shakenfist import baseobject
 from shakenfist import etcd
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.baseobject import DatabaseBackedObjectIterator as dbo_iter
@@ -15,10 +16,59 @@ from shakenfist.util import general as util_general
 LOG, _ = logs.setup(__name__)
 
 
+# Membership set changes are applied in transactions of at most this many
+# operations, to stay under the etcd server's --max-txn-ops.
+MEMBERSHIP_BATCH_SIZE = 100
+
+# Membership sets moved from single list attributes to one key per member in
+# node version 8. Nodes running older releases only understand the attributes,
+# so nodes stored before then keep using them until every node has been
+# upgraded.
+MEMBER_KEYS_VERSION = 8
+MEMBER_SETS = ['blobs', 'instances']
+
+
+# The node inventory is built from a handful of prefix reads, and is cached in
+# each process for this many seconds.
+NODE_INVENTORY_TTL = 5
+NODE_INVENTORY_ATTRIBUTES = [
+    'state', 'observed', 'roles', 'metadata', 'dependency_versions',
+    'qemu_version', 'libvirt_version', 'python_version', 'python_implementation'
+]
+CACHED_NODE_INVENTORY = None
+
+
+def _member_prefix(node, setname):
+    return f'/sf/index/node{setname}/{node}/'
+
+
+def _migrate_member_sets(node):
+    # Move any legacy list attributes into individual keys.
+    for setname in MEMBER_SETS:
+        if not etcd.get('attribute/node', node, setname):
+            continue
+
+        with etcd.get_lock('attribute/node', node, setname,
+                           op='Migrate %s' % setname):
+            # The batches are not applied atomically with the deletion of the
+            # legacy attribute. That is fine: the puts are idempotent, so if we
+            # fail part way through the next attempt migrates the whole list
+            # again. A concurrent add_*() between batches only adds a member
+            # key which is not in the legacy list.
+            members = (etcd.get('attribute/node', node, setname) or {}).get(
+                setname, [])
+            prefix = _member_prefix(node, setname)
+            for i in range(0, len(members), MEMBERSHIP_BATCH_SIZE):
+                etcd.apply_many(puts={
+                    prefix + member: {}
+                    for member in members[i:i + MEMBERSHIP_BATCH_SIZE]})
+            etcd.delete('attribute/node', node, setname)
+
+
 class Node(dbo):
     object_type = 'node'
     initial_version = 2
-    current_version = 7
+    current_version = 8
 
     # docs/developer_guide/state_machine.md has a description of these states.
     STATE_MISSING = 'missing'
@@ -45,6 +95,7 @@ class Node(dbo):
     }
 
     def __init__(self, static_values):
+        stored_version = static_values.get('version', self.initial_version)
         self.upgrade(static_values)
 
         # We treat a node name as a UUID here for historical reasons
@@ -53,6 +104,13 @@ class Node(dbo):
         self.__ip = static_values['ip']
         self.__fqdn = static_values['fqdn']
 
+        # If every node was upgraded when we were loaded, the upgrade has moved
+        # any legacy membership sets already.
+        self.__legacy_member_sets = (
+            stored_version < MEMBER_KEYS_VERSION and
+            baseobject.get_minimum_object_version(self.object_type) <
+            MEMBER_KEYS_VERSION)
+
     @classmethod
     def _upgrade_step_2_to_3(cls, static_values):
         ...
@@ -73,6 +131,15 @@ class Node(dbo):
     def _upgrade_step_6_to_7(cls, static_values):
         etcd.delete('attribute/node',  static_values['fqdn'], 'instances-active')
 
+    @classmethod
+    def _upgrade_step_7_to_8(cls, static_values):
+        # Membership sets are only moved once every node understands the new
+        # keys, which is also when this upgrade is committed. Until then they
+        # stay in the legacy attributes, see _member_sets_legacy().
+        if (baseobject.get_minimum_object_version(cls.object_type) >=
+                MEMBER_KEYS_VERSION):
+            _migrate_member_sets(static_values['fqdn'])
+
     @classmethod
     def new(cls, name, ip):
         n = Node.from_db(name, suppress_failure_audit=True)
@@ -140,33 +207,105 @@ class Node(dbo):
     def installed_version(self):
         return self._db_get_attribute('observed').get('release')
 
+    # Membership sets. The blobs and instances present on a node are each
+    # stored as one etcd key per member, so adding or removing a member is a
+    # single put or delete with no lock and no rewrite of the rest of the set.
+    def _member_prefix(self, setname):
+        return _member_prefix(self.uuid, setname)
+
+    def _member_sets_legacy(self):
+        # Nodes stored before MEMBER_KEYS_VERSION keep their membership sets in
+        # list attributes until every node is upgraded. If that has happened
+        # since we were loaded, move them now.
+        if not self.__legacy_member_sets:
+            return False
+        if (baseobject.get_minimum_object_version(self.object_type) <
+                MEMBER_KEYS_VERSION):
+            return True
+
+        _migrate_member_sets(self.uuid)
+        self.__legacy_member_sets = False
+        return False
+
+    def _member_iter(self, setname):
+        if self._member_sets_legacy():
+            yield from self._db_get_attribute(setname).get(setname, [])
+            return
+
+        prefix = self._member_prefix(setname)
+        for key, _ in etcd.get_prefix_paged(prefix):
+            yield key[len(prefix):]
+
+    def _member_count(self, setname):
+        if self._member_sets_legacy():
+            return len(self._db_get_attribute(setname).get(setname, []))
+        return etcd.count_prefix(self._member_prefix(setname))
+
+    def _member_add(self, setname, member):
+        if self._member_sets_legacy():
+            self._add_item_in_attribute_list(setname, member)
+        else:
+            etcd.put_raw(self._member_prefix(setname) + member, {})
+
+    def _member_remove(self, setname, member):
+        if self._member_sets_legacy():
+            self._remove_item_in_attribute_list(setname, member)
+        else:
+            etcd.delete_raw(self._member_prefix(setname) + member)
+
+    def _member_replace(self, setname, members):
+        if self._member_sets_legacy():
+            self._db_set_attribute(setname, {setname: list(members)})
+            return
+
+        # Only the differences between the current and new sets are written.
+        prefix = self._member_prefix(setname)
+        current = set(self._member_iter(setname))
+        members = set(members)
+
+        changes = [(prefix + m, True) for m in sorted(members - current)]
+        changes.extend([(prefix + m, False) for m in sorted(current - members)])
+        for i in range(0, len(changes), MEMBERSHIP_BATCH_SIZE):
+            batch = changes[i:i + MEMBERSHIP_BATCH_SIZE]
+            etcd.apply_many(
+                puts={key: {} for key, add in batch if add},
+                deletes=[key for key, add in batch if not add])
+
     @property
     def blobs(self):
-        return self._db_get_attribute('blobs').get('blobs', [])
+        return set(self._member_iter('blobs'))
 
     @blobs.setter
     def blobs(self, value):
-        self._db_set_attribute('blobs', {'blobs': value})
+        self._member_replace('blobs', value)
+
+    @property
+    def blob_count(self):
+        return self._member_count('blobs')
 
     def add_blob(self, blob):
-        self._add_item_in_attribute_list('blobs', blob)
+        self._member_add('blobs', blob)
 
     def remove_blob(self, blob):
-        self._remove_item_in_attribute_list('blobs', blob)
+        self._member_remove('blobs', blob)
 
     @property
     def instances(self):
-        return self._db_get_attribute('instances').get('instances', [])
+        return set(self._member_iter('instances'))
 
     @instances.setter
     def instances(self, value):
-        self._db_set_attribute('instances', {'instances': value})
+        self._member_replace('instances', value)
+
+    @property
+    def instance_count(self):
+        return self._member_count('instances')
 
     def add_instance(self, instance_uuid):
-        self._add_item_in_attribute_list('instances', instance_uuid)
+        self._member_add('instances', instance_uuid)
 
     def remove_instance(self, instance_uuid):
-        self._remove_item_in_attribute_list('instances', instance_uuid)
+        self._member_remove('instances', instance_uuid)
 
     @property
     def dependency_versions(self):
@@ -256,6 +395,83 @@ class Nodes(dbo_iter):
                 yield out
 
 
+def _read_node_inventory():
+    inventory = {}
+    for _, static_values in etcd.get_all('node', None):
+        name = static_values.get('fqdn', static_values.get('uuid'))
+        if not name:
+            continue
+        inventory[name] = {
+            'name': name,
+            'ip': static_values.get('ip'),
+            'version': static_values.get('version'),
+            'attributes': {},
+            'metrics': {},
+            'metrics_timestamp': 0,
+            'is_cluster_maintainer': False
+        }
+
+    attribute_prefix = '/sf/attribute/node/'
+    for key, data in etcd.get_prefix_paged(attribute_prefix):
+        name, _, attribute = key[len(attribute_prefix):].partition('/')
+        if name in inventory and attribute in NODE_INVENTORY_ATTRIBUTES:
+            inventory[name]['attributes'][attribute] = etcd.decode_value(data)
+
+    metrics_prefix = '/sf/metrics/'
+    for key, data in etcd.get_prefix_paged(metrics_prefix):
+        name = key[len(metrics_prefix):].rstrip('/')
+        if name in inventory:
+            data = etcd.decode_value(data)
+            inventory[name]['metrics'] = data.get('metrics', {})
+            inventory[name]['metrics_timestamp'] = data.get('timestamp', 0)
+
+    maintainer = etcd.get_lock_holder('cluster', None, None)
+    if maintainer and maintainer.get('node') in inventory:
+        inventory[maintainer['node']]['is_cluster_maintainer'] = True
+
+    return inventory
+
+
+def get_node_inventory(max_age=NODE_INVENTORY_TTL):
+    """Return a dictionary of node name to a summary of that node.
+
+    Each summary includes the node's static values, the attributes listed in
+    NODE_INVENTORY_ATTRIBUTES, its most recent metrics, and whether it is the
+    current cluster maintainer.
+    """
+    global CACHED_NODE_INVENTORY
+
+    if CACHED_NODE_INVENTORY:
+        fetched_at, inventory = CACHED_NODE_INVENTORY
+        if time.time() - fetched_at <= max_age:
+            return inventory
+
+    inventory = _read_node_inventory()
+    CACHED_NODE_INVENTORY = (time.time(), inventory)
+    return inventory
+
+
+def inventory_state(entry):
+    return entry['attributes'].get('state', {}).get('value')
+
+
+def inventory_external_view(entry):
+    attributes = entry['attributes']
+    retval = {
+        'uuid': entry['name'],
+        'state': inventory_state(entry),
+        'metadata': attributes.get('metadata') or {},
+        'version': entry['version'],
+        'name': entry['name'],
+        'ip': entry['ip'],
+        'lastseen': attributes.get('observed', {}).get('at', 0),
+        'release': attributes.get('observed', {}).get('release'),
+        'is_cluster_maintainer': entry['is_cluster_maintainer']
+    }
+    retval.update(attributes.get('roles', {}))
+    return retval
+
+
 def _sort_by_key(d):
     for k in sorted(d, reverse=True):
         yield from d[k]
@@ -268,12 +484,10 @@ def nodes_by_free_disk_descending(minimum=0, maximum=-1, intention=None):
     else:
         intention = '_%s' % intention
 
-    for n in Nodes([], prefilter='active'):
-        metrics = etcd.get('metrics', n.fqdn, None)
-        if metrics:
-            metrics = metrics.get('metrics', {})
-        else:
-            metrics = {}
+    for name, entry in get_node_inventory().items():
+        if inventory_state(entry) not in Node.ACTIVE_STATES:
+            continue
+        metrics = entry['metrics']
 
         disk_free_gb = int(
             int(metrics.get('disk_free%s' % intention, '0')) / GiB)
@@ -283,6 +497,6 @@ def nodes_by_free_disk_descending(minimum=0, maximum=-1, intention=None):
         if maximum != -1 and disk_free_gb > maximum:
             continue
 
-        by_disk[disk_free_gb].append(n.fqdn)
+        by_disk[disk_free_gb].append(name)
 
     return list(_sort_by_key(by_disk))
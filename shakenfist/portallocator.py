@@ -0,0 +1,219 @@
+import os
+import random
+import socket
+import threading
+import time
+
+from shakenfist_utilities import logs
+
+from shakenfist import etcd
+from shakenfist import exceptions
+from shakenfist.config import config
+from shakenfist.util import general as util_general
+
+
+LOG, _ = logs.setup(__name__)
+
+
+# Console and VDI ports for instances are allocated from a fixed range on each
+# hypervisor, and each allocated port is recorded in etcd as
+#
+#   /sf/console/...node.../...port... = {instance_uuid, port}
+#
+# Rather than listing every allocated port on the node for each allocation,
+# each process keeps a bitmap of the ports in use on its node. The bitmap is
+# seeded from etcd once, and the queues daemon keeps its copy in sync with a
+# watch. Queue workers are forked from the queues daemon, so they start with a
+# current bitmap for free. The bitmap is only a hint though -- all of the ports
+# for an instance are claimed in a single transaction which fails if any of
+# them has been claimed by someone else, in which case we reseed and try again.
+
+PORT_RANGE_START = 30000
+PORT_RANGE_END = 50000
+PORT_COUNT = PORT_RANGE_END - PORT_RANGE_START + 1
+
+ALLOCATION_ATTEMPTS = 5
+
+# If the watch has been quiet for this long, reseed the bitmap from etcd in
+# case we have missed events, for example because the watch was cancelled by
+# a compaction.
+WATCH_RESEED_INTERVAL = 300
+
+
+def _port_key(node, port):
+    return f'/sf/console/{node}/{port}'
+
+
+class PortAllocator:
+    def __init__(self, node):
+        self.node = node
+        self.prefix = f'/sf/console/{node}/'
+        self.bitmap = None
+        self.revision = 0
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _check_fork(self):
+        # If we have been forked, the lock might have been held by a thread
+        # which does not exist in this process, and the watch thread is gone.
+        # The bitmap itself is still a useful hint.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.watcher = None
+
+    def _in_use(self, port):
+        offset = port - PORT_RANGE_START
+        return self.bitmap[offset // 8] & (1 << (offset % 8)) != 0
+
+    def _mark(self, port, in_use):
+        if port < PORT_RANGE_START or port > PORT_RANGE_END:
+            return
+        offset = port - PORT_RANGE_START
+        if in_use:
+            self.bitmap[offset // 8] |= 1 << (offset % 8)
+        else:
+            self.bitmap[offset // 8] &= ~(1 << (offset % 8)) & 0xff
+
+    def _port_from_key(self, key):
+        try:
+            return int(key[len(self.prefix):])
+        except ValueError:
+            return None
+
+    def seed(self):
+        entries, revision = etcd.get_prefix_by_create(self.prefix)
+        bitmap = bytearray((PORT_COUNT + 7) // 8)
+        with self.lock:
+            self.bitmap = bitmap
+            for key, _, _, _ in entries:
+                port = self._port_from_key(key)
+                if port:
+                    self._mark(port, True)
+            self.revision = revision
+        return revision
+
+    def _watch(self):
+        while True:
+            try:
+                revision = self.seed()
+                events = etcd.watch_prefix(self.prefix, start_revision=revision + 1,
+                                           timeout=WATCH_RESEED_INTERVAL)
+                try:
+                    for event in events:
+                        if not event:
+                            break
+
+                        event_type, key, _, revision = event
+                        port = self._port_from_key(key)
+                        if port:
+                            with self.lock:
+                                self._mark(port, event_type != 'DELETE')
+                                self.revision = revision
+                finally:
+                    events.close()
+
+            except Exception as e:
+                util_general.ignore_exception('console port watch', e)
+                time.sleep(1)
+
+    def start_watching(self):
+        """Keep the bitmap in sync with etcd from a background thread."""
+        self._check_fork()
+        if self.watcher:
+            return
+        self.seed()
+        self.watcher = threading.Thread(target=self._watch, daemon=True,
+                                        name='console-port-watch')
+        self.watcher.start()
+
+    def _choose(self, count, exclude):
+        # Walk the range from a random starting point, skipping ports which are
+        # in use in etcd. We hold each candidate port open until it is claimed
+        # in etcd, both to check that nothing else on this machine is using it
+        # and to stop anyone else from picking it in the meantime.
+        chosen = []
+        sockets = []
+        start = random.randint(0, PORT_COUNT - 1)
+        for i in range(PORT_COUNT):
+            port = PORT_RANGE_START + (start + i) % PORT_COUNT
+            if port in exclude:
+                continue
+            with self.lock:
+                if self._in_use(port):
+                    continue
+
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                s.bind(('0.0.0.0', port))
+            except OSError:
+                LOG.info('Collided with in use port %d, selecting another' % port)
+                s.close()
+                exclude.add(port)
+                continue
+
+            chosen.append(port)
+            sockets.append(s)
+            if len(chosen) == count:
+                break
+
+        return chosen, sockets
+
+    def allocate(self, instance_uuid, count):
+        """Allocate count ports for an instance in a single transaction."""
+        self._check_fork()
+        if self.bitmap is None:
+            self.seed()
+
+        exclude = set()
+        for _ in range(ALLOCATION_ATTEMPTS):
+            ports, sockets = self._choose(count, exclude)
+            try:
+                if len(ports) < count:
+                    break
+
+                keys = [_port_key(self.node, port) for port in ports]
+                puts = {}
+                for key, port in zip(keys, ports):
+                    puts[key] = {'instance_uuid': instance_uuid, 'port': port}
+                if etcd.apply_many(puts=puts, create=keys):
+                    with self.lock:
+                        for port in ports:
+                            self._mark(port, True)
+                    return ports
+            finally:
+                for s in sockets:
+                    s.close()
+
+            # Someone else claimed at least one of these ports since our bitmap
+            # was last updated.
+            LOG.with_fields({'instance': instance_uuid}).info(
+                'Console port allocation collided, reseeding port bitmap')
+            self.seed()
+
+        raise exceptions.ConsolePortsExhausted(
+            'Unable to allocate %d console ports on %s' % (count, self.node))
+
+    def release(self, ports):
+        """Release ports in a single transaction."""
+        self._check_fork()
+        ports = [port for port in ports if port]
+        if not ports:
+            return
+
+        etcd.apply_many(deletes=[_port_key(self.node, port) for port in ports])
+        if self.bitmap is not None:
+            with self.lock:
+                for port in ports:
+                    self._mark(port, False)
+
+
+ALLOCATOR = None
+
+
+def get_allocator():
+    global ALLOCATOR
+    if not ALLOCATOR:
+        ALLOCATOR = PortAllocator(config.NODE_NAME)
+    return ALLOCATOR
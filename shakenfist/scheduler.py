@@ -7,13 +7,14 @@ from collections import defaultdict
 
 from shakenfist_utilities import logs
 
-from shakenfist import etcd
 from shakenfist import exceptions
 from shakenfist import instance
 from shakenfist import networkinterface
 from shakenfist.config import config
 from shakenfist.constants import EVENT_TYPE_AUDIT
 from shakenfist.constants import GiB
+from shakenfist.node import get_node_inventory
+from shakenfist.node import inventory_state
 from shakenfist.node import Node
 from shakenfist.node import Nodes
 from shakenfist.util import general as util_general
@@ -48,22 +49,28 @@ def get_network_node():
 def get_active_node_metrics():
     metrics = {}
 
-    for n in Nodes([], prefilter='active'):
-        try:
-            new_metrics = etcd.get('metrics', n.uuid, None)
-            if new_metrics:
-                if time.time() - new_metrics.get('timestamp', 0) < 120:
-                    new_metrics = new_metrics.get('metrics', {})
-                else:
-                    n.add_event(EVENT_TYPE_AUDIT, 'stale metrics from database for node')
-                    new_metrics = {}
-            else:
-                n.add_event(EVENT_TYPE_AUDIT, 'empty metrics from database for node')
-                new_metrics = {}
-            metrics[n.uuid] = new_metrics
-
-        except exceptions.ReadException:
-            n.add_event(EVENT_TYPE_AUDIT, 'refreshing metrics for node failed')
+    # The scheduler maintains its own cache of metrics, so always read a fresh
+    # node inventory here.
+    try:
+        inventory = get_node_inventory(max_age=0)
+    except exceptions.ReadException:
+        LOG.warning('Refreshing node metrics failed')
+        return metrics
+
+    for name, entry in inventory.items():
+        if inventory_state(entry) not in Node.ACTIVE_STATES:
+            continue
+
+        if not entry['metrics_timestamp']:
+            Node.from_db(name).add_event(
+                EVENT_TYPE_AUDIT, 'empty metrics from database for node')
+            metrics[name] = {}
+        elif time.time() - entry['metrics_timestamp'] < 120:
+            metrics[name] = entry['metrics']
+        else:
+            Node.from_db(name).add_event(
+                EVENT_TYPE_AUDIT, 'stale metrics from database for node')
+            metrics[name] = {}
 
     return metrics
 
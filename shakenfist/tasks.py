@@ -323,13 +323,15 @@ class FetchImageTask(ImageTask):
 class SnapshotTask(QueueTask):
     _name = 'snapshot'
 
-    def __init__(self, instance_uuid, disk, artifact_uuid, blob_uuid, thin=False):
+    def __init__(self, instance_uuid, disk, artifact_uuid, blob_uuid, thin=False,
+                 incremental=False):
         super().__init__()
         self._instance_uuid = instance_uuid
         self._disk = disk
         self._artifact_uuid = artifact_uuid
         self._blob_uuid = blob_uuid
         self._thin = thin
+        self._incremental = incremental
 
     def obj_dict(self):
         return {
@@ -338,7 +340,8 @@ class SnapshotTask(QueueTask):
             'disk': self._disk,
             'artifact_uuid': self._artifact_uuid,
             'blob_uuid': self._blob_uuid,
-            'thin': self._thin
+            'thin': self._thin,
+            'incremental': self._incremental
         }
 
     # Data methods
@@ -357,6 +360,32 @@ class SnapshotTask(QueueTask):
     def thin(self):
         return self._thin
 
+    def incremental(self):
+        return self._incremental
+
+
+class ConsolidateSnapshotTask(QueueTask):
+    _name = 'consolidate_snapshot'
+
+    def __init__(self, artifact_uuid, blob_uuids):
+        super().__init__()
+        self._artifact_uuid = artifact_uuid
+        self._blob_uuids = blob_uuids
+
+    def obj_dict(self):
+        return {
+            **super().obj_dict(),
+            'artifact_uuid': self._artifact_uuid,
+            'blob_uuids': self._blob_uuids
+        }
+
+    # Data methods
+    def artifact_uuid(self):
+        return self._artifact_uuid
+
+    def blob_uuids(self):
+        return self._blob_uuids
+
 #
 # Blob tasks
 #
@@ -393,18 +422,20 @@ class HashBlobTask(BlobTask):
 class ArchiveTranscodeTask(QueueTask):
     _name = 'archive_transcode'
 
-    def __init__(self, blob_uuid, cache_path, transcode_description):
+    def __init__(self, blob_uuid, cache_path, transcode_description, sha512=None):
         super().__init__()
         self._blob_uuid = blob_uuid
         self._cache_path = cache_path
         self._transcode_description = transcode_description
+        self._sha512 = sha512
 
     def obj_dict(self):
         return {
             **super().obj_dict(),
             'blob_uuid': self._blob_uuid,
             'cache_path': self._cache_path,
-            'transcode_description': self._transcode_description
+            'transcode_description': self._transcode_description,
+            'sha512': self._sha512
         }
 
     # Data methods
@@ -417,6 +448,9 @@ class ArchiveTranscodeTask(QueueTask):
     def transcode_description(self):
         return self._transcode_description
 
+    def sha512(self):
+        return self._sha512
+
 
 #
 # Agent operation tasks
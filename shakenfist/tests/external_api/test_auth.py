@@ -1,11 +1,18 @@
 import json
 import logging
+import time
 from unittest import mock
 
+import bcrypt
+from flask_jwt_extended import create_access_token
+
+from shakenfist import etcd
+from shakenfist import namespace
 from shakenfist.baseobject import DatabaseBackedObject as dbo
 from shakenfist.config import config
 from shakenfist.config import SFConfig
 from shakenfist.external_api import app as external_api
+from shakenfist.external_api import auth
 from shakenfist.namespace import Namespace
 from shakenfist.tests import base
 from shakenfist.tests.mock_etcd import MockEtcd
@@ -177,6 +184,115 @@ class AuthWithServiceKeyTestCase(base.ShakenFistTestCase):
         self.assertIn('access_token', resp.get_json())
 
 
+class AuthKeyLookupTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        external_api.TESTING = True
+        external_api.app.testing = True
+        external_api.app.debug = False
+
+        self.mock_etcd = MockEtcd(self, node_count=4)
+        self.mock_etcd.setup()
+
+        ns = Namespace.new('banana')
+        for i in range(4):
+            ns.add_key('key%d' % i, 'secret%d' % i)
+        auth.VERIFIED_KEYS = {}
+
+        self.checkpw = mock.patch('shakenfist.external_api.auth.bcrypt.checkpw',
+                                  wraps=bcrypt.checkpw)
+        self.mock_checkpw = self.checkpw.start()
+        self.addCleanup(self.checkpw.stop)
+
+        self.client = external_api.app.test_client()
+
+    def _auth(self, **kwargs):
+        kwargs['namespace'] = 'banana'
+        return self.client.post('/auth', data=json.dumps(kwargs))
+
+    def test_key_name(self):
+        resp = self._auth(key='secret3', key_name='key3')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(1, self.mock_checkpw.call_count)
+
+    def test_key_name_wrong(self):
+        self.assertEqual(401, self._auth(key='secret3', key_name='key2').status_code)
+        self.assertEqual(401, self._auth(key='secret3', key_name='nope').status_code)
+        self.assertEqual(1, self.mock_checkpw.call_count)
+
+    def test_cached_verification(self):
+        self.assertEqual(200, self._auth(key='secret3').status_code)
+        self.assertEqual(4, self.mock_checkpw.call_count)
+
+        self.assertEqual(200, self._auth(key='secret3').status_code)
+        self.assertEqual(200, self._auth(key='secret3', key_name='key3').status_code)
+        self.assertEqual(4, self.mock_checkpw.call_count)
+
+        # Replacing the key invalidates the cached verification
+        Namespace.from_db('banana').add_key('key3', 'other')
+        self.assertEqual(401, self._auth(key='secret3', key_name='key3').status_code)
+        self.assertEqual(5, self.mock_checkpw.call_count)
+
+    def test_cache_expiry(self):
+        self.assertEqual(200, self._auth(key='secret0', key_name='key0').status_code)
+        with mock.patch('shakenfist.external_api.auth.time.time',
+                        return_value=time.time() + auth.VERIFIED_KEY_TTL + 1):
+            self.assertEqual(200, self._auth(key='secret0', key_name='key0').status_code)
+        self.assertEqual(2, self.mock_checkpw.call_count)
+
+
+class ServiceTokenTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        external_api.TESTING = True
+        external_api.app.testing = True
+        external_api.app.debug = False
+
+        self.mock_etcd = MockEtcd(self, node_count=4)
+        self.mock_etcd.setup()
+
+        self.mock_etcd.create_namespace('banana', 'key1', 'bacon')
+        namespace.CACHED_TOKENS = {}
+        self.client = external_api.app.test_client()
+
+    @mock.patch('shakenfist.namespace.bcrypt.hashpw')
+    def test_service_token(self, mock_hashpw):
+        with external_api.app.app_context():
+            token = namespace.get_api_token('http://node2:13000', namespace='banana')
+            self.assertEqual(
+                token, namespace.get_api_token('http://node3:13000', namespace='banana'))
+        mock_hashpw.assert_not_called()
+
+        with mock.patch('shakenfist.external_api.base.Namespace.add_event') as mock_event:
+            resp = self.client.get('/auth/namespaces/banana/keys',
+                                   headers={'Authorization': token})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['key1'], resp.get_json())
+        mock_event.assert_not_called()
+
+    def test_service_key_name_without_claim(self):
+        # A token for a key named _service_key which was not minted by a node
+        # must still match a key in the namespace.
+        with external_api.app.app_context():
+            token = create_access_token(
+                identity=['banana', '_service_key'],
+                additional_claims={'iss': config.ZONE, 'nonce': 'wrong'})
+        resp = self.client.get('/auth/namespaces/banana/keys',
+                               headers={'Authorization': 'Bearer %s' % token})
+        self.assertEqual(401, resp.status_code)
+
+    def test_remove_expired_keys(self):
+        ns = Namespace.from_db('banana')
+        ns.add_key('_service_key_abcde', 'cheese', expiry=time.time() - 10)
+        ns.add_key('_service_key_fghij', 'cheese', expiry=time.time() + 300)
+
+        ns.remove_expired_keys()
+        stored = etcd.get('attribute/namespace', 'banana', 'keys')['nonced_keys']
+        self.assertEqual(['_service_key_fghij', 'key1'], sorted(stored))
+
+
 class AuthWithLingeringInstance(base.ShakenFistTestCase):
     def setUp(self):
         super().setUp()
@@ -512,8 +628,9 @@ class ExternalApiTestCase(base.ShakenFistTestCase):
         self.assertEqual(None, resp.get_json())
         self.assertEqual(200, resp.status_code)
         self.assertEqual(
-            json.dumps({'foo': 'bar'}, indent=4, sort_keys=True),
-            self.mock_etcd.db['/sf/attribute/namespace/system/metadata'])
+            {'foo': 'bar'},
+            etcd.decode_value(
+                self.mock_etcd.db['/sf/attribute/namespace/system/metadata']))
 
     @mock.patch('shakenfist.etcd.get_lock')
     def test_post_namespace_metadata(self, mock_get_lock):
@@ -526,8 +643,9 @@ class ExternalApiTestCase(base.ShakenFistTestCase):
         self.assertEqual(None, resp.get_json())
         self.assertEqual(200, resp.status_code)
         self.assertEqual(
-            json.dumps({'foo': 'bar'}, indent=4, sort_keys=True),
-            self.mock_etcd.db['/sf/attribute/namespace/system/metadata'])
+            {'foo': 'bar'},
+            etcd.decode_value(
+                self.mock_etcd.db['/sf/attribute/namespace/system/metadata']))
 
     @mock.patch('shakenfist.etcd.get_lock')
     def test_delete_namespace_metadata(self, mock_get_lock):
@@ -539,8 +657,9 @@ class ExternalApiTestCase(base.ShakenFistTestCase):
         self.assertEqual(None, resp.get_json())
         self.assertEqual(200, resp.status_code)
         self.assertEqual(
-            json.dumps({'real': 'smart'}, indent=4, sort_keys=True),
-            self.mock_etcd.db['/sf/attribute/namespace/system/metadata'])
+            {'real': 'smart'},
+            etcd.decode_value(
+                self.mock_etcd.db['/sf/attribute/namespace/system/metadata']))
 
     @mock.patch('shakenfist.etcd.get_lock')
     def test_delete_namespace_metadata_bad_key(self, mock_get_lock):
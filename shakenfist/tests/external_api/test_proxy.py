@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from shakenfist.daemons import daemon
+from shakenfist.external_api import app as external_api
+from shakenfist.external_api import proxy
+from shakenfist.tests import base
+from shakenfist.tests.http_server import ImageServer
+
+
+class ProxyTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.content = os.urandom(300 * 1024)
+        self.server = ImageServer(self.content)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.config = mock.patch('shakenfist.external_api.proxy.config')
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+        self.mock_config.API_PORT = self.server.server_address[1]
+        self.mock_config.API_TIMEOUT = 30
+
+        self.token = mock.patch(
+            'shakenfist.external_api.proxy.get_api_token', return_value='Bearer abc')
+        self.mock_token = self.token.start()
+        self.addCleanup(self.token.stop)
+
+        self.user_agent = mock.patch(
+            'shakenfist.external_api.proxy._USER_AGENT', 'test')
+        self.user_agent.start()
+        self.addCleanup(self.user_agent.stop)
+
+    def _latency_count(self):
+        return REGISTRY.get_sample_value(
+            'api_proxy_latency_seconds_count', {'target': '127.0.0.1'}) or 0
+
+    def test_proxy_request_streams(self):
+        before = self._latency_count()
+        with external_api.app.test_request_context(
+                '/instances/foo/consoledata', method='GET',
+                headers={'X-Request-ID': 'req-1'}):
+            resp = proxy.proxy_request('127.0.0.1', 'banana', data=b'{"offset": 0}')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(self.content, b''.join(resp.response))
+        self.assertEqual(before + 1, self._latency_count())
+        self.assertEqual([b'{"offset": 0}'], self.server.bodies)
+
+        self.mock_token.assert_called_with(
+            'http://127.0.0.1:%d' % self.server.server_address[1],
+            namespace='banana')
+        headers = self.server.gets()[0]
+        self.assertEqual('Bearer abc', headers['Authorization'])
+        self.assertEqual('req-1', headers['X-Request-ID'])
+        self.assertEqual('test', headers['User-Agent'])
+
+    def test_session_is_shared(self):
+        self.assertIs(proxy._session(), proxy._session())
+
+        with mock.patch('shakenfist.external_api.proxy.os.getpid',
+                        return_value=-1):
+            self.assertIsNot(proxy._SESSION, proxy._session())
+
+    @mock.patch('shakenfist.daemons.daemon.start_http_server')
+    def test_metrics_exported_from_workers(self, mock_server):
+        # API workers are separate processes which record their metrics in a
+        # shared directory, for the API daemon's metrics server to export
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics_dir = os.path.join(tmp, 'api-metrics')
+            with mock.patch('shakenfist.daemons.daemon.API_METRICS_DIR',
+                            metrics_dir):
+                daemon.start_metrics_server('api')
+            registry = mock_server.call_args.kwargs['registry']
+
+            subprocess.run(
+                [sys.executable, '-c',
+                 'from shakenfist.external_api import proxy; '
+                 'proxy.PROXY_LATENCY.labels("10.0.0.1").observe(0.5)'],
+                env=dict(os.environ, PROMETHEUS_MULTIPROC_DIR=metrics_dir),
+                check=True)
+
+            self.assertEqual(1, registry.get_sample_value(
+                'api_proxy_latency_seconds_count', {'target': '10.0.0.1'}))
@@ -0,0 +1,107 @@
+import http.server
+import threading
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a single image, with enough HTTP to test downloads.
+
+    The server supports HEAD, conditional requests with If-None-Match and
+    If-Modified-Since, and ranged requests with If-Range. It can also drop the
+    connection part way through a response to simulate an interrupted
+    download.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _record(self):
+        body = b''
+        if self.headers.get('Content-Length'):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.command, dict(self.headers)))
+        self.server.bodies.append(body)
+
+    def _send_headers(self, status, length, extra=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Last-Modified', self.server.last_modified)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        for key, value in (extra or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def _not_modified(self):
+        if self.headers.get('If-None-Match'):
+            return self.headers['If-None-Match'] == self.server.etag
+        if self.headers.get('If-Modified-Since'):
+            return self.headers['If-Modified-Since'] == self.server.last_modified
+        return False
+
+    def do_HEAD(self):
+        self._record()
+        if self._not_modified():
+            self.send_response(304)
+            self.end_headers()
+            return
+        self._send_headers(200, len(self.server.content))
+
+    def do_GET(self):
+        self._record()
+        content = self.server.content
+        start, end = 0, len(content) - 1
+        status = 200
+        extra = {}
+
+        if_range = self.headers.get('If-Range')
+        if (self.server.accept_ranges and self.headers.get('Range') and
+                (not if_range or if_range == self.server.etag)):
+            first, last = self.headers['Range'][len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = int(last)
+            status = 206
+            extra['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(content))
+
+        body = content[start:end + 1]
+        self._send_headers(status, len(body), extra)
+
+        if self.server.fail_after is not None:
+            body = body[:self.server.fail_after]
+            self.server.fail_after = None
+            self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+
+class ImageServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content, etag='"v1"',
+                 last_modified='Sun, 09 Jan 2022 23:05:25 GMT'):
+        super().__init__(('127.0.0.1', 0), ImageRequestHandler)
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.accept_ranges = True
+        self.fail_after = None
+        self.requests = []
+        self.bodies = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/image.qcow2' % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def gets(self):
+        return [headers for command, headers in self.requests if command == 'GET']
@@ -3,13 +3,18 @@
 #
 # Mock the Etcd store with a Python dict.
 #
+import base64
 import json
 import os
+import threading
 import time
 from collections import defaultdict
 from itertools import count
 from unittest import mock
 
+from etcd3gw.exceptions import WatchTimedOut
+from etcd3gw.utils import _encode
+
 from shakenfist.instance import Instance
 from shakenfist.namespace import Namespace
 from shakenfist.network import Network
@@ -30,6 +35,18 @@ class MockEtcd():
         self.db = {}
         self.obj_counter = count(1)
 
+        # Create and modification revisions for each key, as (create, mod)
+        self.revision = 1
+        self.key_revisions = {}
+
+        # Leases and the revisions at which keys were deleted, which are used
+        # by locks. Changes are notified so that lock waiters in other threads
+        # can watch for deletions.
+        self.leases = {}
+        self.lease_counter = count(1)
+        self.deletions = defaultdict(list)
+        self.changed = threading.Condition(threading.RLock())
+
         # Define ShakenFist Nodes
         if nodes is not None:
             self.nodes = nodes.copy()
@@ -84,6 +101,50 @@ class MockEtcd():
         self.etcd_delete_prefix.start()
         self.test_obj.addCleanup(self.etcd_delete_prefix.stop)
 
+        self.etcd_get_range_page = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient.get_range_page',
+            side_effect=self.get_range_page)
+        self.etcd_get_range_page.start()
+        self.test_obj.addCleanup(self.etcd_get_range_page.stop)
+
+        self.etcd_get_range_by_create = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient.get_range_by_create',
+            side_effect=self.get_range_by_create)
+        self.etcd_get_range_by_create.start()
+        self.test_obj.addCleanup(self.etcd_get_range_by_create.stop)
+
+        self.etcd_count_range = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient.count_range',
+            side_effect=self.count_range)
+        self.etcd_count_range.start()
+        self.test_obj.addCleanup(self.etcd_count_range.stop)
+
+        self.etcd_transaction = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient.transaction',
+            side_effect=self.transaction)
+        self.etcd_transaction.start()
+        self.test_obj.addCleanup(self.etcd_transaction.stop)
+
+        # Raw API calls, which are only made by locks and leases
+        self.etcd_post = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient._post_with_retry',
+            side_effect=self.post)
+        self.etcd_post.start()
+        self.test_obj.addCleanup(self.etcd_post.stop)
+
+        self.etcd_watch_once = mock.patch(
+            'shakenfist.etcd.WrappedEtcdClient.watch_once',
+            side_effect=self.watch_once)
+        self.etcd_watch_once.start()
+        self.test_obj.addCleanup(self.etcd_watch_once.stop)
+
+        # Each test has its own database, so must not see another test's
+        # cached node inventory
+        self.node_inventory = mock.patch(
+            'shakenfist.node.CACHED_NODE_INVENTORY', None)
+        self.node_inventory.start()
+        self.test_obj.addCleanup(self.node_inventory.stop)
+
         # Mock etcd
         self.etcd_get_lock = mock.patch('shakenfist.etcd.get_lock')
         self.etcd_get_lock.start()
@@ -105,8 +166,33 @@ class MockEtcd():
     # DB operations - Low level
     #
 
+    def _record_write(self, path, lease=None):
+        with self.changed:
+            self.revision += 1
+            create_revision = self.key_revisions.get(path, (self.revision, 0))[0]
+            self.key_revisions[path] = (create_revision, self.revision)
+            if lease:
+                self.leases[int(lease)].add(path)
+            self.changed.notify_all()
+
+    def _record_delete(self, path):
+        with self.changed:
+            self.revision += 1
+            self.key_revisions.pop(path, None)
+            self.deletions[path].append(self.revision)
+            for keys in self.leases.values():
+                keys.discard(path)
+            self.changed.notify_all()
+
+    def expire_lease(self, lease_id):
+        """Delete the keys attached to a lease, as etcd does when it expires."""
+        with self.changed:
+            for key in sorted(self.leases.pop(lease_id, set())):
+                self.delete(key)
+
     def create(self, path, encoded, lease=None):
         self.db[path] = encoded
+        self._record_write(path)
         self._trace(f'MockEtcd.create() {path}: {encoded}')
         return True
 
@@ -129,21 +215,194 @@ class MockEtcd():
                 self._trace('MockEtcd.delete_prefix() %s' % k)
         return ret
 
+    def get_range_page(self, key, range_end, limit=0, revision=0):
+        ret = []
+        more = False
+        for k in sorted(self.db):
+            if key <= k.encode('utf-8') < range_end:
+                if limit and len(ret) == limit:
+                    more = True
+                    break
+                value = self.db[k]
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                ret.append((value, {'key': k.encode('utf-8')}))
+        self._trace(f'MockEtcd.get_range_page() {key} returned {len(ret)} keys')
+        return ret, 1, more
+
+    def get_range_by_create(self, key, range_end, limit=0, min_create_revision=0):
+        ret = []
+        for k in self.db:
+            if key <= k.encode('utf-8') < range_end:
+                create_revision, mod_revision = self.key_revisions.get(k, (0, 0))
+                if create_revision < min_create_revision:
+                    continue
+                value = self.db[k]
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                ret.append((value, {
+                    'key': k.encode('utf-8'),
+                    'create_revision': str(create_revision),
+                    'mod_revision': str(mod_revision)
+                }))
+        ret.sort(key=lambda kv: int(kv[1]['create_revision']))
+        if limit:
+            ret = ret[:limit]
+        self._trace(f'MockEtcd.get_range_by_create() {key} returned {len(ret)} keys')
+        return ret, self.revision
+
+    def count_range(self, key, range_end):
+        count = 0
+        for k in self.db:
+            if key <= k.encode('utf-8') < range_end:
+                count += 1
+        self._trace(f'MockEtcd.count_range() {key} returned {count}')
+        return count, self.revision
+
+    def transaction(self, txn):
+        with self.changed:
+            return self._transaction(txn)
+
+    def _transaction(self, txn):
+        # Only create revision comparisons against zero, and modification
+        # revision and value equality comparisons are supported
+        for compare in txn.get('compare', []):
+            key = base64.b64decode(compare['key']).decode('utf-8')
+            create_revision, mod_revision = self.key_revisions.get(key, (0, 0))
+            if key not in self.db:
+                create_revision = 0
+            if compare.get('target') == 'CREATE':
+                if compare.get('result', 'EQUAL') == 'EQUAL':
+                    succeeded = create_revision == 0
+                else:
+                    succeeded = create_revision > 0
+            elif compare.get('target') == 'MOD':
+                succeeded = (key in self.db and
+                             mod_revision == compare.get('mod_revision'))
+            elif compare.get('target') == 'VALUE':
+                value = self.db.get(key)
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                succeeded = value == base64.b64decode(compare['value'])
+            else:
+                succeeded = False
+            if not succeeded:
+                return {'succeeded': False, 'responses': []}
+
+        responses = []
+        for op in txn['success']:
+            if 'request_put' in op:
+                key = base64.b64decode(op['request_put']['key']).decode('utf-8')
+                self.db[key] = base64.b64decode(op['request_put']['value'])
+                self._record_write(key, lease=op['request_put'].get('lease'))
+                responses.append({'response_put': {}})
+            elif 'request_range' in op:
+                key = base64.b64decode(op['request_range']['key']).decode('utf-8')
+                kvs = []
+                if key in self.db:
+                    value = self.db[key]
+                    if isinstance(value, str):
+                        value = value.encode('utf-8')
+                    kvs.append({
+                        'key': op['request_range']['key'],
+                        'value': base64.b64encode(value).decode('utf-8')
+                    })
+                responses.append({'response_range': {'kvs': kvs}})
+            elif 'request_delete_range' in op:
+                key = base64.b64decode(op['request_delete_range']['key']).decode('utf-8')
+                if key in self.db:
+                    del self.db[key]
+                    self._record_delete(key)
+                responses.append({'response_delete_range': {}})
+        self._trace(f'MockEtcd.transaction() with {len(responses)} operations')
+        return {'succeeded': True, 'responses': responses}
+
     def put(self, path, encoded, lease=None):
         self.db[path] = encoded
+        self._record_write(path)
         self._trace(f'MockEtcd.put() {path}: {encoded}')
 
     def delete(self, path):
         if path in self.db:
             del self.db[path]
+            self._record_delete(path)
             self._trace('MockEtcd.delete() %s' % path)
 
     def delete_prefix(self, path, sort_order=None, sort_target=None, limit=0):
         for k in sorted(self.db):
             if k.startswith(path):
                 del self.db[k]
+                self._record_delete(k)
                 self._trace('MockEtcd.delete_prefix() %s' % k)
 
+    def post(self, url, **kwargs):
+        # Only the raw API calls made by locks and leases are supported
+        body = kwargs.get('json', {})
+        with self.changed:
+            if url.endswith('/lease/grant'):
+                lease_id = next(self.lease_counter)
+                self.leases[lease_id] = set()
+                return {'ID': str(lease_id), 'TTL': str(body['TTL'])}
+
+            if url.endswith('/lease/keepalive'):
+                if body['ID'] not in self.leases:
+                    return {'result': {}}
+                return {'result': {'TTL': '60'}}
+
+            if url.endswith('/kv/lease/timetolive'):
+                keys = sorted(self.leases.get(body['ID'], set()))
+                return {'TTL': '60', 'keys': [_encode(k) for k in keys]}
+
+            if url.endswith('/kv/lease/revoke'):
+                self.expire_lease(body['ID'])
+                return {}
+
+            if url.endswith('/kv/put'):
+                key = base64.b64decode(body['key']).decode('utf-8')
+                self.db[key] = base64.b64decode(body['value'])
+                self._record_write(key, lease=body.get('lease'))
+                return {'header': {'revision': str(self.revision)}}
+
+            if url.endswith('/kv/range'):
+                # Locks only ever list their waiters in create order
+                key = base64.b64decode(body['key'])
+                range_end = base64.b64decode(body['range_end'])
+                max_create_revision = body.get('max_create_revision')
+                kvs = []
+                for k in self.db:
+                    if not key <= k.encode('utf-8') < range_end:
+                        continue
+                    create_revision = self.key_revisions.get(k, (0, 0))[0]
+                    if max_create_revision and create_revision > max_create_revision:
+                        continue
+                    kvs.append((create_revision, k))
+                kvs.sort(reverse=body.get('sort_order') == 'DESCEND')
+                if body.get('limit'):
+                    kvs = kvs[:body['limit']]
+                return {
+                    'header': {'revision': str(self.revision)},
+                    'kvs': [{'key': _encode(k)} for _, k in kvs]
+                }
+
+        raise NotImplementedError('MockEtcd does not support %s' % url)
+
+    def watch_once(self, key, timeout=None, start_revision=0, filters=None):
+        # Only deletions are reported, which is all that locks watch for
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        deadline = time.time() + timeout
+        with self.changed:
+            while True:
+                for revision in self.deletions.get(key, []):
+                    if revision >= start_revision:
+                        return {'type': 'DELETE',
+                                'kv': {'key': _encode(key),
+                                       'mod_revision': str(revision)}}
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WatchTimedOut()
+                self.changed.wait(remaining)
+
     #
     # DB operations - Utilizing SF DB functionality
     #
@@ -0,0 +1,377 @@
+import time
+from unittest import mock
+
+from shakenfist import artifact
+from shakenfist import blob
+from shakenfist import exceptions
+from shakenfist.artifact import Artifact
+from shakenfist.daemons import queues
+from shakenfist.blob import Blob
+from shakenfist.instance import Instance
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class ArtifactIndexTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=6)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.index_ready = mock.patch('shakenfist.artifact.INDEX_READY', False)
+        self.index_ready.start()
+        self.addCleanup(self.index_ready.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.url = 'https://images.shakenfist.com/debian:11/latest.qcow2'
+
+    def _index_keys(self):
+        return sorted(k for k in self.mock_etcd.db
+                      if k.startswith(artifact.INDEX_PREFIX + 'url/') or
+                      k.startswith(artifact.INDEX_PREFIX + 'name/'))
+
+    def test_index_maintained(self):
+        a = Artifact.new(Artifact.TYPE_IMAGE, self.url, namespace='foo')
+        self.assertEqual(
+            [
+                '/sf/index/artifact/name/latest.qcow2/foo/%s' % a.uuid,
+                '/sf/index/artifact/url/image/https%%3A%%2F%%2Fimages.shakenfist.com'
+                '%%2Fdebian%%3A11%%2Flatest.qcow2/%s' % a.uuid
+            ],
+            self._index_keys())
+
+        # Errored artifacts can no longer satisfy a URL, but can still be
+        # found by name
+        a.state = Artifact.STATE_ERROR
+        self.assertEqual(
+            ['/sf/index/artifact/name/latest.qcow2/foo/%s' % a.uuid],
+            self._index_keys())
+
+        a.state = Artifact.STATE_DELETED
+        self.assertEqual([], self._index_keys())
+
+    def test_in_memory_artifacts_are_not_indexed(self):
+        Artifact.new(Artifact.TYPE_IMAGE, artifact.BLOB_URL + 'abc',
+                     namespace='foo')
+        self.assertEqual([], self._index_keys())
+
+    def test_from_url_uses_index(self):
+        artifact.rebuild_index()
+        a = Artifact.new(Artifact.TYPE_IMAGE, self.url, namespace='foo')
+        a.state = Artifact.STATE_CREATED
+        other = Artifact.new(Artifact.TYPE_IMAGE, self.url, namespace='bar')
+        other.state = Artifact.STATE_CREATED
+
+        with mock.patch('shakenfist.artifact.Artifacts') as mock_artifacts:
+            self.assertEqual(
+                a.uuid,
+                Artifact.from_url(Artifact.TYPE_IMAGE, self.url, namespace='foo').uuid)
+            self.assertIsNone(
+                Artifact.from_url(Artifact.TYPE_IMAGE, self.url, namespace='baz'))
+            self.assertIsNone(
+                Artifact.from_url(Artifact.TYPE_LABEL, self.url, namespace='foo'))
+            self.assertRaises(
+                exceptions.TooManyMatches, Artifact.from_url,
+                Artifact.TYPE_IMAGE, self.url, namespace='system')
+
+            # Sharing makes an artifact visible to other namespaces
+            other.shared = True
+            self.assertEqual(
+                other.uuid,
+                Artifact.from_url(Artifact.TYPE_IMAGE, self.url, namespace='baz').uuid)
+
+            # But we still prefer our own
+            self.assertEqual(
+                a.uuid,
+                Artifact.from_url(Artifact.TYPE_IMAGE, self.url, namespace='foo').uuid)
+
+            mock_artifacts.assert_not_called()
+
+    def test_from_url_without_index(self):
+        a = Artifact.new(Artifact.TYPE_IMAGE, self.url, namespace='foo')
+        self.assertFalse(artifact.index_ready())
+        self.assertEqual(
+            a.uuid,
+            Artifact.from_url(Artifact.TYPE_IMAGE, self.url, namespace='foo').uuid)
+
+    def test_rebuild_index(self):
+        a = Artifact.new(Artifact.TYPE_IMAGE, self.url, namespace='foo')
+        a.state = Artifact.STATE_CREATED
+        d = Artifact.new(Artifact.TYPE_IMAGE, self.url + '.old', namespace='foo')
+        d.state = Artifact.STATE_DELETED
+
+        for key in self._index_keys():
+            del self.mock_etcd.db[key]
+
+        artifact.rebuild_index()
+        self.assertTrue(artifact.index_ready())
+        self.assertEqual(2, len(self._index_keys()))
+        for key in self._index_keys():
+            self.assertTrue(key.endswith(a.uuid))
+
+    def test_from_db_by_ref_uses_index(self):
+        artifact.rebuild_index()
+        a = Artifact.new(Artifact.TYPE_LABEL, 'sf://label/foo/mylabel',
+                         name='mylabel', namespace='foo')
+        a.state = Artifact.STATE_CREATED
+        b = Artifact.new(Artifact.TYPE_LABEL, 'sf://label/bar/mylabel',
+                         name='mylabel', namespace='bar')
+        b.state = Artifact.STATE_CREATED
+
+        with mock.patch('shakenfist.baseobject.DatabaseBackedObject.filter') as m:
+            self.assertEqual(a.uuid, Artifact.from_db_by_ref('mylabel', 'foo').uuid)
+            self.assertEqual(b.uuid, Artifact.from_db_by_ref('mylabel', 'bar').uuid)
+            self.assertIsNone(Artifact.from_db_by_ref('mylabel', 'baz'))
+            self.assertRaises(exceptions.MultipleObjects,
+                              Artifact.from_db_by_ref, 'mylabel', 'system')
+            m.assert_not_called()
+
+
+class BlobSummaryTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=6)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.artifact = Artifact.new(
+            Artifact.TYPE_IMAGE, 'https://images.shakenfist.com/debian:11/latest.qcow2',
+            namespace='foo')
+        self.artifact.state = Artifact.STATE_CREATED
+
+        self.blob_uuid = self.mock_etcd.next_uuid()
+        b = Blob.new(self.blob_uuid, 1024, time.time(), time.time())
+        b.state = Blob.STATE_CREATED
+        self.artifact.add_index(self.blob_uuid)
+
+    def test_summary_is_cached(self):
+        with mock.patch('shakenfist.instance.instance_usage_for_blob_uuids',
+                        return_value={self.blob_uuid: []}) as mock_usage:
+            ev = self.artifact.external_view(include_instances=True)
+            self.assertEqual(
+                {
+                    1: {
+                        'uuid': self.blob_uuid,
+                        'size': 1024,
+                        'reference_count': 1,
+                        'depends_on': None,
+                        'instances': []
+                    }
+                }, ev['blobs'])
+            self.assertEqual(1, ev['index'])
+            self.assertEqual(1, mock_usage.call_count)
+
+            # A second view is served from the cache
+            ev = self.artifact.external_view(include_instances=True)
+            self.assertEqual([], ev['blobs'][1]['instances'])
+            self.assertEqual(1, mock_usage.call_count)
+
+    def test_default_view_does_not_find_instances(self):
+        with mock.patch('shakenfist.instance.instance_usage_for_blob_uuids') as mock_usage:
+            ev = self.artifact.external_view()
+        self.assertNotIn('instances', ev['blobs'][1])
+        self.assertEqual(1, ev['blobs'][1]['reference_count'])
+        mock_usage.assert_not_called()
+        self.assertEqual({}, self.artifact._db_get_attribute('blob_summary'))
+
+    def test_summary_ignores_unrelated_blobs(self):
+        self.artifact.blob_summary()
+
+        other = Blob.new(self.mock_etcd.next_uuid(), 2048, time.time(), time.time())
+        other.state = Blob.STATE_CREATED
+        other.ref_count_inc(self.artifact)
+
+        with mock.patch('shakenfist.instance.instance_usage_for_blob_uuids') as mock_usage:
+            self.artifact.blob_summary()
+        mock_usage.assert_not_called()
+
+    def test_summary_invalidated_by_new_version(self):
+        self.artifact.blob_summary()
+
+        new_blob_uuid = self.mock_etcd.next_uuid()
+        b = Blob.new(new_blob_uuid, 2048, time.time(), time.time())
+        b.state = Blob.STATE_CREATED
+        self.artifact.add_index(new_blob_uuid)
+        self.assertEqual(
+            {}, self.artifact._db_get_attribute('blob_summary'))
+
+        summary = self.artifact.blob_summary()
+        self.assertEqual([1, 2], sorted(summary))
+        self.assertEqual(2048, summary[2]['size'])
+
+    def test_summary_tracks_instance_usage(self):
+        self.assertEqual([], self.artifact.blob_summary()[1]['instances'])
+
+        inst = self.mock_etcd.create_instance('banana', place_on_node='node2')
+        inst._db_set_attribute(
+            'block_devices', {'devices': [{'blob_uuid': self.blob_uuid}]},
+            extra_puts=blob.usage_generation_bump_for_disks(
+                [{'blob_uuid': self.blob_uuid}]))
+        self.assertEqual(
+            [inst.uuid], self.artifact.blob_summary()[1]['instances'])
+
+        # Instances which are no longer healthy do not use blobs
+        inst.state = Instance.STATE_DELETE_WAIT
+        self.assertEqual([], self.artifact.blob_summary()[1]['instances'])
+
+    def test_shared_usage(self):
+        other = Artifact.new(
+            Artifact.TYPE_IMAGE, 'https://images.shakenfist.com/debian:12/latest.qcow2',
+            namespace='foo')
+        other_blob_uuid = self.mock_etcd.next_uuid()
+        b = Blob.new(other_blob_uuid, 2048, time.time(), time.time())
+        b.state = Blob.STATE_CREATED
+        other.add_index(other_blob_uuid)
+
+        with mock.patch('shakenfist.instance.instance_usage_for_blob_uuids',
+                        return_value={self.blob_uuid: [], other_blob_uuid: []}) \
+                as mock_usage, \
+                mock.patch('shakenfist.blob.usage_generations') as mock_generations:
+            usage = artifact.BlobUsage([self.blob_uuid, other_blob_uuid])
+            views = [a.external_view(include_instances=True, usage=usage)
+                     for a in [self.artifact, other]]
+
+        # One scan of the instances covers both artifacts, and listing does
+        # not write summaries
+        self.assertEqual([], views[0]['blobs'][1]['instances'])
+        self.assertEqual(2048, views[1]['blobs'][1]['size'])
+        mock_usage.assert_called_once_with({self.blob_uuid, other_blob_uuid})
+        mock_generations.assert_not_called()
+        self.assertEqual({}, other._db_get_attribute('blob_summary'))
+
+        # A summary cached by a show is used by later listings
+        self.artifact.blob_summary()
+        with mock.patch('shakenfist.instance.instance_usage_for_blob_uuids') \
+                as mock_usage:
+            usage = artifact.BlobUsage([self.blob_uuid])
+            self.artifact.external_view(include_instances=True, usage=usage)
+        mock_usage.assert_not_called()
+
+    def test_summary_tracks_reference_counts(self):
+        self.assertEqual(1, self.artifact.blob_summary()[1]['reference_count'])
+        Blob.from_db(self.blob_uuid).ref_count_inc(self.artifact)
+        self.assertEqual(2, self.artifact.blob_summary()[1]['reference_count'])
+
+    def test_progress(self):
+        self.assertEqual({}, self.artifact.progress)
+        self.assertNotIn('progress', self.artifact.external_view())
+
+        self.artifact.set_progress(self.blob_uuid, 'converting', 512, 2048)
+        progress = self.artifact.progress
+        self.assertEqual('converting', progress['phase'])
+        self.assertEqual(25.0, progress['percent'])
+        self.assertEqual(progress, self.artifact.external_view()['progress'])
+
+        self.artifact.set_progress(self.blob_uuid, 'created')
+        self.assertEqual(100, self.artifact.progress['percent'])
+
+
+class IncrementalSnapshotTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=6)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.enqueue = mock.patch('shakenfist.artifact.etcd.enqueue')
+        self.mock_enqueue = self.enqueue.start()
+        self.addCleanup(self.enqueue.stop)
+
+        self.artifact = Artifact.new(
+            Artifact.TYPE_SNAPSHOT, artifact.INSTANCE_URL + 'inst/vda',
+            max_versions=2, namespace='foo')
+        self.artifact.state = Artifact.STATE_CREATED
+
+    def _snapshot(self, depends_on=None):
+        b = Blob.new(self.mock_etcd.next_uuid(), 1024, time.time(), time.time(),
+                     depends_on=depends_on)
+        b.state = Blob.STATE_CREATED
+        if depends_on:
+            Blob.from_db(depends_on).ref_count_inc(b)
+        return b
+
+    def _add_version(self, depends_on=None):
+        b = self._snapshot(depends_on=depends_on)
+        self.artifact.add_index(b.uuid)
+        return b.uuid
+
+    def test_pruning_queues_consolidation(self):
+        first = self._add_version()
+        second = self._add_version(depends_on=first)
+        self.mock_enqueue.assert_not_called()
+
+        self._add_version(depends_on=second)
+        self.assertEqual(2, len(list(self.artifact.get_all_indexes())))
+
+        # The pruned first version is still used by the second version
+        self.assertEqual(1, Blob.from_db(first).ref_count)
+        self.mock_enqueue.assert_called_once()
+        queue, workitem = self.mock_enqueue.call_args[0]
+        self.assertEqual('%s-background' % artifact.config.NODE_NAME, queue)
+        task = workitem['tasks'][0]
+        self.assertEqual(self.artifact.uuid, task.artifact_uuid())
+        self.assertEqual([first], task.blob_uuids())
+
+    def test_pruning_independent_versions(self):
+        for _ in range(3):
+            self._add_version()
+        self.mock_enqueue.assert_not_called()
+
+    def test_replace_index_blob(self):
+        first = self._add_version()
+        replacement = self._snapshot().uuid
+
+        self.assertFalse(
+            self.artifact.replace_index_blob(1, replacement, first))
+        self.assertTrue(
+            self.artifact.replace_index_blob(1, first, replacement))
+        self.assertEqual(
+            replacement, self.artifact.most_recent_index['blob_uuid'])
+        self.assertEqual(1, Blob.from_db(replacement).ref_count)
+        self.assertEqual(Blob.STATE_DELETED, Blob.from_db(first).state.value)
+
+    def test_consolidate(self):
+        first = self._add_version()
+        second = self._add_version(depends_on=first)
+        third = self._add_version(depends_on=second)
+
+        rebased = {}
+
+        def fake_rebase(b, backing_uuid, unsafe=False, related_object=None):
+            new_blob = self._snapshot(depends_on=backing_uuid)
+            rebased[b.uuid] = (new_blob.uuid, backing_uuid, unsafe)
+            return new_blob
+
+        with mock.patch('shakenfist.blob.rebase_snapshot',
+                        side_effect=fake_rebase):
+            queues.consolidate_snapshot(self.artifact.uuid, [first])
+
+        # The second version is flattened, and the third pointed at the
+        # rewritten second version
+        new_second, backing, unsafe = rebased[second]
+        self.assertIsNone(backing)
+        self.assertFalse(unsafe)
+        new_third, backing, unsafe = rebased[third]
+        self.assertEqual(new_second, backing)
+        self.assertTrue(unsafe)
+
+        self.assertEqual(
+            [new_second, new_third],
+            [i['blob_uuid'] for i in self.artifact.get_all_indexes()])
+        for old in [first, second, third]:
+            self.assertEqual(Blob.STATE_DELETED, Blob.from_db(old).state.value)
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from click.testing import CliRunner
+
+from shakenfist import exceptions
+from shakenfist.client import backup
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class BackupTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mock_etcd = MockEtcd(self, node_count=4)
+        self.mock_etcd.setup()
+
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.backup_path = os.path.join(self.tempdir, 'backup.tgz')
+
+        # Include a key with a trailing slash, as these are used for metrics
+        self.mock_etcd.set_node_metrics_same()
+
+    def _db_as_bytes(self):
+        out = {}
+        for k, v in self.mock_etcd.db.items():
+            if isinstance(v, str):
+                v = v.encode('utf-8')
+            out[k] = v
+        return out
+
+    def test_backup_restore_roundtrip(self):
+        original = self._db_as_bytes()
+        self.assertIn('/sf/metrics/node1_net/', original)
+
+        runner = CliRunner()
+        result = runner.invoke(
+            backup.cli, ['backup', self.backup_path, '--page-size', '3'])
+        self.assertEqual(0, result.exit_code, result.output)
+
+        self.mock_etcd.db = {}
+        result = runner.invoke(
+            backup.cli, ['restore', self.backup_path, '--batch-size', '5'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(original, self._db_as_bytes())
+
+    def test_backup_prefix_filter(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            backup.cli, ['backup', self.backup_path, '--page-size', '2',
+                         '--prefix', '/sf/metrics/'])
+        self.assertEqual(0, result.exit_code, result.output)
+
+        self.mock_etcd.db = {}
+        result = runner.invoke(backup.cli, ['restore', self.backup_path])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(4, len(self.mock_etcd.db))
+        for k in self.mock_etcd.db:
+            self.assertTrue(k.startswith('/sf/metrics/'))
+
+    def test_restore_verification_failure(self):
+        runner = CliRunner()
+        result = runner.invoke(backup.cli, ['backup', self.backup_path])
+        self.assertEqual(0, result.exit_code, result.output)
+
+        # Simulate a restore which silently drops a write
+        real_batch_put = backup.etcd.batch_put
+
+        def lossy_batch_put(items):
+            real_batch_put(items[1:])
+
+        self.mock_etcd.db = {}
+        with mock.patch('shakenfist.etcd.batch_put', side_effect=lossy_batch_put):
+            result = runner.invoke(
+                backup.cli, ['restore', self.backup_path, '--batch-size', '1000'])
+        self.assertEqual(1, result.exit_code, result.output)
+        self.assertIn('1 restored keys do not match the backup', result.output)
+
+    def test_paged_reads_are_pinned_to_a_revision(self):
+        revisions = []
+
+        def get_range_page(key, range_end, limit=0, revision=0):
+            revisions.append(revision)
+            kvs, _, more = self.mock_etcd.get_range_page(
+                key, range_end, limit=limit, revision=revision)
+            return kvs, 42 + len(revisions), more
+
+        with mock.patch('shakenfist.etcd.WrappedEtcdClient.get_range_page',
+                        side_effect=get_range_page):
+            keys = [k for k, _ in backup.etcd.get_prefix_paged('/sf/', page_size=2)]
+
+        self.assertEqual(sorted(self.mock_etcd.db), keys)
+        self.assertTrue(len(revisions) > 2)
+        self.assertEqual(0, revisions[0])
+        for r in revisions[1:]:
+            self.assertEqual(43, r)
+
+    def _compacting_get_range_page(self, compactions):
+        # Pages after the first raise RevisionCompacted the given number of
+        # times in total
+        remaining = [compactions]
+
+        def get_range_page(key, range_end, limit=0, revision=0):
+            if revision and remaining[0]:
+                remaining[0] -= 1
+                raise exceptions.RevisionCompacted('compacted')
+            return self.mock_etcd.get_range_page(
+                key, range_end, limit=limit, revision=revision)
+        return get_range_page
+
+    def test_backup_restarts_after_compaction(self):
+        original = self._db_as_bytes()
+
+        runner = CliRunner()
+        with mock.patch('shakenfist.etcd.WrappedEtcdClient.get_range_page',
+                        side_effect=self._compacting_get_range_page(2)):
+            result = runner.invoke(
+                backup.cli, ['backup', self.backup_path, '--page-size', '3'])
+        self.assertEqual(0, result.exit_code, result.output)
+
+        # The restarted backup replaces the partial one
+        self.mock_etcd.db = {}
+        result = runner.invoke(backup.cli, ['restore', self.backup_path])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(original, self._db_as_bytes())
+
+    def test_backup_gives_up_after_repeated_compaction(self):
+        runner = CliRunner()
+        with mock.patch('shakenfist.etcd.WrappedEtcdClient.get_range_page',
+                        side_effect=self._compacting_get_range_page(
+                            backup.BACKUP_ATTEMPTS)) as mock_page:
+            result = runner.invoke(
+                backup.cli, ['backup', self.backup_path, '--page-size', '3'])
+        self.assertEqual(1, result.exit_code, result.output)
+        self.assertIn('compacted the revision being backed up', result.output)
+        self.assertEqual(2 * backup.BACKUP_ATTEMPTS, mock_page.call_count)
@@ -2,10 +2,13 @@ from unittest import mock
 
 import testtools
 
+from shakenfist import baseobject
+from shakenfist import etcd
 from shakenfist import exceptions
 from shakenfist.baseobject import DatabaseBackedObject
 from shakenfist.baseobject import State
 from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
 
 
 class DatabaseBackedObjectTestCase(base.ShakenFistTestCase):
@@ -57,3 +60,97 @@ class DatabaseBackedObjectTestCase(base.ShakenFistTestCase):
             d.error = 'real bad'
 
         d.error = 'real bad'
+
+
+class ObjectVersionCacheTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+        self.mock_etcd.set_node_metrics_same({
+            'object_version_instance': 9,
+            'object_version_blob': 3
+        })
+
+        self.thread = mock.patch('shakenfist.baseobject.threading.Thread')
+        self.mock_thread = self.thread.start()
+        self.addCleanup(self.thread.stop)
+
+    def test_publish(self):
+        versions = baseobject.publish_minimum_object_versions()
+        self.assertEqual(9, versions['instance'])
+        self.assertEqual(3, versions['blob'])
+        self.assertIsNone(versions['upload'])
+
+        published = etcd.get_raw(baseobject.OBJECT_VERSIONS_KEY)
+        self.assertEqual(versions, published['versions'])
+
+        # Unchanged versions are not rewritten
+        with mock.patch('shakenfist.etcd.put_raw') as mock_put:
+            baseobject.publish_minimum_object_versions()
+        mock_put.assert_not_called()
+
+    @mock.patch('shakenfist.baseobject.compute_minimum_object_versions')
+    def test_reads_published_versions(self, mock_compute):
+        etcd.put_raw(baseobject.OBJECT_VERSIONS_KEY,
+                     {'versions': {'instance': 7}, 'timestamp': 0})
+
+        c = baseobject.ObjectVersionCache()
+        self.assertEqual(7, c.get('instance'))
+        self.assertEqual(float('inf'), c.get('blob'))
+        mock_compute.assert_not_called()
+        self.mock_thread.return_value.start.assert_called_once()
+
+        # Later lookups are served from the cache
+        with mock.patch('shakenfist.etcd.get_prefix_by_create') as mock_get:
+            self.assertEqual(7, c.get('instance'))
+        mock_get.assert_not_called()
+
+    def test_falls_back_to_scan(self):
+        c = baseobject.ObjectVersionCache()
+        self.assertEqual(9, c.get('instance'))
+        self.assertFalse(c.published)
+
+    def test_forked_child_uses_inherited_versions(self):
+        etcd.put_raw(baseobject.OBJECT_VERSIONS_KEY,
+                     {'versions': {'instance': 7}, 'timestamp': 0})
+        c = baseobject.ObjectVersionCache()
+        self.assertEqual(7, c.get('instance'))
+
+        c.pid = -1
+        with mock.patch('shakenfist.etcd.get_prefix_by_create') as mock_get:
+            self.assertEqual(7, c.get('instance'))
+        mock_get.assert_not_called()
+        self.assertIsNone(c.watcher)
+
+        # Once the inherited versions expire the child loads them itself
+        c.fresh_until = 0
+        self.assertEqual(7, c.get('instance'))
+        self.assertIsNotNone(c.watcher)
+
+    def test_quiet_watch_is_restarted(self):
+        etcd.put_raw(baseobject.OBJECT_VERSIONS_KEY,
+                     {'versions': {'instance': 7}, 'timestamp': 0})
+        c = baseobject.ObjectVersionCache()
+        self.assertEqual(7, c.get('instance'))
+        c.fresh_until = 0
+
+        class StopWatching(BaseException):
+            pass
+
+        def quiet(*args, **kwargs):
+            yield None
+            yield None
+
+        with mock.patch('shakenfist.etcd.watch_prefix',
+                        side_effect=[quiet(), StopWatching()]) as mock_watch:
+            with testtools.ExpectedException(StopWatching):
+                c._watch(41)
+
+        # The quiet watch was restarted from the same revision, and did not
+        # extend the life of the cached versions
+        self.assertEqual(2, mock_watch.call_count)
+        for call in mock_watch.call_args_list:
+            self.assertEqual(42, call.kwargs['start_revision'])
+        self.assertEqual(0, c.fresh_until)
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from shakenfist import blob
+from shakenfist import exceptions
+from shakenfist.tests import base
+from shakenfist.tests.http_server import ImageServer
+
+
+class HTTPDownloadTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        self.config = mock.patch('shakenfist.blob.config')
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+        self.mock_config.STORAGE_PATH = self.tempdir
+        self.mock_config.HTTP_PROXY_SERVER = ''
+        self.mock_config.IMAGE_DOWNLOAD_RANGES = 1
+        self.mock_config.IMAGE_DOWNLOAD_RANGE_MINIMUM = 0
+
+        self.user_agent = mock.patch(
+            'shakenfist.blob.util_general.get_user_agent', return_value='test')
+        self.user_agent.start()
+        self.addCleanup(self.user_agent.stop)
+
+        self.content = os.urandom(300 * 1024)
+        self.server = ImageServer(self.content)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def _download(self):
+        return blob._Download(self.server.url, [], blob.LOG, None, 'blob').fetch()
+
+    def _check(self, path, size, sha512):
+        self.assertEqual(len(self.content), size)
+        self.assertEqual(hashlib.sha512(self.content).hexdigest(), sha512)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+    def test_single_request(self):
+        path, size, sha512, validators = self._download()
+        self._check(path, size, sha512)
+        self.assertEqual({
+            'etag': '"v1"',
+            'last_modified': 'Sun, 09 Jan 2022 23:05:25 GMT',
+            'content_length': len(self.content)
+        }, validators)
+
+        gets = self.server.gets()
+        self.assertEqual(1, len(gets))
+        self.assertNotIn('Range', gets[0])
+        self.assertFalse(os.path.exists(blob._download_paths(self.server.url)[1]))
+
+    def test_interrupted_download_resumes(self):
+        self.server.fail_after = 100 * 1024
+        path, size, sha512, _ = self._download()
+        self._check(path, size, sha512)
+
+        gets = self.server.gets()
+        self.assertEqual(2, len(gets))
+        self.assertTrue(gets[1]['Range'].endswith('-%d' % (len(self.content) - 1)))
+        self.assertEqual('"v1"', gets[1]['If-Range'])
+
+    @mock.patch('shakenfist.blob.HTTP_FETCH_ATTEMPTS', 1)
+    def test_failed_download_resumes_later(self):
+        self.server.fail_after = 100 * 1024
+        self.assertRaises(exceptions.BlobFetchFailed, self._download)
+
+        path, size, sha512, _ = self._download()
+        self._check(path, size, sha512)
+        self.assertIn('Range', self.server.gets()[-1])
+
+    @mock.patch('shakenfist.blob.HTTP_FETCH_ATTEMPTS', 1)
+    def test_changed_resource_restarts(self):
+        self.server.fail_after = 100 * 1024
+        self.assertRaises(exceptions.BlobFetchFailed, self._download)
+
+        self.content = os.urandom(200 * 1024)
+        self.server.content = self.content
+        self.server.etag = '"v2"'
+
+        path, size, sha512, validators = self._download()
+        self._check(path, size, sha512)
+        self.assertEqual('"v2"', validators['etag'])
+        self.assertNotIn('Range', self.server.gets()[-1])
+
+    def test_parallel_ranges(self):
+        self.mock_config.IMAGE_DOWNLOAD_RANGES = 4
+        self.server.fail_after = 10 * 1024
+
+        path, size, sha512, _ = self._download()
+        self._check(path, size, sha512)
+
+        ranges = [g['Range'] for g in self.server.gets()]
+        self.assertEqual(5, len(ranges))
+        self.assertIn('bytes=0-76799', ranges)
+
+    def test_parallel_ranges_unsupported(self):
+        self.mock_config.IMAGE_DOWNLOAD_RANGES = 4
+        self.server.accept_ranges = False
+
+        path, size, sha512, _ = self._download()
+        self._check(path, size, sha512)
+        self.assertEqual(1, len(self.server.gets()))
+
+    @mock.patch('shakenfist.blob.time.sleep')
+    @mock.patch('shakenfist.blob.LOCK_REFRESH_SECONDS', -1)
+    @mock.patch('shakenfist.blob.etcd.refresh_locks')
+    @mock.patch('shakenfist.blob.lockutils.external_lock')
+    def test_download_lock_waits(self, mock_lock, mock_refresh, mock_sleep):
+        # Another download of the same URL holds the lock for two attempts
+        mock_lock.return_value.acquire.side_effect = [False, False, True]
+        with blob._download_lock(self.server.url, ['lock']):
+            mock_lock.return_value.release.assert_not_called()
+        mock_lock.return_value.release.assert_called_once()
+
+        self.assertEqual(
+            'download-%s' % blob._download_name(self.server.url),
+            mock_lock.call_args.args[0])
+        self.assertEqual(2, mock_sleep.call_count)
+        mock_refresh.assert_called_with(['lock'])
+
+
+class DigestFileTestCase(base.ShakenFistTestCase):
+    def test_single_pass(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'snapshot')
+        content = b'QFI\xfb' + os.urandom(3 * blob.SNAPSHOT_DIGEST_CHUNK_SIZE)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        progress = []
+        hashes, mime_type = blob._digest_file(
+            path, progress_callback=lambda *args: progress.append(args))
+        self.assertEqual(hashlib.sha512(content).hexdigest(), hashes['sha512'])
+        self.assertEqual(hashlib.sha256(content).hexdigest(), hashes['sha256'])
+        self.assertNotIn('xxh128', hashes)
+        self.assertEqual('application/x-qemu-disk', mime_type)
+        self.assertEqual(4, len(progress))
+        self.assertEqual(('hashing', len(content), len(content)), progress[-1])
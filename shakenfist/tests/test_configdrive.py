@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import pycdlib
+
+from shakenfist import configdrive
+from shakenfist.tests import base
+
+
+class ConfigDriveTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.disk_path = os.path.join(self.tempdir, 'disk1.raw')
+
+        self.md = {'uuid': 'abc', 'name': 'banana'}
+        self.ud = b'#cloud-config\n'
+        self.nd = {'links': [], 'networks': [], 'services': []}
+
+    def _read_iso(self):
+        cd = pycdlib.PyCdlib()
+        cd.open(self.disk_path)
+        try:
+            with cd.open_file_from_iso(
+                    rr_path='/openstack/latest/user_data') as f:
+                return f.read()
+        finally:
+            cd.close()
+
+    def test_hash_ignores_random_seed(self):
+        md = dict(self.md)
+        md['random_seed'] = 'banana'
+        self.assertEqual(
+            configdrive.content_hash('iso9660', self.md, self.ud, self.nd),
+            configdrive.content_hash('iso9660', md, self.ud, self.nd))
+        self.assertNotEqual(
+            configdrive.content_hash('iso9660', self.md, self.ud, self.nd),
+            configdrive.content_hash('vfat', self.md, self.ud, self.nd))
+
+    def test_unchanged_content_reused(self):
+        self.assertTrue(configdrive.build(
+            self.disk_path, self.md, self.ud, self.nd, fmt='iso9660'))
+        self.assertEqual(self.ud, self._read_iso())
+
+        with mock.patch('shakenfist.configdrive._write_iso9660') as mock_write:
+            self.assertFalse(configdrive.build(
+                self.disk_path, self.md, self.ud, self.nd, fmt='iso9660'))
+            mock_write.assert_not_called()
+
+    def test_changed_content_rebuilt(self):
+        configdrive.build(self.disk_path, self.md, self.ud, self.nd, fmt='iso9660')
+        self.assertTrue(configdrive.build(
+            self.disk_path, self.md, b'#cloud-config\nhostname: foo\n', self.nd,
+            fmt='iso9660'))
+        self.assertEqual(b'#cloud-config\nhostname: foo\n', self._read_iso())
+
+    def test_empty_placeholder_rebuilt(self):
+        configdrive.build(self.disk_path, self.md, self.ud, self.nd, fmt='iso9660')
+        open(self.disk_path, 'w').close()
+        self.assertTrue(configdrive.build(
+            self.disk_path, self.md, self.ud, self.nd, fmt='iso9660'))
+
+    @mock.patch('shakenfist.configdrive.util_process.execute')
+    @mock.patch('shakenfist.configdrive.util_general.clone_file')
+    @mock.patch('shakenfist.configdrive._ensure_vfat_skeleton',
+                return_value='/skeleton.vfat')
+    @mock.patch('os.rename')
+    def test_vfat_uses_skeleton(self, mock_rename, mock_skeleton, mock_copy,
+                                mock_execute):
+        configdrive.build(self.disk_path, self.md, self.ud, self.nd, fmt='vfat')
+        mock_copy.assert_called_with('/skeleton.vfat', self.disk_path + '.partial')
+
+        # Only the per-instance files are written, one mcopy per directory
+        commands = [c.args[1] for c in mock_execute.mock_calls]
+        self.assertEqual(2, len(commands))
+        for command in commands:
+            self.assertTrue(command.startswith(
+                'mcopy -o -i %s.partial ' % self.disk_path))
+            self.assertIn('meta_data.json', command)
+            self.assertIn('user_data', command)
+            self.assertIn('network_data.json', command)
+            self.assertNotIn('vendor_data', command)
@@ -0,0 +1,193 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from shakenfist import consolelog
+from shakenfist import exceptions
+from shakenfist.blob import Blob
+from shakenfist.config import BaseSettings
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class FakeConfig(BaseSettings):
+    CONSOLE_LOG_ROTATE_SIZE: int = 10
+    CONSOLE_LOG_MAX_SEGMENTS: int = 2
+    CONSOLE_LOG_POLL_INTERVAL: float = 0.01
+    CONSOLE_LOG_MAX_WAIT: int = 3
+    API_TIMEOUT: int = 2
+
+
+fake_config = FakeConfig()
+
+
+class ConsoleLogTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        self.config = mock.patch('shakenfist.consolelog.config', fake_config)
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+        self.cl = consolelog.ConsoleLog(self.tempdir)
+
+    def _write(self, data):
+        with open(os.path.join(self.tempdir, 'console.log'), 'ab') as f:
+            f.write(data)
+
+    def test_missing(self):
+        self.assertFalse(self.cl.exists())
+        self.assertEqual((0, 0), self.cl.extent())
+        self.assertEqual((0, b''), self.cl.read(0))
+
+    def test_offsets_survive_rotation(self):
+        self._write(b'0123456789')
+        self.assertEqual((0, 10), self.cl.extent())
+        self.assertEqual((4, b'456'), self.cl.read(4, 3))
+
+        # Nothing to rotate yet
+        self.assertEqual((None, None), self.cl.rotate(20))
+
+        self.assertEqual((0, b'0123456789'), self.cl.rotate(10))
+        self._write(b'abcdef')
+        self.assertEqual((0, 16), self.cl.extent())
+        self.assertEqual((8, b'89abc'), self.cl.read(8, 5))
+        self.assertEqual((12, b'cdef'), self.cl.read(12))
+        self.assertEqual((16, b''), self.cl.read(16))
+        self.assertEqual((13, b'def'), self.cl.tail(3))
+
+        # A second rotation drops the oldest output from this node
+        self._write(b'ghij')
+        self.assertEqual((10, b'abcdefghij'), self.cl.rotate(10))
+        self.assertEqual((10, 20), self.cl.extent())
+        self.assertEqual((10, b'abcdefghij'), self.cl.read(0))
+        self.assertEqual((10, b'abcdefghij'), self.cl.tail(-1))
+
+    def test_clear(self):
+        self._write(b'0123456789')
+        self.cl.rotate(10)
+        self._write(b'abc')
+        self.cl.clear()
+        self.assertEqual((13, 13), self.cl.extent())
+
+        self._write(b'xyz')
+        self.assertEqual((13, b'xyz'), self.cl.read(0))
+
+    def test_wait(self):
+        self._write(b'0123')
+        self.assertEqual(4, self.cl.wait(2, 1))
+
+        start = time.time()
+        self.assertEqual(4, self.cl.wait(4, 0.1))
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_wait_is_capped(self):
+        self._write(b'0123')
+        start = time.time()
+        self.assertEqual(4, self.cl.wait(4, 60))
+        self.assertTrue(time.time() - start < 1)
+
+    def test_rotation_keeps_output_written_while_reading(self):
+        self._write(b'0123456789')
+        real_open = open
+
+        class GrowingFile:
+            # Simulates libvirt writing more output during our first read
+            def __init__(self, f):
+                self.f = f
+                self.reads = 0
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.f.close()
+
+            def read(self):
+                self.reads += 1
+                data = self.f.read()
+                if self.reads == 1:
+                    with real_open(self.f.name, 'ab') as w:
+                        w.write(b'abc')
+                return data
+
+        def fake_open(path, mode='r'):
+            f = real_open(path, mode)
+            if path.endswith('console.log') and mode == 'rb':
+                return GrowingFile(f)
+            return f
+
+        with mock.patch('shakenfist.consolelog.open', create=True,
+                        side_effect=fake_open):
+            self.assertEqual((0, b'0123456789abc'), self.cl.rotate(10))
+        self.assertEqual((13, b''), self.cl.read(13))
+        self._write(b'ABC')
+        self.assertEqual((13, b'ABC'), self.cl.read(13))
+
+    def test_reads_retry_during_rotation(self):
+        self._write(b'0123')
+        state = self.cl._read_state()
+        state['sequence'] = 1
+        self.cl._write_state(state)
+        self.assertRaises(exceptions.ConsoleLogBusy, self.cl.read, 0)
+
+
+class InstanceConsoleLogTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        self.config = mock.patch('shakenfist.instance.config', fake_config)
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=6)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.instance_path = mock.patch(
+            'shakenfist.instance.Instance.instance_path', self.tempdir)
+        self.instance_path.start()
+        self.addCleanup(self.instance_path.stop)
+
+        self.blob_path = mock.patch(
+            'shakenfist.blob.Blob.filepath',
+            side_effect=lambda blob_uuid: os.path.join(self.tempdir, blob_uuid))
+        self.blob_path.start()
+        self.addCleanup(self.blob_path.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+        self.inst = self.mock_etcd.create_instance('banana')
+
+    def _write(self, data):
+        with open(os.path.join(self.tempdir, 'console.log'), 'ab') as f:
+            f.write(data)
+
+    @mock.patch('shakenfist.blob.Blob.observe')
+    def test_rotated_output_is_readable(self, mock_observe):
+        segments = []
+        for chunk in [b'0123456789', b'abcdefghij', b'ABCDEFGHIJ']:
+            self._write(chunk)
+            self.inst.rotate_console_log()
+            segments.append(self.inst.console_segments[-1]['blob_uuid'])
+        self._write(b'tail')
+
+        # Only two segments are kept, and the released blob is deleted
+        self.assertEqual(
+            [(10, 20), (20, 30)],
+            [(s['start'], s['end']) for s in self.inst.console_segments])
+        self.assertEqual(0, Blob.from_db(segments[0]).ref_count)
+        self.assertEqual(1, Blob.from_db(segments[1]).ref_count)
+
+        self.assertEqual((10, b'abcde'), self.inst.read_console_data(0, 5))
+        self.assertEqual((15, b'fghij'), self.inst.read_console_data(15))
+        self.assertEqual((20, b'ABCDEFGHIJtail'), self.inst.read_console_data(20))
+        self.assertEqual((34, b''), self.inst.read_console_data(34))
+        self.assertEqual((30, b'tail'), self.inst.get_console_data(4))
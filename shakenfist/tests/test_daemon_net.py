@@ -0,0 +1,148 @@
+import time
+import uuid
+from unittest import mock
+
+from shakenfist import etcd
+from shakenfist import ipam
+from shakenfist.daemons import net
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class FloatingIPReconciliationTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        ipam_uuid = str(uuid.uuid4())
+        self.ipam = ipam.IPAM.new(ipam_uuid, None, ipam_uuid, '192.168.10.0/24')
+        self.floating_network = mock.patch(
+            'shakenfist.daemons.net.network.floating_network',
+            return_value=mock.MagicMock(ipam=self.ipam))
+        self.floating_network.start()
+        self.addCleanup(self.floating_network.stop)
+
+    def _add_object(self, object_type, object_uuid, state, attribute, value):
+        etcd.put('attribute/%s' % object_type, object_uuid, 'state',
+                 {'value': state, 'update_time': time.time()})
+        etcd.put('attribute/%s' % object_type, object_uuid, attribute, value)
+
+    def _reserve(self, address, user, reservation_type, age):
+        self.ipam.reserve(address, user, reservation_type, '')
+        reservation = self.ipam.get_reservation(address)
+        reservation['when'] -= age
+        etcd.put_raw(self.ipam.reservations_path + address, reservation)
+
+    def test_floating_address_users(self):
+        self._add_object('network', 'net1', 'created', 'routing',
+                         {'floating_gateway': '192.168.10.5'})
+        self._add_object('network', 'net2', 'deleted', 'routing',
+                         {'floating_gateway': '192.168.10.6'})
+        self._add_object('networkinterface', 'ni1', 'created', 'floating',
+                         {'floating_address': '192.168.10.7'})
+        self._add_object('networkinterface', 'ni2', 'created', 'floating',
+                         {'floating_address': None})
+
+        with mock.patch('shakenfist.etcd.WrappedEtcdClient.get',
+                        wraps=self.mock_etcd.get) as mock_get:
+            expected, network_uuids = net._floating_address_users()
+        mock_get.assert_not_called()
+
+        self.assertEqual(
+            {
+                '192.168.10.5': (('network', 'net1'), ipam.RESERVATION_TYPE_GATEWAY),
+                '192.168.10.7': (('networkinterface', 'ni1'),
+                                 ipam.RESERVATION_TYPE_FLOATING)
+            }, expected)
+        self.assertEqual({'net1', 'net2'}, network_uuids)
+
+    def test_plan(self):
+        now = time.time()
+        reservations = {
+            '192.168.10.0': {'type': ipam.RESERVATION_TYPE_NETWORK, 'when': 0},
+            '192.168.10.5': {'type': ipam.RESERVATION_TYPE_GATEWAY, 'when': 0},
+            '192.168.10.8': {'type': ipam.RESERVATION_TYPE_FLOATING, 'when': 0},
+            '192.168.10.9': {'type': ipam.RESERVATION_TYPE_FLOATING, 'when': now},
+            '192.168.10.10': {'type': ipam.RESERVATION_TYPE_DELETION_HALO, 'when': 0},
+            '192.168.10.11': {'type': ipam.RESERVATION_TYPE_ROUTED, 'when': 0,
+                              'user': ['network', 'net1']},
+            '192.168.10.12': {'type': ipam.RESERVATION_TYPE_ROUTED, 'when': 0,
+                              'user': ['network', 'missing']}
+        }
+        expected = {
+            '192.168.10.5': (('network', 'net1'), ipam.RESERVATION_TYPE_GATEWAY),
+            '192.168.10.7': (('networkinterface', 'ni1'),
+                             ipam.RESERVATION_TYPE_FLOATING)
+        }
+
+        missing, leaks = net.plan_floating_ip_reconciliation(
+            reservations, expected, {'net1'}, {'192.168.10.0'}, now)
+        self.assertEqual({'192.168.10.7': expected['192.168.10.7']}, missing)
+        self.assertEqual({'192.168.10.8': 0, '192.168.10.12': 0}, leaks)
+
+    def test_reconcile(self):
+        self._add_object('networkinterface', 'ni1', 'created', 'floating',
+                         {'floating_address': '192.168.10.7'})
+        self._reserve('192.168.10.8', ('networkinterface', 'ni2'),
+                      ipam.RESERVATION_TYPE_FLOATING, 600)
+        self._reserve('192.168.10.9', ('networkinterface', 'ni3'),
+                      ipam.RESERVATION_TYPE_FLOATING, 0)
+
+        net.reconcile_floating_ips()
+
+        self.assertEqual(('networkinterface', 'ni1'),
+                         tuple(self.ipam.get_reservation('192.168.10.7')['user']))
+        self.assertEqual(ipam.RESERVATION_TYPE_DELETION_HALO,
+                         self.ipam.get_reservation('192.168.10.8')['type'])
+        self.assertEqual(ipam.RESERVATION_TYPE_FLOATING,
+                         self.ipam.get_reservation('192.168.10.9')['type'])
+
+    def test_reconcile_skips_changed_reservations(self):
+        self._reserve('192.168.10.8', ('networkinterface', 'ni2'),
+                      ipam.RESERVATION_TYPE_FLOATING, 600)
+
+        # The address is released and reserved again between the comparison
+        # and the lock being taken
+        plan = net.plan_floating_ip_reconciliation
+
+        def replan(*args, **kwargs):
+            result = plan(*args, **kwargs)
+            etcd.delete_raw(self.ipam.reservations_path + '192.168.10.8')
+            self._reserve('192.168.10.8', ('networkinterface', 'ni4'),
+                          ipam.RESERVATION_TYPE_FLOATING, 0)
+            return result
+
+        with mock.patch('shakenfist.daemons.net.plan_floating_ip_reconciliation',
+                        side_effect=replan):
+            net.reconcile_floating_ips()
+
+        reservation = self.ipam.get_reservation('192.168.10.8')
+        self.assertEqual(ipam.RESERVATION_TYPE_FLOATING, reservation['type'])
+        self.assertEqual(['networkinterface', 'ni4'], reservation['user'])
+
+    def test_reconcile_skips_released_owners(self):
+        self._add_object('networkinterface', 'ni1', 'created', 'floating',
+                         {'floating_address': '192.168.10.7'})
+        self._add_object('network', 'net1', 'created', 'routing',
+                         {'floating_gateway': '192.168.10.5'})
+
+        # The interface is defloated, and the network deleted, between the
+        # comparison and the lock being taken
+        plan = net.plan_floating_ip_reconciliation
+
+        def replan(*args, **kwargs):
+            result = plan(*args, **kwargs)
+            etcd.put('attribute/networkinterface', 'ni1', 'floating',
+                     {'floating_address': None})
+            etcd.put('attribute/network', 'net1', 'state',
+                     {'value': 'deleted', 'update_time': time.time()})
+            return result
+
+        with mock.patch('shakenfist.daemons.net.plan_floating_ip_reconciliation',
+                        side_effect=replan):
+            net.reconcile_floating_ips()
+
+        self.assertIsNone(self.ipam.get_reservation('192.168.10.7'))
+        self.assertIsNone(self.ipam.get_reservation('192.168.10.5'))
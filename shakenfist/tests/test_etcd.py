@@ -1,6 +1,12 @@
+import itertools
 import json
+import threading
+import time
 from unittest import mock
 
+from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.utils import _decode
+from etcd3gw.utils import _encode
 from shakenfist_utilities import logs
 
 from shakenfist import etcd
@@ -8,6 +14,7 @@ from shakenfist import exceptions
 from shakenfist import tasks
 from shakenfist.config import BaseSettings
 from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
 
 LOG, _ = logs.setup(__name__)
 
@@ -15,6 +22,10 @@ LOG, _ = logs.setup(__name__)
 class FakeConfig(BaseSettings):
     NODE_NAME: str = 'thisnode'
     SLOW_LOCK_THRESHOLD: int = 2
+    ETCD_SLOW_CALL_THRESHOLD: float = 1.0
+    LOG_ETCD_CONNECTIONS: bool = False
+    ETCD_VALUE_FORMAT: str = 'json'
+    ETCD_HOST: str = 'localhost'
 
 
 fake_config = FakeConfig()
@@ -40,11 +51,15 @@ class ActualLockTestCase(base.ShakenFistTestCase):
                 })
     @mock.patch('shakenfist.util.callstack.get_caller',
                 return_value='banana.py:43')
+    @mock.patch('shakenfist.etcd.ActualLock._dequeue_waiter')
+    @mock.patch('shakenfist.etcd.ActualLock._predecessor', return_value=(None, 10))
+    @mock.patch('shakenfist.etcd.ActualLock._enqueue_waiter', return_value=10)
     @mock.patch('etcd3gw.lock.Lock.release')
-    @mock.patch('etcd3gw.lock.Lock.acquire', return_value=True)
+    @mock.patch('shakenfist.etcd.ActualLock.acquire', return_value=True)
     @mock.patch('shakenfist.etcd.ActualLock.get_lease')
     @mock.patch('os.getpid', return_value=42)
     def test_context_manager(self, mock_pid, mock_lease, mock_acquire, mock_release,
+                             mock_enqueue, mock_predecessor, mock_dequeue,
                              mock_get_caller, mock_get_holder, mock_fake_id):
         al = etcd.ActualLock('instance', None, 'auuid', op='Test case')
 
@@ -71,7 +86,9 @@ class ActualLockTestCase(base.ShakenFistTestCase):
 
         with al:
             mock_acquire.assert_called_with()
+            mock_predecessor.assert_called_with(10)
 
+        mock_dequeue.assert_called_with()
         mock_release.assert_called_with()
 
     @mock.patch('shakenfist_utilities.random.random_id', return_value='fakeid')
@@ -88,27 +105,38 @@ class ActualLockTestCase(base.ShakenFistTestCase):
                 side_effect=[100.0, 101.0, 102.0, 103.0, 104.0, 105.0,
                              106.0, 107.0, 108.0, 109.0, 110.0, 111.0,
                              112.0, 113.0, 114.0, 115.0, 116.0, 117.0])
-    @mock.patch('time.sleep')
+    @mock.patch('shakenfist.etcd.ActualLock._wait_for_delete', return_value=True)
+    @mock.patch('shakenfist.etcd.ActualLock._dequeue_waiter')
+    @mock.patch('shakenfist.etcd.ActualLock._predecessor',
+                side_effect=[('/sflockwaiters/sf/instance/auuid/other', 11),
+                             (None, 12), (None, 13)])
+    @mock.patch('shakenfist.etcd.ActualLock._enqueue_waiter', return_value=10)
     @mock.patch('etcd3gw.lock.Lock.release')
-    @mock.patch('etcd3gw.lock.Lock.acquire',
-                side_effect=[False, False, False, False, False, True])
+    @mock.patch('shakenfist.etcd.ActualLock.acquire', side_effect=[False, True])
     @mock.patch('shakenfist.etcd.ActualLock.get_lease')
     @mock.patch('os.getpid', return_value=42)
-    def test_context_manager_slow(
-            self, mock_pid, mock_lease, mock_acquire, mock_release, mock_sleep,
-            mock_time, mock_add_event, mock_get_holder, mock_fake_id):
+    def test_context_manager_contended(
+            self, mock_pid, mock_lease, mock_acquire, mock_release, mock_enqueue,
+            mock_predecessor, mock_dequeue, mock_wait, mock_time, mock_add_event,
+            mock_get_holder, mock_fake_id):
         al = etcd.ActualLock('instance', None, 'auuid', op='Test case', timeout=12)
         al.log_ctx = mock.MagicMock()
+        al.waiter_lease = mock.MagicMock()
+        contended = etcd.LOCK_CONTENDED.labels('instance')._value.get()
 
         with al:
-            mock_acquire.assert_has_calls(
-                [mock.call(), mock.call(), mock.call(),
-                 mock.call(), mock.call(), mock.call()])
-            mock_sleep.assert_has_calls(
-                [mock.call(1), mock.call(1), mock.call(1), mock.call(1)])
-
-        mock_get_holder.assert_called_with()
+            # First we wait for the waiter ahead of us, then for the holder
+            mock_wait.assert_has_calls([
+                mock.call('/sflockwaiters/sf/instance/auuid/other', 11, 5),
+                mock.call('/sflocks/sf/instance/auuid', 12, 5)])
+            mock_predecessor.assert_has_calls(
+                [mock.call(10), mock.call(10), mock.call(10)])
+            self.assertEqual(2, mock_acquire.call_count)
+
+        mock_dequeue.assert_called_with()
         mock_release.assert_called_with()
+        self.assertEqual(
+            contended + 1, etcd.LOCK_CONTENDED.labels('instance')._value.get())
 
     @mock.patch('shakenfist_utilities.random.random_id', return_value='fakeid')
     @mock.patch('shakenfist.etcd.ActualLock.get_holder',
@@ -124,28 +152,146 @@ class ActualLockTestCase(base.ShakenFistTestCase):
                 side_effect=[100.0, 101.0, 102.0, 103.0, 104.0, 105.0,
                              106.0, 107.0, 108.0, 109.0, 110.0, 111.0,
                              112.0, 113.0, 114.0, 115.0, 116.0, 117.0])
-    @mock.patch('time.sleep')
-    @mock.patch('etcd3gw.lock.Lock.release')
-    @mock.patch('etcd3gw.lock.Lock.acquire',
-                side_effect=[False, False, False, False, False, True])
-    @mock.patch('shakenfist.etcd.ActualLock.get_lease')
+    @mock.patch('shakenfist.etcd.ActualLock._wait_for_delete', return_value=False)
+    @mock.patch('shakenfist.etcd.ActualLock._dequeue_waiter')
+    @mock.patch('shakenfist.etcd.ActualLock._predecessor',
+                return_value=('/sflockwaiters/sf/instance/auuid/other', 11))
+    @mock.patch('shakenfist.etcd.ActualLock._enqueue_waiter', return_value=10)
+    @mock.patch('shakenfist.etcd.ActualLock.acquire')
     @mock.patch('os.getpid', return_value=42)
     def test_context_manager_timeout(
-            self, mock_pid, mock_lease, mock_acquire, mock_release, mock_sleep,
-            mock_time, mock_add_event, mock_get_holder, mock_fake_id):
+            self, mock_pid, mock_acquire, mock_enqueue, mock_predecessor,
+            mock_dequeue, mock_wait, mock_time, mock_add_event, mock_get_holder,
+            mock_fake_id):
         al = etcd.ActualLock('instance', None, 'auuid', op='Test case',
                              timeout=4)
         al.log_ctx = mock.MagicMock()
+        al.waiter_lease = mock.MagicMock()
+        timeouts = etcd.LOCK_TIMEOUTS.labels('instance')._value.get()
 
         self.assertRaises(exceptions.LockException, al.__enter__)
 
-        mock_acquire.assert_has_calls([mock.call(), mock.call()])
-        mock_sleep.assert_has_calls([mock.call(1), mock.call(1)])
+        # We never reached the head of the queue, so never tried to acquire
+        mock_acquire.assert_not_called()
+        mock_wait.assert_called_with('/sflockwaiters/sf/instance/auuid/other', 11, 1.0)
+        mock_dequeue.assert_called_with()
+        self.assertEqual(
+            timeouts + 1, etcd.LOCK_TIMEOUTS.labels('instance')._value.get())
+
+    @mock.patch('os.getpid', return_value=42)
+    def test_acquire_uses_waiter_lease(self, mock_pid):
+        client = mock.MagicMock()
+        client.transaction.return_value = {'succeeded': True}
+        al = etcd.ActualLock('ipam', 'reservations', 'auuid', client=client)
+        waiter_lease = mock.MagicMock()
+        waiter_lease.id = 42
+        al.waiter_lease = waiter_lease
+
+        self.assertTrue(al.acquire())
+        self.assertEqual(waiter_lease, al.get_lease())
+        self.assertIsNone(al.waiter_lease)
+        self.assertEqual('ipam/reservations', al.metric_name)
+
+        txn = client.transaction.call_args[0][0]
+        self.assertEqual(
+            '/sflocks/sf/ipam/reservations/auuid',
+            _decode(txn['success'][0]['request_put']['key']).decode('utf-8'))
+        self.assertEqual(42, txn['success'][0]['request_put']['lease'])
+        self.assertEqual(
+            al.waiter_key,
+            _decode(txn['success'][1]['request_delete_range']['key']).decode('utf-8'))
 
-        mock_get_holder.assert_called_with(key_prefix='current')
-        mock_release.assert_not_called()
 
+class ActualLockQueueTestCase(base.ShakenFistTestCase):
+    # These tests run real lock waiters in threads against the mock etcd,
+    # instead of mocking the queue operations.
+    def setUp(self):
+        super().setUp()
 
+        self.config = mock.patch('shakenfist.etcd.config', fake_config)
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=1)
+        self.mock_etcd.setup()
+
+        self.acquired = []
+        self.errors = []
+
+    def _lock(self, timeout=10):
+        return etcd.ActualLock('instance', None, 'auuid', timeout=timeout,
+                               client=etcd.get_etcd_client())
+
+    def _waiters(self):
+        return [k for k in self.mock_etcd.db
+                if k.startswith(etcd.LOCK_WAITER_PREFIX + '/sf/instance/auuid/')]
+
+    def _wait_for_waiters(self, count):
+        deadline = time.time() + 5
+        while len(self._waiters()) < count:
+            self.assertLess(time.time(), deadline, 'waiter was never queued')
+            time.sleep(0.01)
+
+    def _waiter(self, name, timeout=10):
+        def run():
+            try:
+                with self._lock(timeout=timeout):
+                    self.acquired.append(name)
+            except exceptions.LockException:
+                self.errors.append(name)
+            finally:
+                etcd.reset_client()
+
+        t = threading.Thread(target=run)
+        t.start()
+        self.addCleanup(t.join, 15)
+        return t
+
+    def test_waiters_acquire_in_order(self):
+        with self._lock():
+            threads = []
+            for i, name in enumerate(['first', 'second', 'third']):
+                threads.append(self._waiter(name))
+                self._wait_for_waiters(i + 1)
+            self.assertEqual([], self.acquired)
+
+        for t in threads:
+            t.join(15)
+        self.assertEqual(['first', 'second', 'third'], self.acquired)
+        self.assertEqual([], self.errors)
+        self.assertEqual([], self._waiters())
+        self.assertNotIn(etcd.LOCK_PREFIX + '/sf/instance/auuid',
+                         self.mock_etcd.db)
+
+    def test_waiter_promoted_after_predecessor_times_out(self):
+        with self._lock():
+            impatient = self._waiter('impatient', timeout=0.5)
+            self._wait_for_waiters(1)
+            patient = self._waiter('patient')
+            self._wait_for_waiters(2)
+
+            impatient.join(15)
+            self.assertEqual(['impatient'], self.errors)
+            self.assertEqual(1, len(self._waiters()))
+
+        patient.join(15)
+        self.assertEqual(['patient'], self.acquired)
+
+    def test_waiter_promoted_after_predecessor_dies(self):
+        # A waiter which crashed leaves its key until its lease expires
+        crashed = self._lock()
+        crashed._enqueue_waiter()
+
+        patient = self._waiter('patient')
+        self._wait_for_waiters(2)
+        self.assertEqual([], self.acquired)
+
+        self.mock_etcd.expire_lease(crashed.waiter_lease.id)
+        patient.join(15)
+        self.assertEqual(['patient'], self.acquired)
+
+
+@mock.patch('shakenfist.etcd.config', fake_config)
 class TaskEncodingETCDtestCase(base.ShakenFistTestCase):
     @mock.patch('etcd3gw.Etcd3Client.put')
     def test_put_PreflightInstanceTask(self, mock_put):
@@ -511,3 +657,205 @@ class GeneralETCDtestCase(base.ShakenFistTestCase):
             }
         },
             data)
+
+    @mock.patch('shakenfist.etcd.WrappedEtcdClient.post',
+                side_effect=Etcd3Exception(
+                    '{"error":"etcdserver: mvcc: required revision has been '
+                    'compacted","code":11}', 'Bad Request'))
+    @mock.patch('shakenfist.etcd.WrappedEtcdClient.status')
+    def test_compacted_page_is_not_retried(self, mock_status, mock_post):
+        client = etcd.WrappedEtcdClient()
+        self.assertRaises(exceptions.RevisionCompacted, client.get_range_page,
+                          b'/sf/', b'/sf0', limit=2, revision=42)
+        self.assertRaises(Etcd3Exception, client.get_range_page,
+                          b'/sf/', b'/sf0', limit=2)
+
+
+#
+# Value codecs
+#
+class ValueCodecTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, etcd, 'WRITE_FORMAT_CACHE', None)
+        etcd.WRITE_FORMAT_CACHE = None
+
+    def test_roundtrip(self):
+        data = {
+            'block_devices': {'devices': [{'size': 20, 'present_as': 'disk'}]},
+            'big': 2 ** 70,
+            'float': 1.5,
+            'none': None,
+            'unicode': 'ŝhaken fist',
+            'task': tasks.FetchImageTask('http://server/image', namespace='foo')
+        }
+        expected = json.loads(json.dumps(data, cls=etcd.JSONEncoderCustomTypes))
+
+        for value_format in [etcd.VALUE_FORMAT_JSON,
+                             etcd.VALUE_FORMAT_COMPACT_JSON,
+                             etcd.VALUE_FORMAT_MSGPACK]:
+            encoded = etcd.encode_value(data, value_format=value_format)
+            self.assertEqual(expected, etcd.decode_value(encoded))
+
+        # Values which msgpack cannot represent fall back to compact JSON
+        self.assertEqual(
+            '{"big":1180591620717411303424}',
+            etcd.encode_value({'big': 2 ** 70}, value_format=etcd.VALUE_FORMAT_MSGPACK))
+
+    def test_msgpack_is_detected(self):
+        data = {'interfaces': ['a', 'b'], 'order': 1}
+        encoded = etcd.encode_value(data, value_format=etcd.VALUE_FORMAT_MSGPACK)
+        self.assertTrue(encoded.startswith(etcd.MSGPACK_MAGIC))
+        self.assertTrue(
+            len(encoded) < len(etcd.encode_value(data, value_format=etcd.VALUE_FORMAT_JSON)))
+
+        # Non-string keys are returned as strings, just like JSON
+        encoded = etcd.encode_value({1: 'one', 2: 'two'},
+                                    value_format=etcd.VALUE_FORMAT_MSGPACK)
+        self.assertEqual({'1': 'one', '2': 'two'}, etcd.decode_value(encoded))
+
+    def test_msgpack_decode_tasks(self):
+        encoded = etcd.encode_value(
+            {'tasks': [tasks.PreflightInstanceTask('fake_uuid')]},
+            value_format=etcd.VALUE_FORMAT_MSGPACK)
+        decoded = etcd.decode_value(encoded, object_hook=etcd.decodeTasks)
+        self.assertEqual({'tasks': [tasks.PreflightInstanceTask('fake_uuid')]},
+                         decoded)
+
+    @mock.patch('shakenfist.etcd.get_minimum_value_codec_version', return_value=1)
+    def test_write_format_gated(self, mock_minimum):
+        fake_config = FakeConfig(ETCD_VALUE_FORMAT='msgpack')
+        with mock.patch('shakenfist.etcd.config', fake_config):
+            self.assertEqual(etcd.VALUE_FORMAT_COMPACT_JSON, etcd.get_write_format())
+
+            # The decision is cached
+            mock_minimum.return_value = 2
+            self.assertEqual(etcd.VALUE_FORMAT_COMPACT_JSON, etcd.get_write_format())
+
+            etcd.WRITE_FORMAT_CACHE = None
+            self.assertEqual(etcd.VALUE_FORMAT_MSGPACK, etcd.get_write_format())
+
+    @mock.patch('shakenfist.etcd.get', return_value={'value': 'created'})
+    @mock.patch('shakenfist.etcd.get_all')
+    def test_minimum_value_codec_version(self, mock_get_all, mock_get):
+        now = time.time()
+        mock_get_all.return_value = [
+            ('/sf/metrics/sf-1', {'fqdn': 'sf-1', 'timestamp': now,
+                                  'metrics': {'etcd_value_codec_version': 2}}),
+            ('/sf/metrics/sf-2', {'fqdn': 'sf-2', 'timestamp': now,
+                                  'metrics': {'etcd_value_codec_version': 2}})
+        ]
+        self.assertEqual(2, etcd.get_minimum_value_codec_version())
+
+        # Nodes running older versions do not report a codec version at all
+        mock_get_all.return_value.append(
+            ('/sf/metrics/sf-3', {'fqdn': 'sf-3', 'timestamp': now,
+                                  'metrics': {}}))
+        self.assertEqual(1, etcd.get_minimum_value_codec_version())
+
+
+#
+# Call instrumentation
+#
+class InstrumentationTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = mock.patch('shakenfist.etcd.config', fake_config)
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+        etcd.reset_instrumentation()
+        self.addCleanup(etcd.reset_instrumentation)
+        etcd.set_instrumentation_caller('unittest')
+        self.addCleanup(etcd.set_instrumentation_caller, 'unknown')
+
+    def test_key_prefix(self):
+        self.assertEqual(
+            'instance', etcd._key_prefix('/sf/instance/2b4ad3d1-4a4a-4d3b-8a45'))
+        self.assertEqual(
+            'attribute/instance',
+            etcd._key_prefix(b'/sf/attribute/instance/2b4ad3d1-4a4a/state'))
+        self.assertEqual(
+            'locks/network',
+            etcd._key_prefix('/sflocks/sf/network/d2950d74-50c7-4790'))
+        self.assertEqual('other', etcd._key_prefix('/sf'))
+        self.assertEqual('other', etcd._key_prefix('/elsewhere/foo'))
+
+    def test_classify_call(self):
+        key = _encode('/sf/instance/uuid')
+        self.assertEqual(
+            ('get', key, 0),
+            etcd._classify_call('http://localhost:2379/v3beta/kv/range',
+                                {'json': {'key': key}}))
+        self.assertEqual(
+            ('get_prefix', key, 0),
+            etcd._classify_call('http://localhost:2379/v3beta/kv/range',
+                                {'json': {'key': key, 'range_end': key}}))
+        self.assertEqual(
+            ('put', key, 4),
+            etcd._classify_call('http://localhost:2379/v3beta/kv/put',
+                                {'json': {'key': key, 'value': 'abcd'}}))
+        self.assertEqual(
+            ('lock_acquire', key, 2),
+            etcd._classify_call(
+                'http://localhost:2379/v3beta/kv/txn',
+                {'json': {
+                    'compare': [{'key': key, 'result': 'EQUAL',
+                                 'target': 'CREATE', 'create_revision': 0}],
+                    'success': [{'request_put': {'key': key, 'value': 'ab',
+                                                 'lease': 42}}],
+                    'failure': []}}))
+        self.assertEqual(
+            ('lock_release', key, 0),
+            etcd._classify_call(
+                'http://localhost:2379/v3beta/kv/txn',
+                {'json': {
+                    'compare': [{'key': key, 'result': 'EQUAL',
+                                 'target': 'VALUE', 'value': 'ab'}],
+                    'success': [{'request_delete_range': {'key': key}}],
+                    'failure': []}}))
+        self.assertEqual(
+            ('lease_keepalive', None, 0),
+            etcd._classify_call('http://localhost:2379/v3beta/lease/keepalive',
+                                {'json': {'ID': 42}}))
+
+    @mock.patch('etcd3gw.client.Etcd3Client.post',
+                return_value={'kvs': [{'key': 'a2V5', 'value': 'dmFsdWU='}]})
+    def test_post_is_recorded(self, mock_post):
+        client = etcd.WrappedEtcdClient(host='localhost')
+        etcd.set_instrumentation_task('unittest task')
+        self.addCleanup(etcd.set_instrumentation_task, None)
+
+        client.post('http://localhost:2379/v3beta/kv/range',
+                    json={'key': _encode('/sf/attribute/instance/uuid/state')})
+        before = etcd.ETCD_CALLS.labels(
+            'get', 'attribute/instance', 'unittest/unittest task')._value.get()
+        client.post('http://localhost:2379/v3beta/kv/range',
+                    json={'key': _encode('/sf/attribute/instance/uuid/state')})
+        self.assertEqual(
+            before + 1,
+            etcd.ETCD_CALLS.labels(
+                'get', 'attribute/instance', 'unittest/unittest task')._value.get())
+
+        summary = etcd.get_instrumentation_summary()
+        self.assertEqual(2, summary['get attribute/instance']['count'])
+        self.assertEqual(16, summary['get attribute/instance']['bytes'])
+
+    @mock.patch('time.time',
+                side_effect=itertools.chain([100.0, 103.5], itertools.repeat(104.0)))
+    def test_slow_call_logged(self, mock_time):
+        client = mock.MagicMock()
+        with mock.patch('etcd3gw.client.Etcd3Client.post', return_value={}), \
+                mock.patch('shakenfist.etcd.LOG') as mock_log:
+            etcd.WrappedEtcdClient.post(
+                client, 'http://localhost:2379/v3beta/kv/put',
+                json={'key': _encode('/sf/network/uuid'), 'value': 'abc'})
+
+        client._post_with_retry.assert_called()
+        fields = mock_log.with_fields.call_args[0][0]
+        self.assertEqual('put', fields['operation'])
+        self.assertEqual('network', fields['prefix'])
+        self.assertEqual('3.500', fields['duration'])
+        self.assertIn('test_slow_call_logged', fields['stack'])
+        mock_log.with_fields.return_value.warning.assert_called_with(
+            'Slow etcd call')
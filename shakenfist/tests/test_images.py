@@ -1,4 +1,16 @@
+import gzip
+import hashlib
+import lzma
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from shakenfist import blob
+from shakenfist import exceptions
 from shakenfist import images
+from shakenfist.tests.http_server import ImageServer
+from shakenfist.util import image as util_image
 from shakenfist.tests import base
 
 
@@ -22,3 +34,213 @@ class ImageResolverTestCase(base.ShakenFistTestCase):
         self.assertEqual(
             'https://images.shakenfist.com/ubuntu:22.04/latest.qcow2',
             images._resolve_image('ubuntu:22.04'))
+
+
+class ImageFetchHelperTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.artifact = mock.MagicMock()
+        self.artifact.uuid = 'artifact'
+        self.artifact.source_url = 'http://example.com/image.qcow2'
+        self.artifact.last_fetch = {}
+        self.helper = images.ImageFetchHelper(mock.MagicMock(), self.artifact)
+
+    @mock.patch('shakenfist.images.ImageFetchHelper.transcode_image')
+    @mock.patch('shakenfist.images.ImageFetchHelper.transfer_image')
+    def test_get_image_uses_node_lock(self, mock_transfer, mock_transcode):
+        mock_transfer.return_value.depends_on = None
+        self.helper.get_image()
+        self.artifact.get_lock.assert_called_once_with(
+            op='get image', global_scope=False)
+        mock_transcode.assert_called_once_with(mock_transfer.return_value)
+
+    @mock.patch('shakenfist.images.ImageFetchHelper._blob_get')
+    @mock.patch('shakenfist.images.ImageFetchHelper._http_get_inner')
+    def test_single_flight_downloads(self, mock_http_get, mock_blob_get):
+        self.artifact.most_recent_index = {'index': 0}
+        mock_http_get.return_value.uuid = 'new'
+
+        self.artifact.add_index.return_value = {'index': 1, 'blob_uuid': 'new'}
+
+        self.assertEqual(mock_http_get.return_value,
+                         self.helper.transfer_image())
+        self.artifact.add_index.assert_called_once_with('new')
+        self.artifact.record_fetch.assert_called_once_with(
+            self.artifact.source_url, 'new')
+        mock_blob_get.assert_not_called()
+
+    @mock.patch('shakenfist.images.ImageFetchHelper._blob_get')
+    @mock.patch('shakenfist.images.ImageFetchHelper._http_get_inner')
+    def test_single_flight_fetched_elsewhere(self, mock_http_get, mock_blob_get):
+        # The index moves on while we wait for the artifact lock
+        type(self.artifact).most_recent_index = mock.PropertyMock(side_effect=[
+            {'index': 0},
+            {'index': 1, 'blob_uuid': 'other'}
+        ])
+
+        self.assertEqual(mock_blob_get.return_value,
+                         self.helper.transfer_image())
+        mock_blob_get.assert_called_once_with('sf://blob/other')
+        mock_http_get.assert_not_called()
+        self.artifact.add_index.assert_not_called()
+
+    @mock.patch('shakenfist.images.ImageFetchHelper._most_recent_blob_if_current',
+                return_value=None)
+    @mock.patch('shakenfist.images.ImageFetchHelper._blob_get')
+    @mock.patch('shakenfist.images.ImageFetchHelper._http_get_inner')
+    def test_single_flight_fetched_elsewhere_unchanged(
+            self, mock_http_get, mock_blob_get, mock_current):
+        # Another node downloads the image while we wait for the artifact
+        # lock, but the download matches the existing blob so the index does
+        # not move on
+        self.artifact.most_recent_index = {'index': 1, 'blob_uuid': 'old'}
+        type(self.artifact).last_fetch = mock.PropertyMock(side_effect=[
+            {},
+            {'url': self.artifact.source_url, 'blob_uuid': 'old',
+             'fetched_at': 1}
+        ])
+
+        self.assertEqual(mock_blob_get.return_value,
+                         self.helper.transfer_image())
+        mock_blob_get.assert_called_once_with('sf://blob/old')
+        mock_http_get.assert_not_called()
+        self.artifact.add_index.assert_not_called()
+
+
+@mock.patch('shakenfist.images.util_general.get_user_agent', return_value='test')
+class ImageSourceCheckTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ImageServer(b'image')
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.helper = images.ImageFetchHelper(mock.MagicMock(), mock.MagicMock())
+
+        self.blob = mock.MagicMock()
+        self.blob.modified = blob.Blob.normalize_timestamp(self.server.last_modified)
+        self.blob.size = 5
+        self.from_db = mock.patch('shakenfist.blob.Blob.from_db',
+                                  return_value=self.blob)
+        self.from_db.start()
+        self.addCleanup(self.from_db.stop)
+
+    def test_unchanged(self, mock_user_agent):
+        self.blob.http_validators = {'url': self.server.url, 'etag': '"v1"'}
+        self.assertEqual(
+            self.blob, self.helper._most_recent_blob_if_current(
+                self.server.url, {'index': 1, 'blob_uuid': 'b'}))
+        self.assertEqual(1, len(self.server.requests))
+        command, headers = self.server.requests[0]
+        self.assertEqual('HEAD', command)
+        self.assertEqual('"v1"', headers['If-None-Match'])
+
+    def test_etag_changed(self, mock_user_agent):
+        self.blob.http_validators = {'url': self.server.url, 'etag': '"v0"'}
+        self.assertIsNone(self.helper._most_recent_blob_if_current(
+            self.server.url, {'index': 1, 'blob_uuid': 'b'}))
+        self.assertEqual([], self.server.gets())
+
+    def test_no_validators(self, mock_user_agent):
+        # Blobs fetched before validators were recorded fall back to
+        # comparing Last-Modified and Content-Length
+        self.blob.http_validators = {}
+        self.assertEqual(
+            self.blob, self.helper._most_recent_blob_if_current(
+                self.server.url, {'index': 1, 'blob_uuid': 'b'}))
+        self.assertNotIn('If-None-Match', self.server.requests[0][1])
+
+
+class DecompressTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.destination = os.path.join(self.tempdir, 'out')
+
+    def _compress(self, opener, data):
+        path = os.path.join(self.tempdir, 'compressed')
+        with opener(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_gzip_raw(self):
+        data = b'hello' * 1000 + bytes(3 * util_image.DECOMPRESS_CHUNK_SIZE) + b'end'
+        path = self._compress(gzip.open, data)
+
+        info, sha512 = util_image.decompress(path, 'gzip', self.destination)
+        self.assertEqual({'file format': 'raw'}, info)
+        self.assertEqual(hashlib.sha512(data).hexdigest(), sha512)
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        # The run of zeros is a hole, not written data
+        st = os.stat(self.destination)
+        self.assertLess(st.st_blocks * 512, len(data))
+
+    def test_xz_qcow2(self):
+        header = (util_image.QCOW2_MAGIC + (3).to_bytes(4, 'big') + bytes(12) +
+                  (16).to_bytes(4, 'big'))
+        path = self._compress(lzma.open, header + b'data')
+
+        info, _ = util_image.decompress(path, 'xz', self.destination)
+        self.assertEqual({'file format': 'qcow2', 'cluster_size': 65536}, info)
+
+    def test_corrupt(self):
+        path = os.path.join(self.tempdir, 'compressed')
+        with open(path, 'wb') as f:
+            f.write(b'not gzip data')
+
+        self.assertRaises(exceptions.ImageDecompressionFailed,
+                          util_image.decompress, path, 'gzip', self.destination)
+        self.assertFalse(os.path.exists(self.destination))
+
+
+class ExecuteWithProgressTestCase(base.ShakenFistTestCase):
+    def test_progress_reported(self):
+        progress = []
+        # The trailing comment swallows the -p flag we add for qemu-img
+        util_image._execute_with_progress(
+            None,
+            "printf '    (0.00/100%%)\\r    (50.00/100%%)\\r    (100.00/100%%)\\r' #",
+            progress_callback=lambda done, total: progress.append((done, total)),
+            total_bytes=1000)
+        self.assertEqual([(0, 1000), (500, 1000), (1000, 1000)], progress)
+
+    def test_failure_raises(self):
+        self.assertRaises(
+            util_image.processutils.ProcessExecutionError,
+            util_image._execute_with_progress, None, 'false #',
+            progress_callback=lambda done, total: None)
+
+
+class IncrementalSnapshotTestCase(base.ShakenFistTestCase):
+    @mock.patch('shakenfist.util.image.util_general.move_file')
+    @mock.patch('shakenfist.util.image._execute_with_progress')
+    @mock.patch('shakenfist.util.image.util_process.execute')
+    @mock.patch('shakenfist.util.image.identify',
+                return_value={'virtual size': 1024})
+    @mock.patch('shakenfist.util.image.Node')
+    @mock.patch('shakenfist.util.image.config')
+    def test_snapshot_incremental(self, mock_config, mock_node, mock_identify,
+                                  mock_execute, mock_progress, mock_move):
+        mock_config.STORAGE_PATH = '/srv/shakenfist'
+        mock_config.COMPRESS_SNAPSHOTS = False
+
+        self.assertEqual(
+            'previous',
+            util_image.snapshot_incremental(
+                None, '/srv/disk', '/srv/shakenfist/blobs/new.partial',
+                'previous'))
+
+        partial = '/srv/shakenfist/image_cache/new.partial.partial'
+        self.assertEqual(
+            'qemu-img create -f qcow2 -o cluster_size=%s -u -b /srv/disk '
+            '-F qcow2 %s 1024' % (util_image.constants.QCOW2_CLUSTER_SIZE, partial),
+            mock_execute.call_args[0][1])
+        self.assertEqual(
+            'qemu-img rebase -U -f qcow2 -b previous.qcow2 -F qcow2 %s' % partial,
+            mock_progress.call_args[0][1])
+        self.assertEqual('/srv/shakenfist/image_cache',
+                         mock_progress.call_args[1]['cwd'])
+        mock_move.assert_called_with(partial, '/srv/shakenfist/blobs/new.partial')
@@ -10,9 +10,12 @@ from unittest import mock
 import pycdlib
 import testtools
 
+from shakenfist import agentoperation
 from shakenfist import baseobject
+from shakenfist import etcd
 from shakenfist import exceptions
 from shakenfist import instance
+from shakenfist.agentoperation import AgentOperation
 from shakenfist.baseobject import State
 from shakenfist.config import SFConfig
 from shakenfist.tests import base
@@ -95,7 +98,7 @@ class VirtMetaTestCase(base.ShakenFistTestCase):
                  'ssh_key': 'sshkey',
                  'user_data': 'userdata',
                  'uuid': 'uuid42',
-                 'version': 14,
+                 'version': 15,
                  'video': {'memory': 16384, 'model': 'cirrus', 'vdi': 'spice'},
                  'uefi': False,
                  'configdrive': 'openstack-disk',
@@ -331,8 +334,9 @@ class InstanceTestCase(base.ShakenFistTestCase):
             cd.close()
 
         finally:
-            if os.path.exists(cd_file):
-                os.unlink(cd_file)
+            for path in [cd_file, cd_file + '.hash']:
+                if os.path.exists(path):
+                    os.unlink(path)
 
     def test_make_config_drive_provide_dns(self):
         instance_uuid = str(uuid.uuid4())
@@ -479,8 +483,9 @@ class InstanceTestCase(base.ShakenFistTestCase):
             cd.close()
 
         finally:
-            if os.path.exists(cd_file):
-                os.unlink(cd_file)
+            for path in [cd_file, cd_file + '.hash']:
+                if os.path.exists(path):
+                    os.unlink(path)
 
 
 class InstancesTestCase(base.ShakenFistTestCase):
@@ -536,3 +541,166 @@ class InstancesTestCase(base.ShakenFistTestCase):
             uuids.append(i.uuid)
 
         self.assertEqual(['373a165e-9720-4e14-bd0e-9612de79ff15'], uuids)
+
+
+class AgentOperationQueueTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=6)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.inst = self.mock_etcd.create_instance('banana', place_on_node='node2')
+
+    def _queue_keys(self):
+        prefix = agentoperation.queue_key(self.inst.uuid)
+        entries, _ = etcd.get_prefix_by_create(prefix)
+        return [key[len(prefix):] for key, _, _, _ in entries]
+
+    def _new_agentop(self, state=AgentOperation.STATE_QUEUED):
+        o = AgentOperation.new(self.mock_etcd.next_uuid(), 'unittest',
+                               self.inst.uuid, [{'command': 'is-system-running'}])
+        self.inst.agent_operation_enqueue(o.uuid)
+        if state:
+            o.state = state
+        return o
+
+    def test_dequeue_in_order(self):
+        first = self._new_agentop()
+        second = self._new_agentop()
+        self.assertEqual([first.uuid, second.uuid],
+                         self.inst.agent_operation_queue())
+
+        self.assertEqual(first.uuid, self.inst.agent_operation_dequeue().uuid)
+        self.assertEqual(second.uuid, self.inst.agent_operation_dequeue().uuid)
+        self.assertIsNone(self.inst.agent_operation_dequeue())
+
+        # Dequeued operations remain in the history
+        self.assertEqual([first.uuid, second.uuid],
+                         list(self.inst.agent_operation_history()))
+
+    def test_dequeue_waits_for_head(self):
+        first = self._new_agentop(state=None)
+        self._new_agentop()
+        self.assertIsNone(self.inst.agent_operation_dequeue())
+
+        # Becoming ready updates the queue entry, waking watchers
+        first.state = AgentOperation.STATE_QUEUED
+        key = agentoperation.queue_key(self.inst.uuid, first.uuid)
+        self.assertEqual(AgentOperation.STATE_QUEUED, etcd.get_raw(key)['state'])
+        self.assertEqual(first.uuid, self.inst.agent_operation_dequeue().uuid)
+
+    def test_dequeue_claim_lost(self):
+        first = self._new_agentop()
+        with mock.patch('shakenfist.etcd.delete_if_unchanged',
+                        return_value=False):
+            self.assertIsNone(self.inst.agent_operation_dequeue())
+        self.assertEqual([first.uuid], self.inst.agent_operation_queue())
+
+    def test_dequeue_removes_invalid(self):
+        self.inst.agent_operation_enqueue('nosuchop')
+        self.assertIsNone(self.inst.agent_operation_dequeue())
+        self.assertEqual([], self.inst.agent_operation_queue())
+
+    def test_history_paging(self):
+        agentops = [self._new_agentop().uuid for _ in range(5)]
+        self.assertEqual(
+            agentops, list(self.inst.agent_operation_history(page_size=2)))
+
+    def _legacy_instance(self):
+        # An instance stored by a release which kept agent operations in a
+        # single attribute
+        static_values = etcd.get('instance', None, self.inst.uuid)
+        static_values['version'] = 14
+        etcd.put('instance', None, self.inst.uuid, static_values)
+        self.inst._db_set_attribute(
+            'agent_operations', {'queue': ['b', 'c'], 'all': ['a', 'b', 'c']})
+
+    def test_legacy_attribute_used_until_upgraded(self):
+        self._legacy_instance()
+        self.mock_gmov.return_value = 14
+        inst = instance.Instance.from_db(self.inst.uuid)
+
+        # Older nodes still use the attribute, so we do too
+        inst.agent_operation_enqueue('d')
+        self.assertEqual(['b', 'c', 'd'], inst.agent_operation_queue())
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         list(inst.agent_operation_history()))
+        self.assertEqual([], self._queue_keys())
+
+        # Once every node is upgraded the operations are moved
+        self.mock_gmov.return_value = 15
+        self.assertEqual(['b', 'c', 'd'], inst.agent_operation_queue())
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         list(inst.agent_operation_history()))
+        self.assertEqual({}, inst._db_get_attribute('agent_operations'))
+        self.assertEqual(['b', 'c', 'd'], self._queue_keys())
+
+    def test_migrated_by_upgrade(self):
+        self._legacy_instance()
+        self.mock_gmov.return_value = 15
+        inst = instance.Instance.from_db(self.inst.uuid)
+        self.assertEqual({}, inst._db_get_attribute('agent_operations'))
+        self.assertEqual(15, etcd.get('instance', None, inst.uuid)['version'])
+
+        # The legacy attribute is not read again
+        with mock.patch('shakenfist.instance.Instance._db_get_attribute') as mock_get:
+            self.assertEqual(['b', 'c'], inst.agent_operation_queue())
+        mock_get.assert_not_called()
+
+    def test_new_instances_use_keys(self):
+        with mock.patch('shakenfist.instance.Instance._db_get_attribute') as mock_get:
+            self.inst.agent_operation_enqueue('a')
+            self.assertEqual(['a'], self.inst.agent_operation_queue())
+        mock_get.assert_not_called()
+
+
+class InstanceCreateTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.inst = self.mock_etcd.create_instance(
+            'banana', set_state=instance.Instance.STATE_PREFLIGHT,
+            place_on_node='node2')
+
+        for name, kwargs in [
+                ('os.makedirs', {}),
+                ('shakenfist.instance.Instance.allocate_instance_ports', {}),
+                ('shakenfist.instance.Instance._configure_block_devices', {}),
+                ('shakenfist.instance.Instance._make_config_drive', {}),
+                ('shakenfist.instance.Instance.power_on', {}),
+                ('shakenfist.instance.Instance.is_powered_on', {'return_value': True})]:
+            patcher = mock.patch(name, **kwargs)
+            setattr(self, 'mock_' + name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_create_profile(self):
+        plumbed = []
+        start_profile = self.inst.create(
+            ['iface'], prerequisites={'networks': lambda: plumbed.append(True)})
+
+        self.assertEqual([True], plumbed)
+        self.mock_allocate_instance_ports.assert_called_once()
+        self.mock_power_on.assert_called_once()
+        self.assertEqual(
+            ['block_devices', 'config_drive', 'networks', 'ports'],
+            sorted(start_profile['phases']))
+        self.assertEqual(start_profile, self.inst.start_profile)
+        self.assertEqual(instance.Instance.STATE_CREATED, self.inst.state.value)
+
+    def test_create_prerequisite_fails(self):
+        def _fail():
+            raise exceptions.NetworkMissing('no network')
+
+        self.assertRaises(
+            exceptions.NetworkMissing, self.inst.create, ['iface'],
+            prerequisites={'networks': _fail})
+        self.mock_power_on.assert_not_called()
@@ -0,0 +1,171 @@
+import json
+from unittest import mock
+
+from shakenfist import etcd
+from shakenfist import node
+from shakenfist.constants import GiB
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class NodeMembershipTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=7)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.node = node.Node.from_db('node2')
+
+    def _member_keys(self, setname):
+        prefix = '/sf/index/node%s/node2/' % setname
+        return sorted(k[len(prefix):] for k in self.mock_etcd.db
+                      if k.startswith(prefix))
+
+    def test_add_and_remove(self):
+        self.node.add_blob('blob1')
+        self.node.add_blob('blob2')
+        self.node.add_blob('blob1')
+        self.node.add_instance('inst1')
+
+        self.assertEqual({'blob1', 'blob2'}, self.node.blobs)
+        self.assertEqual(2, self.node.blob_count)
+        self.assertEqual({'inst1'}, self.node.instances)
+        self.assertEqual(1, self.node.instance_count)
+
+        self.node.remove_blob('blob1')
+        self.node.remove_blob('missing')
+        self.node.remove_instance('inst1')
+        self.assertEqual(['blob2'], self._member_keys('blobs'))
+        self.assertEqual([], self._member_keys('instances'))
+
+    def test_updates_do_not_lock(self):
+        with mock.patch('shakenfist.node.Node.get_lock_attr') as mock_lock:
+            self.node.add_blob('blob1')
+            self.node.remove_blob('blob1')
+            self.node.add_instance('inst1')
+        mock_lock.assert_not_called()
+
+    def test_replace(self):
+        self.node.blobs = ['blob1', 'blob2']
+        self.assertEqual(['blob1', 'blob2'], self._member_keys('blobs'))
+
+        with mock.patch('shakenfist.etcd.apply_many',
+                        wraps=etcd.apply_many) as mock_apply:
+            self.node.blobs = ['blob2', 'blob3']
+        self.assertEqual(['blob2', 'blob3'], self._member_keys('blobs'))
+        mock_apply.assert_called_once_with(
+            puts={'/sf/index/nodeblobs/node2/blob3': {}},
+            deletes=['/sf/index/nodeblobs/node2/blob1'])
+
+    def _legacy_node(self):
+        # A node stored by a release which kept membership sets in lists
+        static_values = etcd.get('node', None, 'node2')
+        static_values['version'] = 7
+        etcd.put('node', None, 'node2', static_values)
+        etcd.put('attribute/node', 'node2', 'blobs',
+                 {'blobs': ['blob1', 'blob2', 'blob3'], 'initialized': True})
+        etcd.put('attribute/node', 'node2', 'instances',
+                 {'instances': ['inst1'], 'initialized': True})
+
+    def test_legacy_attribute_used_until_upgraded(self):
+        self._legacy_node()
+        n = node.Node.from_db('node2')
+
+        # Older nodes still use the attributes, so we do too
+        n.add_instance('inst2')
+        n.remove_blob('blob1')
+        self.assertEqual({'blob2', 'blob3'}, n.blobs)
+        self.assertEqual(2, n.instance_count)
+        self.assertEqual(['inst1', 'inst2'],
+                         etcd.get('attribute/node', 'node2', 'instances')['instances'])
+        self.assertEqual([], self._member_keys('instances'))
+
+        # Once every node is upgraded the sets are moved
+        self.mock_gmov.return_value = 8
+        self.assertEqual({'inst1', 'inst2'}, n.instances)
+        self.assertIsNone(etcd.get('attribute/node', 'node2', 'instances'))
+        self.assertIsNone(etcd.get('attribute/node', 'node2', 'blobs'))
+        self.assertEqual(['inst1', 'inst2'], self._member_keys('instances'))
+
+    @mock.patch('shakenfist.node.MEMBERSHIP_BATCH_SIZE', 2)
+    def test_migrated_by_upgrade(self):
+        self._legacy_node()
+        self.mock_gmov.return_value = 8
+        n = node.Node.from_db('node2')
+        self.assertIsNone(etcd.get('attribute/node', 'node2', 'blobs'))
+        self.assertEqual(['blob1', 'blob2', 'blob3'], self._member_keys('blobs'))
+        self.assertEqual(['inst1'], self._member_keys('instances'))
+        self.assertEqual(8, etcd.get('node', None, 'node2')['version'])
+
+        # The legacy attributes are not read again
+        with mock.patch('shakenfist.node.Node._db_get_attribute') as mock_get:
+            n.add_blob('blob4')
+            n.remove_blob('blob1')
+            self.assertEqual({'blob2', 'blob3', 'blob4'}, n.blobs)
+        mock_get.assert_not_called()
+
+
+class NodeInventoryTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.gmov = mock.patch(
+            'shakenfist.baseobject.get_minimum_object_version', return_value=7)
+        self.mock_gmov = self.gmov.start()
+        self.addCleanup(self.gmov.stop)
+
+        self.mock_etcd = MockEtcd(self, node_count=3)
+        self.mock_etcd.setup()
+        self.mock_etcd.set_node_metrics_same()
+
+        node.Node.from_db('node2')._db_set_attribute(
+            'observed', {'at': 1234, 'release': '0.8.0'})
+        node.Node.from_db('node3').delete()
+        self.mock_etcd.db['/sflocks/sf/cluster/'] = json.dumps(
+            {'node': 'node2', 'pid': 1})
+
+    def test_inventory(self):
+        with mock.patch('shakenfist.etcd.WrappedEtcdClient.get',
+                        wraps=self.mock_etcd.get) as mock_get:
+            inventory = node.get_node_inventory()
+        mock_get.assert_called_once_with('/sflocks/sf/cluster/')
+
+        self.assertEqual(['node1_net', 'node2', 'node3'], sorted(inventory))
+        self.assertEqual(
+            {
+                'uuid': 'node2',
+                'state': 'created',
+                'metadata': {},
+                'version': 8,
+                'name': 'node2',
+                'ip': '10.0.0.2',
+                'lastseen': 1234,
+                'release': '0.8.0',
+                'is_cluster_maintainer': True
+            },
+            node.inventory_external_view(inventory['node2']))
+        self.assertEqual(22000, inventory['node2']['metrics']['memory_available'])
+        self.assertEqual('deleted', node.inventory_state(inventory['node3']))
+
+    def test_inventory_is_cached(self):
+        inventory = node.get_node_inventory()
+        with mock.patch('shakenfist.node._read_node_inventory') as mock_read:
+            self.assertIs(inventory, node.get_node_inventory())
+            node.get_node_inventory(max_age=0)
+        mock_read.assert_called_once()
+
+    def test_nodes_by_free_disk_descending(self):
+        etcd.put('metrics', 'node2', None,
+                 {'fqdn': 'node2', 'metrics': {'disk_free': 500 * GiB}})
+        self.assertEqual(['node2', 'node1_net'],
+                         node.nodes_by_free_disk_descending())
+        self.assertEqual(['node2'],
+                         node.nodes_by_free_disk_descending(minimum=100))
+        self.assertEqual(['node1_net', 'node2'],
+                         node.nodes_by_free_disk_descending(intention='instances'))
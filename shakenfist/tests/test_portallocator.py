@@ -0,0 +1,71 @@
+from unittest import mock
+
+from shakenfist import etcd
+from shakenfist import exceptions
+from shakenfist import portallocator
+from shakenfist.tests import base
+from shakenfist.tests.mock_etcd import MockEtcd
+
+
+class PortAllocatorTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.mock_etcd = MockEtcd(self, node_count=2)
+        self.mock_etcd.setup()
+
+        self.socket = mock.patch('shakenfist.portallocator.socket.socket')
+        self.mock_socket = self.socket.start()
+        self.addCleanup(self.socket.stop)
+
+        self.allocator = portallocator.PortAllocator('node2')
+
+    def _allocated(self):
+        return sorted(int(k.split('/')[-1]) for k in self.mock_etcd.db
+                      if k.startswith('/sf/console/node2/'))
+
+    def test_allocate_and_release(self):
+        ports = self.allocator.allocate('inst', 3)
+        self.assertEqual(3, len(set(ports)))
+        for port in ports:
+            self.assertTrue(portallocator.PORT_RANGE_START <= port <=
+                            portallocator.PORT_RANGE_END)
+            self.assertEqual(
+                {'instance_uuid': 'inst', 'port': port},
+                etcd.get_raw('/sf/console/node2/%d' % port))
+        self.assertEqual(sorted(ports), self._allocated())
+
+        self.allocator.release(ports + [None])
+        self.assertEqual([], self._allocated())
+        for port in ports:
+            self.assertFalse(self.allocator._in_use(port))
+
+    def test_bitmap_seeded_from_etcd(self):
+        etcd.put_raw('/sf/console/node2/31000', {'instance_uuid': 'other',
+                                                 'port': 31000})
+        self.allocator.seed()
+        self.assertTrue(self.allocator._in_use(31000))
+        self.assertFalse(self.allocator._in_use(31001))
+
+    @mock.patch('shakenfist.portallocator.random.randint', return_value=0)
+    def test_stale_bitmap_reseeds(self, mock_randint):
+        self.allocator.seed()
+
+        # Someone else claims the first port after we seeded
+        etcd.put_raw('/sf/console/node2/30000', {'instance_uuid': 'other',
+                                                 'port': 30000})
+        self.assertEqual([30001, 30002], self.allocator.allocate('inst', 2))
+        self.assertEqual(
+            {'instance_uuid': 'other', 'port': 30000},
+            etcd.get_raw('/sf/console/node2/30000'))
+
+    @mock.patch('shakenfist.portallocator.random.randint', return_value=0)
+    def test_ports_in_use_locally_skipped(self, mock_randint):
+        self.mock_socket.return_value.bind.side_effect = [OSError(), None]
+        self.assertEqual([30001], self.allocator.allocate('inst', 1))
+
+    @mock.patch('shakenfist.portallocator.PORT_COUNT', 2)
+    def test_exhausted(self):
+        self.allocator.allocate('inst', 2)
+        self.assertRaises(exceptions.ConsolePortsExhausted,
+                          self.allocator.allocate, 'inst', 1)
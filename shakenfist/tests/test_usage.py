@@ -0,0 +1,127 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from shakenfist import usage
+from shakenfist.config import BaseSettings
+from shakenfist.tests import base
+
+
+class FakeConfig(BaseSettings):
+    STORAGE_PATH: str = ''
+    USAGE_RAW_RETENTION: int = 3600 * 24 * 2
+    USAGE_FIVE_MINUTE_RETENTION: int = 3600 * 24 * 14
+    MAX_USAGE_EVENT_AGE: int = 3600 * 24 * 30
+
+
+class ColumnEncodingTestCase(base.ShakenFistTestCase):
+    def test_roundtrip(self):
+        for values in [[], [42], [0, 0, 0, 0], [5, 3, 1, -1, -3],
+                       [1000, 1060, 1120, 1180, 1300, 1360],
+                       [2 ** 62, 2 ** 62 + 1, -2 ** 62]]:
+            self.assertEqual(values, usage.decode_column(usage.encode_column(values)))
+
+    def test_regular_timestamps_compress(self):
+        timestamps = list(range(1685229480, 1685229480 + 60 * 1000, 60))
+        encoded = usage.encode_column(timestamps)
+
+        # One run for the first value, and one run for the constant delta
+        self.assertTrue(len(encoded) < 16)
+        self.assertEqual(timestamps, usage.decode_column(encoded))
+
+    def test_flatten_statistics(self):
+        self.assertEqual(
+            {
+                'cpu usage/cpu time ns': 42,
+                'disk usage/vda/read bytes': 1024,
+                'oom_score': 667,
+                'ratio': 2
+            },
+            usage.flatten_statistics({
+                'cpu usage': {'cpu time ns': 42},
+                'disk usage': {'vda': {'read bytes': 1024}},
+                'oom_score': '667\n',
+                'ratio': 1.6,
+                'state': 'running',
+                'enabled': True
+            }))
+
+    def test_downsample(self):
+        self.assertEqual(
+            [(0, 3), (300, 5)],
+            usage.downsample([(0, 1), (60, 2), (299, 3), (300, 4), (360, 5)], 300))
+
+
+class UsageStoreTestCase(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        fake_config = FakeConfig(STORAGE_PATH=self.tempdir)
+        self.config = mock.patch('shakenfist.usage.config', fake_config)
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+    def _record_hour(self, store, start, objuuid='inst1', namespace='ns1'):
+        for i in range(60):
+            store.record('instance', objuuid, start + i * 60,
+                         {'cpu usage': {'cpu time ns': i * 1000},
+                          'namespace': namespace},
+                         namespace=namespace)
+
+    def test_record_compact_query(self):
+        start = 1685228400
+        with usage.UsageStore() as store:
+            self._record_hour(store, start)
+            self._record_hour(store, start, objuuid='inst2', namespace='ns2')
+
+            # Nothing is sealed until the segment window closes
+            self.assertEqual(0, store.compact(now=start + 1800))
+            results = store.query(start, start + 3600, namespace='ns1')
+            self.assertEqual([('instance', 'inst1')], list(results.keys()))
+            self.assertEqual(
+                60, len(results[('instance', 'inst1')]['metrics']['cpu usage/cpu time ns']))
+
+            self.assertEqual(2, store.compact(now=start + 3600))
+            results = store.query(start, start + 3600, namespace='ns1')
+            series = results[('instance', 'inst1')]['metrics']['cpu usage/cpu time ns']
+            self.assertEqual(60, len(series))
+            self.assertEqual([start, 0], series[0])
+            self.assertEqual([start + 59 * 60, 59000], series[-1])
+
+            results = store.query(start, start + 3600, resolution=300)
+            self.assertEqual(2, len(results))
+            series = results[('instance', 'inst2')]['metrics']['cpu usage/cpu time ns']
+            self.assertEqual(12, len(series))
+            self.assertEqual([start, 4000], series[0])
+
+            results = store.query(start, start + 3600,
+                                  objects=[('instance', 'inst2')])
+            self.assertEqual([('instance', 'inst2')], list(results.keys()))
+
+    def test_downsampling(self):
+        start = 1685228400
+        with usage.UsageStore() as store:
+            self._record_hour(store, start)
+            store.compact(now=start + 3600)
+
+            # Age out the raw segment into five minute resolution
+            now = start + 3600 + 3600 * 24 * 2
+            self.assertEqual(1, store.downsample(now=now))
+            series = store.query(start, now)[('instance', 'inst1')][
+                'metrics']['cpu usage/cpu time ns']
+            self.assertEqual(12, len(series))
+            self.assertEqual([start + 55 * 60, 59000], series[-1])
+
+            # And then into hourly resolution
+            now = start + 3600 * 24 * 21
+            self.assertEqual(1, store.downsample(now=now))
+            series = store.query(start, now)[('instance', 'inst1')][
+                'metrics']['cpu usage/cpu time ns']
+            self.assertEqual([[start, 59000]], series)
+
+            # And then discarded entirely
+            now = start + 3600 * 24 * 60
+            self.assertEqual(1, store.downsample(now=now))
+            self.assertEqual({}, store.query(start, now))
@@ -1,3 +1,7 @@
+import errno
+import os
+import shutil
+import tempfile
 from unittest import mock
 
 from shakenfist.tests import base
@@ -16,3 +20,90 @@ class UtilUserAgent(base.ShakenFistTestCase):
         self.assertEqual('Mozilla/5.0 (Debian GNU/Linux 10 (buster); '
                          'GenuineIntel x86_64) Shaken Fist/1.2.3',
                          ua)
+
+
+class UtilPhaseProfile(base.ShakenFistTestCase):
+    @mock.patch('time.time', side_effect=[100, 101, 104, 110])
+    def test_phases(self, mock_time):
+        p = util_general.PhaseProfile()
+        self.assertEqual('banana', p.run('fruit', lambda: 'banana'))
+        self.assertEqual(
+            {
+                'total': 10,
+                'phases': {'fruit': {'start': 1, 'duration': 3}}
+            }, p.summary())
+
+    def test_phase_recorded_on_error(self):
+        p = util_general.PhaseProfile()
+
+        def _fail():
+            raise ValueError('nope')
+
+        self.assertRaises(ValueError, p.run, 'broken', _fail)
+        self.assertIn('broken', p.summary()['phases'])
+
+
+class UtilCloneFile(base.ShakenFistTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        self.source = os.path.join(self.tempdir, 'source')
+        self.destination = os.path.join(self.tempdir, 'destination')
+        self.data = os.urandom(1024 * 1024 + 17)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+
+    def _destination_data(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    @mock.patch('fcntl.ioctl')
+    def test_reflink(self, mock_ioctl):
+        self.assertEqual(util_general.CLONE_REFLINK,
+                         util_general.clone_file(self.source, self.destination))
+        self.assertEqual(util_general.FICLONE, mock_ioctl.call_args.args[1])
+
+    @mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'nope'))
+    def test_copy_file_range(self, mock_ioctl):
+        self.assertEqual(util_general.CLONE_COPY_FILE_RANGE,
+                         util_general.clone_file(self.source, self.destination))
+        self.assertEqual(self.data, self._destination_data())
+
+    @mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'nope'))
+    @mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'nope'))
+    def test_buffered_copy(self, mock_cfr, mock_ioctl):
+        self.assertEqual(util_general.CLONE_COPY,
+                         util_general.clone_file(self.source, self.destination))
+        self.assertEqual(self.data, self._destination_data())
+
+    def test_copy_after_partial_reflink(self):
+        def partial_reflink(fd, request, src_fd):
+            os.write(fd, b'partial clone')
+            raise OSError(errno.EIO, 'nope')
+
+        with mock.patch('fcntl.ioctl', side_effect=partial_reflink):
+            self.assertEqual(util_general.CLONE_COPY_FILE_RANGE,
+                             util_general.clone_file(self.source, self.destination))
+        self.assertEqual(self.data, self._destination_data())
+
+    def test_move_rename(self):
+        self.assertEqual(util_general.MOVE_RENAME,
+                         util_general.move_file(self.source, self.destination))
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self.data, self._destination_data())
+
+    @mock.patch('os.rename', side_effect=OSError(errno.EXDEV, 'cross device'))
+    def test_move_between_filesystems(self, mock_rename):
+        self.assertIn(util_general.move_file(self.source, self.destination),
+                      [util_general.CLONE_REFLINK, util_general.CLONE_COPY_FILE_RANGE,
+                       util_general.CLONE_COPY])
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self.data, self._destination_data())
+
+    @mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'cross device'))
+    @mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'nope'))
+    def test_link_falls_back_to_symlink(self, mock_ioctl, mock_link):
+        util_general.link(self.source, self.destination)
+        self.assertTrue(os.path.islink(self.destination))
@@ -0,0 +1,399 @@
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+from oslo_concurrency import lockutils
+from shakenfist_utilities import logs
+
+from shakenfist.config import config
+
+
+LOG, _ = logs.setup(__name__)
+
+
+# The usage store is a compact time series store for the usage data emitted by
+# the resources daemon for instances and networks. It lives on the eventlog node
+# alongside the event logs, but instead of storing each usage sample as a JSON
+# blob in the per-object event log, each numeric metric is stored as a column of
+# samples. Recent samples are buffered in a simple table, and are then sealed
+# into segments where the timestamps and values are delta and run length
+# encoded. Because usage is sampled at a fixed frequency and most counters move
+# slowly (or not at all), these columns compress extremely well.
+#
+# Segments are downsampled as they age: raw samples are retained for
+# USAGE_RAW_RETENTION seconds, five minute samples until
+# USAGE_FIVE_MINUTE_RETENTION seconds, and hourly samples until
+# MAX_USAGE_EVENT_AGE. Downsampling keeps the last sample in each bucket, which
+# is correct for the monotonic counters which make up the bulk of usage data.
+
+RESOLUTION_RAW = 0
+RESOLUTION_FIVE_MINUTE = 300
+RESOLUTION_HOURLY = 3600
+RESOLUTIONS = [RESOLUTION_RAW, RESOLUTION_FIVE_MINUTE, RESOLUTION_HOURLY]
+
+# How much time a single segment covers at a given resolution
+SEGMENT_WINDOWS = {
+    RESOLUTION_RAW: 3600,
+    RESOLUTION_FIVE_MINUTE: 24 * 3600,
+    RESOLUTION_HOURLY: 7 * 24 * 3600
+}
+
+
+# This is the version of the usage sqlite database
+VERSION = 1
+CREATE_TABLES = [
+    (
+        'CREATE TABLE IF NOT EXISTS samples('
+        'objtype text, objuuid text, namespace text, timestamp int, '
+        'metric text, value int);'
+    ),
+    'CREATE INDEX IF NOT EXISTS samples_timestamp_idx ON samples (timestamp);',
+    (
+        'CREATE TABLE IF NOT EXISTS segments('
+        'objtype text, objuuid text, namespace text, resolution int, '
+        'start int, end int, metric text, count int, timestamps blob, '
+        'vals blob, PRIMARY KEY (objtype, objuuid, resolution, start, metric));'
+    ),
+    'CREATE INDEX IF NOT EXISTS segments_namespace_idx ON segments (namespace, start);',
+    'CREATE INDEX IF NOT EXISTS segments_resolution_idx ON segments (resolution, start);',
+    'CREATE TABLE IF NOT EXISTS version(version int primary key);'
+]
+
+
+def _zigzag(n):
+    return -2 * n - 1 if n < 0 else 2 * n
+
+
+def _unzigzag(n):
+    return -((n + 1) >> 1) if n & 1 else n >> 1
+
+
+def _write_varint(out, n):
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return
+
+
+def _read_varint(data, offset):
+    shift = 0
+    n = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, offset
+        shift += 7
+
+
+def encode_column(values):
+    # Delta encode, then run length encode the deltas. Each run is written as
+    # a pair of varints: the zigzag encoded delta, and the run length.
+    out = bytearray()
+    previous = 0
+    run_delta = None
+    run_length = 0
+
+    for v in values:
+        delta = v - previous
+        previous = v
+        if delta == run_delta:
+            run_length += 1
+            continue
+
+        if run_length:
+            _write_varint(out, _zigzag(run_delta))
+            _write_varint(out, run_length)
+        run_delta = delta
+        run_length = 1
+
+    if run_length:
+        _write_varint(out, _zigzag(run_delta))
+        _write_varint(out, run_length)
+    return bytes(out)
+
+
+def decode_column(data):
+    values = []
+    previous = 0
+    offset = 0
+    while offset < len(data):
+        delta, offset = _read_varint(data, offset)
+        run_length, offset = _read_varint(data, offset)
+        delta = _unzigzag(delta)
+        for _ in range(run_length):
+            previous += delta
+            values.append(previous)
+    return values
+
+
+def flatten_statistics(statistics, prefix=''):
+    # Usage statistics are nested dictionaries, for example
+    # {'disk usage': {'vda': {'read bytes': 42}}}. Flatten those into metric
+    # names like "disk usage/vda/read bytes", discarding anything which is not
+    # numeric.
+    out = {}
+    for key, value in statistics.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            out.update(flatten_statistics(value, prefix=f'{name}/'))
+        elif isinstance(value, bool):
+            continue
+        elif isinstance(value, (int, float)):
+            out[name] = int(round(value))
+        elif isinstance(value, str):
+            try:
+                out[name] = int(value.strip())
+            except ValueError:
+                pass
+    return out
+
+
+def downsample(points, resolution):
+    # Keep the last sample in each bucket, timestamped at the start of the
+    # bucket. points is a sorted list of (timestamp, value) tuples.
+    if resolution == RESOLUTION_RAW:
+        return points
+
+    buckets = {}
+    for timestamp, value in points:
+        buckets[timestamp - timestamp % resolution] = value
+    return sorted(buckets.items())
+
+
+def _segment_start(timestamp, resolution):
+    window = SEGMENT_WINDOWS[resolution]
+    return timestamp - timestamp % window
+
+
+class UsageStore:
+    # A UsageStore is a single sqlite database. Like the EventLog, locking is
+    # done with an external lock so that the gRPC event service threads and
+    # the eventlog daemon's maintenance loop do not collide.
+    def __init__(self):
+        self.dbdir = os.path.join(config.STORAGE_PATH, 'usage')
+        os.makedirs(self.dbdir, exist_ok=True)
+        self.dbpath = os.path.join(self.dbdir, 'usage.db')
+        self.lock = lockutils.external_lock('usage.lock', lock_path=self.dbdir)
+        self.con = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def _bootstrap(self):
+        if self.con:
+            return
+
+        self.con = sqlite3.connect(self.dbpath, timeout=30)
+        self.con.row_factory = sqlite3.Row
+        for statement in CREATE_TABLES:
+            self.con.execute(statement)
+
+        cur = self.con.cursor()
+        cur.execute('SELECT * FROM version')
+        row = cur.fetchone()
+        if not row:
+            LOG.info('Creating usage store')
+            self.con.execute('INSERT INTO version VALUES (?)', (VERSION, ))
+        self.con.commit()
+
+    def close(self):
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    def record(self, objtype, objuuid, timestamp, statistics, namespace=None):
+        metrics = flatten_statistics(statistics)
+        if not metrics:
+            return 0
+
+        timestamp = int(timestamp)
+        with self.lock:
+            self._bootstrap()
+            self.con.executemany(
+                'INSERT INTO samples(objtype, objuuid, namespace, timestamp, '
+                'metric, value) VALUES (?, ?, ?, ?, ?, ?)',
+                [(objtype, objuuid, namespace, timestamp, metric, value)
+                 for metric, value in metrics.items()])
+            self.con.commit()
+        return len(metrics)
+
+    def _read_segment(self, objtype, objuuid, resolution, start, metric):
+        cur = self.con.cursor()
+        cur.execute(
+            'SELECT timestamps, vals FROM segments WHERE objtype = ? AND '
+            'objuuid = ? AND resolution = ? AND start = ? AND metric = ?',
+            (objtype, objuuid, resolution, start, metric))
+        row = cur.fetchone()
+        if not row:
+            return []
+        return list(zip(decode_column(row['timestamps']),
+                        decode_column(row['vals'])))
+
+    def _write_segment(self, objtype, objuuid, namespace, resolution, start,
+                       metric, points):
+        points = sorted(dict(points).items())
+        self.con.execute(
+            'INSERT OR REPLACE INTO segments(objtype, objuuid, namespace, '
+            'resolution, start, end, metric, count, timestamps, vals) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (objtype, objuuid, namespace, resolution, start,
+             start + SEGMENT_WINDOWS[resolution], metric, len(points),
+             encode_column([p[0] for p in points]),
+             encode_column([p[1] for p in points])))
+
+    def compact(self, now=None):
+        # Seal buffered samples into raw segments. We only seal samples from
+        # segment windows which have closed, so that a given segment is
+        # normally written exactly once.
+        if not now:
+            now = time.time()
+        cutoff = _segment_start(int(now), RESOLUTION_RAW)
+
+        with self.lock:
+            self._bootstrap()
+            cur = self.con.cursor()
+            cur.execute(
+                'SELECT * FROM samples WHERE timestamp < ? '
+                'ORDER BY timestamp ASC', (cutoff, ))
+
+            pending = defaultdict(list)
+            namespaces = {}
+            for row in cur.fetchall():
+                key = (row['objtype'], row['objuuid'],
+                       _segment_start(row['timestamp'], RESOLUTION_RAW),
+                       row['metric'])
+                pending[key].append((row['timestamp'], row['value']))
+                namespaces[key] = row['namespace']
+
+            for key, points in pending.items():
+                objtype, objuuid, start, metric = key
+                existing = self._read_segment(
+                    objtype, objuuid, RESOLUTION_RAW, start, metric)
+                self._write_segment(
+                    objtype, objuuid, namespaces[key], RESOLUTION_RAW, start,
+                    metric, existing + points)
+
+            self.con.execute('DELETE FROM samples WHERE timestamp < ?', (cutoff, ))
+            self.con.commit()
+        return len(pending)
+
+    def downsample(self, now=None):
+        # Move segments which have aged out of their resolution's retention
+        # period into the next coarser resolution, and discard segments which
+        # have aged out entirely.
+        if not now:
+            now = time.time()
+        retentions = {
+            RESOLUTION_RAW: config.USAGE_RAW_RETENTION,
+            RESOLUTION_FIVE_MINUTE: config.USAGE_FIVE_MINUTE_RETENTION,
+            RESOLUTION_HOURLY: config.MAX_USAGE_EVENT_AGE
+        }
+
+        changed = 0
+        with self.lock:
+            self._bootstrap()
+            for idx, resolution in enumerate(RESOLUTIONS):
+                if retentions[resolution] == -1:
+                    continue
+                cutoff = now - retentions[resolution]
+
+                cur = self.con.cursor()
+                cur.execute(
+                    'SELECT * FROM segments WHERE resolution = ? AND end <= ?',
+                    (resolution, cutoff))
+                for row in cur.fetchall():
+                    if idx + 1 < len(RESOLUTIONS):
+                        target = RESOLUTIONS[idx + 1]
+                        points = downsample(
+                            list(zip(decode_column(row['timestamps']),
+                                     decode_column(row['vals']))),
+                            target)
+                        start = _segment_start(row['start'], target)
+                        existing = self._read_segment(
+                            row['objtype'], row['objuuid'], target, start,
+                            row['metric'])
+                        self._write_segment(
+                            row['objtype'], row['objuuid'], row['namespace'],
+                            target, start, row['metric'],
+                            downsample(sorted(existing + points), target))
+
+                    self.con.execute(
+                        'DELETE FROM segments WHERE objtype = ? AND objuuid = ? '
+                        'AND resolution = ? AND start = ? AND metric = ?',
+                        (row['objtype'], row['objuuid'], resolution,
+                         row['start'], row['metric']))
+                    changed += 1
+
+            self.con.commit()
+        return changed
+
+    def query(self, start, end, namespace=None, objects=None, resolution=None):
+        # Return usage for all objects matching the namespace and / or the
+        # list of (objtype, objuuid) tuples in objects, between start and end.
+        # Results are keyed by (objtype, objuuid), and each contains the
+        # namespace and a dictionary of metric names to lists of
+        # [timestamp, value] pairs.
+        where = ['end > ?', 'start <= ?']
+        args = [start, end]
+        sample_where = ['timestamp >= ?', 'timestamp <= ?']
+        sample_args = [start, end]
+        if namespace:
+            where.append('namespace = ?')
+            args.append(namespace)
+            sample_where.append('namespace = ?')
+            sample_args.append(namespace)
+
+        wanted = None
+        if objects is not None:
+            wanted = {tuple(o) for o in objects}
+
+        points = defaultdict(lambda: defaultdict(dict))
+        namespaces = {}
+
+        with self.lock:
+            self._bootstrap()
+            cur = self.con.cursor()
+            cur.execute('SELECT * FROM segments WHERE %s' % ' AND '.join(where),
+                        args)
+            for row in cur.fetchall():
+                key = (row['objtype'], row['objuuid'])
+                if wanted is not None and key not in wanted:
+                    continue
+                namespaces[key] = row['namespace']
+                for timestamp, value in zip(decode_column(row['timestamps']),
+                                            decode_column(row['vals'])):
+                    if start <= timestamp <= end:
+                        points[key][row['metric']][timestamp] = value
+
+            cur.execute('SELECT * FROM samples WHERE %s'
+                        % ' AND '.join(sample_where), sample_args)
+            for row in cur.fetchall():
+                key = (row['objtype'], row['objuuid'])
+                if wanted is not None and key not in wanted:
+                    continue
+                namespaces[key] = row['namespace']
+                points[key][row['metric']][row['timestamp']] = row['value']
+
+        out = {}
+        for key in points:
+            metrics = {}
+            for metric, values in points[key].items():
+                series = sorted(values.items())
+                if resolution:
+                    series = downsample(series, resolution)
+                metrics[metric] = [list(p) for p in series]
+            out[key] = {
+                'namespace': namespaces[key],
+                'metrics': metrics
+            }
+        return out
@@ -1,7 +1,12 @@
+import contextlib
+import errno
+import fcntl
 import os
 import pathlib
+import shutil
 import stat
 import sys
+import threading
 import time
 import traceback
 import uuid
@@ -61,6 +66,42 @@ class RecordedOperation():
         return object_type, object_uuid
 
 
+class PhaseProfile():
+    """Record the wall time of the named phases of a larger operation.
+
+    Phases may run concurrently in different threads. Start times are recorded
+    relative to the creation of the profile.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = {
+                    'start': start_time - self.start_time,
+                    'duration': time.time() - start_time
+                }
+
+    def run(self, name, func, *args, **kwargs):
+        with self.phase(name):
+            return func(*args, **kwargs)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'total': time.time() - self.start_time,
+                'phases': dict(self.phases)
+            }
+
+
 CACHED_VERSION = None
 
 
@@ -120,11 +161,102 @@ def file_permutation_exists(basename, extensions):
     return None
 
 
+# The FICLONE ioctl from linux/fs.h, which makes the destination file share
+# the extents of the source file on filesystems which support it (XFS with
+# reflink enabled, btrfs, and others).
+FICLONE = 0x40049409
+
+CLONE_REFLINK = 'reflink'
+CLONE_COPY_FILE_RANGE = 'copy_file_range'
+CLONE_COPY = 'copy'
+MOVE_RENAME = 'rename'
+
+CLONE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def _reflink(src, dst):
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def clone_file(source, destination):
+    """Copy a file, sharing storage with the source where we can.
+
+    Returns how the copy was made: CLONE_REFLINK if the destination shares
+    the extents of the source, CLONE_COPY_FILE_RANGE if the kernel copied the
+    data without passing it through userspace, or CLONE_COPY for a buffered
+    copy.
+    """
+    start_time = time.time()
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if _reflink(src, dst):
+            method = CLONE_REFLINK
+        else:
+            # A clone which failed part way may have left some of the source
+            # in the destination, so start the copy from an empty file.
+            dst.seek(0)
+            dst.truncate()
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                method = CLONE_COPY_FILE_RANGE
+            except OSError:
+                # For example, older kernels do not support copies between
+                # filesystems.
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+                shutil.copyfileobj(src, dst, CLONE_BUFFER_SIZE)
+                method = CLONE_COPY
+
+    LOG.with_fields({
+        'source': source,
+        'destination': destination,
+        'method': method,
+        'duration': time.time() - start_time
+    }).info('Cloned file')
+    return method
+
+
+def move_file(source, destination):
+    """Move a file, even between filesystems.
+
+    Returns MOVE_RENAME if the file was renamed, otherwise how it was copied.
+    """
+    try:
+        os.rename(source, destination)
+        return MOVE_RENAME
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    method = clone_file(source, destination)
+    os.unlink(source)
+    return method
+
+
 def link(source, destination):
-    """ Hardlink a file, unless we have to symlink. """
+    """ Hardlink a file, unless we have to reflink or symlink. """
     try:
         os.link(source, destination)
     except OSError:
+        # A reflink is as cheap as a link where the filesystem supports it,
+        # and unlike a symlink doesn't break if the source is removed.
+        try:
+            with open(source, 'rb') as src, open(destination, 'xb') as dst:
+                if _reflink(src, dst):
+                    return
+            os.unlink(destination)
+        except OSError:
+            pass
+
         try:
             os.symlink(source, destination)
         except FileExistsError as e:
@@ -1,14 +1,20 @@
+import contextlib
+import gzip
+import hashlib
+import lzma
 import os
 import re
-import shutil
+import subprocess
 
 import versions
+from oslo_concurrency import processutils
 from shakenfist_utilities import logs
 
 from shakenfist import constants
 from shakenfist import exceptions
 from shakenfist.config import config
 from shakenfist.node import Node
+from shakenfist.util import general as util_general
 from shakenfist.util import process as util_process
 # To avoid circular imports, util modules should only import a limited
 # set of shakenfist modules, mainly exceptions, and specific
@@ -20,6 +26,22 @@ LOG, _ = logs.setup(__name__)
 
 VALUE_WITH_BRACKETS_RE = re.compile(r'.* \(([0-9]+) bytes\)')
 QEMU_REQUIRES_BACKING_FORMAT = versions.parse_version_set(">=6.0.0")
+QEMU_SUPPORTS_REBASE_COMPRESSION = versions.parse_version_set(">=8.2.0")
+
+# Compressed image formats we can decompress, by mime type.
+COMPRESSED_MIME_TYPES = {
+    'application/gzip': 'gzip',
+    'application/x-gzip': 'gzip',
+    'application/x-xz': 'xz',
+    'application/zstd': 'zstd',
+    'application/x-zstd': 'zstd'
+}
+DECOMPRESS_CHUNK_SIZE = constants.MiB
+QCOW2_MAGIC = b'QFI\xfb'
+
+# qemu-img reports progress with -p as "(12.34/100%)", separated by carriage
+# returns.
+PROGRESS_RE = re.compile(r'\(([0-9.]+)/100%\)')
 
 
 def convert_numeric_qemu_value(qemu_value):
@@ -122,6 +144,91 @@ def create_cow(locks, cache_file, disk_file, disk_size):
             iopriority=util_process.PRIORITY_LOW)
 
 
+def identify_header(header):
+    """Work out what an image is from its first bytes.
+
+    This only distinguishes qcow2 from raw images, but unlike identify() it
+    does not need the image to be on disk. The keys returned match those
+    from identify().
+    """
+    if header[:4] == QCOW2_MAGIC and len(header) >= 24:
+        return {
+            'file format': 'qcow2',
+            'cluster_size': 1 << int.from_bytes(header[20:24], 'big')
+        }
+    return {'file format': 'raw'}
+
+
+@contextlib.contextmanager
+def _open_decompressed(path, compression):
+    if compression == 'gzip':
+        with gzip.open(path, 'rb') as f:
+            yield f
+    elif compression == 'xz':
+        with lzma.open(path, 'rb') as f:
+            yield f
+    elif compression == 'zstd':
+        # There is no zstd support in the standard library, so we stream from
+        # the zstd command line tool instead.
+        p = subprocess.Popen(['zstd', '-d', '-c', '-q', path],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            _, stderr = p.communicate()
+        if p.returncode != 0:
+            raise exceptions.ImageDecompressionFailed(
+                'zstd failed to decompress %s: %s' % (path, stderr.decode('utf-8')))
+    else:
+        raise exceptions.ImageDecompressionFailed(
+            'Unknown compression format %s' % compression)
+
+
+def decompress(path, compression, destination):
+    """Decompress an image in a single streaming pass.
+
+    The format of the image is detected from its header, and its sha512
+    computed, as the data passes through. Chunks which are entirely zero are
+    skipped rather than written, so the destination is sparse. Returns the
+    image information in the style of identify(), and the sha512 hexdigest.
+    """
+    sha512_hash = hashlib.sha512()
+    zeros = bytes(DECOMPRESS_CHUNK_SIZE)
+    info = None
+    size = 0
+
+    try:
+        with _open_decompressed(path, compression) as src, \
+                open(destination, 'wb') as dst:
+            while chunk := src.read(DECOMPRESS_CHUNK_SIZE):
+                if info is None:
+                    info = identify_header(chunk)
+                sha512_hash.update(chunk)
+                size += len(chunk)
+
+                if chunk == zeros[:len(chunk)]:
+                    dst.seek(len(chunk), os.SEEK_CUR)
+                else:
+                    dst.write(chunk)
+            dst.truncate(size)
+
+    except (OSError, EOFError, lzma.LZMAError) as e:
+        if os.path.exists(destination):
+            os.unlink(destination)
+        raise exceptions.ImageDecompressionFailed(
+            'Failed to decompress %s: %s' % (path, e))
+
+    except exceptions.ImageDecompressionFailed:
+        if os.path.exists(destination):
+            os.unlink(destination)
+        raise
+
+    if info is None:
+        info = {'file format': 'raw'}
+    return info, sha512_hash.hexdigest()
+
+
 def create_qcow2(locks, cache_file, disk_file, disk_size=None):
     """Make a qcow2 copy of the disk from the image cache."""
 
@@ -151,9 +258,49 @@ def create_blank(locks, disk_file, disk_size):
         iopriority=util_process.PRIORITY_LOW)
 
 
-def snapshot(locks, source, destination, thin=False):
-    """Convert a possibly COW layered disk file into a snapshot."""
-    backing_file = identify(source).get('backing file')
+def _execute_with_progress(locks, command, cwd=None, progress_callback=None,
+                           total_bytes=0):
+    # Progress is not reported for callers which hold locks, as those locks
+    # are refreshed by util_process.execute().
+    if not progress_callback or locks:
+        util_process.execute(locks, command, iopriority=util_process.PRIORITY_LOW,
+                             cwd=cwd)
+        return
+
+    # We need to see the progress output as it is written, so we can't use
+    # util_process.execute() here.
+    command = 'ionice -c %d -n %d %s -p' % (
+        util_process.PRIORITY_LOW[0], util_process.PRIORITY_LOW[1], command)
+    LOG.info('Executing %s with progress reporting', command)
+    p = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+
+    buffered = b''
+    while data := p.stdout.read1(4096):
+        buffered += data
+        *lines, buffered = re.split(b'[\r\n]', buffered)
+        for line in lines:
+            m = PROGRESS_RE.search(line.decode('utf-8', errors='replace'))
+            if m:
+                progress_callback(int(float(m.group(1)) * total_bytes / 100),
+                                  total_bytes)
+
+    _, stderr = p.communicate()
+    if p.returncode != 0:
+        raise processutils.ProcessExecutionError(
+            stderr=stderr.decode('utf-8', errors='replace'),
+            exit_code=p.returncode, cmd=command)
+
+
+def snapshot(locks, source, destination, thin=False, progress_callback=None):
+    """Convert a possibly COW layered disk file into a snapshot.
+
+    If progress_callback is provided, it is called with the number of bytes of
+    the source disk converted so far and the virtual size of the source disk.
+    """
+    source_info = identify(source)
+    backing_file = source_info.get('backing file')
+    total_bytes = int(source_info.get('virtual size', 0))
     LOG.with_fields({
         'source': source,
         'backing file': backing_file}).debug('Detecting backing file for snapshot')
@@ -185,11 +332,13 @@ def snapshot(locks, source, destination, thin=False):
             'backing': backing_uuid_with_extension
         }
 
-        util_process.execute(locks, ' '.join([cmd, source, temporary_location]),
-                             iopriority=util_process.PRIORITY_LOW, cwd=backing_path)
+        _execute_with_progress(locks, ' '.join([cmd, source, temporary_location]),
+                               cwd=backing_path,
+                               progress_callback=progress_callback,
+                               total_bytes=total_bytes)
 
         # TODO(mikal): its likely this move should be done with a low IO priority?
-        shutil.move(temporary_location, destination)
+        util_general.move_file(temporary_location, destination)
         return backing_uuid
 
     # Produce a single file with any backing files flattened. This is also the
@@ -203,6 +352,85 @@ def snapshot(locks, source, destination, thin=False):
         'cluster_size': constants.QCOW2_CLUSTER_SIZE
     }
 
-    util_process.execute(locks, ' '.join([cmd, source, destination]),
-                         iopriority=util_process.PRIORITY_LOW)
+    _execute_with_progress(locks, ' '.join([cmd, source, destination]),
+                           progress_callback=progress_callback,
+                           total_bytes=total_bytes)
     return None
+
+
+def _rebase_command(backing_uuid, unsafe=False):
+    qemu_command = 'qemu-img rebase -U -f qcow2'
+    if unsafe:
+        qemu_command += ' -u'
+    elif (config.COMPRESS_SNAPSHOTS and
+            Node.from_db(config.NODE_NAME).qemu_version.matches(
+                QEMU_SUPPORTS_REBASE_COMPRESSION)):
+        qemu_command += ' -c'
+
+    if backing_uuid:
+        qemu_command += ' -b %s.qcow2 -F qcow2' % backing_uuid
+    else:
+        qemu_command += " -b ''"
+    return qemu_command
+
+
+def snapshot_incremental(locks, source, destination, previous_uuid,
+                         progress_callback=None):
+    """Snapshot a disk as the changes since a previous snapshot.
+
+    The previous snapshot, and anything it depends on, must already be in the
+    image cache. An empty overlay of the disk is rebased onto the previous
+    snapshot, which writes only the clusters where the disk now differs from
+    that snapshot. Returns the UUID of the previous snapshot, which the new
+    snapshot depends on.
+    """
+    source_info = identify(source)
+    total_bytes = int(source_info.get('virtual size', 0))
+    LOG.with_fields({
+        'source': source,
+        'previous': previous_uuid}).debug('Producing incremental snapshot')
+
+    # As for thin snapshots, the snapshot is made in the image cache directory
+    # so that its backing file can be a relative path.
+    image_cache_path = os.path.join(config.STORAGE_PATH, 'image_cache')
+    _, destination_uuid = os.path.split(destination)
+    temporary_location = os.path.join(image_cache_path,
+                                      destination_uuid + '.partial')
+
+    util_process.execute(
+        locks,
+        ('qemu-img create -f qcow2 -o cluster_size=%(cluster_size)s -u '
+         '-b %(source)s -F qcow2 %(destination)s %(size)d')
+        % {
+            'cluster_size': constants.QCOW2_CLUSTER_SIZE,
+            'source': source,
+            'destination': temporary_location,
+            'size': total_bytes
+        },
+        iopriority=util_process.PRIORITY_LOW)
+
+    try:
+        _execute_with_progress(
+            locks, ' '.join([_rebase_command(previous_uuid), temporary_location]),
+            cwd=image_cache_path, progress_callback=progress_callback,
+            total_bytes=total_bytes)
+        util_general.move_file(temporary_location, destination)
+    finally:
+        if os.path.exists(temporary_location):
+            os.unlink(temporary_location)
+    return previous_uuid
+
+
+def rebase(locks, path, backing_uuid, unsafe=False):
+    """Change the backing file of a qcow2 file in the image cache.
+
+    A safe rebase copies whatever data differs between the old and new backing
+    files into the file, so that what the file presents is unchanged. Passing
+    no backing_uuid flattens the file. An unsafe rebase only rewrites the
+    backing file name, and is only correct if the new backing file presents
+    exactly the same data as the old one.
+    """
+    util_process.execute(
+        locks, ' '.join([_rebase_command(backing_uuid, unsafe=unsafe), path]),
+        iopriority=util_process.PRIORITY_LOW,
+        cwd=os.path.join(config.STORAGE_PATH, 'image_cache'))